@@ -0,0 +1,102 @@
+# Measures how fast libtpu can marshal a C API call into Python and back.
+#
+# "reflect" is the original api_callback path, kept here as the baseline:
+# look the function up in globals(), build an inspect.signature, and run
+# `argv` on every argument.
+# "compiled" goes through the cached Dispatcher for the same function.
+#
+#   python3 benchmarks/bench_dispatch.py [seconds-per-case]
+#
+# Neither path includes the CALL:/arg tracing that api_callback prints.
+import builtins
+import sys
+import time
+import inspect
+import ctypes
+
+import libtpujesus
+import libtpu
+from libtpu.handles import HandleError, is_handle
+
+
+def argv(f, i, val):
+  params = list(inspect.signature(f).parameters.values())
+  kind = params[i].annotation
+  if isinstance(kind, str):
+    kind = getattr(builtins, kind, kind)
+  if isinstance(kind, str):
+    kind = libtpu.__dict__.get(kind)
+  assert kind is not None
+  assert not isinstance(kind, str)
+  if kind == int:
+    return (libtpu.int_t * 1)(val)[0]
+  if kind == bool:
+    return val == 1
+  if val == 0:
+    return None
+  if kind is libtpu.cstr_t and isinstance(val, str):
+    return val
+  if libtpu.is_cpointertype(kind):
+    return ctypes.cast(val, kind)
+  if libtpu.is_cstructtype(kind):
+    return ctypes.cast(val, ctypes.POINTER(kind)).contents
+  if libtpu.is_cdatatype(kind):
+    return kind(val)
+  try:
+    return libtpu.handle_table.lookup(val, kind)
+  except HandleError as e:
+    if is_handle(val) or val in libtpu.handle_table.pinned:
+      libtpu.panic('object was an unrelated type', e)
+  if isinstance(val, libtpu.TpuType):
+    libtpu.warn('untracked val', val)
+    return val
+  libtpu.panic('Unknown annotation', kind, f, i)
+
+
+def reflect(name, *args):
+  f = libtpu.__dict__.get(name)
+  sig = inspect.signature(f)
+  vals = tuple([argv(f, i, args[i]) for i in range(len(sig.parameters))])
+  return libtpu.to_result(f(*vals))
+
+
+def compiled(name, *args):
+  return libtpu.dispatcher(name)(*args)
+
+
+def measure(call, name, args, seconds):
+  n = 0
+  batch = 1000
+  start = time.perf_counter()
+  deadline = start + seconds
+  while True:
+    for _ in range(batch):
+      call(name, *args)
+    n += batch
+    now = time.perf_counter()
+    if now >= deadline:
+      return n / (now - start)
+
+
+def main(seconds=1.0):
+  platform = libtpu.new(libtpu.SE_Platform.New())
+  topology = libtpu.new(libtpu.SE_Platform.get().topology)
+  core = libtpu.new(libtpu.SE_Platform.get().topology.cores[0])
+  xyz = (libtpu.int_t * 3)()
+  x, y, z = (ctypes.addressof(xyz) + i * ctypes.sizeof(libtpu.int_t) for i in range(3))
+  cases = [
+    ('TpuPlatform_TpuMemoryLimit', (platform,)),
+    ('TpuPlatform_VisibleDeviceCount', (platform,)),
+    ('TpuTopology_NumCores', (topology, 0)),
+    ('TpuCoreLocation_Id', (core,)),
+    ('TpuCoreLocation_ChipCoordinates', (core, x, y, z)),
+  ]
+  print(f"{'function':<36} {'reflect/s':>12} {'compiled/s':>12} {'speedup':>8}")
+  for name, args in cases:
+    before = measure(reflect, name, args, seconds)
+    after = measure(compiled, name, args, seconds)
+    print(f"{name:<36} {before:>12,.0f} {after:>12,.0f} {after / before:>7.1f}x")
+
+
+if __name__ == '__main__':
+  main(*[float(x) for x in sys.argv[1:]])
@@ -0,0 +1,76 @@
+# Measures host <-> device copy bandwidth through the C API.
+#
+# "native" is TpuExecutor_SynchronousMemcpyFromHost / _ToHost, which
+# memcpy straight into the device buffer (splitting big copies across the
+# memcpy pool). "slice" is what a pure-Python copy costs: read the source
+# into a bytes object with ctypes.string_at, then memmove it into place.
+#
+#   python3 benchmarks/bench_memcpy.py [seconds-per-case]
+#
+# LIBTPU_MEMCPY_THREADS=1 disables the pool, for comparison.
+import sys
+import time
+import ctypes
+
+import libtpujesus
+import libtpu
+
+lib = ctypes.PyDLL(libtpujesus.__file__)
+
+
+class DeviceMemoryBase(ctypes.Structure):
+  _fields_ = [('opaque', ctypes.c_void_p),
+              ('size', ctypes.c_uint64),
+              ('payload', ctypes.c_uint64)]
+
+
+def cfunc(name, restype, *argtypes):
+  f = getattr(lib, name)
+  f.restype = restype
+  f.argtypes = argtypes
+  return f
+
+
+handle = ctypes.c_ssize_t
+allocate = cfunc('TpuExecutor_Allocate', DeviceMemoryBase, handle, ctypes.c_uint64, ctypes.c_int64)
+deallocate = cfunc('TpuExecutor_Deallocate', None, handle, ctypes.POINTER(DeviceMemoryBase))
+to_device = cfunc('TpuExecutor_SynchronousMemcpyFromHost', None,
+                  handle, ctypes.POINTER(DeviceMemoryBase), ctypes.c_void_p, ctypes.c_uint64, handle)
+to_host = cfunc('TpuExecutor_SynchronousMemcpyToHost', None,
+                handle, ctypes.c_void_p, ctypes.POINTER(DeviceMemoryBase), ctypes.c_uint64, handle)
+
+
+def measure(copy, size, seconds):
+  n = 0
+  start = time.perf_counter()
+  deadline = start + seconds
+  while True:
+    copy()
+    n += 1
+    now = time.perf_counter()
+    if now >= deadline:
+      return n * size / (now - start) / 1e9
+
+
+def main(seconds=0.5):
+  status = cfunc('TpuStatus_New', handle)()
+  platform = cfunc('TpuPlatform_New', handle)()
+  config = cfunc('TpuStreamExecutorConfig_Default', handle)()
+  executor = cfunc('TpuPlatform_GetExecutor', handle, handle, handle, handle)(platform, config, status)
+  print(f"{'size':>10} {'h2d GB/s':>10} {'d2h GB/s':>10} {'slice GB/s':>11} {'speedup':>8}")
+  for shift in range(12, 29, 2):
+    size = 1 << shift
+    host = ctypes.create_string_buffer(size)
+    ctypes.memset(host, 1, size)
+    mem = allocate(executor, size, 0)
+    assert mem.opaque, f'out of device memory at {size} bytes'
+    dst = ctypes.addressof(host)
+    h2d = measure(lambda: to_device(executor, ctypes.byref(mem), dst, size, status), size, seconds)
+    d2h = measure(lambda: to_host(executor, dst, ctypes.byref(mem), size, status), size, seconds)
+    slow = measure(lambda: ctypes.memmove(mem.opaque, ctypes.string_at(dst, size), size), size, seconds)
+    print(f"{size:>10} {h2d:>10.2f} {d2h:>10.2f} {slow:>11.2f} {h2d / slow:>7.1f}x")
+    deallocate(executor, ctypes.byref(mem))
+
+
+if __name__ == '__main__':
+  main(*[float(x) for x in sys.argv[1:]])
@@ -0,0 +1,73 @@
+# Measures what a short-lived job pays before it can use the device: each
+# run is a fresh interpreter that imports libtpujesus, then libtpu, then
+# makes its first C API calls (TpuPlatform_New, _Initialize and
+# _VisibleDeviceCount, through ctypes.CDLL as jaxlib would call them).
+#
+# "direct" runs skip `import libtpu` and go straight to the C API, so the
+# first call has to load libtpu itself.
+#
+# Importing should print nothing; the last column is how many bytes each
+# run wrote to stdout and stderr besides its timings.
+#
+#   python3 benchmarks/bench_startup.py [runs]
+import json
+import statistics
+import subprocess
+import sys
+
+CHILD = r'''
+import time
+t0 = time.perf_counter()
+import ctypes, io, json, sys
+out, err = sys.stdout, sys.stderr
+sys.stdout = sys.stderr = noise = io.StringIO()
+t1 = time.perf_counter()
+import libtpujesus
+t2 = time.perf_counter()
+if {import_libtpu}:
+  import libtpu
+t3 = time.perf_counter()
+lib = ctypes.CDLL(libtpujesus.__file__)
+lib.TpuPlatform_New.restype = ctypes.c_void_p
+lib.TpuStatus_New.restype = ctypes.c_void_p
+lib.TpuPlatform_Initialize.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p,
+                                       ctypes.c_void_p, ctypes.c_void_p]
+lib.TpuPlatform_VisibleDeviceCount.argtypes = [ctypes.c_void_p]
+lib.TpuPlatform_VisibleDeviceCount.restype = ctypes.c_int64
+platform = lib.TpuPlatform_New()
+status = lib.TpuStatus_New()
+lib.TpuPlatform_Initialize(platform, 0, None, None, status)
+devices = lib.TpuPlatform_VisibleDeviceCount(platform)
+t4 = time.perf_counter()
+sys.stdout, sys.stderr = out, err
+print(json.dumps({{'libtpujesus': t2 - t1, 'libtpu': t3 - t2, 'first call': t4 - t3,
+                  'total': t4 - t0, 'devices': devices, 'noise': len(noise.getvalue())}}))
+'''
+
+COLUMNS = ('libtpujesus', 'libtpu', 'first call', 'total')
+
+
+def run(import_libtpu):
+  proc = subprocess.run([sys.executable, '-c', CHILD.format(import_libtpu=import_libtpu)],
+                        capture_output=True, text=True, check=True)
+  lines = proc.stdout.splitlines()
+  result = json.loads(lines[-1])
+  # anything printed before the child redirected its streams, or by C
+  result['noise'] += len(proc.stderr) + sum(len(line) + 1 for line in lines[:-1])
+  return result
+
+
+def main(runs=10):
+  runs = int(runs)
+  print(f"{'':<8} {'':<8}" + ''.join(f' {c + " ms":>15}' for c in COLUMNS) + f" {'output':>8}")
+  for name, import_libtpu in (('import', True), ('direct', False)):
+    results = [run(import_libtpu) for _ in range(runs)]
+    if not results[0]['devices']:
+      print(f'{name}: no devices visible', file=sys.stderr)
+    for stat, f in (('median', statistics.median), ('min', min)):
+      print(f'{name:<8} {stat:<8}' + ''.join(f' {f(r[c] for r in results) * 1e3:>15.1f}' for c in COLUMNS)
+            + f" {max(r['noise'] for r in results):>8}")
+
+
+if __name__ == '__main__':
+  main(*sys.argv[1:])
@@ -0,0 +1,106 @@
+# Measures per-call latency of the native TpuStatus_* and friends against
+# a trampoline into Python.
+#
+# "call" is the wall time per call through ctypes.CDLL, which includes
+# ctypes' own overhead; "inside" is the time libtpu itself spent, from
+# libtpujesus.stats(). The python rows are trivial Python-backed symbols,
+# i.e. what every status call cost while statuses lived in Python.
+#
+# Afterwards it reruns the New+Free cases and prints the object pools: in
+# steady state every New should be a pool hit.
+#
+#   python3 benchmarks/bench_status.py [seconds-per-case]
+import sys
+import time
+import ctypes
+
+import libtpujesus
+import libtpu
+
+lib = ctypes.CDLL(libtpujesus.__file__)
+
+
+def cfunc(name, restype, *argtypes):
+  f = getattr(lib, name)
+  f.restype = restype
+  f.argtypes = argtypes
+  return f
+
+
+handle = ctypes.c_ssize_t
+
+
+def measure(call, seconds):
+  n = 0
+  batch = 1000
+  start = time.perf_counter()
+  deadline = start + seconds
+  while True:
+    for _ in range(batch):
+      call()
+    n += batch
+    now = time.perf_counter()
+    if now >= deadline:
+      return (now - start) / n
+
+
+def main(seconds=1.0):
+  seconds = float(seconds)
+  status_new = cfunc('TpuStatus_New', handle)
+  status_free = cfunc('TpuStatus_Free', None, handle)
+  status = status_new()
+  platform = cfunc('TpuPlatform_New', handle)()
+  core = libtpu.new(libtpu.SE_Platform.get().topology.cores[0])
+  config_default = cfunc('TpuStreamExecutorConfig_Default', handle)
+  config_free = cfunc('TpuStreamExecutorConfig_Free', None, handle)
+  description_new = cfunc('TpuDeviceDescription_New', handle)
+  description_free = cfunc('TpuDeviceDescription_Free', None, handle)
+  msg = b'deadline exceeded'
+  set_ = cfunc('TpuStatus_Set', None, handle, ctypes.c_int, ctypes.c_char_p, ctypes.c_int32)
+  create = cfunc('TpuStatus_Create', handle, ctypes.c_int32, ctypes.c_char_p)
+  code = cfunc('TpuStatus_Code', ctypes.c_int, handle)
+  ok = cfunc('TpuStatus_Ok', ctypes.c_bool, handle)
+  message = cfunc('TpuStatus_Message', ctypes.c_void_p, handle)
+  count = cfunc('TpuPlatform_VisibleDeviceCount', ctypes.c_int64, handle)
+  core_id = cfunc('TpuCoreLocation_Id', ctypes.c_int, handle)
+  cases = [
+    ('native', 'TpuStatus_New+Free', ('TpuStatus_New', 'TpuStatus_Free'),
+     lambda: status_free(status_new())),
+    ('native', 'TpuStatus_Create+Free', ('TpuStatus_Create', 'TpuStatus_Free'),
+     lambda: status_free(create(9, msg))),
+    ('native', 'TpuStatus_Set', ('TpuStatus_Set',), lambda: set_(status, 4, msg, len(msg))),
+    ('native', 'TpuStatus_Code', (), lambda: code(status)),
+    ('native', 'TpuStatus_Ok', (), lambda: ok(status)),
+    ('native', 'TpuStatus_Message', (), lambda: message(status)),
+    ('native', 'TpuStreamExecutorConfig_Default+Free', (), lambda: config_free(config_default())),
+    ('native', 'TpuDeviceDescription_New+Free', (), lambda: description_free(description_new())),
+    ('python', 'TpuPlatform_VisibleDeviceCount', ('TpuPlatform_VisibleDeviceCount',),
+     lambda: count(platform)),
+    ('python', 'TpuCoreLocation_Id', ('TpuCoreLocation_Id',), lambda: core_id(core)),
+  ]
+  print(f"{'':<7} {'function':<38} {'call ns':>9} {'inside ns':>10}")
+  for kind, name, syms, call in cases:
+    libtpujesus.reset_stats()
+    per_call = measure(call, seconds)
+    stats = libtpujesus.stats()
+    inside = '-'
+    if syms:
+      calls = stats.get(syms[0], {}).get('calls', 0)
+      total = sum(stats.get(sym, {}).get('total_ns', 0) for sym in syms)
+      inside = f'{total / calls:,.0f}' if calls else '-'
+    print(f'{kind:<7} {name:<38} {per_call * 1e9:>9,.0f} {inside:>10}')
+  status_free(status)
+  libtpujesus.reset_stats()
+  for kind, name, syms, call in cases:
+    if name.endswith('+Free'):
+      for _ in range(10000):
+        call()
+  print()
+  print(f"{'pool':<26} {'live':>6} {'high':>6} {'free':>6} {'hits':>12} {'misses':>8} {'hit %':>7}")
+  for name, pool in libtpujesus.pool_stats().items():
+    print(f"{name:<26} {pool['live']:>6} {pool['high_water']:>6} {pool['free']:>6} "
+          f"{pool['hits']:>12,} {pool['misses']:>8,} {pool['hit_rate'] * 100:>7.2f}")
+
+
+if __name__ == '__main__':
+  main(*sys.argv[1:])
@@ -0,0 +1,198 @@
+# Hammers the C API from many OS threads at once, the way jaxlib's worker
+# threads call it, and reports throughput per thread count.
+#
+# Calls go through ctypes.CDLL, which drops the GIL for the duration of
+# each foreign call, so every trampoline has to take the GIL itself. Cases:
+#
+#   status    TpuStatus_New/Set/Code/Message/Free, native: a freelist
+#             lock and no GIL, so it should scale
+#   topology  TpuTopology_NumCores + TpuCoreLocation_Id, read-only Python
+#   memcpy    64 KiB TpuExecutor_SynchronousMemcpyFromHost, native: never
+#             touches the GIL, so it should scale with cores
+#   stream    libtpujesus.stream_enqueue on one shared stream; even threads
+#             also stream_wait, so waiters and enqueuers overlap
+#   feed      a third of the threads push 64-byte infeed records through
+#             TpuExecutor_EnqueueInfeed, a third pop them with
+#             infeed_dequeue, and a third poll feed_stats
+#
+#   python3 benchmarks/bench_threads.py [seconds-per-case] [max-threads]
+#
+# Each thread checks what it reads back (a status it set must report its
+# own code and message), and at the end the handle table must hold no more
+# live handles than before and no call may have raised.
+import os
+import sys
+import time
+import ctypes
+import threading
+
+import libtpujesus
+import libtpu
+
+lib = ctypes.CDLL(libtpujesus.__file__)
+
+
+class DeviceMemoryBase(ctypes.Structure):
+  _fields_ = [('opaque', ctypes.c_void_p),
+              ('size', ctypes.c_uint64),
+              ('payload', ctypes.c_uint64)]
+
+
+def cfunc(name, restype, *argtypes):
+  f = getattr(lib, name)
+  f.restype = restype
+  f.argtypes = argtypes
+  return f
+
+
+handle = ctypes.c_ssize_t
+status_new = cfunc('TpuStatus_New', handle)
+status_set = cfunc('TpuStatus_Set', None, handle, ctypes.c_int, ctypes.c_char_p, ctypes.c_int)
+status_code = cfunc('TpuStatus_Code', ctypes.c_int, handle)
+status_message = cfunc('TpuStatus_Message', ctypes.c_char_p, handle)
+status_free = cfunc('TpuStatus_Free', None, handle)
+num_cores = cfunc('TpuTopology_NumCores', ctypes.c_int, handle, ctypes.c_int)
+core_id = cfunc('TpuCoreLocation_Id', ctypes.c_int, handle)
+allocate = cfunc('TpuExecutor_Allocate', DeviceMemoryBase, handle, ctypes.c_uint64, ctypes.c_int64)
+deallocate = cfunc('TpuExecutor_Deallocate', None, handle, ctypes.POINTER(DeviceMemoryBase))
+to_device = cfunc('TpuExecutor_SynchronousMemcpyFromHost', None,
+                  handle, ctypes.POINTER(DeviceMemoryBase), ctypes.c_void_p, ctypes.c_uint64, handle)
+stream_new = cfunc('TpuStream_New', handle, handle)
+stream_free = cfunc('TpuStream_Free', None, handle)
+allocate_stream = cfunc('TpuExecutor_AllocateStream', ctypes.c_bool, handle, handle)
+deallocate_stream = cfunc('TpuExecutor_DeallocateStream', None, handle, handle)
+enqueue_infeed = cfunc('TpuExecutor_EnqueueInfeed', None,
+                       handle, ctypes.c_int32, ctypes.c_char_p, ctypes.c_int64, handle)
+
+
+def status_case(ctx, tid):
+  msg = b'thread %d' % tid
+  def call():
+    s = status_new()
+    status_set(s, tid % 16 + 1, msg, len(msg))
+    ok = status_code(s) == tid % 16 + 1 and status_message(s) == msg
+    status_free(s)
+    return ok
+  return call
+
+
+def topology_case(ctx, tid):
+  topology, core, cores = ctx['topology'], ctx['core'], ctx['cores']
+  return lambda: num_cores(topology, 0) == cores and core_id(core) == 0
+
+
+def memcpy_case(ctx, tid):
+  executor, status = ctx['executor'], ctx['status']
+  size = 64 << 10
+  host = ctypes.create_string_buffer(size)
+  mem = allocate(executor, size, 0)
+  assert mem.opaque, 'out of device memory'
+  ctx.setdefault('buffers', []).append(mem)
+  src, ref = ctypes.addressof(host), ctypes.byref(mem)
+  def call():
+    to_device(executor, ref, src, size, status)
+    return True
+  return call
+
+
+def stream_case(ctx, tid):
+  stream = ctx['stream']
+  def noop():
+    pass
+  if tid % 2:
+    return lambda: libtpujesus.stream_enqueue(stream, noop) is None
+  def call():
+    libtpujesus.stream_enqueue(stream, noop)
+    return libtpujesus.stream_wait(stream) == 0
+  return call
+
+
+def feed_case(ctx, tid):
+  executor, ordinal = ctx['executor'], ctx['ordinal']
+  if tid % 3 == 0:
+    record, status = bytes([tid % 256]) * 64, ctx['status']
+    return lambda: enqueue_infeed(executor, 0, record, 64, status) is None
+  if tid % 3 == 1:
+    def call():
+      # short timeout, so consumers can outnumber producers
+      record = libtpujesus.infeed_dequeue(ordinal, 0, 0.001)
+      return record is None or (len(record) == 64 and len(set(record)) == 1)
+    return call
+  return lambda: 0 in libtpujesus.feed_stats(ordinal)['infeed']
+
+
+def drain_infeed(ctx):
+  while libtpujesus.infeed_dequeue(ctx['ordinal'], 0, 0) is not None:
+    pass
+
+
+def run(case, ctx, threads, seconds):
+  """(calls/s, wrong answers) for `threads` threads running case()."""
+  calls = [0] * threads
+  wrong = [0] * threads
+  start = threading.Barrier(threads + 1)
+  stop = threading.Event()
+  def worker(tid):
+    call = case(ctx, tid)
+    start.wait()
+    n = bad = 0
+    while not stop.is_set():
+      for _ in range(100):
+        bad += not call()
+      n += 100
+    calls[tid], wrong[tid] = n, bad
+  pool = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+  for t in pool:
+    t.start()
+  start.wait()
+  t0 = time.perf_counter()
+  time.sleep(seconds)
+  stop.set()
+  for t in pool:
+    # a producer stopped on a full queue needs someone to make room
+    while t.is_alive():
+      ctx.get('drain', lambda ctx: None)(ctx)
+      t.join(0.01)
+  return sum(calls) / (time.perf_counter() - t0), sum(wrong)
+
+
+def errors():
+  return sum(s['errors'] for s in libtpujesus.stats().values())
+
+
+def main(seconds=1.0, max_threads=None):
+  seconds = float(seconds)
+  max_threads = int(max_threads or min(os.cpu_count() or 1, 16))
+  status = status_new()
+  platform = cfunc('TpuPlatform_New', handle)()
+  config = cfunc('TpuStreamExecutorConfig_Default', handle)()
+  executor = cfunc('TpuPlatform_GetExecutor', handle, handle, handle, handle)(platform, config, status)
+  topology = libtpu.new(libtpu.SE_Platform.get().topology)
+  core = libtpu.new(libtpu.SE_Platform.get().topology.cores[0])
+  stream = stream_new(executor)
+  allocate_stream(executor, stream)
+  ctx = dict(status=status, executor=executor, topology=topology, core=core,
+             cores=num_cores(topology, 0), stream=stream,
+             ordinal=libtpujesus.stream_device(stream), drain=drain_infeed)
+  # the feed case needs a queue to exist before the first feed_stats
+  enqueue_infeed(executor, 0, bytes(64), 64, status)
+  cases = [('status', status_case), ('topology', topology_case), ('memcpy', memcpy_case),
+           ('stream', stream_case), ('feed', feed_case)]
+  counts = [n for n in (1, 2, 4, 8, 16, 32, 64) if n <= max_threads]
+  live, failed = libtpu.handle_table.live, errors()
+  print(f"{'case':<10} {'threads':>7} {'calls/s':>12} {'scaling':>8} {'wrong':>6}")
+  for name, case in cases:
+    base = None
+    for n in counts:
+      rate, wrong = run(case, ctx, n, seconds)
+      base = base or rate
+      print(f"{name:<10} {n:>7} {rate:>12,.0f} {rate / base:>7.2f}x {wrong:>6}")
+  for mem in ctx.get('buffers', []):
+    deallocate(executor, ctypes.byref(mem))
+  deallocate_stream(executor, stream)
+  stream_free(stream)
+  print(f'handles: {libtpu.handle_table.live - live:+d} live, calls raised: {errors() - failed}')
+
+
+if __name__ == '__main__':
+  main(*sys.argv[1:])
@@ -4,7 +4,24 @@ from distutils.command.build_ext import build_ext, Extension, DistutilsPlatformE
 ext_modules = [
     Extension("libtpujesus",
               include_dirs=[],
-              sources=["libtpu/libtpujesus.c"]
+              sources=["libtpu/libtpujesus.c",
+                       "libtpu/tpu_allocator.c",
+                       "libtpu/tpu_device.c",
+                       "libtpu/tpu_stream.c",
+                       "libtpu/tpu_event.c",
+                       "libtpu/tpu_memcpy.c",
+                       "libtpu/tpu_feed.c",
+                       "libtpu/tpu_shape.c",
+                       "libtpu/tpu_layout.c",
+                       "libtpu/tpu_compile.c",
+                       "libtpu/tpu_status.c",
+                       "libtpu/tpu_pool.c",
+                       "libtpu/tpu_profiler.c"],
+              depends=["libtpu/libtpujesus.h",
+                       "libtpu/tpu_library_init_fns.inc",
+                       "libtpu/tpu_executor_init_fns.inc",
+                       "libtpu/tpu_api.h",
+                       "libtpu/tpu_trampolines.inc"]
              ),
 ]
 
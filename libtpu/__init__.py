@@ -1,22 +1,28 @@
 from __future__ import annotations
 import sys
-__saved_stdout__, sys.stdout = sys.stdout, sys.__stdout__
 import libtpujesus
 # import libtpu
 from typing import NamedTuple
 import ctypes
 import inspect
-import traceback
-import pdb
+import math
 import posix
+import atexit
+import threading
+import os
 import builtins
 import copy
-from dataclasses import dataclass, is_dataclass
+from dataclasses import dataclass, field, is_dataclass
 from typing import Tuple, Sequence, List, ClassVar, Any
 from enum import Enum, auto
 from pyembc import pyembc_struct, pyembc_union
-from pprint import pprint as pp
 from functools import partial
+from .handles import table as handle_table, HandleError
+from .shapecache import cache as shape_cache
+from .compilecache import cache as compile_cache
+from .capi import SIGNATURES as c_signatures
+from . import compilecache
+from . import placement
 
 struct = partial(pyembc_struct, pack=8)
 union = partial(pyembc_union, pack=8)
@@ -47,6 +53,35 @@ class Wrappable:
 def warn(msg, *args):
   print(msg, args, file=sys.stderr)
 
+# trace levels; keep in sync with TRACE_* in libtpujesus.c
+TRACE_OFF = 0
+TRACE_CALLS = 1
+TRACE_ARGS = 2
+TRACE_DEBUG = 3
+
+def trace(msg, *args, level=TRACE_DEBUG):
+  if libtpujesus.trace_level() >= level:
+    libtpujesus.trace(' '.join([str(msg), *map(repr, args)]))
+
+def option(name, default=None):
+  """Look up a libtpu option: TpuPlatform_Initialize's libtpu_<name>,
+  then $LIBTPU_<NAME>."""
+  platform = SE_Platform.get()
+  if platform is not None and 'libtpu_' + name in platform.options:
+    return platform.options['libtpu_' + name]
+  return os.environ.get('LIBTPU_' + name.upper(), default)
+
+def set_trace(spec):
+  """Apply a trace spec of the form level[:sym,prefix*,...]."""
+  level, _, filter = str(spec).partition(':')
+  libtpujesus.set_trace(int(level or 0), filter or None)
+
+def set_layout_policy(name):
+  """Switch device layouts between 'tiled' and 'compact' (tpu_layout.c).
+  Cached device shapes and sizes are stale after a switch, so drop them."""
+  if libtpujesus.layout_policy(name) != name:
+    shape_cache.flush()
+
 def exit(code=0):
   posix._exit(code)
 
@@ -55,11 +90,13 @@ def fatal(msg, *args):
   exit()
 
 def brk():
+  import pdb
   mypdb = pdb.Pdb(stdout=sys.__stderr__)
   mypdb.reset()
   mypdb.set_trace()
 
 def pm(t=None):
+  import pdb
   mypdb = pdb.Pdb(stdout=sys.__stderr__)
   mypdb.reset()
   if t is None:
@@ -72,10 +109,10 @@ def pm(t=None):
 
 def panic(msg, *args):
   warn(msg, *args)
+  libtpujesus.trace_flush()
   brk()
   exit()
 
-stackptr_t = ctypes.POINTER(ctypes.c_ssize_t)
 int8_t = ctypes.c_int8
 int16_t = ctypes.c_int16
 int32_t = ctypes.c_int32
@@ -109,6 +146,7 @@ def is_cpointer(x): return is_cpointertype(type(x))
 def is_cstructtype(x): return issubclass(x, ctypes.Structure)
 def is_cstruct(x): return isinstance(x, ctypes.Structure)
 def is_cdata(x): return is_cdatatype(type(x))
+def is_ctypes_obj(x): return isinstance(x, (ctypes._SimpleCData, ctypes._Pointer, ctypes.Structure, ctypes.Union, ctypes.Array))
 def is_nullptr(x): x = getattr(x, 'value', x); return x is None or x == 0
 
 def cvalue(x):
@@ -120,82 +158,197 @@ def deref(x):
   if is_nullptr(x):
     panic("Tried to deref a null pointer", x)
   if isinstance(x, int):
-    if x in objs:
-      return objs[x]
-    panic("Tried to deref unknown address", x)
+    try:
+      return handle_table.lookup(x)
+    except HandleError as e:
+      panic("Tried to deref unknown address", x, e)
   if is_cpointer(x):
     if hasattr(x, 'contents'):
       return x[0]
   panic("Can't deref", x)
 
-objs = {}
-stack_ptr = None
-
-def addr(x):
-  try:
-    return ctypes.addressof(x)
-  except TypeError:
-    return id(x)
-
 def pin(x, ptr = None):
-  if ptr is None:
-    ptr = addr(x)
-  objs[ptr] = x
-  return ptr
+  """Keep `x` alive for C. ctypes objects are passed by address, anything
+  else gets a handle."""
+  if ptr is None and not is_ctypes_obj(x):
+    return handle_table.new(x)
+  return handle_table.pin(x, ctypes.addressof(x) if ptr is None else ptr)
 
 def new(x):
-  return pin(x)
+  return handle_table.new(x)
 
 def delete(x):
-  if addr(x) in objs:
-    del objs[addr(x)]
-  elif x:
-    panic('Delete of unknown ptr', x)
-
-_argv = []
-
-def arg(i) -> ctypes.c_ssize_t:
-  #assert stack_ptr
-  #return stack_ptr.contents[i]
-  return _argv[i]
-
-def argv(f, i):
-  val = arg(i)
-  params = list(inspect.signature(f).parameters.values())
-  kind = params[i].annotation
+  if not x:
+    return
+  if is_ctypes_obj(x):
+    if handle_table.unpin(ctypes.addressof(x)):
+      return
+  else:
+    try:
+      return handle_table.delete(x)
+    except HandleError as e:
+      panic('Delete of unknown ptr', x, e)
+  panic('Delete of unknown ptr', x)
+
+#
+# Precompiled dispatchers
+#
+# `argv` re-inspects the signature and re-resolves the annotation on every
+# argument of every call. The dispatchers below do that work once per API
+# function, and keep a tuple of converters around for the call path.
+#
+# Where capi.py has the symbol's C signature, that decides how each word
+# from the trampoline is read: integers arrive already sign- or
+# zero-extended, bools as 0 or 1, and structs passed by value as the
+# address of the trampoline's copy. The annotation only picks the Python
+# type of pointer arguments.
+#
+
+def resolve_annotation(kind):
+  if kind is inspect.Parameter.empty:
+    return kind
+  if kind == 'None':
+    return None
   if isinstance(kind, str):
     kind = getattr(builtins, kind, kind)
   if isinstance(kind, str):
     kind = globals().get(kind)
   assert kind is not None
   assert not isinstance(kind, str)
+  return kind
+
+def to_int32(val):
+  return ((val + 0x80000000) & 0xFFFFFFFF) - 0x80000000
+
+def to_bool(val):
+  return val == 1
+
+def to_uint64(val):
+  return val & 0xFFFFFFFFFFFFFFFF
+
+C_SCALARS = {'void', 'bool', 'ptr',
+             'i8', 'i16', 'i32', 'i64', 'u8', 'u16', 'u32', 'u64'}
+
+def is_struct_kind(ckind):
+  return ckind not in C_SCALARS
+
+def arg_converter(kind, f=None, i=None):
   if kind == int:
-    # return ctypes.cast(val, int_t)
-    #return ctypes.cast((int_t * 1)(val), ctypes.POINTER(int_t))[0]
-    return (int_t * 1)(val)[0]
+    return to_int32
   if kind == bool:
-    return val == 1
-  if val == 0:
-    return None
-  if kind is cstr_t and isinstance(val, str):
-    return val
+    return to_bool
+  if kind is inspect.Parameter.empty:
+    kind = object
   if is_cpointertype(kind):
-    return ctypes.cast(val, kind)
+    return lambda val: ctypes.cast(val, kind) if val != 0 else None
   if is_cstructtype(kind):
-    return ctypes.cast(val, ctypes.POINTER(kind)).contents # TODO: this is dubious
+    return lambda val: kind.from_address(val) if val != 0 else None
   if is_cdatatype(kind):
-    #return ctypes.cast(val, kind)
-    return kind(val)
-  if val in objs:
-    o = objs[val]
-    if isinstance(o, kind):
-      return o
+    return lambda val: kind(val) if val != 0 else None
+  return handle_table.converter(kind)
+
+def c_arg_converter(ckind, kind, f=None, i=None):
+  """Converter for an argument the trampoline passes as C kind `ckind`
+  (see capi.py), annotated `kind`."""
+  if ckind == 'ptr':
+    return arg_converter(kind, f, i)
+  if is_struct_kind(ckind):
+    cls = kind if is_cstructtype(kind) else globals()[ckind]
+    return cls.from_address
+  if kind in (int, bool, inspect.Parameter.empty):
+    if ckind == 'bool':
+      return bool
+    return to_uint64 if ckind == 'u64' else int
+  convert = arg_converter(kind, f, i)
+  if ckind == 'u64':
+    return lambda val: convert(to_uint64(val))
+  return convert
+
+def to_result(result):
+  if result is None:
+    return 0
+  elif isinstance(result, (bool, int)):
+    return int(result)
+  elif is_cstruct(result):
+    pin(result) # TODO: is this necessary?
+    return ctypes.addressof(result)
+  elif isinstance(result, (Wrappable, tuple)) or is_dataclass_instance(result):
+    return new(result)
+  elif is_cdata(result):
+    return cvalue(result)
+  else:
+    panic("Don't know how to return", result)
+
+def result_converter(kind):
+  if kind in (int, bool):
+    return lambda result: int(result) if type(result) in (int, bool) else to_result(result)
+  if isinstance(kind, type) and is_dataclass(kind):
+    return lambda result: new(result) if type(result) is kind else to_result(result)
+  if isinstance(kind, type) and is_cdatatype(kind):
+    return lambda result: result.value if type(result) is kind else to_result(result)
+  return to_result
+
+class Dispatcher:
+  __slots__ = ('name', 'f', 'converters', 'result')
+
+  def __init__(self, name, f):
+    sig = inspect.signature(f)
+    params = list(sig.parameters.values())
+    self.name = name
+    self.f = f
+    csig = c_signatures.get(name)
+    if csig is None:
+      self.converters = tuple(arg_converter(resolve_annotation(param.annotation), f, i)
+                              for i, param in enumerate(params))
     else:
-      panic('object was an unrelated type', dict(expected=kind, actual=type(o)), o)
-  if isinstance(val, TpuType):
-    warn('untracked val', val)
-    return val
-  panic('Unknown annotation', kind, f, i)
+      _, cparams, decl = csig
+      if len(params) != len(cparams):
+        warn(f'{name} takes {len(params)} arguments; the C API passes {len(cparams)}', decl)
+      self.converters = tuple(c_arg_converter(ckind, resolve_annotation(param.annotation), f, i)
+                              for i, (param, (ckind, _)) in enumerate(zip(params, cparams)))
+    self.result = result_converter(resolve_annotation(sig.return_annotation))
+
+  def convert(self, args):
+    return tuple([convert(val) for convert, val in zip(self.converters, args)])
+
+  def finish(self, args, result):
+    return self.result(result)
+
+  def __call__(self, *args):
+    return self.result(self.f(*[convert(val) for convert, val in zip(self.converters, args)]))
+
+  def __repr__(self):
+    return f'{type(self).__name__}({self.name!r}, {self.f!r})'
+
+class StructResultDispatcher(Dispatcher):
+  """For a symbol returning a struct by value. The trampoline passes the
+  address of its return value ahead of the arguments, and the struct the
+  implementation returns is copied there."""
+  __slots__ = ()
+
+  def convert(self, args):
+    return Dispatcher.convert(self, args[1:])
+
+  def finish(self, args, result):
+    if result is not None:
+      ctypes.memmove(args[0], ctypes.addressof(result), ctypes.sizeof(result))
+    return 0
+
+  def __call__(self, *args):
+    return self.finish(args, self.f(*self.convert(args)))
+
+dispatchers = {}
+
+def dispatcher(name):
+  d = dispatchers.get(name)
+  if d is None:
+    f = globals().get(name, None)
+    if not f:
+      return None
+    csig = c_signatures.get(name)
+    cls = StructResultDispatcher if csig and is_struct_kind(csig[0]) else Dispatcher
+    d = dispatchers[name] = cls(name, f)
+  return d
 
 class NewFree:
   @classmethod
@@ -204,27 +357,37 @@ class NewFree:
   def Free(self):
     return delete(self)
 
-def getmembers(cls):
-  return [(k, v) for k, v in inspect.getmembers(cls)
-          if isinstance(k, str) and not (k.startswith('__') and k.endswith('__'))]
+def is_api_name(name):
+  """C API methods are FooBar style; fields and helpers are lowercase."""
+  return name[:1].isupper() and not name[1:2].isupper()
+
+def api_members(cls):
+  """(name, member) for the API methods a TpuType defines or inherits
+  (e.g. from NewFree), nearest definition first. Reads the class dicts
+  directly; inspect.getmembers would evaluate every attribute of every
+  class at import."""
+  seen = set()
+  for base in cls.__mro__:
+    if base is TpuType or base is object:
+      continue
+    for name in vars(base):
+      if name not in seen and is_api_name(name):
+        seen.add(name)
+        yield name, getattr(cls, name)
 
 class TpuType:
+  """Base for the classes behind the C API: each FooBar method becomes the
+  implementation of <use_name>_FooBar when the class is defined."""
   def __init_subclass__(cls, use_name=None, wraps=None, **kwargs):
     super().__init_subclass__(**kwargs)
     if use_name is None:
       use_name = cls.__name__
-    print('init_subclass', wraps, cls, kwargs, file=sys.stderr)
     if wraps is not None:
       cls.__wraps__ = wraps
-      # print('TKTK', wraps, file=sys.stderr)
-    for name, impl in getmembers(cls):
-      if len(name) > 1 and not (name[0].isupper() and not name[1].isupper()):
-        warn(f'expected FooBarBaz style name, got {name}')
-      else:
-        global_name = f'{use_name}_{name}'
-        assert global_name not in globals(), f'{global_name} already implemented'
-        globals()[global_name] = impl
-        print('IMPLEMENTING:', global_name, impl, file=sys.stderr)
+    for name, impl in api_members(cls):
+      global_name = f'{use_name}_{name}'
+      assert global_name not in globals(), f'{global_name} already implemented'
+      globals()[global_name] = impl
 
 
 
@@ -235,6 +398,9 @@ class SE_TpuTopology_Core(TpuType, use_name='TpuCoreLocation'):
   z: int = 0
   id: int = 0
   index: int = 0
+  host_x: int = 0
+  host_y: int = 0
+  host_z: int = 0
   # void TpuCoreLocation_ChipCoordinates(SE_TpuTopology_Core* tpu_core_location,
   #                                      int* x, int* y, int* z);
   def ChipCoordinates(self: SE_TpuTopology_Core,
@@ -246,9 +412,9 @@ class SE_TpuTopology_Core(TpuType, use_name='TpuCoreLocation'):
   #                                      int* x, int* y, int* z);
   def HostCoordinates(self: SE_TpuTopology_Core,
                       x: int_out, y: int_out, z: int_out):
-    x[0] = self.x if self is not None else 0
-    y[0] = self.y if self is not None else 0
-    z[0] = self.z if self is not None else 0
+    x[0] = self.host_x if self is not None else 0
+    y[0] = self.host_y if self is not None else 0
+    z[0] = self.host_z if self is not None else 0
   # int TpuCoreLocation_Index(SE_TpuTopology_Core* tpu_core_location);
   def Index(self: SE_TpuTopology_Core) -> int_t: return self.index if self else 0
   # int TpuCoreLocation_Id(SE_TpuTopology_Core* tpu_core_location);
@@ -263,6 +429,7 @@ SE_TpuTopology_Core_array = ptr_out
 #   kEmbeddingV2,
 # };
 TpuCoreTypeEnum = int
+kTensorCore, kEmbeddingV1, kEmbeddingV2 = range(3)
 
 # enum TpuVersionEnum {
 #   kUnknownTpuVersion,
@@ -319,7 +486,9 @@ class SE_TpuTopology_Host(TpuType, use_name='TpuHostLocation'):
   # int TpuHostLocation_NumCores(SE_TpuTopology_Host* tpu_host_location,
   #                              TpuCoreTypeEnum tpu_core_type);
   def NumCores(self: SE_TpuTopology_Host, tpu_core_type: TpuCoreTypeEnum) -> int_t:
-    return len(self.cores) if self is not None else 0
+    if self is None or tpu_core_type != kTensorCore:
+      return 0
+    return len(self.cores)
   # // 'cores' should be a preallocated array of size TpuHostLocation_NumCores.
   # void TpuHostLocation_Cores(SE_TpuTopology_Host* tpu_host_location,
   #                            TpuCoreTypeEnum tpu_core_type,
@@ -327,43 +496,76 @@ class SE_TpuTopology_Host(TpuType, use_name='TpuHostLocation'):
   def Cores(self: SE_TpuTopology_Host,
             tpu_core_type: TpuCoreTypeEnum,
             cores: SE_TpuTopology_Core_array):
-    if self is not None:
+    if self is not None and tpu_core_type == kTensorCore:
       for i, core in enumerate(self.cores):
         cores[i] = pin(core)
 
 @dataclass
 class SE_TpuTopology(TpuType, use_name='TpuTopology'):
   id: int
-  cores: List[SE_TpuTopology_Core]
+  cores: List[SE_TpuTopology_Core]  # by id
+  hosts: List[SE_TpuTopology_Host] = field(default_factory=list)  # by id
+  bounds: tuple = (1, 1, 1)  # chips along x, y, z
+  host_bounds: tuple = (1, 1, 1)  # hosts along x, y, z
+  cores_per_chip: int = 1
+  grid: List[SE_TpuTopology_Core] = field(default_factory=list)  # by grid_index()
+  def grid_index(self, x, y, z, index=0):
+    bx, by, bz = self.bounds
+    if not (0 <= x < bx and 0 <= y < by and 0 <= z < bz and 0 <= index < self.cores_per_chip):
+      return -1
+    return ((z * by + y) * bx + x) * self.cores_per_chip + index
   # int TpuTopology_LogicalDevicesPerHost(SE_TpuTopology* tpu_topology,
   #                                       TpuCoreTypeEnum tpu_core_type);
+  def LogicalDevicesPerHost(self: SE_TpuTopology, tpu_core_type: TpuCoreTypeEnum) -> int_t:
+    return self.NumCores(tpu_core_type) // len(self.hosts)
   # int TpuTopology_LogicalDevicesPerChip(SE_TpuTopology* tpu_topology,
   #                                       TpuCoreTypeEnum tpu_core_type);
+  def LogicalDevicesPerChip(self: SE_TpuTopology, tpu_core_type: TpuCoreTypeEnum) -> int_t:
+    return self.cores_per_chip if tpu_core_type == kTensorCore else 0
   # int TpuTopology_HostCount(SE_TpuTopology* tpu_topology);
+  def HostCount(self: SE_TpuTopology) -> int_t:
+    return len(self.hosts)
   # int TpuTopology_ChipsPerHost(SE_TpuTopology* tpu_topology);
+  def ChipsPerHost(self: SE_TpuTopology) -> int_t:
+    return len(self.cores) // self.cores_per_chip // len(self.hosts)
   #
   # int TpuTopology_ChipBounds_X(SE_TpuTopology* tpu_topology);
+  def ChipBounds_X(self: SE_TpuTopology) -> int_t:
+    return self.bounds[0]
   # int TpuTopology_ChipBounds_Y(SE_TpuTopology* tpu_topology);
+  def ChipBounds_Y(self: SE_TpuTopology) -> int_t:
+    return self.bounds[1]
   # int TpuTopology_ChipBounds_Z(SE_TpuTopology* tpu_topology);
+  def ChipBounds_Z(self: SE_TpuTopology) -> int_t:
+    return self.bounds[2]
   # bool TpuTopology_HasChip(SE_TpuTopology* tpu_topology, int x, int y, int z);
+  def HasChip(self: SE_TpuTopology, x: int, y: int, z: int) -> bool:
+    return self.grid_index(x, y, z) >= 0
   # SE_TpuTopology_Core* TpuTopology_CoreForId(SE_TpuTopology* tpu_topology,
   #                                            TpuCoreTypeEnum tpu_core_type,
   #                                            int id);
+  def CoreForId(self: SE_TpuTopology, tpu_core_type: TpuCoreTypeEnum,
+                id: int) -> SE_TpuTopology_Core:
+    if tpu_core_type == kTensorCore and 0 <= id < len(self.cores):
+      return self.cores[id]
   # SE_TpuTopology_Core* TpuTopology_Core(SE_TpuTopology* tpu_topology,
   #                                       TpuCoreTypeEnum tpu_core_type, int x,
   #                                       int y, int z, int index);
+  def Core(self: SE_TpuTopology, tpu_core_type: TpuCoreTypeEnum,
+           x: int, y: int, z: int, index: int) -> SE_TpuTopology_Core:
+    i = self.grid_index(x, y, z, index)
+    if tpu_core_type == kTensorCore and i >= 0:
+      return self.grid[i]
   # int TpuTopology_NumCores(SE_TpuTopology* tpu_topology,
   #                          TpuCoreTypeEnum tpu_core_type);
   def NumCores(self: SE_TpuTopology, tpu_core_type: TpuCoreTypeEnum):
-    return len(self.cores)
-  # // 'cores' should be a preallocated array of size TpuTopology_NumCores.
-  # void TpuTopology_Cores(SE_TpuTopology* tpu_topology,
-  #                        TpuCoreTypeEnum tpu_core_type,
-  #                        SE_TpuTopology_Core** cores);
+    return len(self.cores) if tpu_core_type == kTensorCore else 0
   # int TpuTopology_IdForHost(SE_TpuTopology* tpu_topology, int x, int y, int z);
   def IdForHost(self: SE_TpuTopology, x: int, y: int, z: int) -> int:
-    print('IdForHost', x, y, z)
-    return 0
+    hx, hy, hz = self.host_bounds
+    if not (0 <= x < hx and 0 <= y < hy and 0 <= z < hz):
+      return -1
+    return (z * hy + y) * hx + x
   # TpuVersionEnum TpuTopology_Version(SE_TpuTopology* tpu_topology);
   def Version(self: SE_TpuTopology) -> TpuVersionEnum:
     return TpuVersionEnum.kTpuV2.value
@@ -375,8 +577,49 @@ class SE_TpuTopology(TpuType, use_name='TpuTopology'):
             tpu_core_type: TpuCoreTypeEnum,
             cores: SE_TpuTopology_Core_array, # SE_TpuTopology_Core**
             ):
-    for i, core in enumerate(self.cores):
-      cores[i] = pin(core)
+    if tpu_core_type == kTensorCore:
+      for i, core in enumerate(self.cores):
+        cores[i] = pin(core)
+
+def make_topology(chips='1x1x1', cores_per_chip=1, host_count=1):
+  """Lay out a virtual slice of `chips` (XxYxZ) with `cores_per_chip` cores
+  each, split across `host_count` hosts.
+
+  Each host gets an equal block of chips, carved out of x first, then y,
+  then z. Core ids run host by host, so a host's cores have consecutive
+  ids, and within a host chip by chip in z, y, x order; a host's cores
+  are its executors' ordinals in the same order."""
+  bounds = tuple(int(n) for n in str(chips).lower().split('x'))
+  bounds = (bounds + (1, 1, 1))[:3]
+  cores_per_chip, host_count = int(cores_per_chip), int(host_count)
+  nchips = bounds[0] * bounds[1] * bounds[2]
+  if min(bounds) < 1 or cores_per_chip < 1 or host_count < 1 or nchips % host_count:
+    raise ValueError(f'bad topology: {chips} chips, {cores_per_chip} cores per chip, {host_count} hosts')
+  block, rest = [], nchips // host_count
+  for n in bounds:
+    block.append(math.gcd(n, rest))
+    rest //= block[-1]
+  if rest != 1:
+    raise ValueError(f"can't split {chips} chips evenly across {host_count} hosts")
+  host_bounds = tuple(n // b for n, b in zip(bounds, block))
+  topology = SE_TpuTopology(id=0, cores=[], bounds=bounds, host_bounds=host_bounds,
+                            cores_per_chip=cores_per_chip,
+                            grid=[None] * (nchips * cores_per_chip))
+  for hz in range(host_bounds[2]):
+    for hy in range(host_bounds[1]):
+      for hx in range(host_bounds[0]):
+        host = SE_TpuTopology_Host(id=len(topology.hosts), cores=[])
+        for z in range(hz * block[2], (hz + 1) * block[2]):
+          for y in range(hy * block[1], (hy + 1) * block[1]):
+            for x in range(hx * block[0], (hx + 1) * block[0]):
+              for index in range(cores_per_chip):
+                core = SE_TpuTopology_Core(x=x, y=y, z=z, id=len(topology.cores), index=index,
+                                           host_x=hx, host_y=hy, host_z=hz)
+                topology.cores.append(core)
+                topology.grid[topology.grid_index(x, y, z, index)] = core
+                host.cores.append(core)
+        topology.hosts.append(host)
+  return topology
 
 
 #
@@ -386,27 +629,32 @@ class SE_TpuTopology(TpuType, use_name='TpuTopology'):
 @dataclass
 class SE_Platform(TpuType, use_name='TpuPlatform'):
   inst: ClassVar[SE_Platform] = None
+  lock: ClassVar = threading.Lock()
   @classmethod
   def get(cls) -> SE_Platform:
     return cls.inst
   devices: List
-  executor: SE_StreamExecutor
   topology: SE_TpuTopology
   topology_host: SE_TpuTopology_Host
   runtime_version: TpuRuntimeVersion
   initialized: bool = False
+  options: dict = field(default_factory=dict)
+  executors: dict = field(default_factory=dict)
   # def TpuPlatform_New() -> SE_Platform: return SE_Platform([None])
   @classmethod
   def New(cls: SE_Platform) -> SE_Platform:
-    if cls.inst is None:
-      cores = [SE_TpuTopology_Core()]
-      cls.inst = cls(
-        devices=[None],
-        executor=SE_StreamExecutor(),
-        topology=SE_TpuTopology(id=0, cores=cores),
-        topology_host=SE_TpuTopology_Host(id=0, cores=cores),
-        runtime_version=TpuRuntimeVersion(int3_t(1, 2, 3), cstr_t(b'foo'), size_t(3)),
-      )
+    with cls.lock:
+      if cls.inst is None:
+        topology = make_topology()
+        platform = cls(
+          devices=[None],
+          topology=topology,
+          topology_host=topology.hosts[0],
+          runtime_version=TpuRuntimeVersion(int3_t(1, 2, 3), cstr_t(b'foo'), size_t(3)),
+        )
+        configure_topology(platform)
+        # published only once configured; get() doesn't lock
+        cls.inst = platform
     return cls.inst
   # def TpuPlatform_Free(platform: SE_Platform): return delete(platform)
   def Free(self: SE_Platform):
@@ -420,6 +668,18 @@ class SE_Platform(TpuType, use_name='TpuPlatform'):
                  options_value: cstr_array_t,
                  status: TF_Status):
     assert self
+    for i in range(options_size):
+      self.options[options_key[i].decode()] = options_value[i].decode()
+    if 'libtpu_trace' in self.options:
+      set_trace(self.options['libtpu_trace'])
+    shape_cache.resize(int(option('shape_cache_size', shape_cache.capacity)))
+    set_layout_policy(option('layout', 'tiled'))
+    configure_compile_cache()
+    try:
+      configure_topology(self)
+    except ValueError as e:
+      status.set(3, str(e))
+      return
     self.initialized = True
   # bool TpuPlatform_Initialized(SE_Platform* platform);
   def Initialized(self: SE_Platform) -> bool:
@@ -430,80 +690,112 @@ class SE_Platform(TpuType, use_name='TpuPlatform'):
   def GetExecutor(self: SE_Platform,
                   config: SE_StreamExecutorConfig,
                   status: TF_Status) -> SE_StreamExecutor:
+    ordinal = max(config.ordinal, 0) if config else 0
+    if ordinal >= len(self.devices):
+      status.set(3, f'Invalid device ordinal {ordinal}')
+      return None
+    executor = self.executors.get(ordinal)
+    if executor is None:
+      executor = self.executors[ordinal] = SE_StreamExecutor(
+        ordinal=ordinal, core=self.topology_host.cores[ordinal])
+      path = None
+      if option('memory_mode', 'anon') == 'file':
+        # A directory, or a path that gets .<ordinal> appended. /tmp is
+        # often tmpfs, which is RAM, so default to /var/tmp, which is disk.
+        path = option('memory_file', '/var/tmp' if os.path.isdir('/var/tmp') else None)
+        if path is None:
+          import tempfile
+          path = tempfile.gettempdir()
+      libtpujesus.bind_executor(new(executor), ordinal, self.TpuMemoryLimit(), path,
+                                int(option('memory_release_threshold', 1 << 20)),
+                                int(option('feed_capacity', 64 << 20)))
     status.ok()
-    return SE_StreamExecutor()
+    return executor
   # SE_PlatformId TpuPlatform_Id(SE_Platform* platform);
   # int64_t TpuPlatform_VisibleDeviceCount(SE_Platform* platform);
   def VisibleDeviceCount(self: SE_Platform) -> int64_t:
     return int64_t(len(self.devices))
   # int64_t TpuPlatform_TpuMemoryLimit(SE_Platform* platform);
+  def TpuMemoryLimit(self: SE_Platform) -> int64_t:
+    return int(option('memory_limit', 8 << 30))
   # bool TpuPlatform_ShouldRegisterTpuDeviceToDeviceCopy(SE_Platform* platform);
   # SE_TpuTopology* TpuPlatform_GetTopologyPtr(SE_Platform* platform);
   def GetTopologyPtr(self: SE_Platform) -> SE_TpuTopology:
-    print('GetTopoPtr TKTK')
     return self.topology
   # SE_TpuTopology_Host* TpuPlatform_GetHostLocation(SE_Platform* platform);
   def GetHostLocation(self: SE_Platform) -> SE_TpuTopology_Host:
-    print('GetHost TKTK')
     return self.topology_host
   # TpuRuntimeVersion TpuPlatform_GetRuntimeVersion(SE_Platform* platform);
   def GetRuntimeVersion(self: SE_Platform) -> TpuRuntimeVersion:
-    return [self.runtime_version]
+    return self.runtime_version
+
+def configure_topology(platform: SE_Platform):
+  """Lay out the platform's slice from the topology options:
+
+    libtpu_topology         chips as XxYxZ, e.g. 2x2x1 (default 1x1x1)
+    libtpu_cores_per_chip   default 1
+    libtpu_host_count       default 1
+    libtpu_host_id          which of those hosts this process is (default 0)
+
+  or $LIBTPU_TOPOLOGY etc. The local host's cores become the devices."""
+  topology = make_topology(option('topology', '1x1x1'),
+                           option('cores_per_chip', 1),
+                           option('host_count', 1))
+  host_id = int(option('host_id', 0))
+  if not 0 <= host_id < len(topology.hosts):
+    raise ValueError(f'host id {host_id} out of range for {len(topology.hosts)} hosts')
+  host = topology.hosts[host_id]
+  if platform.executors and len(host.cores) != len(platform.devices):
+    raise ValueError("can't change the number of devices once executors exist")
+  platform.topology = topology
+  platform.topology_host = host
+  platform.devices = [None] * len(host.cores)
+  for ordinal, executor in platform.executors.items():
+    executor.core = host.cores[ordinal]
 
 # TpuStatus / TF_Status
 #
+# Statuses are native (tpu_status.c). This is a view of the head of one;
+# set it through set() so the message is copied into the status.
 
-@dataclass
+@struct
 class TF_Status:
-  code: int
-  message: str
-  @classmethod
-  def copy(cls, other):
-    assert isinstance(other, cls)
-    return copy.copy(other)
-  def set(self, other):
-    self.code = other.code
-    self.message = other.message
-    return self
-  def ok(self):
-    self.set(self.OK)
-
-TF_Status.OK = TF_Status(code=0, message="OK")
-
-def TpuStatus_New() -> TF_Status: return TF_Status.copy(TF_Status.OK)
-def TpuStatus_Create(code: int, msg: str) -> TF_Status: return TF_Status(code, msg)
-def TpuStatus_Set(status: TF_Status, code: int32_t, msg: cstr_t, len: int = -1) -> None:
-  status.code = code
-  status.message = msg.value
-def TpuStatus_Free(status: TF_Status): return delete(status)
-def TpuStatus_Message(status: TF_Status): return status.message
-def TpuStatus_Code(status: TF_Status): return status.code
-def TpuStatus_Ok(status: TF_Status): return status.code == TF_Status.OK.code
+  code: int32_t
+  magic: uint32_t
+  message_: void_p
+
+def status_set(self, code, message=None):
+  if isinstance(message, str):
+    message = message.encode()
+  libtpujesus.status_set(ctypes.addressof(self), code, message)
+  return self
+
+def status_ok(self):
+  return status_set(self, 0)
+
+def status_message(self):
+  return ctypes.string_at(self.message_).decode(errors='replace') if self.message_ else ''
+
+def status_new():
+  return TF_Status.from_address(libtpujesus.status_new())
+
+def status_free(self):
+  libtpujesus.status_free(ctypes.addressof(self))
+
+TF_Status.set = status_set
+TF_Status.ok = status_ok
+TF_Status.message = property(status_message)
+TF_Status.New = staticmethod(status_new)
+TF_Status.Free = status_free
 
 #
 # TpuStreamExecutorConfig / SE_StreamExecutorConfig
 #
-@dataclass
-class SE_StreamExecutorConfig(TpuType, use_name='TpuStreamExecutorConfig'):
-  inst: ClassVar = None
-  ordinal: int32_t = -1
-  @classmethod
-  def Default(cls):
-    if cls.inst is None:
-      cls.inst = SE_StreamExecutorConfig(ordinal=0)
-    return cls.inst
+# Native too; the platform only reads the ordinal.
 
-
-# SE_StreamExecutorConfig* TpuStreamExecutorConfig_Default();
-def TpuStreamExecutorConfig_Default() -> SE_StreamExecutorConfig:
-  return SE_StreamExecutorConfig()
-# void TpuStreamExecutorConfig_SetOrdinal(SE_StreamExecutorConfig*, int ordinal);
-def TpuStreamExecutorConfig_SetOrdinal(self: SE_StreamExecutorConfig, ordinal: int32_t):
-  print('TpuStreamExecutorConfig_SetOrdinal', ordinal)
-  self.ordinal = ordinal
-# void TpuStreamExecutorConfig_Free(SE_StreamExecutorConfig*);
-def TpuStreamExecutorConfig_Free(self: SE_StreamExecutorConfig):
-  return delete(self)
+@struct
+class SE_StreamExecutorConfig:
+  ordinal: int_t
 
 #
 # Tpu_Compiler
@@ -524,14 +816,8 @@ def TpuCompiler_Free(compiler: Tpu_Compiler): return delete(compiler)
 #
 # TpuDeviceDescription / SE_DeviceDescription
 #
+# Allocated natively (tpu_status.c), strings and all; this is a view.
 class SE_DeviceDescription(ctypes.Structure):
-    def __init__(self, *args, **kws):
-      super().__init__(*args, **kws)
-      print('SE_DeviceDescription_ctor', *args, kws)
-      for name, ctype in self._fields_:
-        if ctype == cstr_t:
-          setattr(self, name, ctype(b""))
-
     _fields_ = [
       #   char* device_vendor;
       ('device_vendor', cstr_t),
@@ -605,12 +891,6 @@ class SE_DeviceDescription(ctypes.Structure):
     ]
 
 
-# SE_DeviceDescription* TpuDeviceDescription_New();
-def TpuDeviceDescription_New() -> SE_DeviceDescription: return SE_DeviceDescription()
-# void TpuDeviceDescription_Free(SE_DeviceDescription* description);
-def TpuDeviceDescription_Free(description: SE_DeviceDescription): return delete(description)
-
-
 # typedef struct SE_DeviceMemoryBase {
 #   void* opaque;
 #   uint64_t size;
@@ -630,6 +910,8 @@ SE_DeviceMemoryBase_p = ctypes.POINTER(SE_DeviceMemoryBase)
 #
 @dataclass
 class SE_StreamExecutor(TpuType, use_name='TpuExecutor'):
+  ordinal: int = 0
+  core: SE_TpuTopology_Core = None
   # void TpuExecutor_CreateDeviceDescription(SE_StreamExecutor* executor,
   #                                          SE_DeviceDescription* description,
   #                                          TF_Status* status);
@@ -653,38 +935,18 @@ class SE_StreamExecutor(TpuType, use_name='TpuExecutor'):
   #   mem = SE_DeviceMemoryBase(opaque=p, size=size, payload=size)
   #   brk()
   #   return mem
-  # bool TpuExecutor_Allocate(SE_StreamExecutor* executor,
-  #                           uint64_t size, int64_t memory_space, SE_DeviceMemoryBase* result);
-  def Allocate(self: SE_StreamExecutor,
-               size: uint64_t, memory_space: int64_t, result: SE_DeviceMemoryBase_p) -> bool:
-    print('Allocate', dict(size=size, memory_space=memory_space))
-    p = malloc(size)
-    if p:
-      result.contents.opaque = p
-      result.contents.size = size
-      result.contents.payload = size
-      return True
-    else:
-      panic('Allocation failed', size, memory_space)
-      result.contents.opaque = void_p(None)
-      result.contents.size = 0
-      result.contents.payload = 0
-      return False
-  # void TpuExecutor_Deallocate(SE_StreamExecutor* executor,
-  #                             SE_DeviceMemoryBase* memory);
-  # bool TpuExecutor_GetAllocatorStats(SE_StreamExecutor* executor,
-  #                                    SE_AllocatorStats* stats);
-  # bool TpuExecutor_DeviceMemoryUsage(SE_StreamExecutor* executor, int64_t* free,
-  #                                    int64_t* total);
+  #
+  # TpuExecutor_Allocate, _Deallocate, _GetAllocatorStats and
+  # _DeviceMemoryUsage are native (tpu_device.c); GetExecutor binds each
+  # executor to its device memory with libtpujesus.bind_executor.
+  #
+  # The stream functions below are native (tpu_stream.c), and so are
+  # events, timers and CreateStreamDependency (tpu_event.c), the
+  # synchronous copies (tpu_memcpy.c) and infeed/outfeed (tpu_feed.c).
   #
   # bool TpuExecutor_AllocateStream(SE_StreamExecutor* executor, SE_Stream* stream);
-  def AllocateStream(self: SE_StreamExecutor, stream: SE_Stream) -> bool:
-    print('AllocateStream', self, stream)
-    return True
   # void TpuExecutor_DeallocateStream(SE_StreamExecutor* executor,
   #                                   SE_Stream* stream);
-  def DeallocateStream(self: SE_StreamExecutor, stream: SE_Stream):
-    print('DeallocateStream', self, stream)
   # bool TpuExecutor_CreateStreamDependency(SE_StreamExecutor* executor,
   #                                         SE_Stream* dependent, SE_Stream* other);
   # void TpuExecutor_GetStatus(SE_StreamExecutor* executor, SE_Stream* stream,
@@ -692,7 +954,7 @@ class SE_StreamExecutor(TpuType, use_name='TpuExecutor'):
   #
   # SE_TpuTopology_Core* TpuExecutor_GetCoreLocation(SE_StreamExecutor* executor);
   def GetCoreLocation(self: SE_StreamExecutor) -> SE_TpuTopology_Core:
-    return SE_TpuTopology_Core(id=0)
+    return self.core
   #
   # void TpuExecutor_AllocateEvent(SE_StreamExecutor* executor, SE_Event* event,
   #                                TF_Status* status);
@@ -744,16 +1006,10 @@ class SE_StreamExecutor(TpuType, use_name='TpuExecutor'):
   #
   # void TpuExecutor_BlockHostUntilDone(SE_StreamExecutor* executor,
   #                                     SE_Stream* stream, TF_Status* status);
-  def BlockHostUntilDone(self: SE_StreamExecutor,
-                         stream: SE_Stream, status: TF_Status):
-    print('BlockHostUntilDone', stream, status)
-    status.ok()
   # void TpuExecutor_BlockUntilDoneOrFailed(SE_StreamExecutor* executor,
   #                                         TF_Status* status);
   # void TpuExecutor_SyncAndForgetFailedStreams(SE_StreamExecutor* executor);
   # bool TpuExecutor_SynchronizeAllActivity(SE_StreamExecutor* executor);
-  def SynchronizeAllActivity(self: SE_StreamExecutor) -> bool:
-    return True
   #
   # void TpuExecutor_UnloadAllPrograms(SE_StreamExecutor* executor,
   #                                    TF_Status* status);
@@ -764,31 +1020,28 @@ class SE_StreamExecutor(TpuType, use_name='TpuExecutor'):
 #
 # TpuStream / SE_Stream
 #
-@dataclass
-class SE_Stream(TpuType, use_name='TpuStream'):
-  parent: SE_StreamExecutor
-  # SE_Stream* TpuStream_New(SE_StreamExecutor* parent);
-  @classmethod
-  def New(cls: SE_Stream, parent: SE_StreamExecutor) -> SE_Stream:
-    return cls(parent=parent)
-  # void TpuStream_Free(SE_Stream*);
-  def Free(self: SE_Stream):
-    return delete(self)
-  # void* TpuStream_Stream(SE_Stream*);
-  # bool TpuStream_Status(SE_Stream*);
-  # bool TpuStream_IsSameSharedMemoryLocation(SE_Stream*, SE_Stream*);
-  # void TpuStream_EnqueueTransferHostToDevice(SE_Stream* stream,
-  #                                            SE_DeviceMemoryBase device_dst,
-  #                                            void* host_src, uint64_t size,
-  #                                            TF_Status* status);
-  # void TpuStream_EnqueueTransferDeviceToHost(SE_Stream* stream,
-  #                                            SE_DeviceMemoryBase device_src,
-  #                                            void* host_dst, uint64_t size,
-  #                                            TF_Status* status);
-  # void TpuStream_TpuEnqueueOnDeviceSendRecvLocal(SE_Stream* stream,
-  #                                                SE_DeviceMemoryBase send_buffer,
-  #                                                SE_DeviceMemoryBase recv_buffer,
-  #                                                TF_Status* status);
+# Streams, and the executor functions that queue work on them or wait for
+# them, are native (tpu_stream.c). Python code gets the raw SE_Stream*;
+# use libtpujesus.stream_enqueue(stream.value, fn) to run fn on the
+# stream's worker in order with its other work.
+SE_Stream = ctypes.c_void_p
+# SE_Stream* TpuStream_New(SE_StreamExecutor* parent);
+# void TpuStream_Free(SE_Stream*);
+# void* TpuStream_Stream(SE_Stream*);
+# bool TpuStream_Status(SE_Stream*);
+# bool TpuStream_IsSameSharedMemoryLocation(SE_Stream*, SE_Stream*);
+# void TpuStream_EnqueueTransferHostToDevice(SE_Stream* stream,
+#                                            SE_DeviceMemoryBase device_dst,
+#                                            void* host_src, uint64_t size,
+#                                            TF_Status* status);
+# void TpuStream_EnqueueTransferDeviceToHost(SE_Stream* stream,
+#                                            SE_DeviceMemoryBase device_src,
+#                                            void* host_dst, uint64_t size,
+#                                            TF_Status* status);
+# void TpuStream_TpuEnqueueOnDeviceSendRecvLocal(SE_Stream* stream,
+#                                                SE_DeviceMemoryBase send_buffer,
+#                                                SE_DeviceMemoryBase recv_buffer,
+#                                                TF_Status* status);
 
 
 TPU_C_API_MAX_INLINED = 6
@@ -809,53 +1062,34 @@ TPU_C_API_MAX_INLINED_Int64List = int64_t * TPU_C_API_MAX_INLINED
 #   inlined: TPU_C_API_MAX_INLINED_Int64List
 Int64ListHeap = int64_t * TPU_C_API_MAX_INLINED
 
-class ListBase:
-  def view(self, ctype=int32_t):
-    if self.size > TPU_C_API_MAX_INLINED:
-      p = ctypes.cast(ctypes.addressof(self.u), ctypes.POINTER(ctypes.POINTER(ctype)))[0]
-    else:
-      p = ctypes.cast(ctypes.addressof(self.u), ctypes.POINTER(ctype))
-    return p[0:self.size]
+# Shape structs are deep-copied and freed natively (tpu_shape.c), with
+# the ownership rules of tensorflow's ApiConverter: lists longer than
+# TPU_C_API_MAX_INLINED own a heap array, tuple shapes own their
+# children. Set() overwrites without freeing, since output shapes arrive
+# uninitialized; Free() releases everything and zeroes the struct.
+
+def shape_set(self, other):
+  libtpujesus.shape_copy(type(self).__name__, ctypes.addressof(self), ctypes.addressof(other))
+  return self
+
+def shape_free(self):
+  libtpujesus.shape_free(type(self).__name__, ctypes.addressof(self))
+
+def list_items(self, ctype):
+  """The elements of an Int64List/BoolList/TileList, inline or on the heap."""
+  if self.size > TPU_C_API_MAX_INLINED:
+    return ctypes.cast(ctypes.addressof(self.u), ctypes.POINTER(ctypes.POINTER(ctype)))[0][:self.size]
+  return self.u[:self.size]
 
 
 @struct
 class Int64List:
   u: Int64ListHeap
   size: int64_t
-  # def __len__(self):
-  #   return self.size
-  # def __getitem__(self, i):
-  #   if not isinstance(i, int):
-  #     raise TypeError("Indices must be integers")
-  #   if not (0 <= i < self.size):
-  #     raise IndexError("Index out of range")
-  #   if self.size > TPU_C_API_MAX_INLINED:
-  #     return self.u.heap[i]
-  #   else:
-  #     return self.u.inlined[i]
-
-def Int64List_Free(self: Int64List):
-  if self.size > TPU_C_API_MAX_INLINED:
-    raise NotImplementedError
-    # self.u.ptr = free(self.u.ptr)
-    # free(ctypes.addressof(self.u))
-    # self.u = free(self.u)
-  self.size = 0
-
-Int64List.Free = Int64List_Free
-
-def Int64List_Set(self: Int64List, other: Int64List):
-  if other.size > TPU_C_API_MAX_INLINED:
-    raise NotImplementedError
-  for i in range(TPU_C_API_MAX_INLINED):
-    self.u[i] = 0
-  self.size = 0
-  for i in range(other.size):
-    self.u[i] = other.u[i]
-    self.size += 1
-  return self
 
-Int64List.Set = Int64List_Set
+Int64List.Free = shape_free
+Int64List.Set = shape_set
+Int64List.items = lambda self: list_items(self, int64_t)
 
 # struct BoolList {
 #   union {
@@ -864,12 +1098,6 @@ Int64List.Set = Int64List_Set
 #   };
 #   int64_t size;
 # };
-# TPU_C_API_MAX_INLINED_BoolList = bool_t * TPU_C_API_MAX_INLINED
-
-# @pyembc_union
-# class BoolListHeap:
-#   heap: int64_p
-#   inlined: TPU_C_API_MAX_INLINED_BoolList
 BoolListHeap = bool_t * TPU_C_API_MAX_INLINED
 
 @struct
@@ -877,28 +1105,9 @@ class BoolList:
   u: BoolListHeap
   size: int64_t
 
-def BoolList_Free(self: BoolList):
-  if self.size > TPU_C_API_MAX_INLINED:
-    raise NotImplementedError
-    # self.u.ptr = free(self.u.ptr)
-    # free(ctypes.addressof(self.u))
-    # self.u = free(self.u)
-  self.size = 0
-
-BoolList.Free = BoolList_Free
-
-def BoolList_Set(self: BoolList, other: BoolList):
-  if other.size > TPU_C_API_MAX_INLINED:
-    raise NotImplementedError
-  for i in range(TPU_C_API_MAX_INLINED):
-    self.u[i] = False
-  self.size = 0
-  for i in range(other.size):
-    self.u[i] = other.u[i]
-    self.size += 1
-  return self
-
-BoolList.Set = BoolList_Set
+BoolList.Free = shape_free
+BoolList.Set = shape_set
+BoolList.items = lambda self: list_items(self, bool_t)
 
 # typedef struct XLA_Tile {
 #   Int64List dimensions;
@@ -925,12 +1134,6 @@ XLA_Tile.Set = XLA_Tile_Set
 #   };
 #   int64_t size;
 # };
-# TPU_C_API_MAX_INLINED_TileList = XLA_Tile * TPU_C_API_MAX_INLINED
-
-# @pyembc_union
-# class TileListHeap:
-#   heap: int64_p
-#   inlined: TPU_C_API_MAX_INLINED_TileList
 TileListHeap = XLA_Tile * TPU_C_API_MAX_INLINED
 
 @struct
@@ -938,29 +1141,9 @@ class TileList:
   u: TileListHeap
   size: int64_t
 
-def TileList_Free(self: TileList):
-  for i in range(self.size):
-    self.u[i].Free()
-  if self.size > TPU_C_API_MAX_INLINED:
-    raise NotImplementedError
-  #   u, self.u = self.u, None
-  #   free(ctypes.addressof(u))
-  self.size = 0
-
-TileList.Free = TileList_Free
-
-def TileList_Set(self: TileList, other: TileList):
-  if other.size > TPU_C_API_MAX_INLINED:
-    raise NotImplementedError
-  for i in range(TPU_C_API_MAX_INLINED):
-    self.u[i].Set(XLA_Tile())
-  self.size = 0
-  for i in range(other.size):
-    self.u[i].Set(other.u[i])
-    self.size += 1
-  return self
-
-TileList.Set = TileList_Set
+TileList.Free = shape_free
+TileList.Set = shape_set
+TileList.items = lambda self: list_items(self, XLA_Tile)
 
 # typedef struct XLA_Layout {
 #   int format;
@@ -978,29 +1161,8 @@ class XLA_Layout:
   element_size_in_bits: int64_t
   memory_space: int64_t
 
-def XLA_Layout_Set(self: XLA_Layout, other: XLA_Layout):
-  self.format = other.format
-  self.minor_to_major.Set(other.minor_to_major)
-  self.tiles.Set(other.tiles)
-  self.element_size_in_bits = other.element_size_in_bits
-  self.memory_space = other.memory_space
-  return self
-
-XLA_Layout.Set = XLA_Layout_Set
-
-# void Free(XLA_Layout* c_layout) {
-def XLA_Layout_Free(self: XLA_Layout):
-  # if (c_layout->minor_to_major.size > TPU_C_API_MAX_INLINED) {
-  #   delete[] c_layout->minor_to_major.heap;
-  # }
-  self.minor_to_major.Free()
-  # if (c_layout->tiles.size > TPU_C_API_MAX_INLINED) {
-  #   delete[] c_layout->tiles.heap;
-  # }
-  self.tiles.Free()
-# }
-
-XLA_Layout.Free = XLA_Layout_Free
+XLA_Layout.Set = shape_set
+XLA_Layout.Free = shape_free
 
 # // Represents an XLA shape tree.
 # typedef struct XLA_Shape {
@@ -1012,8 +1174,6 @@ XLA_Layout.Free = XLA_Layout_Free
 #   XLA_Layout layout;
 # } XLA_Shape;
 
-#XLA_Shape_p = ctypes.POINTER(XLA_Shape)
-
 @struct
 class XLA_Shape:
   element_type: int_t
@@ -1023,52 +1183,23 @@ class XLA_Shape:
   ntuple_shapes: int_t
   layout: XLA_Layout
 
-def XLA_Shape_Set(self: XLA_Shape, other: XLA_Shape):
-  # brk()
-  # self.Free() # TODO: Figure out how not to leak
-  self.element_type = other.element_type
-  self.dimensions.Set(other.dimensions)
-  self.dynamic_dimensions.Set(other.dynamic_dimensions)
-  self.ntuple_shapes = other.ntuple_shapes
-  if self.ntuple_shapes > 0:
-    tuple_shapes_p = malloc(ctypes.sizeof(XLA_Shape) * self.ntuple_shapes)
-    self.tuple_shapes = ctypes.cast(tuple_shapes_p, XLA_Shape_p)
-    for i in range(self.ntuple_shapes):
-      self.tuple_shapes[i].Set(other.tuple_shapes[i])
-  self.layout.Set(other.layout)
-  return self
+XLA_Shape.Set = shape_set
+XLA_Shape.Free = shape_free
 
-XLA_Shape.Set = XLA_Shape_Set
+def shape_fingerprint(shape: XLA_Shape):
+  return libtpujesus.shape_fingerprint(ctypes.addressof(shape))
 
-# void Free(XLA_Shape* c_shape) {
-def XLA_Shape_Free(self: XLA_Shape):
-  #   if (c_shape->dimensions.size > TPU_C_API_MAX_INLINED) {
-  #     delete[] c_shape->dimensions.heap;
-  #   }
-  self.dimensions.Free()
-  #   if (c_shape->dynamic_dimensions.size > TPU_C_API_MAX_INLINED) {
-  #     delete[] c_shape->dynamic_dimensions.heap;
-  #   }
-  self.dynamic_dimensions.Free()
-  # if (c_shape->ntuple_shapes > 0) {
-  if self.ntuple_shapes > 0:
-    # for (int i = 0; i < c_shape->ntuple_shapes; ++i) {
-    #   Free(&c_shape->tuple_shapes[i]);
-    # }
-    n, self.ntuple_shapes = self.ntuple_shapes, 0
-    for i in range(n):
-      self.tuple_shapes[i].Free()
-    # delete[] c_shape->tuple_shapes;
-    # free(self.tuple_shapes) # TODO: leak?
-  # }
-  # if (c_shape->layout.format != xla::INVALID_FORMAT) {
-  #   Free(&c_shape->layout);
-  # }
-  if self.layout.format != 0: # xla.INVALID_FORMAT
-    self.layout.Free()
-  # }
-
-XLA_Shape.Free = XLA_Shape_Free
+def cached_shape(kind, shape: XLA_Shape, out: XLA_Shape, compute):
+  """Fill `out` with compute(shape, out), going through the shape cache."""
+  if shape_cache.capacity <= 0:
+    return compute(shape, out)
+  fp = shape_fingerprint(shape)
+  # another thread's eviction would free `value` under us
+  with shape_cache.lock:
+    value = shape_cache.get(fp, kind)
+    if value is None:
+      value = shape_cache.put(fp, kind, compute(shape, XLA_Shape()))
+    return out.Set(value)
 
 
 XLA_Shape_p = ctypes.POINTER(XLA_Shape)
@@ -1122,7 +1253,7 @@ XLA_name2type = dict(
 XLA_type2name = {v: k for k, v in XLA_name2type.items()}
 XLA_name2size = dict(
   PRIMITIVE_TYPE_INVALID=-1,
-  PRED=-1,
+  PRED=1,
   S8=1,
   S16=2,
   S32=4,
@@ -1141,6 +1272,23 @@ XLA_name2size = dict(
   OPAQUE_TYPE=-1,
   TOKEN=-1)
 
+# Modes of shape_byte_size; see tpu_layout.c.
+SIZE_PADDED, SIZE_COMPACT, SIZE_COMPACT_RAW = 0, 1, 2
+
+def shape_byte_size(shape: XLA_Shape, mode=SIZE_PADDED):
+  total = libtpujesus.shape_size(ctypes.addressof(shape), mode)
+  if total < 0:
+    panic('Shape type not implemented', shape)
+  return total
+
+def device_layout(shape: XLA_Shape, out: XLA_Shape):
+  libtpujesus.device_shape(ctypes.addressof(out), ctypes.addressof(shape))
+  return out
+
+def compact_layout(shape: XLA_Shape, out: XLA_Shape):
+  libtpujesus.device_shape(ctypes.addressof(out), ctypes.addressof(shape), 1)
+  return out
+
 #
 # TpuTransferManager / XLA_TransferManager
 #
@@ -1160,7 +1308,7 @@ class XLA_TransferManager(NewFree, TpuType, use_name="TpuTransferManager"):
   def HostShapeToDeviceShape(self: XLA_TransferManager,
                              host_shape: XLA_Shape,
                              device_shape: XLA_Shape):
-    device_shape.Set(host_shape)
+    cached_shape('device_shape', host_shape, device_shape, device_layout)
   # void TpuTransferManager_TransferLiteralToDeviceAsync(
   #     XLA_TransferManager* manager, SE_Stream* stream, XLA_Literal* literal,
   #     XLA_ShapedBuffer* device_buffer, TF_Status* status);
@@ -1172,13 +1320,10 @@ class XLA_TransferManager(NewFree, TpuType, use_name="TpuTransferManager"):
   #                                                   XLA_Shape* shape);
   def GetByteSizeRequirement(self: XLA_TransferManager,
                              shape: XLA_Shape):
-    type = XLA_type2name[shape.element_type]
-    total = XLA_name2size[type]
-    if total < 0:
-      panic('Shape type not implemented', shape)
-    for i in range(shape.dimensions.size):
-      dim = shape.dimensions.u[i]
-      total *= dim
+    fp = shape_fingerprint(shape)
+    total = shape_cache.get(fp, 'bytes')
+    if total is None:
+      total = shape_cache.put(fp, 'bytes', shape_byte_size(shape))
     return total
 
   # void TpuTransferManager_ChooseCompactLayoutForShape(
@@ -1187,7 +1332,7 @@ class XLA_TransferManager(NewFree, TpuType, use_name="TpuTransferManager"):
   def ChooseCompactLayoutForShape(
           self: XLA_TransferManager, host_shape: XLA_Shape, output: XLA_Shape,
           status: TF_Status):
-    output.Set(host_shape)
+    cached_shape('compact_layout', host_shape, output, compact_layout)
     status.ok()
   # bool TpuTransferManager_CanShapedBufferBeAccessedNow(
   #     XLA_TransferManager* manager, SE_StreamExecutor* executor,
@@ -1199,6 +1344,15 @@ class XLA_TransferManager(NewFree, TpuType, use_name="TpuTransferManager"):
   #     XLA_TransferManager* manager, SE_Stream* stream,
   #     SE_DeviceMemoryBase* elements, size_t elements_len, XLA_Shape* shape,
   #     SE_DeviceMemoryBase* region, TF_Status* status);
+  def WriteSingleTupleIndexTable(self: XLA_TransferManager, stream: SE_Stream,
+                                 elements: SE_DeviceMemoryBase_p, elements_len: int,
+                                 shape: XLA_Shape, region: SE_DeviceMemoryBase,
+                                 status: TF_Status):
+    # a tuple buffer holds its elements' addresses, see interpreter.py
+    pointers = [elements[i].opaque or 0 for i in range(elements_len)]
+    if pointers and region.opaque:
+      libtpujesus.stream_enqueue(stream.value, partial(write_index_table, region.opaque, pointers))
+    status.ok()
   # void TpuTransferManager_GetInfeedLayout(XLA_Shape* shape,
   #                                         XLA_Shape* infeed_shape);
   # void TpuTransferManager_LinearizeToBuffers(
@@ -1206,6 +1360,10 @@ class XLA_TransferManager(NewFree, TpuType, use_name="TpuTransferManager"):
   #     int64_t** buffers_size, int64_t* buffers_array_size, TF_Status* status);
   # void TpuTransferManager_FreeBuffers(char** buffers_array, int64_t* buffers_size,
   #                                     int64_t buffers_array_size);
+  #
+  # TransferLiteralToInfeed, TransferBuffersToInfeed and
+  # TransferLiteralFromOutfeed are native (tpu_feed.c).
+  #
   # void TpuTransferManager_TransferLiteralToInfeed(XLA_TransferManager* manager,
   #                                                 SE_StreamExecutor* executor,
   #                                                 XLA_Literal* c_literal,
@@ -1258,17 +1416,10 @@ class TpuComputationPlacer(TpuType, wraps=XLA_ComputationPlacer):
                     computation_count: int,
                     assignment: int_out,
                     status: TF_Status):
-    print('AssignDevices', replica_count, computation_count)
-    i = 0
-    for replica in range(replica_count):
-      for computation in range(computation_count):
-        # v = assignment[replica*replica_count + computation]
-        # print(f'{replica},{computation} = {v}')
-        assignment[replica*replica_count + computation] = i
-        print(f'{replica},{computation} = {i}')
-        i += 1
-        i %= len(SE_Platform.get().devices)
-    status.ok()
+    trace('AssignDevices', replica_count, computation_count)
+    platform = SE_Platform.get()
+    place(platform.topology, platform.topology_host, False,
+          replica_count, computation_count, assignment, status)
   # void TpuComputationPlacer_AssignLocalDevices(SE_TpuTopology_Host* host,
   #                                              int replica_count,
   #                                              int computation_count,
@@ -1279,73 +1430,641 @@ class TpuComputationPlacer(TpuType, wraps=XLA_ComputationPlacer):
                          computation_count: int,
                          assignment: int_out,
                          status: TF_Status):
-    print('AssignLocalDevices', replica_count, computation_count)
-    i = 0
-    for replica in range(replica_count):
-      for computation in range(computation_count):
-        # v = assignment[replica*replica_count + computation]
-        # print(f'{replica},{computation} = {v}')
-        assignment[replica*replica_count + computation] = i
-        print(f'{replica},{computation} = {i}')
-        i += 1
-        i %= len(SE_Platform.get().devices)
-    status.ok()
+    trace('AssignLocalDevices', replica_count, computation_count)
+    place(SE_Platform.get().topology, self, True,
+          replica_count, computation_count, assignment, status)
 
+def place(topology, host, local, replica_count, computation_count, assignment, status):
+  try:
+    cores = placement.device_order(topology, option('placement', 'host'), host, local)
+    ids = placement.assign(cores, replica_count, computation_count)
+  except ValueError as e:
+    status.set(3, str(e))
+    return
+  (int_t * len(ids)).from_address(ctypes.addressof(assignment.contents))[:] = ids
+  status.ok()
 
 
-@libtpujesus.set_callback
-def api_callback(name, stack_pointer, arg0, *args):
-  result = 0
-  try:
-    global stack_ptr
-    global _argv
-    _argv = args
-    ptr = ctypes.cast(stack_pointer, stackptr_t)
-    stack_ptr = ptr
-    f = globals().get(name, None)
-    if not f:
-      #print(f"\nTPU API function not implemented: {name}{args!r}\n")
-      panic("TPU API function not implemented", name)
-    else:
-      sig = inspect.signature(f)
-      args = _argv[:len(sig.parameters)]
-      # print(f"TPU API function implemented! {name}{args!r}")
-      vals = tuple([argv(f, i) for i in range(len(sig.parameters))])
-      print(f"\nCALL: {name}")
-      for i, val in enumerate(vals):
-        print(f"\targ[{i}]={val!r}")
-      result = f(*vals)
-      print(f"-> {result!r}\n")
-      # print(f"TPU API function returning {result}: {name}{vals!r}")
-  except:
-    traceback.print_exc()
-    pdb.post_mortem(sys.exc_info()[2])
-    panic("Unhandled error")
-  if result is None:
-    result = 0
-  elif isinstance(result, (bool, int)):
-    result = int(result)
-  elif isinstance(result, list) and len(result) == 1 and is_cstruct(result[0]):
-    # result = ctypes.pointer(result[0])
-    # pin(result)
-    # result = ctypes.addressof(result)
-    # result = 0
-    result = pin(result[0])
-    result = 0
-    raise NotImplementedError
-  elif is_cstruct(result):
-    pin(result) # TODO: is this necessary?
-    result = ctypes.addressof(result)
-  elif isinstance(result, (Wrappable, tuple)) or is_dataclass_instance(result):
-    result = new(result)
-  elif is_cdata(result):
-    result = cvalue(result)
+#
+# TpuCompiler / TpuExecutable / TpuProgram
+#
+# Compiled programs run on the host: interpreter.py turns the HLO module
+# into NumPy calls, and running a program queues those on the stream, where
+# they read and write device memory in place. jaxlib's stream executor path
+# (TpuCompiler_*, TpuExecutable_ExecuteAsyncOnStream) and TF's
+# (TpuCompile_*, TpuExecutable_LoadProgramAndEnqueueToStream) share it.
+#
+
+# typedef struct TpuSerializedProto {
+#   const char* bytes;
+#   size_t size;
+# } TpuSerializedProto;
+@struct
+class TpuSerializedProto:
+  bytes: void_p
+  size: size_t
+
+def proto_bytes(proto: TpuSerializedProto):
+  return ctypes.string_at(proto.bytes, proto.size) if proto.bytes else b''
+
+def serialize_proto(proto: TpuSerializedProto, data):
+  """Point `proto` at a malloc'd copy of `data`, which the caller frees."""
+  p = libtpujesus.malloc(len(data))
+  ctypes.memmove(p, data, len(data))
+  proto.bytes = p
+  proto.size = len(data)
+
+# typedef struct TpuProgramFingerprint {
+#   const char* bytes;
+#   size_t size;
+# } TpuProgramFingerprint;
+@struct
+class TpuProgramFingerprint:
+  bytes: void_p
+  size: size_t
+
+@struct
+class XLA_ComputationLayout:
+  parameter_count: int_t
+  parameter_layouts: void_p
+  result_layout: XLA_Shape
+
+@struct
+class XLA_HloModuleConfig:
+  seed: uint64_t
+  launch_id: int32_t
+  replica_count: int64_t
+  num_partitions: int64_t
+  use_spmd_partitioning: bool_t
+  debug_options: TpuSerializedProto
+  has_static_device_assignment: bool_t
+  static_device_assignment: TpuSerializedProto
+  has_entry_computation_layout: bool_t
+  entry_computation_layout: XLA_ComputationLayout
+
+@struct
+class XLA_HloModule:
+  proto: TpuSerializedProto
+  module_config: XLA_HloModuleConfig
+
+@struct
+class XLA_HloModuleGroup:
+  proto: TpuSerializedProto
+  module_config: void_p
+
+@struct
+class SE_DeviceMemoryAllocator:
+  platform: void_p
+  ctx: void_p
+  allocate: void_p
+  deallocate: void_p
+
+# typedef void (*SE_AllocateFn)(void* ctx, int device_ordinal, uint64_t size,
+#                               bool retry_on_failure, int64_t memory_space,
+#                               SE_ScopedDeviceMemory* result, TF_Status* status);
+# typedef void (*SE_DeallocateFn)(void* ctx, SE_DeviceMemoryBase* base,
+#                                 int device_ordinal, TF_Status* status);
+# PYFUNCTYPE keeps the GIL held; the allocator calls back into TpuStatus_Set.
+SE_AllocateFn = ctypes.PYFUNCTYPE(None, void_p, int_t, uint64_t, bool_t, int64_t, void_p, ssize_t)
+SE_DeallocateFn = ctypes.PYFUNCTYPE(None, void_p, void_p, int_t, ssize_t)
+
+@struct
+class SE_ScopedDeviceMemory:
+  wrapped: SE_DeviceMemoryBase
+  device_ordinal: int_t
+
+@struct
+class SE_ExecutableRunOptions:
+  allocator: SE_DeviceMemoryAllocator
+  device_ordinal: int_t
+  stream_: void_p  # pyembc structs have a stream() method
+  host_to_device_stream: void_p
+  device_assignment: TpuSerializedProto
+  rng_seed: int_t
+  run_id: int64_t
+  launch_id: int_t
+
+@struct
+class SE_MaybeOwningDeviceMemory:
+  memory: SE_DeviceMemoryBase
+  owned: bool_t
+  device_ordinal: int_t
+  allocator: SE_DeviceMemoryAllocator
+
+@struct
+class XLA_MaybeOwningDeviceMemoryShapeTree:
+  shape: XLA_Shape
+  buffers: void_p
+
+@struct
+class XLA_ShapeIndex:
+  indices: int64_t * 8
+  count: int64_t
+
+@struct
+class SE_ExecutionInput:
+  shape_tree: XLA_MaybeOwningDeviceMemoryShapeTree
+  unowned_indices: void_p
+  unowned_indices_size: int_t
+  dynamic_shape: XLA_Shape
+
+@struct
+class XLA_ShapedBuffer:
+  on_device_shape: XLA_Shape
+  device_ordinal: int_t
+  bases: void_p
+  count: size_t
+
+@struct
+class SE_ExecutionOutput:
+  result: XLA_ShapedBuffer
+  to_be_released: void_p
+  to_be_released_size: int_t
+  aliased_indices: void_p
+  aliased_indices_size: int_t
+
+@struct
+class TpuExecutable_LoadProgramAndEnqueueToStream_Params:
+  struct_size: int32_t
+  priv: void_p
+  program: void_p
+  arguments: void_p
+  arguments_len: size_t
+  result: void_p
+  has_cross_program_prefetch_addr: bool_t
+  cross_program_prefetch_addr: void_p
+  rng_seed: int32_t
+  device_assignment: void_p
+  stream_: void_p  # pyembc structs have a stream() method
+  status: void_p
+
+size_out = ctypes.POINTER(size_t)
+
+def int64_list_set(self: Int64List, values):
+  self.size = len(values)
+  if len(values) > TPU_C_API_MAX_INLINED:
+    heap = libtpujesus.malloc(8 * len(values))
+    (int64_t * len(values)).from_address(heap)[:] = values
+    ctypes.cast(ctypes.addressof(self.u), ptr_p)[0] = heap
   else:
-    panic("Don't know how to return", result)
-  print(f"finally returning {result}: {name}{vals!r}")
-  return result,
+    self.u[:len(values)] = values
+
+def shape_from_proto(proto, out: XLA_Shape):
+  """Fill a zeroed XLA_Shape from an hlo.ShapeProto."""
+  out.element_type = proto.element_type
+  int64_list_set(out.dimensions, proto.dimensions)
+  if proto.layout is not None:
+    int64_list_set(out.layout.minor_to_major, proto.layout.minor_to_major)
+  n = len(proto.tuple_shapes)
+  if n:
+    size = ctypes.sizeof(XLA_Shape)
+    p = libtpujesus.malloc(n * size)
+    ctypes.memset(p, 0, n * size)
+    void_p.from_address(ctypes.addressof(out) + XLA_Shape.tuple_shapes.offset).value = p
+    out.ntuple_shapes = n
+    for i, sub in enumerate(proto.tuple_shapes):
+      shape_from_proto(sub, tuple_shape(out, i))
+  return out
+
+def tuple_shape(shape: XLA_Shape, i):
+  base = void_p.from_address(ctypes.addressof(shape) + XLA_Shape.tuple_shapes.offset).value
+  return XLA_Shape.from_address(base + i * ctypes.sizeof(XLA_Shape))
+
+def shape_preorder(shape: XLA_Shape):
+  yield shape
+  for i in range(shape.ntuple_shapes):
+    yield from shape_preorder(tuple_shape(shape, i))
+
+def configure_compile_cache():
+  """Open the on-disk compile cache named by the compile_cache option, if
+  any; compile_cache_bytes is its budget."""
+  path = option('compile_cache')
+  if not path:
+    return
+  try:
+    compile_cache.open(os.path.expanduser(path), int(option('compile_cache_bytes', compile_cache.budget)))
+  except OSError as e:
+    warn('libtpu: compile cache disabled:', e)
+    compile_cache.close()
+
+def topology_signature():
+  platform = SE_Platform.get()
+  t = platform and platform.topology
+  shape = f'{t.bounds}/{t.cores_per_chip}/{len(t.hosts)}' if t else ''
+  return f'{shape}/{libtpujesus.layout_policy()}'
+
+def module_config_options(config: XLA_HloModuleConfig):
+  return (f'{config.replica_count}/{config.num_partitions}/{bool(config.use_spmd_partitioning)}',
+          proto_bytes(config.debug_options))
+
+def compile_hlo(data, status, wrapper=None, module=None, options=()):
+  """An interpreter.Executable for serialized HLO, or None with `status`
+  set. Goes through the on-disk compile cache, keyed on `data`, `options`
+  (strings or bytes that change the program) and the topology."""
+  from . import hlo, interpreter, profiler, tpuprog
+  key = None
+  if compile_cache.enabled:
+    key = compilecache.key(data, getattr(wrapper, '__name__', 'HloModuleProto'), *options,
+                           topology_signature())
+    program = compile_cache.get(key, tpuprog.loads)
+    if program is not None:
+      return program
+  try:
+    if module is None:
+      module = hlo.parse_module(data, wrapper)
+    if module is None or not module.computations:
+      status.set(12, 'only HLO modules can be compiled')
+      return None
+    with profiler.span(module.name or 'compile', profiler.COMPILE):
+      program = interpreter.compile(module, data)
+  except interpreter.Unimplemented as e:
+    status.set(12, f'not supported by the interpreter: {e}')
+    return None
+  except (hlo.DecodeError, KeyError, StopIteration) as e:
+    status.set(3, f'malformed HLO module: {e!r}')
+    return None
+  if key is not None:
+    compile_cache.put(key, tpuprog.image(program))
+  return program
+
+def device_allocate(allocator: SE_DeviceMemoryAllocator, ordinal, size, status: TF_Status):
+  mem = SE_ScopedDeviceMemory()
+  SE_AllocateFn(allocator.allocate)(allocator.ctx, ordinal, size, False, 0,
+                                    ctypes.addressof(mem), ctypes.addressof(status))
+  return mem.wrapped
+
+def device_deallocate(allocator: SE_DeviceMemoryAllocator, ordinal, base: SE_DeviceMemoryBase):
+  status = TF_Status.New()
+  SE_DeallocateFn(allocator.deallocate)(allocator.ctx, ctypes.addressof(base), ordinal, ctypes.addressof(status))
+  status.Free()
+
+def write_index_table(addr, pointers):
+  (ctypes.c_uint64 * len(pointers)).from_address(addr)[:] = pointers
+
+# TFTPU_CAPI_EXPORT void TpuCompiler_RunHloPasses(
+#     Tpu_Compiler* compiler, XLA_HloModule* se_hlo_module,
+#     SE_StreamExecutor* stream_executor, SE_DeviceMemoryAllocator* allocator,
+#     XLA_HloModule* result, TF_Status* status);
+def TpuCompiler_RunHloPasses(compiler: Tpu_Compiler, module: XLA_HloModule,
+                             executor: SE_StreamExecutor, allocator: SE_DeviceMemoryAllocator,
+                             result: XLA_HloModule, status: TF_Status):
+  # the interpreter runs the module as given; only result.proto is read back
+  serialize_proto(result.proto, proto_bytes(module.proto))
+  status.ok()
+
+# TFTPU_CAPI_EXPORT void TpuCompiler_RunBackend(
+#     Tpu_Compiler* compiler, XLA_HloModule* se_hlo_module,
+#     SE_StreamExecutor* stream_executor, SE_DeviceMemoryAllocator* allocator,
+#     SE_Executable** result, TF_Status* status);
+def TpuCompiler_RunBackend(compiler: Tpu_Compiler, module: XLA_HloModule,
+                           executor: SE_StreamExecutor, allocator: SE_DeviceMemoryAllocator,
+                           result: ptr_out, status: TF_Status):
+  program = compile_hlo(proto_bytes(module.proto), status,
+                        options=module_config_options(module.module_config))
+  if program is not None:
+    result[0] = new(SE_Executable(program))
+    status.ok()
+
+# TFTPU_CAPI_EXPORT void TpuCompiler_Compile(
+#     Tpu_Compiler* compiler, XLA_HloModuleGroup* se_hlo_module_group,
+#     SE_StreamExecutorList* stream_exec_lists, int num_lists,
+#     SE_DeviceMemoryAllocator* allocator, SE_Executable** executables,
+#     TF_Status* status);
+def TpuCompiler_Compile(compiler: Tpu_Compiler, group: XLA_HloModuleGroup,
+                        stream_exec_lists: void_p, num_lists: int,
+                        allocator: SE_DeviceMemoryAllocator, executables: ptr_out,
+                        status: TF_Status):
+  from . import hlo
+  data = proto_bytes(group.proto)
+  try:
+    modules = hlo.HloModuleGroupProto.parse(data).hlo_modules
+  except hlo.DecodeError as e:
+    status.set(3, f'malformed HLO module group: {e}')
+    return
+  programs = [compile_hlo(data + b'%d' % i, status, module=m) for i, m in enumerate(modules)]
+  if None in programs:
+    return
+  for i, program in enumerate(programs):
+    executables[i] = new(SE_Executable(program))
+  status.ok()
+
+@dataclass
+class SE_Executable(TpuType, use_name='TpuExecutable'):
+  program: Any = None
+  fingerprint: Any = None
+
+  # TFTPU_CAPI_EXPORT void TpuExecutable_ExecuteAsyncOnStream(
+  #     SE_Executable* executable, SE_ExecutableRunOptions* se_options,
+  #     SE_ExecutionInput** se_arguments, int se_arguments_size,
+  #     SE_HloExecutionProfile* hlo_execution_profile,
+  #     SE_ExecutionOutput* se_output, TF_Status* status);
+  def ExecuteAsyncOnStream(self: SE_Executable, options: SE_ExecutableRunOptions,
+                           arguments: ptr_p, argument_count: int, profile: void_p,
+                           output: SE_ExecutionOutput, status: TF_Status):
+    from . import interpreter
+    program = self.program
+    args, released = [], []
+    for i, shape in enumerate(program.parameter_shapes[:argument_count]):
+      tree = SE_ExecutionInput.from_address(arguments[i]).shape_tree
+      n = sum(1 for _ in interpreter.subshapes(shape))
+      buffers = (SE_MaybeOwningDeviceMemory * n).from_address(tree.buffers)
+      args.append(interpreter.tree_from_preorder(shape, iter([b.memory.opaque or 0 for b in buffers])))
+      # donated inputs go back to the caller to free once the run is done
+      released += [b for b in buffers if b.owned]
+    result = output.result
+    host = shape_from_proto(program.result_shape, XLA_Shape())
+    device_layout(host, result.on_device_shape)
+    host.Free()
+    subshapes = list(shape_preorder(result.on_device_shape))
+    bases = (SE_DeviceMemoryBase * len(subshapes)).from_address(
+      libtpujesus.malloc(len(subshapes) * ctypes.sizeof(SE_DeviceMemoryBase)))
+    for i, shape in enumerate(subshapes):
+      bases[i] = device_allocate(options.allocator, options.device_ordinal, shape_byte_size(shape), status)
+      if status.code != 0:
+        for base in bases[:i]:
+          device_deallocate(options.allocator, options.device_ordinal, base)
+        libtpujesus.free(ctypes.addressof(bases))
+        result.on_device_shape.Free()
+        return
+    result.device_ordinal = options.device_ordinal
+    result.bases = ctypes.addressof(bases)
+    result.count = len(subshapes)
+    output.to_be_released = None
+    output.to_be_released_size = len(released)
+    if released:
+      size = ctypes.sizeof(SE_MaybeOwningDeviceMemory)
+      output.to_be_released = libtpujesus.malloc(len(released) * size)
+      for i, b in enumerate(released):
+        ctypes.memmove(output.to_be_released + i * size, ctypes.addressof(b), size)
+    output.aliased_indices = None
+    output.aliased_indices_size = 0
+    tree = interpreter.tree_from_preorder(program.result_shape, iter([b.opaque or 0 for b in bases]))
+    libtpujesus.stream_enqueue(options.stream_, partial(program.run, args, tree, options.device_ordinal))
+    status.ok()
+
+  # TFTPU_CAPI_EXPORT void TpuExecutable_Fingerprint(SE_Executable* executable,
+  #                                                  const char** fingerprint,
+  #                                                  size_t* size);
+  def Fingerprint(self: SE_Executable, fingerprint: ptr_out, size: size_out):
+    if self.fingerprint is None:
+      self.fingerprint = ctypes.create_string_buffer(self.program.fingerprint, len(self.program.fingerprint))
+    fingerprint[0] = ctypes.addressof(self.fingerprint)
+    size[0] = len(self.fingerprint)
+
+  # TpuExecutable_HloModule isn't implemented: programs keep the decoded
+  # module, not its serialized proto.
+  #
+  # TFTPU_CAPI_EXPORT void TpuExecutable_Free(SE_Executable*);
+  def Free(self: SE_Executable):
+    return delete(self)
+
+@dataclass
+class XLA_TpuProgram(TpuType, use_name='TpuProgram'):
+  program: Any = None
+
+  # TFTPU_CAPI_EXPORT XLA_TpuProgram* TpuProgram_New();
+  @classmethod
+  def New(cls) -> XLA_TpuProgram:
+    return cls()
+
+  # TFTPU_CAPI_EXPORT void TpuProgram_Free(XLA_TpuProgram* tpu_program);
+  def Free(self: XLA_TpuProgram):
+    return delete(self)
+
+  # TFTPU_CAPI_EXPORT XLA_TpuProgram** TpuProgram_NewArray(size_t count);
+  @classmethod
+  def NewArray(cls, count: int) -> int:
+    p = libtpujesus.malloc(count * 8)
+    ctypes.memset(p, 0, count * 8)
+    return p
+
+  # TFTPU_CAPI_EXPORT int64_t
+  # TpuProgram_GetProgramSize(const XLA_TpuProgram* tpu_program);
+  def GetProgramSize(self: XLA_TpuProgram) -> int:
+    from . import tpuprog
+    return len(tpuprog.image(self.program)) if self.program else 0
+
+  # TFTPU_CAPI_EXPORT void TpuProgram_LogProgramMemorySummary(
+  #     const XLA_TpuProgram* tpu_program);
+  def LogProgramMemorySummary(self: XLA_TpuProgram):
+    from . import tpuprog
+    if not self.program:
+      return
+    summary = tpuprog.summary(tpuprog.image(self.program))
+    sections = ' '.join(f'{tag}={size}' for tag, size in summary['sections'].items())
+    print(f"libtpu: program {summary['name']} {self.program.fingerprint[:16].decode()}: "
+          f"{summary['size']} bytes ({sections}), {summary['constants']} constants",
+          file=sys.stderr)
+
+  # TFTPU_CAPI_EXPORT void TpuProgram_SerializeTpuExecutable(
+  #     const XLA_TpuProgram* tpu_program, TpuExecutableSerializedProto* executable,
+  #     TF_Status* status);
+  def SerializeTpuExecutable(self: XLA_TpuProgram, executable: TpuSerializedProto, status: TF_Status):
+    from . import tpuprog
+    serialize_proto(executable, tpuprog.image(self.program))
+    status.ok()
+
+  # TFTPU_CAPI_EXPORT void TpuProgram_SerializeCompilerMetadata(
+  #     const XLA_TpuProgram* tpu_program,
+  #     CompilerMetadataSerializedProto* compiler_metadata, TF_Status* status);
+  def SerializeCompilerMetadata(self: XLA_TpuProgram, metadata: TpuSerializedProto, status: TF_Status):
+    from . import tpuprog
+    serialize_proto(metadata, tpuprog.dumps(self.program, metadata_only=True))
+    status.ok()
+
+  # TFTPU_CAPI_EXPORT void TpuProgram_DeserializeFromGetTpuProgramResponseProto(
+  #     TpuSerializedProto get_tpu_program_response, XLA_TpuProgram* tpu_program,
+  #     TF_Status* status);
+  def DeserializeFromGetTpuProgramResponseProto(response: TpuSerializedProto,
+                                                self: XLA_TpuProgram, status: TF_Status):
+    from . import interpreter, tpuprog
+    # one copy out of the caller's buffer; constants are used in place
+    try:
+      self.program = tpuprog.loads(tpuprog.copy_from(response.bytes or 0, response.size))
+    except (ValueError, KeyError, interpreter.Unimplemented) as e:
+      status.set(3, f'not a serialized TPU program: {e}')
+      return
+    status.ok()
+
+  # TFTPU_CAPI_EXPORT TpuProgramFingerprint
+  # TpuProgram_GetFingerprint(const XLA_TpuProgram* tpu_program);
+  def GetFingerprint(self: XLA_TpuProgram) -> TpuProgramFingerprint:
+    data = self.program.fingerprint if self.program else b''
+    p = libtpujesus.malloc(len(data) + 1)
+    ctypes.memmove(p, data + b'\0', len(data) + 1)
+    return TpuProgramFingerprint(p, len(data))
+
+def compile_programs(data, wrapper, tpu_programs, count, status):
+  program = compile_hlo(data, status, wrapper)
+  if program is None:
+    return
+  array = XLA_TpuProgram.NewArray(1)
+  (void_p * 1).from_address(array)[0] = new(XLA_TpuProgram(program))
+  tpu_programs[0] = array
+  count[0] = 1
+  status.ok()
+
+# TFTPU_CAPI_EXPORT void TpuConfigurationApi_RemoteCompilationCacheSizeInBytes(
+#     int64_t* cache_size_in_bytes);
+def TpuConfigurationApi_RemoteCompilationCacheSizeInBytes(cache_size_in_bytes: int64_p):
+  cache_size_in_bytes[0] = compile_cache.budget if compile_cache.enabled else 0
+
+# TFTPU_CAPI_EXPORT void TpuCompile_CompileAndBuild(
+#     TpuSerializedProto compilation_request, const XLA_TpuMeshState* mesh_state,
+#     XLA_TpuProgram** tpu_programs[], size_t* count, TF_Status* status);
+def TpuCompile_CompileAndBuild(request: TpuSerializedProto, mesh_state: void_p,
+                               tpu_programs: ptr_out, count: size_out, status: TF_Status):
+  # Only requests carrying an HloModuleProto; lowering TF functions or MLIR
+  # is out of reach without TensorFlow.
+  compile_programs(proto_bytes(request), None, tpu_programs, count, status)
+
+# TFTPU_CAPI_EXPORT void TpuCompile_XrtCompileAndBuild(
+#     TpuSerializedProto xrt_computation, const XLA_TpuMeshState* mesh_state,
+#     XLA_TpuProgram** tpu_programs[], size_t* count, TF_Status* status);
+def TpuCompile_XrtCompileAndBuild(computation: TpuSerializedProto, mesh_state: void_p,
+                                  tpu_programs: ptr_out, count: size_out, status: TF_Status):
+  from . import hlo
+  compile_programs(proto_bytes(computation), hlo.XLAComputation,
+                   tpu_programs, count, status)
+
+# TFTPU_CAPI_EXPORT void TpuExecutable_LoadProgramAndEnqueueToStream(
+#     TpuExecutable_LoadProgramAndEnqueueToStream_Params* params);
+def TpuExecutable_LoadProgramAndEnqueueToStream(params: TpuExecutable_LoadProgramAndEnqueueToStream_Params):
+  program = handle_table.lookup(params.program, XLA_TpuProgram).program
+  status = TF_Status.from_address(params.status)
+  args = (SE_DeviceMemoryBase * params.arguments_len).from_address(params.arguments) if params.arguments_len else []
+  roots = [a.opaque or 0 for a in args]
+  result = SE_DeviceMemoryBase.from_address(params.result).opaque or 0
+  # tuple buffers are found through their index tables once the run starts
+  device = libtpujesus.stream_device(params.stream_)
+  libtpujesus.stream_enqueue(params.stream_, partial(program.run_roots, roots, result, device))
+  status.ok()
+
+#
+# TpuProfiler
+#
+# One session at a time, recorded by tpu_profiler.c; see profiler.py.
+# CollectData hands back the session as a serialized XSpace.
+@dataclass
+class TpuProfiler(TpuType):
+  data: Any = None   # the serialized XSpace, between CollectData's two calls
+  running: bool = False
+
+  # TFTPU_CAPI_EXPORT void TpuProfiler_Create(TpuProfiler** tpu_profiler,
+  #                                           TF_Status* status);
+  def Create(tpu_profiler: ptr_out, status: TF_Status):
+    tpu_profiler[0] = new(TpuProfiler())
+    status.ok()
+
+  # TFTPU_CAPI_EXPORT void TpuProfiler_Destroy(TpuProfiler* tpu_profiler);
+  def Destroy(self: TpuProfiler):
+    if self.running:
+      libtpujesus.profiler_stop()
+    delete(self)
+
+  # TFTPU_CAPI_EXPORT void TpuProfiler_Start(TpuProfiler* tpu_profiler,
+  #                                          TF_Status* status);
+  def Start(self: TpuProfiler, status: TF_Status):
+    if not libtpujesus.profiler_start():
+      status.set(9, 'a profiling session is already running')
+      return
+    self.running = True
+    self.data = None
+    status.ok()
+
+  # TFTPU_CAPI_EXPORT void TpuProfiler_Stop(TpuProfiler* tpu_profiler,
+  #                                         TF_Status* status);
+  def Stop(self: TpuProfiler, status: TF_Status):
+    if self.running:
+      libtpujesus.profiler_stop()
+      self.running = False
+    status.ok()
+
+  # TFTPU_CAPI_EXPORT void TpuProfiler_CollectData(TpuProfiler* tpu_profiler,
+  #                                                TF_Status* status,
+  #                                                uint8_t* buffer,
+  #                                                size_t* size_in_bytes);
+  #
+  # Called twice: with no buffer to learn the size, then to fill it. A
+  # buffer too small for the data gets INVALID_ARGUMENT and the size it
+  # needs; the data is kept for a retry.
+  def CollectData(self: TpuProfiler, status: TF_Status, buffer: void_p, size_in_bytes: size_out):
+    from . import profiler
+    if self.data is None:
+      self.data = profiler.collect().serialize()
+    size = len(self.data)
+    if buffer is not None and size_in_bytes[0] < size:
+      message = f'CollectData needs a {size}-byte buffer, got {size_in_bytes[0]}'
+      size_in_bytes[0] = size
+      status.set(3, message)
+      return
+    size_in_bytes[0] = size
+    if buffer is not None:
+      ctypes.memmove(buffer, self.data, size)
+      self.data = None
+    status.ok()
+
+
+
+def api_callback(name):
+  """Resolve a libtpu symbol to the callable libtpujesus dispatches it to.
+
+  libtpujesus calls this once per symbol from set_callback(); returning
+  None marks the symbol as unimplemented. The dispatcher is built on the
+  symbol's first call, so symbols a process never uses cost nothing at
+  import."""
+  if not globals().get(name):
+    return None
+  d = None
+  # Exceptions propagate to libtpujesus, which prints them, counts them in
+  # stats()[name]['errors'] and returns 0 to the caller.
+  def call(*args):
+    nonlocal d
+    try:
+      if d is None:
+        d = dispatcher(name)
+      return d(*args)
+    except BaseException:
+      debug()
+      raise
+  def traced(*args):
+    # used by libtpujesus instead of call() at TRACE_ARGS and above
+    nonlocal d
+    try:
+      if d is None:
+        d = dispatcher(name)
+      vals = d.convert(args)
+      lines = [f"CALL: {name}"]
+      lines += [f"\targ[{i}]={val!r}" for i, val in enumerate(vals)]
+      libtpujesus.trace('\n'.join(lines))
+      result = d.f(*vals)
+      libtpujesus.trace(f"-> {result!r}")
+      return d.finish(args, result)
+    except BaseException:
+      debug()
+      raise
+  def debug():
+    # libtpu_debug / $LIBTPU_DEBUG: inspect the failure before it's reported
+    if option('debug'):
+      import traceback
+      traceback.print_exc()
+      pm(sys.exc_info()[2])
+  call.traced = traced
+  return call
+
+unimplemented = libtpujesus.set_callback(api_callback)
+
+if option('handle_report'):
+  atexit.register(handle_table.report_leaks)
+
+configure_compile_cache()
+if option('compile_cache_report'):
+  atexit.register(compile_cache.report)
+
+if option('profile'):
+  from . import profiler
+  profiler.trace_to(option('profile'))
 
 def configure_library_path():
   print('libtpu.configure_library_path()')
 
-sys.stdout = __saved_stdout__
@@ -0,0 +1,274 @@
+# Generated by genapi.py from tpu_api.h. Do not edit.
+#
+# name: (result kind, ((argument kind, argument name), ...), declaration)
+
+SIGNATURES = {
+  'ConfigureDistributedTpuOp_DoWork': ('void', (('u64', 'num_cores_per_host_size'), ('ptr', 'num_cores_per_host'), ('u64', 'server_address_size'), ('ptr', 'server_address'), ('ptr', 'host_config_output_size'), ('ptr', 'host_config_output'), ('ptr', 'status')),
+    'void ConfigureDistributedTpuOp_DoWork(const size_t num_cores_per_host_size, const int32_t* num_cores_per_host, size_t server_address_size, const char* server_address, size_t* host_config_output_size, char** host_config_output, TF_Status* status);'),
+  'WaitForDistributedTpuOp_DoWork': ('void', (('u64', 'num_hosts'), ('u64', 'num_cores_per_host'), ('ptr', 'host_ordinal_to_global_core_id_map'), ('ptr', 'tpu_mesh_common_state'), ('ptr', 'tpu_topology_output_size'), ('ptr', 'tpu_topology_output'), ('ptr', 'status')),
+    'void WaitForDistributedTpuOp_DoWork(const size_t num_hosts, const size_t num_cores_per_host, const int32_t** host_ordinal_to_global_core_id_map, TpuMeshCommonState* tpu_mesh_common_state, size_t* tpu_topology_output_size, char** tpu_topology_output, TF_Status* status);'),
+  'InitializeHostForDistributedTpuOp_DoWork': ('void', (('u64', 'tpu_host_config_size'), ('ptr', 'tpu_host_config'), ('bool', 'enable_whole_mesh_compilations'), ('bool', 'is_master_worker'), ('ptr', 'core_id_output_size'), ('ptr', 'core_id_output'), ('ptr', 'status')),
+    'void InitializeHostForDistributedTpuOp_DoWork(const size_t tpu_host_config_size, const char* tpu_host_config, const bool enable_whole_mesh_compilations, bool is_master_worker, size_t* core_id_output_size, int32_t** core_id_output, TF_Status* status);'),
+  'SetGlobalTPUArrayOp_DoWork': ('void', (('u64', 'tpu_topology_size'), ('ptr', 'tpu_topology'), ('ptr', 'status')),
+    'void SetGlobalTPUArrayOp_DoWork(const size_t tpu_topology_size, const char* tpu_topology, TF_Status* status);'),
+  'DisconnectDistributedTpuChipsOp_DoWork': ('void', (('ptr', 'number_of_chips_output'), ('ptr', 'status')),
+    'void DisconnectDistributedTpuChipsOp_DoWork(int32_t* number_of_chips_output, TF_Status* status);'),
+  'TpuConfigurationApi_FreeCharArray': ('void', (('ptr', 'output'),),
+    'void TpuConfigurationApi_FreeCharArray(char* output);'),
+  'TpuConfigurationApi_FreeInt32Array': ('void', (('ptr', 'output'),),
+    'void TpuConfigurationApi_FreeInt32Array(int32_t* output);'),
+  'TpuConfigurationApi_HasTPUPodState': ('bool', (),
+    'bool TpuConfigurationApi_HasTPUPodState();'),
+  'TpuConfigurationApi_TpusPerHost': ('void', (('ptr', 'tpus'), ('ptr', 'status')),
+    'void TpuConfigurationApi_TpusPerHost(int32_t* tpus, TF_Status* status);'),
+  'TpuConfigurationApi_TpuMemoryLimit': ('void', (('ptr', 'memory_limit'), ('ptr', 'status')),
+    'void TpuConfigurationApi_TpuMemoryLimit(int64_t* memory_limit, TF_Status* status);'),
+  'TpuConfigurationApi_RemoteCompilationCacheSizeInBytes': ('void', (('ptr', 'cache_size_in_bytes'),),
+    'void TpuConfigurationApi_RemoteCompilationCacheSizeInBytes(int64_t* cache_size_in_bytes);'),
+  'TpuConfigurationApi_CompilationCacheServerAddressFromConfig': ('void', (('u64', 'tpu_host_config_size'), ('ptr', 'tpu_host_config'), ('ptr', 'server_address_output_size'), ('ptr', 'server_address_output'), ('ptr', 'status')),
+    'void TpuConfigurationApi_CompilationCacheServerAddressFromConfig(size_t tpu_host_config_size, const char* tpu_host_config, size_t* server_address_output_size, char** server_address_output, TF_Status* status);'),
+  'TpuConfigurationApi_GetServerAddressAndPort': ('void', (('ptr', 'server_address_output_size'), ('ptr', 'server_address_output'), ('ptr', 'port_output'), ('ptr', 'status')),
+    'void TpuConfigurationApi_GetServerAddressAndPort(size_t* server_address_output_size, char** server_address_output, int* port_output, TF_Status* status);'),
+  'TpuMeshState_Create': ('ptr', (),
+    'XLA_TpuMeshState* TpuMeshState_Create();'),
+  'TpuMeshState_Free': ('void', (('ptr', 'mesh_state'),),
+    'void TpuMeshState_Free(XLA_TpuMeshState* mesh_state);'),
+  'TpuMeshState_MeshCommonState': ('ptr', (('ptr', 'mesh_state'),),
+    'void* TpuMeshState_MeshCommonState(XLA_TpuMeshState* mesh_state);'),
+  'TpuCompile_CompileAndBuild': ('void', (('TpuSerializedProto', 'compilation_request'), ('ptr', 'mesh_state'), ('ptr', 'tpu_programs'), ('ptr', 'count'), ('ptr', 'status')),
+    'void TpuCompile_CompileAndBuild(TpuSerializedProto compilation_request, const XLA_TpuMeshState* mesh_state, XLA_TpuProgram** tpu_programs[], size_t* count, TF_Status* status);'),
+  'TpuCompile_XrtCompileAndBuild': ('void', (('TpuSerializedProto', 'xrt_computation'), ('ptr', 'mesh_state'), ('ptr', 'tpu_programs'), ('ptr', 'count'), ('ptr', 'status')),
+    'void TpuCompile_XrtCompileAndBuild(TpuSerializedProto xrt_computation, const XLA_TpuMeshState* mesh_state, XLA_TpuProgram** tpu_programs[], size_t* count, TF_Status* status);'),
+  'TpuExecutable_LoadProgramAndEnqueueToStream': ('void', (('ptr', 'params'),),
+    'void TpuExecutable_LoadProgramAndEnqueueToStream(TpuExecutable_LoadProgramAndEnqueueToStream_Params* params);'),
+  'TpuExecute_RuntimeInputToPaddedData': ('void', (('ptr', 'runtime_input_ptr'), ('u64', 'runtime_input_size'), ('ptr', 'padded_data_ptr'), ('u64', 'padded_data_size'), ('ptr', 'runtime_shape'), ('ptr', 'compile_time_shape'), ('ptr', 'status')),
+    'void TpuExecute_RuntimeInputToPaddedData(uint32_t* runtime_input_ptr, size_t runtime_input_size, int8_t* padded_data_ptr, size_t padded_data_size, XLA_Shape* runtime_shape, XLA_Shape* compile_time_shape, TF_Status* status);'),
+  'TpuProgram_New': ('ptr', (),
+    'XLA_TpuProgram* TpuProgram_New();'),
+  'TpuProgram_Free': ('void', (('ptr', 'tpu_program'),),
+    'void TpuProgram_Free(XLA_TpuProgram* tpu_program);'),
+  'TpuProgram_NewArray': ('ptr', (('u64', 'count'),),
+    'XLA_TpuProgram** TpuProgram_NewArray(size_t count);'),
+  'TpuProgram_UnloadAndDestroy': ('void', (('ptr', 'program'), ('ptr', 'status')),
+    'void TpuProgram_UnloadAndDestroy(XLA_TpuProgram* program, TF_Status* status);'),
+  'TpuProgram_GetProgramSize': ('i64', (('ptr', 'tpu_program'),),
+    'int64_t TpuProgram_GetProgramSize(const XLA_TpuProgram* tpu_program);'),
+  'TpuProgram_LogProgramMemorySummary': ('void', (('ptr', 'tpu_program'),),
+    'void TpuProgram_LogProgramMemorySummary(const XLA_TpuProgram* tpu_program);'),
+  'TpuProgram_GetExecutableInfo': ('void', (('ptr', 'tpu_program'), ('ptr', 'executable_info'), ('ptr', 'status')),
+    'void TpuProgram_GetExecutableInfo(const XLA_TpuProgram* tpu_program, TpuSerializedProto* executable_info, TF_Status* status);'),
+  'TpuProgram_GetHostTransferInfo': ('void', (('ptr', 'tpu_program'), ('ptr', 'host_transfer_info'), ('ptr', 'status')),
+    'void TpuProgram_GetHostTransferInfo(const XLA_TpuProgram* tpu_program, TpuSerializedProto* host_transfer_info, TF_Status* status);'),
+  'TpuProgram_GetHloMetadata': ('void', (('ptr', 'tpu_program'), ('ptr', 'hlo_metadata'), ('ptr', 'status')),
+    'void TpuProgram_GetHloMetadata(const XLA_TpuProgram* tpu_program, TpuSerializedProto* hlo_metadata, TF_Status* status);'),
+  'TpuProgram_GetMayModifyVariables': ('void', (('ptr', 'tpu_program'), ('ptr', 'may_modify_variables')),
+    'void TpuProgram_GetMayModifyVariables(const XLA_TpuProgram* tpu_program, bool* may_modify_variables);'),
+  'TpuProgram_HasSharding': ('bool', (('ptr', 'tpu_program'),),
+    'bool TpuProgram_HasSharding(const XLA_TpuProgram* tpu_program);'),
+  'TpuProgram_GetTpuProgram': ('ptr', (('ptr', 'tpu_program'), ('i32', 'type')),
+    'XLA_TpuProgram* TpuProgram_GetTpuProgram(XLA_TpuProgram* tpu_program, TpuProgramShardingType type);'),
+  'TpuProgram_SerializeTpuExecutable': ('void', (('ptr', 'tpu_program'), ('ptr', 'executable'), ('ptr', 'status')),
+    'void TpuProgram_SerializeTpuExecutable(const XLA_TpuProgram* tpu_program, TpuExecutableSerializedProto* executable, TF_Status* status);'),
+  'TpuProgram_SerializeCompilerMetadata': ('void', (('ptr', 'tpu_program'), ('ptr', 'compiler_metadata'), ('ptr', 'status')),
+    'void TpuProgram_SerializeCompilerMetadata(const XLA_TpuProgram* tpu_program, CompilerMetadataSerializedProto* compiler_metadata, TF_Status* status);'),
+  'TpuProgram_DeserializeFromGetTpuProgramResponseProto': ('void', (('TpuSerializedProto', 'get_tpu_program_response'), ('ptr', 'tpu_program'), ('ptr', 'status')),
+    'void TpuProgram_DeserializeFromGetTpuProgramResponseProto(TpuSerializedProto get_tpu_program_response, XLA_TpuProgram* tpu_program, TF_Status* status);'),
+  'TpuProgram_GetFingerprint': ('TpuProgramFingerprint', (('ptr', 'tpu_program'),),
+    'TpuProgramFingerprint TpuProgram_GetFingerprint(const XLA_TpuProgram* tpu_program);'),
+  'TpuNodeContext_Create': ('ptr', (('i32', 'device_ordinal'), ('ptr', 'status')),
+    'XLA_TpuNodeContext* TpuNodeContext_Create(int device_ordinal, TF_Status* status);'),
+  'TpuNodeContext_Free': ('void', (('ptr', 'node_context'),),
+    'void TpuNodeContext_Free(XLA_TpuNodeContext* node_context);'),
+  'TpuNodeContext_Initialize': ('void', (('i32', 'device_ordinal'), ('ptr', 'status')),
+    'void TpuNodeContext_Initialize(int device_ordinal, TF_Status* status);'),
+  'TpuNodeContext_StopChipHeartbeats': ('void', (('ptr', 'status'),),
+    'void TpuNodeContext_StopChipHeartbeats(TF_Status* status);'),
+  'TpuNodeContext_CloseTpuHost': ('void', (('ptr', 'status'),),
+    'void TpuNodeContext_CloseTpuHost(TF_Status* status);'),
+  'TpuNodeContext_CompactionSupported': ('bool', (('i32', 'device_ordinal'),),
+    'bool TpuNodeContext_CompactionSupported(int device_ordinal);'),
+  'TpuTopology_AvailableCoreCount': ('i32', (('ptr', 'mesh_state'), ('i32', 'tpu_core_type')),
+    'int TpuTopology_AvailableCoreCount(const XLA_TpuMeshState* mesh_state, TpuCoreTypeEnum tpu_core_type);'),
+  'TpuNetUtil_RecycleUnusedPort': ('void', (('i32', 'port'),),
+    'void TpuNetUtil_RecycleUnusedPort(int port);'),
+  'TpuCompile_IsTpuCompilationEnabled': ('bool', (),
+    'bool TpuCompile_IsTpuCompilationEnabled();'),
+  'TpuCompile_ShouldTpuCompileOpIgnoreCancellation': ('bool', (),
+    'bool TpuCompile_ShouldTpuCompileOpIgnoreCancellation();'),
+  'TpuCompile_CreateGuaranteedConstFingerprint': ('u64', (('u64', 'fingerprint'), ('ptr', 'data'), ('u64', 'size')),
+    'uint64_t TpuCompile_CreateGuaranteedConstFingerprint(uint64_t fingerprint, const char* data, size_t size);'),
+  'TpuProfiler_Create': ('void', (('ptr', 'tpu_profiler'), ('ptr', 'status')),
+    'void TpuProfiler_Create(TpuProfiler** tpu_profiler, TF_Status* status);'),
+  'TpuProfiler_Destroy': ('void', (('ptr', 'tpu_profiler'),),
+    'void TpuProfiler_Destroy(TpuProfiler* tpu_profiler);'),
+  'TpuProfiler_Start': ('void', (('ptr', 'tpu_profiler'), ('ptr', 'status')),
+    'void TpuProfiler_Start(TpuProfiler* tpu_profiler, TF_Status* status);'),
+  'TpuProfiler_Stop': ('void', (('ptr', 'tpu_profiler'), ('ptr', 'status')),
+    'void TpuProfiler_Stop(TpuProfiler* tpu_profiler, TF_Status* status);'),
+  'TpuProfiler_CollectData': ('void', (('ptr', 'tpu_profiler'), ('ptr', 'status'), ('ptr', 'buffer'), ('ptr', 'size_in_bytes')),
+    'void TpuProfiler_CollectData(TpuProfiler* tpu_profiler, TF_Status* status, uint8_t* buffer, size_t* size_in_bytes);'),
+  'TfTpuOrdinalSelector_Create': ('void', (('ptr', 'ordinal_selector'), ('i32', 'num_cores_per_replica')),
+    'void TfTpuOrdinalSelector_Create(TfTpuOrdinalSelector** ordinal_selector, int num_cores_per_replica);'),
+  'TfTpuOrdinalSelector_Destroy': ('void', (('ptr', 'ordinal_selector'),),
+    'void TfTpuOrdinalSelector_Destroy(TfTpuOrdinalSelector* ordinal_selector);'),
+  'TfTpuOrdinalSelector_DequeueFromCoreSelector': ('void', (('ptr', 'ordinal_selector'), ('i32', 'device_ordinal'), ('i64', 'req_id')),
+    'void TfTpuOrdinalSelector_DequeueFromCoreSelector(TfTpuOrdinalSelector* ordinal_selector, int32_t device_ordinal, int64_t req_id);'),
+  'TfTpu_GetTpuPartitionedCallParams': ('void', (('ptr', 'params'),),
+    'void TfTpu_GetTpuPartitionedCallParams(TpuPartitionedCall_Params* params);'),
+  'TpuPlatform_New': ('ptr', (),
+    'SE_Platform* TpuPlatform_New();'),
+  'TpuPlatform_Free': ('void', (('ptr', 'platform'),),
+    'void TpuPlatform_Free(SE_Platform* platform);'),
+  'TpuPlatform_Initialize': ('void', (('ptr', 'platform'), ('u64', 'options_size'), ('ptr', 'options_key'), ('ptr', 'options_value'), ('ptr', 'status')),
+    'void TpuPlatform_Initialize(SE_Platform* platform, size_t options_size, const char** options_key, const char** options_value, TF_Status* status);'),
+  'TpuPlatform_Initialized': ('bool', (('ptr', 'platform'),),
+    'bool TpuPlatform_Initialized(SE_Platform* platform);'),
+  'TpuPlatform_GetExecutor': ('ptr', (('ptr', 'platform'), ('ptr', 'config'), ('ptr', 'status')),
+    'SE_StreamExecutor* TpuPlatform_GetExecutor(SE_Platform* platform, SE_StreamExecutorConfig* config, TF_Status* status);'),
+  'TpuPlatform_Id': ('SE_PlatformId', (('ptr', 'platform'),),
+    'SE_PlatformId TpuPlatform_Id(SE_Platform* platform);'),
+  'TpuPlatform_VisibleDeviceCount': ('i64', (('ptr', 'platform'),),
+    'int64_t TpuPlatform_VisibleDeviceCount(SE_Platform* platform);'),
+  'TpuPlatform_TpuMemoryLimit': ('i64', (('ptr', 'platform'),),
+    'int64_t TpuPlatform_TpuMemoryLimit(SE_Platform* platform);'),
+  'TpuPlatform_ShouldRegisterTpuDeviceToDeviceCopy': ('bool', (('ptr', 'platform'),),
+    'bool TpuPlatform_ShouldRegisterTpuDeviceToDeviceCopy(SE_Platform* platform);'),
+  'TpuPlatform_GetTopologyPtr': ('ptr', (('ptr', 'platform'),),
+    'SE_TpuTopology* TpuPlatform_GetTopologyPtr(SE_Platform* platform);'),
+  'TpuPlatform_GetHostLocation': ('ptr', (('ptr', 'platform'),),
+    'SE_TpuTopology_Host* TpuPlatform_GetHostLocation(SE_Platform* platform);'),
+  'TpuPlatform_GetRuntimeVersion': ('TpuRuntimeVersion', (('ptr', 'platform'),),
+    'TpuRuntimeVersion TpuPlatform_GetRuntimeVersion(SE_Platform* platform);'),
+  'TpuExecutor_Init': ('void', (('ptr', 'executor'), ('i32', 'device_ordinal'), ('ptr', 'device_options'), ('ptr', 'status')),
+    'void TpuExecutor_Init(SE_StreamExecutor* executor, int device_ordinal, SE_DeviceOptions* device_options, TF_Status* status);'),
+  'TpuExecutor_Free': ('void', (('ptr', 'executor'),),
+    'void TpuExecutor_Free(SE_StreamExecutor* executor);'),
+  'TpuExecutor_PlatformDeviceCount': ('i32', (('ptr', 'executor'),),
+    'int TpuExecutor_PlatformDeviceCount(SE_StreamExecutor* executor);'),
+  'TpuExecutor_GetCoreLocation': ('ptr', (('ptr', 'executor'),),
+    'SE_TpuTopology_Core* TpuExecutor_GetCoreLocation(SE_StreamExecutor* executor);'),
+  'TpuExecutor_UnloadAllPrograms': ('void', (('ptr', 'executor'), ('ptr', 'status')),
+    'void TpuExecutor_UnloadAllPrograms(SE_StreamExecutor* executor, TF_Status* status);'),
+  'TpuExecutor_EnqueueCompactionOnStreamForHbm': ('void', (('ptr', 'executor'), ('ptr', 'compaction_stream'), ('ptr', 'status')),
+    'void TpuExecutor_EnqueueCompactionOnStreamForHbm(SE_StreamExecutor* executor, SE_Stream* compaction_stream, TF_Status* status);'),
+  'TpuExecutor_CreateDeviceDescription': ('void', (('ptr', 'executor'), ('ptr', 'description'), ('ptr', 'status')),
+    'void TpuExecutor_CreateDeviceDescription(SE_StreamExecutor* executor, SE_DeviceDescription* description, TF_Status* status);'),
+  'TpuExecutor_NewDeviceOptions': ('ptr', (('u32', 'flags'),),
+    'SE_DeviceOptions* TpuExecutor_NewDeviceOptions(unsigned flags);'),
+  'TpuExecutor_FreeDeviceOptions': ('void', (('ptr', 'options'),),
+    'void TpuExecutor_FreeDeviceOptions(SE_DeviceOptions* options);'),
+  'TpuTransferManager_New': ('ptr', (),
+    'XLA_TransferManager* TpuTransferManager_New();'),
+  'TpuTransferManager_Free': ('void', (('ptr', 'manager'),),
+    'void TpuTransferManager_Free(XLA_TransferManager* manager);'),
+  'TpuTransferManager_PlatformId': ('SE_PlatformId', (('ptr', 'manager'),),
+    'SE_PlatformId TpuTransferManager_PlatformId(XLA_TransferManager* manager);'),
+  'TpuTransferManager_HostShapeToDeviceShape': ('void', (('ptr', 'manager'), ('ptr', 'host_shape'), ('ptr', 'device_shape')),
+    'void TpuTransferManager_HostShapeToDeviceShape(XLA_TransferManager* manager, XLA_Shape* host_shape, XLA_Shape* device_shape);'),
+  'TpuTransferManager_TransferLiteralToDeviceAsync': ('void', (('ptr', 'manager'), ('ptr', 'stream'), ('ptr', 'literal'), ('ptr', 'device_buffer'), ('ptr', 'status')),
+    'void TpuTransferManager_TransferLiteralToDeviceAsync(XLA_TransferManager* manager, SE_Stream* stream, XLA_Literal* literal, XLA_ShapedBuffer* device_buffer, TF_Status* status);'),
+  'TpuTransferManager_TransferLiteralFromDevice': ('void', (('ptr', 'manager'), ('ptr', 'stream'), ('ptr', 'device_buffer'), ('ptr', 'literal'), ('ptr', 'callback'), ('ptr', 'ctx')),
+    'void TpuTransferManager_TransferLiteralFromDevice(XLA_TransferManager* manager, SE_Stream* stream, XLA_ShapedBuffer* device_buffer, XLA_Literal* literal, XLA_StatusCallbackFn callback, void* ctx);'),
+  'TpuTransferManager_GetByteSizeRequirement': ('i64', (('ptr', 'manager'), ('ptr', 'shape')),
+    'int64_t TpuTransferManager_GetByteSizeRequirement(XLA_TransferManager* manager, XLA_Shape* shape);'),
+  'TpuTransferManager_ChooseCompactLayoutForShape': ('void', (('ptr', 'manager'), ('ptr', 'host_shape'), ('ptr', 'output'), ('ptr', 'status')),
+    'void TpuTransferManager_ChooseCompactLayoutForShape(XLA_TransferManager* manager, XLA_Shape* host_shape, XLA_Shape* output, TF_Status* status);'),
+  'TpuTransferManager_CanShapedBufferBeAccessedNow': ('bool', (('ptr', 'manager'), ('ptr', 'executor'), ('ptr', 'device_buffer')),
+    'bool TpuTransferManager_CanShapedBufferBeAccessedNow(XLA_TransferManager* manager, SE_StreamExecutor* executor, XLA_ShapedBuffer* device_buffer);'),
+  'TpuTransferManager_CanBufferBeAccessedNow': ('bool', (('ptr', 'manager'), ('ptr', 'executor'), ('ptr', 'device_buffer')),
+    'bool TpuTransferManager_CanBufferBeAccessedNow(XLA_TransferManager* manager, SE_StreamExecutor* executor, SE_DeviceMemoryBase* device_buffer);'),
+  'TpuTransferManager_WriteSingleTupleIndexTable': ('void', (('ptr', 'manager'), ('ptr', 'stream'), ('ptr', 'elements'), ('u64', 'elements_len'), ('ptr', 'shape'), ('ptr', 'region'), ('ptr', 'status')),
+    'void TpuTransferManager_WriteSingleTupleIndexTable(XLA_TransferManager* manager, SE_Stream* stream, SE_DeviceMemoryBase* elements, size_t elements_len, XLA_Shape* shape, SE_DeviceMemoryBase* region, TF_Status* status);'),
+  'TpuTransferManager_GetInfeedLayout': ('void', (('ptr', 'shape'), ('ptr', 'infeed_shape')),
+    'void TpuTransferManager_GetInfeedLayout(XLA_Shape* shape, XLA_Shape* infeed_shape);'),
+  'TpuTransferManager_LinearizeToBuffers': ('void', (('ptr', 'manager'), ('ptr', 'c_literal'), ('ptr', 'buffers_array'), ('ptr', 'buffers_size'), ('ptr', 'buffers_array_size'), ('ptr', 'status')),
+    'void TpuTransferManager_LinearizeToBuffers(XLA_TransferManager* manager, XLA_Literal* c_literal, char*** buffers_array, int64_t** buffers_size, int64_t* buffers_array_size, TF_Status* status);'),
+  'TpuTransferManager_FreeBuffers': ('void', (('ptr', 'buffers_array'), ('ptr', 'buffers_size'), ('i64', 'buffers_array_size')),
+    'void TpuTransferManager_FreeBuffers(char** buffers_array, int64_t* buffers_size, int64_t buffers_array_size);'),
+  'TpuTransferManager_ResetDevices': ('void', (('ptr', 'manager'), ('ptr', 'executors'), ('i64', 'num_executors'), ('ptr', 'status')),
+    'void TpuTransferManager_ResetDevices(XLA_TransferManager* manager, SE_StreamExecutor** executors, int64_t num_executors, TF_Status* status);'),
+  'TpuTransferManager_ReadDynamicShapes': ('void', (('ptr', 'stream'), ('ptr', 'buffer'), ('ptr', 'original_shape'), ('ptr', 'updated_shape'), ('ptr', 'status')),
+    'void TpuTransferManager_ReadDynamicShapes(SE_Stream* stream, XLA_ShapedBuffer* buffer, const XLA_Shape* original_shape, XLA_Shape* updated_shape, TF_Status* status);'),
+  'TpuComputationPlacer_New': ('ptr', (),
+    'XLA_ComputationPlacer* TpuComputationPlacer_New();'),
+  'TpuComputationPlacer_Free': ('void', (('ptr', 'placer'),),
+    'void TpuComputationPlacer_Free(XLA_ComputationPlacer* placer);'),
+  'TpuComputationPlacer_AssignDevices': ('void', (('ptr', 'placer'), ('i32', 'replica_count'), ('i32', 'computation_count'), ('ptr', 'assignment'), ('ptr', 'status')),
+    'void TpuComputationPlacer_AssignDevices(XLA_ComputationPlacer* placer, int replica_count, int computation_count, int* assignment, TF_Status* status);'),
+  'TpuComputationPlacer_AssignLocalDevices': ('void', (('ptr', 'host'), ('i32', 'replica_count'), ('i32', 'computation_count'), ('ptr', 'assignment'), ('ptr', 'status')),
+    'void TpuComputationPlacer_AssignLocalDevices(SE_TpuTopology_Host* host, int replica_count, int computation_count, int* assignment, TF_Status* status);'),
+  'TpuTopology_LogicalDevicesPerHost': ('i32', (('ptr', 'tpu_topology'), ('i32', 'tpu_core_type')),
+    'int TpuTopology_LogicalDevicesPerHost(SE_TpuTopology* tpu_topology, TpuCoreTypeEnum tpu_core_type);'),
+  'TpuTopology_LogicalDevicesPerChip': ('i32', (('ptr', 'tpu_topology'), ('i32', 'tpu_core_type')),
+    'int TpuTopology_LogicalDevicesPerChip(SE_TpuTopology* tpu_topology, TpuCoreTypeEnum tpu_core_type);'),
+  'TpuTopology_HostCount': ('i32', (('ptr', 'tpu_topology'),),
+    'int TpuTopology_HostCount(SE_TpuTopology* tpu_topology);'),
+  'TpuTopology_ChipsPerHost': ('i32', (('ptr', 'tpu_topology'),),
+    'int TpuTopology_ChipsPerHost(SE_TpuTopology* tpu_topology);'),
+  'TpuTopology_ChipBounds_X': ('i32', (('ptr', 'tpu_topology'),),
+    'int TpuTopology_ChipBounds_X(SE_TpuTopology* tpu_topology);'),
+  'TpuTopology_ChipBounds_Y': ('i32', (('ptr', 'tpu_topology'),),
+    'int TpuTopology_ChipBounds_Y(SE_TpuTopology* tpu_topology);'),
+  'TpuTopology_ChipBounds_Z': ('i32', (('ptr', 'tpu_topology'),),
+    'int TpuTopology_ChipBounds_Z(SE_TpuTopology* tpu_topology);'),
+  'TpuTopology_HasChip': ('bool', (('ptr', 'tpu_topology'), ('i32', 'x'), ('i32', 'y'), ('i32', 'z')),
+    'bool TpuTopology_HasChip(SE_TpuTopology* tpu_topology, int x, int y, int z);'),
+  'TpuTopology_CoreForId': ('ptr', (('ptr', 'tpu_topology'), ('i32', 'tpu_core_type'), ('i32', 'id')),
+    'SE_TpuTopology_Core* TpuTopology_CoreForId(SE_TpuTopology* tpu_topology, TpuCoreTypeEnum tpu_core_type, int id);'),
+  'TpuTopology_Core': ('ptr', (('ptr', 'tpu_topology'), ('i32', 'tpu_core_type'), ('i32', 'x'), ('i32', 'y'), ('i32', 'z'), ('i32', 'index')),
+    'SE_TpuTopology_Core* TpuTopology_Core(SE_TpuTopology* tpu_topology, TpuCoreTypeEnum tpu_core_type, int x, int y, int z, int index);'),
+  'TpuTopology_NumCores': ('i32', (('ptr', 'tpu_topology'), ('i32', 'tpu_core_type')),
+    'int TpuTopology_NumCores(SE_TpuTopology* tpu_topology, TpuCoreTypeEnum tpu_core_type);'),
+  'TpuTopology_Cores': ('void', (('ptr', 'tpu_topology'), ('i32', 'tpu_core_type'), ('ptr', 'cores')),
+    'void TpuTopology_Cores(SE_TpuTopology* tpu_topology, TpuCoreTypeEnum tpu_core_type, SE_TpuTopology_Core** cores);'),
+  'TpuTopology_IdForHost': ('i32', (('ptr', 'tpu_topology'), ('i32', 'x'), ('i32', 'y'), ('i32', 'z')),
+    'int TpuTopology_IdForHost(SE_TpuTopology* tpu_topology, int x, int y, int z);'),
+  'TpuTopology_Version': ('i32', (('ptr', 'tpu_topology'),),
+    'TpuVersionEnum TpuTopology_Version(SE_TpuTopology* tpu_topology);'),
+  'TpuCoreLocation_ChipCoordinates': ('void', (('ptr', 'tpu_core_location'), ('ptr', 'x'), ('ptr', 'y'), ('ptr', 'z')),
+    'void TpuCoreLocation_ChipCoordinates(SE_TpuTopology_Core* tpu_core_location, int* x, int* y, int* z);'),
+  'TpuCoreLocation_HostCoordinates': ('void', (('ptr', 'tpu_core_location'), ('ptr', 'x'), ('ptr', 'y'), ('ptr', 'z')),
+    'void TpuCoreLocation_HostCoordinates(SE_TpuTopology_Core* tpu_core_location, int* x, int* y, int* z);'),
+  'TpuCoreLocation_Index': ('i32', (('ptr', 'tpu_core_location'),),
+    'int TpuCoreLocation_Index(SE_TpuTopology_Core* tpu_core_location);'),
+  'TpuCoreLocation_Id': ('i32', (('ptr', 'tpu_core_location'),),
+    'int TpuCoreLocation_Id(SE_TpuTopology_Core* tpu_core_location);'),
+  'TpuHostLocation_Id': ('i32', (('ptr', 'tpu_host_location'),),
+    'int TpuHostLocation_Id(SE_TpuTopology_Host* tpu_host_location);'),
+  'TpuHostLocation_NumCores': ('i32', (('ptr', 'tpu_host_location'), ('i32', 'tpu_core_type')),
+    'int TpuHostLocation_NumCores(SE_TpuTopology_Host* tpu_host_location, TpuCoreTypeEnum tpu_core_type);'),
+  'TpuHostLocation_Cores': ('void', (('ptr', 'tpu_host_location'), ('i32', 'tpu_core_type'), ('ptr', 'cores')),
+    'void TpuHostLocation_Cores(SE_TpuTopology_Host* tpu_host_location, TpuCoreTypeEnum tpu_core_type, SE_TpuTopology_Core** cores);'),
+  'TpuCompiler_New': ('ptr', (),
+    'Tpu_Compiler* TpuCompiler_New();'),
+  'TpuCompiler_Free': ('void', (('ptr', 'compiler'),),
+    'void TpuCompiler_Free(Tpu_Compiler* compiler);'),
+  'TpuCompiler_RunHloPasses': ('void', (('ptr', 'compiler'), ('ptr', 'se_hlo_module'), ('ptr', 'stream_executor'), ('ptr', 'allocator'), ('ptr', 'result'), ('ptr', 'status')),
+    'void TpuCompiler_RunHloPasses(Tpu_Compiler* compiler, XLA_HloModule* se_hlo_module, SE_StreamExecutor* stream_executor, SE_DeviceMemoryAllocator* allocator, XLA_HloModule* result, TF_Status* status);'),
+  'TpuCompiler_RunBackend': ('void', (('ptr', 'compiler'), ('ptr', 'se_hlo_module'), ('ptr', 'stream_executor'), ('ptr', 'allocator'), ('ptr', 'result'), ('ptr', 'status')),
+    'void TpuCompiler_RunBackend(Tpu_Compiler* compiler, XLA_HloModule* se_hlo_module, SE_StreamExecutor* stream_executor, SE_DeviceMemoryAllocator* allocator, SE_Executable** result, TF_Status* status);'),
+  'TpuCompiler_Compile': ('void', (('ptr', 'compiler'), ('ptr', 'se_hlo_module_group'), ('ptr', 'stream_exec_lists'), ('i32', 'num_lists'), ('ptr', 'allocator'), ('ptr', 'executables'), ('ptr', 'status')),
+    'void TpuCompiler_Compile(Tpu_Compiler* compiler, XLA_HloModuleGroup* se_hlo_module_group, SE_StreamExecutorList* stream_exec_lists, int num_lists, SE_DeviceMemoryAllocator* allocator, SE_Executable** executables, TF_Status* status);'),
+  'TpuExecutable_ExecuteAsyncOnStream': ('void', (('ptr', 'executable'), ('ptr', 'se_options'), ('ptr', 'se_arguments'), ('i32', 'se_arguments_size'), ('ptr', 'hlo_execution_profile'), ('ptr', 'se_output'), ('ptr', 'status')),
+    'void TpuExecutable_ExecuteAsyncOnStream(SE_Executable* executable, SE_ExecutableRunOptions* se_options, SE_ExecutionInput** se_arguments, int se_arguments_size, SE_HloExecutionProfile* hlo_execution_profile, SE_ExecutionOutput* se_output, TF_Status* status);'),
+  'TpuExecutable_Fingerprint': ('void', (('ptr', 'executable'), ('ptr', 'fingerprint'), ('ptr', 'size')),
+    'void TpuExecutable_Fingerprint(SE_Executable* executable, const char** fingerprint, size_t* size);'),
+  'TpuExecutable_Serialize': ('void', (('ptr', 'executable'), ('ptr', 'serialization_handle'), ('ptr', 'status')),
+    'void TpuExecutable_Serialize(SE_Executable* executable, SE_ExecutableSerializationHandle** serialization_handle, TF_Status* status);'),
+  'TpuExecutableSerialize_GetByteSize': ('i32', (('ptr', 'serialization_handle'),),
+    'int TpuExecutableSerialize_GetByteSize(SE_ExecutableSerializationHandle* serialization_handle);'),
+  'TpuExecutableSerialize_WriteToArray': ('void', (('ptr', 'serialization_handle'), ('i32', 'serialized_size'), ('ptr', 'serialized'), ('ptr', 'status')),
+    'void TpuExecutableSerialize_WriteToArray(SE_ExecutableSerializationHandle* serialization_handle, int serialized_size, uint8_t* serialized, TF_Status* status);'),
+  'TpuExecutableSerialize_FreeHandle': ('void', (('ptr', 'serialization_handle'),),
+    'void TpuExecutableSerialize_FreeHandle(SE_ExecutableSerializationHandle* serialization_handle);'),
+  'TpuExecutable_Deserialize': ('void', (('i32', 'serialized_size'), ('ptr', 'serialized'), ('ptr', 'executable'), ('ptr', 'status')),
+    'void TpuExecutable_Deserialize(int serialized_size, const uint8_t* serialized, SE_Executable** executable, TF_Status* status);'),
+  'TpuExecutable_HloModule': ('XLA_HloModule', (('ptr', 'executable'),),
+    'XLA_HloModule TpuExecutable_HloModule(SE_Executable* executable);'),
+  'TpuExecutable_Free': ('void', (('ptr', 'arg0'),),
+    'void TpuExecutable_Free(SE_Executable*);'),
+  'XlaShapeToTpuShapeRepresentation': ('void', (('ptr', 'serialized_xla_shape'), ('i32', 'data_type'), ('bool', 'use_fast_memory'), ('ptr', 'serialized_tensor_shape'), ('ptr', 'status')),
+    'void XlaShapeToTpuShapeRepresentation(XLA_Shape* serialized_xla_shape, int data_type, bool use_fast_memory, XLA_Shape* serialized_tensor_shape, TF_Status* status);'),
+  'XlaShapeToTpuPaddedShape': ('void', (('ptr', 'serialized_xla_shape'), ('ptr', 'padded_shape'), ('ptr', 'status')),
+    'void XlaShapeToTpuPaddedShape(XLA_Shape* serialized_xla_shape, XLA_Shape* padded_shape, TF_Status* status);'),
+}
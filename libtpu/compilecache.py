@@ -0,0 +1,196 @@
+"""Persistent on-disk cache of compiled programs.
+
+Entries are program images (tpuprog.py), so a warm restart maps the file
+and decodes only the op table; constants are paged in from the cache file
+as they're used, and only the cheap lowering step is redone.
+
+Entries are files in one directory:
+
+    <dir>/<key>.tpuprog
+
+keyed by key(), a sha256 of the serialized HLO, the compile options and
+the topology. A file is written under a temporary name and renamed into
+place, so readers never see half an entry and racing writers of the same
+key just replace each other's identical bytes. Entries are read through
+mmap.
+
+The directory is kept under `budget` bytes: after each write the least
+recently used entries go first, by mtime, which a hit refreshes. Other
+processes may share the directory, so the size is re-read from disk
+before evicting.
+
+    cache.open('/path', budget=1 << 30)
+    cache.get(key, load)             -> load(mmap of the entry), or None
+    cache.put(key, data)
+
+libtpu opens it at startup when the libtpu_compile_cache option or
+$LIBTPU_COMPILE_CACHE names a directory; $LIBTPU_COMPILE_CACHE_BYTES sets
+the budget (default 1 GiB) and $LIBTPU_COMPILE_CACHE_REPORT prints the
+counters at exit.
+"""
+import mmap
+import os
+import sys
+import threading
+import time
+
+# Bump to turn every existing entry into a miss.
+SALT = b'libtpu compile cache 2'
+SUFFIX = '.tpuprog'
+
+
+def key(*parts):
+  """Content key over `parts` (bytes or str); each is length-prefixed so
+  concatenations can't collide."""
+  import hashlib
+  h = hashlib.sha256(SALT)
+  for part in parts:
+    if isinstance(part, str):
+      part = part.encode()
+    h.update(len(part).to_bytes(8, 'little'))
+    h.update(part)
+  return h.hexdigest()
+
+
+class CompileCache:
+  __slots__ = ('path', 'budget', 'entries', 'total',
+               'hits', 'misses', 'writes', 'evictions', 'errors', 'lock')
+
+  def __init__(self):
+    self.path = None
+    self.budget = 1 << 30
+    self.entries = {}  # key -> [size, mtime_ns]
+    self.total = 0
+    self.hits = 0
+    self.misses = 0
+    self.writes = 0
+    self.evictions = 0
+    self.errors = 0
+    # guards the bookkeeping; files are safe to race on by construction
+    self.lock = threading.RLock()
+
+  @property
+  def enabled(self):
+    return self.path is not None and self.budget > 0
+
+  def open(self, path, budget=None):
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    with self.lock:
+      self.path = path
+      if budget is not None:
+        self.budget = budget
+      self.scan()
+      self.trim()
+
+  def close(self):
+    with self.lock:
+      self.path = None
+      self.entries = {}
+      self.total = 0
+
+  def file(self, key):
+    return os.path.join(self.path, key + SUFFIX)
+
+  def scan(self):
+    entries = {}
+    with os.scandir(self.path) as it:
+      for entry in it:
+        if entry.name.endswith(SUFFIX):
+          try:
+            st = entry.stat()
+          except FileNotFoundError:
+            continue
+          entries[entry.name[:-len(SUFFIX)]] = [st.st_size, st.st_mtime_ns]
+    with self.lock:
+      self.entries = entries
+      self.total = sum(size for size, _ in entries.values())
+
+  def get(self, key, load):
+    """load(a read-only mmap of the entry), or None on a miss. The mmap
+    stays open for as long as the value refers to it."""
+    if not self.enabled:
+      return None
+    path = self.file(key)
+    try:
+      with open(path, 'rb') as f:
+        value = load(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+      os.utime(path)
+    except FileNotFoundError:
+      with self.lock:
+        self.entries.pop(key, None)
+        self.misses += 1
+      return None
+    except Exception:
+      # an older format, or not a program at all: drop it
+      with self.lock:
+        self.errors += 1
+        self.misses += 1
+        self.remove(key)
+      return None
+    with self.lock:
+      self.hits += 1
+      entry = self.entries.get(key)
+      if entry is not None:
+        entry[1] = time.time_ns()
+    return value
+
+  def put(self, key, data):
+    if not self.enabled or len(data) > self.budget:
+      return
+    import tempfile
+    path = self.file(key)
+    fd, tmp = tempfile.mkstemp(dir=self.path, prefix='.', suffix='.tmp')
+    try:
+      with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+      os.replace(tmp, path)
+    except OSError:
+      self.errors += 1
+      try:
+        os.unlink(tmp)
+      except OSError:
+        pass
+      return
+    with self.lock:
+      old = self.entries.get(key)
+      self.total += len(data) - (old[0] if old else 0)
+      self.entries[key] = [len(data), time.time_ns()]
+      self.writes += 1
+      self.trim()
+
+  def remove(self, key):
+    with self.lock:
+      size, _ = self.entries.pop(key, (0, 0))
+      self.total -= size
+    try:
+      os.unlink(self.file(key))
+    except OSError:
+      pass
+
+  def trim(self):
+    with self.lock:
+      if self.total <= self.budget:
+        return
+      self.scan()
+      for key, _ in sorted(self.entries.items(), key=lambda item: item[1][1]):
+        if self.total <= self.budget:
+          break
+        self.remove(key)
+        self.evictions += 1
+
+  def stats(self):
+    lookups = self.hits + self.misses
+    return dict(path=self.path, entries=len(self.entries), bytes=self.total,
+                budget=self.budget, hits=self.hits, misses=self.misses,
+                hit_rate=self.hits / lookups if lookups else 0.0,
+                writes=self.writes, evictions=self.evictions, errors=self.errors)
+
+  def report(self, file=None):
+    stats = ' '.join(f'{k}={v:.3f}' if isinstance(v, float) else f'{k}={v}'
+                     for k, v in self.stats().items())
+    print(f'libtpu compile cache: {stats}', file=file or sys.stderr)
+
+
+cache = CompileCache()
@@ -0,0 +1,218 @@
+"""Generate the typed trampolines and signature table from tpu_api.h.
+
+    python3 libtpu/genapi.py
+
+writes, next to this file:
+
+  tpu_trampolines.inc   one C definition per TFTPU_SET_FN symbol, with the
+                        symbol's real prototype, that widens each argument
+                        to a ret_t for api_call and narrows the result back
+                        to the declared return type
+  capi.py               SIGNATURES, the argument and result kinds of those
+                        same symbols, which the Python dispatchers are
+                        built from
+
+Both are checked in, so building doesn't need Python to run this first.
+
+Kinds are 'void', 'bool', 'i8'..'i64', 'u8'..'u64', 'ptr', or the name of a
+struct passed or returned by value. Struct arguments reach Python as the
+address of the callee's copy; a struct result is written through a hidden
+first argument, the address of the trampoline's return value. Symbols
+tpu_api.h leaves out keep the untyped STUB in libtpujesus.c.
+"""
+import os
+import re
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+INC_FILES = ('tpu_library_init_fns.inc', 'tpu_executor_init_fns.inc')
+
+# api_call's argument count; see libtpujesus.c
+MAX_ARGS = 8
+
+INTS = {
+  'char': 'i8', 'signed char': 'i8', 'unsigned char': 'u8',
+  'int8_t': 'i8', 'uint8_t': 'u8',
+  'short': 'i16', 'unsigned short': 'u16', 'int16_t': 'i16', 'uint16_t': 'u16',
+  'int': 'i32', 'signed': 'i32', 'unsigned': 'u32', 'unsigned int': 'u32',
+  'int32_t': 'i32', 'uint32_t': 'u32',
+  'long': 'i64', 'unsigned long': 'u64', 'int64_t': 'i64', 'uint64_t': 'u64',
+  'ssize_t': 'i64', 'size_t': 'u64',
+}
+
+
+class Param:
+  def __init__(self, ctype, name, array, kind):
+    self.ctype = ctype
+    self.name = name
+    self.array = array
+    self.kind = kind
+
+  def decl(self):
+    return f"{self.ctype} {self.name}{'[]' if self.array else ''}"
+
+
+class Function:
+  def __init__(self, name, ctype, kind, params, text):
+    self.name = name
+    self.ctype = ctype
+    self.kind = kind
+    self.params = params
+    self.text = text
+
+
+def strip_comments(text):
+  text = re.sub(r'/\*.*?\*/', ' ', text, flags=re.S)
+  return re.sub(r'//[^\n]*', ' ', text)
+
+
+def struct_names(text):
+  """Structs defined, not just declared."""
+  return set(re.findall(r'typedef\s+struct\s+\w+\s*\{.*?\}\s*(\w+)\s*;', text, flags=re.S))
+
+
+def fnptr_names(text):
+  return set(re.findall(r'typedef[^;{}]*\(\s*\*\s*(\w+)\s*\)', text))
+
+
+def kind_of(ctype, enums, fnptrs, structs):
+  if '*' in ctype:
+    return 'ptr'
+  base = ' '.join(w for w in ctype.split() if w != 'const')
+  if base in ('void', 'bool', '_Bool'):
+    return base.lstrip('_')
+  if base in INTS:
+    return INTS[base]
+  if base in enums:
+    return 'i32'
+  if base in fnptrs:
+    return 'ptr'
+  if base in structs:
+    return base
+  raise ValueError(f'no calling convention for {ctype!r}')
+
+
+def split_param(text, i, types):
+  """(type, name, is_array); unnamed parameters are called arg<i>."""
+  text = ' '.join(text.split())
+  array = text.endswith('[]')
+  if array:
+    text = text[:-2].rstrip()
+  m = re.match(r'^(.*?[\s*])(\w+)$', text)
+  if m and m.group(1).strip() not in ('', 'const') and m.group(2) not in types:
+    return m.group(1).strip(), m.group(2), array
+  return text, f'arg{i}', array
+
+
+def parse(api, header):
+  header = strip_comments(header)
+  structs = struct_names(header)
+  fnptrs = fnptr_names(header)
+  text = strip_comments(api)
+  text = re.sub(r'^\s*#.*$', ' ', text, flags=re.M)
+  enums = set(re.findall(r'typedef\s+enum\s+\w*\s*\{[^}]*\}\s*(\w+)\s*;', text))
+  fnptrs |= fnptr_names(text)
+  types = {w for name in INTS for w in name.split()} | {'void', 'bool'} | enums | fnptrs | structs
+  functions = {}
+  for stmt in text.split(';'):
+    stmt = re.sub(r'\(\s', '(', ' '.join(stmt.split()))
+    if not stmt or stmt.startswith('typedef'):
+      continue
+    m = re.match(r'^(.*?[\s*])(\w+)\s*\((.*)\)$', stmt)
+    if not m:
+      raise ValueError(f'not a function declaration: {stmt!r}')
+    ctype, name, args = m.group(1).strip(), m.group(2), m.group(3).strip()
+    params = []
+    if args and args != 'void':
+      for i, arg in enumerate(args.split(',')):
+        ptype, pname, array = split_param(arg, i, types)
+        kind = 'ptr' if array else kind_of(ptype, enums, fnptrs, structs)
+        params.append(Param(ptype, pname, array, kind))
+    kind = kind_of(ctype, enums, fnptrs, structs)
+    if len(params) + (kind in structs) > MAX_ARGS:
+      raise ValueError(f'{name} takes more than {MAX_ARGS} arguments')
+    if name in functions:
+      raise ValueError(f'{name} declared twice')
+    functions[name] = Function(name, ctype, kind, params, stmt + ';')
+  return functions, structs
+
+
+def symbols():
+  """(name, native) for every symbol in the .inc files, in order."""
+  syms = []
+  for inc in INC_FILES:
+    with open(os.path.join(HERE, inc)) as f:
+      for m in re.finditer(r'^\s*TFTPU_SET_(NATIVE_)?FN\(\s*\w+\s*,\s*(\w+)\s*\)', f.read(), flags=re.M):
+        syms.append((m.group(2), bool(m.group(1))))
+  return syms
+
+
+def trampoline(fn, structs):
+  params = ', '.join(p.decl() for p in fn.params) or 'void'
+  args = []
+  if fn.kind in structs:
+    args.append('(ret_t)&ret')
+  for p in fn.params:
+    args.append(f'(ret_t)&{p.name}' if p.kind in structs else f'(ret_t){p.name}')
+  args += ['0'] * (MAX_ARGS - len(args))
+  call = f"api_call(SYM_{fn.name}, {', '.join(args)})"
+  lines = [fn.ctype, f'{fn.name}({params})', '{']
+  if fn.kind in structs:
+    lines += [f'    {fn.ctype} ret;', '',
+              '    memset(&ret, 0, sizeof(ret));',
+              f'    {call};',
+              '    return ret;']
+  elif fn.kind == 'void':
+    lines.append(f'    {call};')
+  elif fn.kind == 'bool':
+    lines.append(f'    return {call} != 0;')
+  else:
+    lines.append(f'    return ({fn.ctype}){call};')
+  lines.append('}')
+  return '\n'.join(lines)
+
+
+def generate(functions, syms, structs):
+  c = ['// Generated by genapi.py from tpu_api.h. Do not edit.', '']
+  py = ['# Generated by genapi.py from tpu_api.h. Do not edit.',
+        '#',
+        '# name: (result kind, ((argument kind, argument name), ...), declaration)',
+        '',
+        'SIGNATURES = {']
+  for name, native in syms:
+    if native:
+      continue
+    fn = functions.get(name)
+    if fn is None:
+      c += [f'STUB({name})', '']
+      continue
+    c += [trampoline(fn, structs), '']
+    params = tuple((p.kind, p.name) for p in fn.params)
+    py += [f'  {name!r}: ({fn.kind!r}, {params!r},',
+           f'    {fn.text!r}),']
+  py.append('}')
+  known = {name for name, _ in syms}
+  extra = sorted(set(functions) - known)
+  if extra:
+    raise ValueError(f'declared but not in the .inc files: {extra}')
+  return '\n'.join(c).rstrip() + '\n', '\n'.join(py) + '\n'
+
+
+def main():
+  with open(os.path.join(HERE, 'libtpujesus.h')) as f:
+    header = f.read()
+  with open(os.path.join(HERE, 'tpu_api.h')) as f:
+    functions, structs = parse(f.read(), header)
+  syms = symbols()
+  c, py = generate(functions, syms, structs)
+  for path, text in (('tpu_trampolines.inc', c), ('capi.py', py)):
+    with open(os.path.join(HERE, path), 'w') as f:
+      f.write(text)
+  typed = sum(1 for name, native in syms if not native and name in functions)
+  stubs = sum(1 for name, native in syms if not native and name not in functions)
+  print(f'{typed} typed trampolines, {stubs} stubs, '
+        f'{sum(native for _, native in syms)} natives', file=sys.stderr)
+
+
+if __name__ == '__main__':
+  main()
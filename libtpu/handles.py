@@ -0,0 +1,179 @@
+"""Generational handle table for Python objects handed out through the C API.
+
+libtpu's opaque types (SE_Platform, TF_Status, SE_Stream, ...) are Python
+objects, so callers get a handle instead of a pointer. A handle is a
+64-bit int:
+
+    63     56 55    48 47          32 31            0
+    [ 0x5A   ][  tag  ][ generation  ][    index     ]
+
+`index` is a slot in a flat list, `generation` is bumped every time that
+slot is freed so stale handles are caught instead of aliasing whatever
+moved in next, and `tag` identifies the object's type so argument
+conversion can type-check with an int compare. The 0x5A marker keeps
+handles out of the range of real user-space addresses.
+
+ctypes structures are different: C code reads their fields directly, so
+they are passed by address and only need to be kept alive (`pin`).
+
+C API calls can arrive from many threads at once (libtpujesus takes the
+GIL per call, but Python switches threads between bytecodes), so every
+change to the table happens under `lock`. Lookups don't take it: delete()
+bumps a slot's generation before clearing it, and readers load the object
+before checking the generation, so a racing lookup either sees the live
+object or fails the check.
+"""
+import sys
+import threading
+from collections import Counter
+
+MAGIC = 0x5A
+INDEX_MASK = 0xFFFFFFFF
+GEN_MASK = 0xFFFF
+TAG_MASK = 0xFF
+MAX_TAGS = 0xFF
+
+class HandleError(Exception):
+  pass
+
+def is_handle(val):
+  return isinstance(val, int) and (val >> 56) == MAGIC
+
+class HandleTable:
+  __slots__ = ('objects', 'generations', 'freed', 'free', 'ids', 'types',
+               'type_tags', 'pinned', 'live', 'peak', 'lock')
+
+  def __init__(self):
+    self.objects = []      # slot -> object, or None when free
+    self.generations = []  # slot -> current generation
+    self.freed = []        # slot -> type of the last object freed from it
+    self.free = []         # free slot indices
+    self.ids = {}          # id(obj) -> handle, for live objects
+    self.types = [None]    # tag -> type; tag 0 means "untagged"
+    self.type_tags = {}    # type -> tag
+    self.pinned = {}       # address -> ctypes object kept alive for C
+    self.live = 0
+    self.peak = 0
+    self.lock = threading.RLock()
+
+  def tag(self, kind):
+    tag = self.type_tags.get(kind)
+    if tag is None:
+      with self.lock:
+        tag = self.type_tags.get(kind)
+        if tag is None:
+          tag = len(self.types) if len(self.types) < MAX_TAGS else 0
+          if tag:
+            self.types.append(kind)
+          self.type_tags[kind] = tag
+    return tag
+
+  def key(self, kind):
+    """The value of `handle >> 48` for live handles of exactly `kind`."""
+    return MAGIC << 8 | self.tag(kind)
+
+  def new(self, obj):
+    """Return the handle for `obj`, allocating one if it isn't live yet."""
+    h = self.ids.get(id(obj))
+    if h is not None:
+      return h
+    tag = self.tag(type(obj))
+    with self.lock:
+      h = self.ids.get(id(obj))
+      if h is not None:
+        return h
+      if self.free:
+        i = self.free.pop()
+        self.objects[i] = obj
+      else:
+        # generations first: a reader that sees the slot sees its generation
+        i = len(self.objects)
+        self.generations.append(0)
+        self.freed.append(None)
+        self.objects.append(obj)
+      h = MAGIC << 56 | tag << 48 | self.generations[i] << 32 | i
+      self.ids[id(obj)] = h
+      self.live += 1
+      if self.live > self.peak:
+        self.peak = self.live
+    return h
+
+  def get(self, h):
+    i = h & INDEX_MASK
+    if (h >> 56) != MAGIC or i >= len(self.objects):
+      raise HandleError(f'invalid handle {h:#x}')
+    if self.generations[i] != (h >> 32) & GEN_MASK or self.objects[i] is None:
+      kind = self.freed[i] or self.types[(h >> 48) & TAG_MASK]
+      raise HandleError(f'use after free of {getattr(kind, "__name__", kind)} handle {h:#x}')
+    return self.objects[i]
+
+  def lookup(self, val, kind=object):
+    """Resolve a handle or pinned address, checking it's a `kind`."""
+    if is_handle(val):
+      obj = self.get(val)
+    elif val in self.pinned:
+      obj = self.pinned[val]
+    else:
+      raise HandleError(f'unknown handle {val:#x} (expected {kind.__name__})')
+    if not isinstance(obj, kind):
+      raise HandleError(f'handle {val:#x} is a {type(obj).__name__}, expected {kind.__name__}')
+    return obj
+
+  def converter(self, kind):
+    """A fast val -> object function for arguments annotated as `kind`."""
+    key = self.key(kind)
+    objects = self.objects
+    generations = self.generations
+    lookup = self.lookup
+    def convert(val):
+      if val == 0:
+        return None
+      if (val >> 48) == key:
+        i = val & INDEX_MASK
+        if i < len(objects):
+          obj = objects[i]
+          if generations[i] == (val >> 32) & GEN_MASK and obj is not None:
+            return obj
+      return lookup(val, kind)
+    return convert
+
+  def delete(self, obj):
+    """Free the handle of `obj` (or `obj` itself if it is a handle)."""
+    with self.lock:
+      h = obj if is_handle(obj) else self.ids.get(id(obj))
+      if h is None:
+        raise HandleError(f'delete of untracked {type(obj).__name__}')
+      obj = self.get(h)
+      i = h & INDEX_MASK
+      del self.ids[id(obj)]
+      self.freed[i] = type(obj)
+      self.generations[i] = (self.generations[i] + 1) & GEN_MASK
+      self.objects[i] = None
+      self.free.append(i)
+      self.live -= 1
+
+  def pin(self, obj, ptr):
+    # single dict operations are atomic under the GIL
+    self.pinned[ptr] = obj
+    return ptr
+
+  def unpin(self, ptr):
+    return self.pinned.pop(ptr, None) is not None
+
+  def by_type(self):
+    return Counter(type(obj).__name__ for obj in self.objects if obj is not None)
+
+  def stats(self):
+    return dict(live=self.live, peak=self.peak, slots=len(self.objects),
+                pinned=len(self.pinned), by_type=dict(self.by_type()))
+
+  def report_leaks(self, file=None):
+    leaks = self.by_type()
+    if not leaks:
+      return
+    file = file or sys.stderr
+    print(f'libtpu: {self.live} live handles at exit (peak {self.peak}):', file=file)
+    for name, count in leaks.most_common():
+      print(f'  {count:8d} {name}', file=file)
+
+table = HandleTable()
@@ -0,0 +1,354 @@
+"""Codec for serialized xla.HloModuleProto, without protobuf.
+
+Only the fields the interpreter needs are described; everything else is
+skipped. Field numbers are from TF 2.7's hlo.proto and xla_data.proto.
+
+    module = hlo.parse_module(data)       # HloModuleProto
+    module = hlo.parse_module(data, hlo.HloSnapshot)
+    data = module.serialize()             # only the described fields
+
+Messages are plain objects with one attribute per field; unset fields
+have their proto3 default.
+"""
+import struct
+
+# Wire types
+VARINT, FIXED64, BYTES, FIXED32 = 0, 1, 2, 5
+
+
+class DecodeError(ValueError):
+  pass
+
+
+def varint(data, i):
+  shift = result = 0
+  while True:
+    if i >= len(data):
+      raise DecodeError('truncated varint')
+    b = data[i]
+    i += 1
+    result |= (b & 0x7f) << shift
+    if b < 0x80:
+      return result, i
+    shift += 7
+
+
+def put_varint(out, v):
+  v &= (1 << 64) - 1
+  while v >= 0x80:
+    out.append(v & 0x7f | 0x80)
+    v >>= 7
+  out.append(v)
+
+
+def put_bytes(out, number, data):
+  put_varint(out, number << 3 | BYTES)
+  put_varint(out, len(data))
+  out += data
+
+
+def signed(v):
+  return v - (1 << 64) if v >= 1 << 63 else v
+
+
+def packed_varints(data, convert):
+  out, i = [], 0
+  while i < len(data):
+    v, i = varint(data, i)
+    out.append(convert(v))
+  return out
+
+
+SCALARS = {
+  # kind: (wire type, default, convert a varint)
+  'int': (VARINT, 0, signed),
+  'uint': (VARINT, 0, int),
+  'bool': (VARINT, False, bool),
+  'f32': (FIXED32, 0.0, None),
+  'f64': (FIXED64, 0.0, None),
+  'str': (BYTES, '', None),
+  'bytes': (BYTES, b'', None),
+}
+
+
+class Message:
+  """Base for the message types below; see message()."""
+  __slots__ = ()
+  fields = {}
+
+  def __init__(self):
+    for name, kind, repeated, _ in self.fields.values():
+      if repeated:
+        setattr(self, name, [])
+      elif kind in SCALARS:
+        setattr(self, name, SCALARS[kind][1])
+      else:
+        setattr(self, name, None)
+
+  def __repr__(self):
+    items = ', '.join(f'{f[0]}={getattr(self, f[0])!r}' for f in self.fields.values()
+                      if getattr(self, f[0]) not in (None, [], 0, '', b'', False))
+    return f'{type(self).__name__}({items})'
+
+  @classmethod
+  def parse(cls, data):
+    msg = cls()
+    data = memoryview(data).cast('B') if not isinstance(data, bytes) else data
+    fields = cls.fields
+    i, n = 0, len(data)
+    while i < n:
+      key, i = varint(data, i)
+      number, wire = key >> 3, key & 7
+      if wire == VARINT:
+        v, i = varint(data, i)
+      elif wire == FIXED64:
+        v, i = data[i:i + 8], i + 8
+      elif wire == FIXED32:
+        v, i = data[i:i + 4], i + 4
+      elif wire == BYTES:
+        size, i = varint(data, i)
+        v, i = data[i:i + size], i + size
+      else:
+        raise DecodeError(f'unsupported wire type {wire} in {cls.__name__}')
+      if i > n:
+        raise DecodeError(f'truncated {cls.__name__}')
+      field = fields.get(number)
+      if field is None:
+        continue
+      name, kind, repeated, sub = field
+      if sub is not None:
+        v = sub.parse(v)
+      elif kind in ('str', 'bytes'):
+        v = bytes(v).decode() if kind == 'str' else bytes(v)
+      elif wire == BYTES:
+        # packed repeated scalars
+        if kind == 'f32':
+          v = list(struct.unpack(f'<{len(v) // 4}f', v))
+        elif kind == 'f64':
+          v = list(struct.unpack(f'<{len(v) // 8}d', v))
+        else:
+          v = packed_varints(v, SCALARS[kind][2])
+        getattr(msg, name).extend(v)
+        continue
+      elif kind == 'f32':
+        v = struct.unpack('<f', v)[0]
+      elif kind == 'f64':
+        v = struct.unpack('<d', v)[0]
+      else:
+        v = SCALARS[kind][2](v)
+      if repeated:
+        getattr(msg, name).append(v)
+      else:
+        setattr(msg, name, v)
+    return msg
+
+  def serialize(self):
+    out = bytearray()
+    for number, (name, kind, repeated, sub) in self.fields.items():
+      value = getattr(self, name)
+      if sub is not None:
+        for v in value if repeated else [] if value is None else [value]:
+          put_bytes(out, number, v.serialize())
+      elif kind in ('str', 'bytes'):
+        for v in value if repeated else [value] if value else []:
+          put_bytes(out, number, v.encode() if kind == 'str' else v)
+      elif repeated:
+        # packed, as proto3 writes them
+        if kind == 'f32':
+          body = struct.pack(f'<{len(value)}f', *value)
+        elif kind == 'f64':
+          body = struct.pack(f'<{len(value)}d', *value)
+        else:
+          body = bytearray()
+          for v in value:
+            put_varint(body, int(v))
+        if body:
+          put_bytes(out, number, body)
+      elif value != SCALARS[kind][1]:
+        wire = SCALARS[kind][0]
+        put_varint(out, number << 3 | wire)
+        if wire == VARINT:
+          put_varint(out, int(value))
+        else:
+          out += struct.pack('<f' if wire == FIXED32 else '<d', value)
+    return bytes(out)
+
+
+def message(name, fields):
+  """Make a Message subclass. `fields` maps field number to
+  (name, kind, repeated=False); kind is a scalar kind or a Message type,
+  or a string naming one defined later (fixed up by link())."""
+  spec = {}
+  for number, (field, kind, *rest) in fields.items():
+    spec[number] = (field, kind, bool(rest and rest[0]), None)
+  cls = type(name, (Message,), {'__slots__': tuple(f[0] for f in spec.values()), 'fields': spec})
+  return cls
+
+
+def link(*types):
+  """Resolve message-typed fields once every type exists."""
+  names = {t.__name__: t for t in types}
+  for t in types:
+    for number, (field, kind, repeated, _) in list(t.fields.items()):
+      if kind not in SCALARS:
+        t.fields[number] = (field, kind, repeated, names[kind])
+
+
+TileProto = message('TileProto', {1: ('dimensions', 'int', True)})
+LayoutProto = message('LayoutProto', {
+  1: ('minor_to_major', 'int', True),
+  4: ('format', 'int'),
+  6: ('tiles', 'TileProto', True),
+  7: ('element_size_in_bits', 'int'),
+  8: ('memory_space', 'int'),
+})
+ShapeProto = message('ShapeProto', {
+  2: ('element_type', 'int'),
+  3: ('dimensions', 'int', True),
+  4: ('tuple_shapes', 'ShapeProto', True),
+  5: ('layout', 'LayoutProto'),
+  6: ('is_dynamic_dimension', 'bool', True),
+})
+ProgramShapeProto = message('ProgramShapeProto', {
+  1: ('parameters', 'ShapeProto', True),
+  2: ('result', 'ShapeProto'),
+  3: ('parameter_names', 'str', True),
+})
+LiteralProto = message('LiteralProto', {
+  1: ('shape', 'ShapeProto'),
+  2: ('preds', 'bool', True),
+  3: ('u8s', 'bytes'),
+  4: ('s32s', 'int', True),
+  5: ('s64s', 'int', True),
+  6: ('u32s', 'uint', True),
+  7: ('u64s', 'uint', True),
+  8: ('f32s', 'f32', True),
+  9: ('f64s', 'f64', True),
+  10: ('tuple_literals', 'LiteralProto', True),
+  11: ('f16s', 'bytes'),
+  12: ('c64s', 'f32', True),
+  13: ('bf16s', 'bytes'),
+  15: ('s8s', 'bytes'),
+  16: ('u16s', 'bytes'),
+  17: ('s16s', 'bytes'),
+  18: ('c128s', 'f64', True),
+})
+SliceDimensions = message('SliceDimensions', {
+  1: ('start', 'int'),
+  2: ('limit', 'int'),
+  3: ('stride', 'int'),
+})
+PaddingConfigDimension = message('PaddingConfigDimension', {
+  1: ('edge_padding_low', 'int'),
+  2: ('edge_padding_high', 'int'),
+  3: ('interior_padding', 'int'),
+})
+PaddingConfig = message('PaddingConfig', {1: ('dimensions', 'PaddingConfigDimension', True)})
+WindowDimension = message('WindowDimension', {
+  1: ('size', 'int'),
+  2: ('stride', 'int'),
+  3: ('padding_low', 'int'),
+  4: ('padding_high', 'int'),
+  5: ('window_dilation', 'int'),
+  6: ('base_dilation', 'int'),
+  7: ('window_reversal', 'bool'),
+})
+Window = message('Window', {1: ('dimensions', 'WindowDimension', True)})
+DotDimensionNumbers = message('DotDimensionNumbers', {
+  1: ('lhs_contracting_dimensions', 'int', True),
+  2: ('rhs_contracting_dimensions', 'int', True),
+  3: ('lhs_batch_dimensions', 'int', True),
+  4: ('rhs_batch_dimensions', 'int', True),
+})
+ConvolutionDimensionNumbers = message('ConvolutionDimensionNumbers', {
+  3: ('kernel_input_feature_dimension', 'int'),
+  4: ('kernel_output_feature_dimension', 'int'),
+  6: ('kernel_spatial_dimensions', 'int', True),
+  7: ('input_batch_dimension', 'int'),
+  8: ('input_feature_dimension', 'int'),
+  9: ('output_batch_dimension', 'int'),
+  10: ('output_feature_dimension', 'int'),
+  11: ('input_spatial_dimensions', 'int', True),
+  12: ('output_spatial_dimensions', 'int', True),
+})
+GatherDimensionNumbers = message('GatherDimensionNumbers', {
+  1: ('offset_dims', 'int', True),
+  2: ('collapsed_slice_dims', 'int', True),
+  3: ('start_index_map', 'int', True),
+  4: ('index_vector_dim', 'int'),
+})
+ScatterDimensionNumbers = message('ScatterDimensionNumbers', {
+  1: ('update_window_dims', 'int', True),
+  2: ('inserted_window_dims', 'int', True),
+  3: ('scatter_dims_to_operand_dims', 'int', True),
+  4: ('index_vector_dim', 'int'),
+})
+HloInstructionProto = message('HloInstructionProto', {
+  1: ('name', 'str'),
+  2: ('opcode', 'str'),
+  3: ('shape', 'ShapeProto'),
+  8: ('literal', 'LiteralProto'),
+  9: ('parameter_number', 'int'),
+  13: ('tuple_index', 'int'),
+  14: ('dimensions', 'int', True),
+  15: ('window', 'Window'),
+  16: ('convolution_dimension_numbers', 'ConvolutionDimensionNumbers'),
+  17: ('slice_dimensions', 'SliceDimensions', True),
+  20: ('dynamic_slice_sizes', 'int', True),
+  21: ('padding_config', 'PaddingConfig'),
+  23: ('distribution', 'int'),
+  28: ('custom_call_target', 'str'),
+  30: ('dot_dimension_numbers', 'DotDimensionNumbers'),
+  33: ('gather_dimension_numbers', 'GatherDimensionNumbers'),
+  34: ('gather_slice_sizes', 'int', True),
+  35: ('id', 'int'),
+  36: ('operand_ids', 'int', True),
+  38: ('called_computation_ids', 'int', True),
+  48: ('scatter_dimension_numbers', 'ScatterDimensionNumbers'),
+  50: ('feature_group_count', 'int'),
+  58: ('batch_group_count', 'int'),
+  60: ('is_stable', 'bool'),
+  63: ('comparison_direction', 'str'),
+  72: ('comparison_type', 'str'),
+})
+HloComputationProto = message('HloComputationProto', {
+  1: ('name', 'str'),
+  2: ('instructions', 'HloInstructionProto', True),
+  4: ('program_shape', 'ProgramShapeProto'),
+  5: ('id', 'int'),
+  6: ('root_id', 'int'),
+})
+HloModuleProto = message('HloModuleProto', {
+  1: ('name', 'str'),
+  2: ('entry_computation_name', 'str'),
+  3: ('computations', 'HloComputationProto', True),
+  4: ('host_program_shape', 'ProgramShapeProto'),
+  5: ('id', 'int'),
+  6: ('entry_computation_id', 'int'),
+})
+HloModuleGroupProto = message('HloModuleGroupProto', {
+  1: ('name', 'str'),
+  2: ('hlo_modules', 'HloModuleProto', True),
+})
+HloProto = message('HloProto', {1: ('hlo_module', 'HloModuleProto')})
+HloSnapshot = message('HloSnapshot', {1: ('hlo', 'HloProto')})
+# xrt.XLAComputation
+XLAComputation = message('XLAComputation', {2: ('hlo_snapshot', 'HloSnapshot')})
+
+link(TileProto, LayoutProto, ShapeProto, ProgramShapeProto, LiteralProto, SliceDimensions,
+     PaddingConfigDimension, PaddingConfig, WindowDimension, Window, DotDimensionNumbers,
+     ConvolutionDimensionNumbers, GatherDimensionNumbers, ScatterDimensionNumbers,
+     HloInstructionProto, HloComputationProto, HloModuleProto, HloModuleGroupProto, HloProto,
+     HloSnapshot, XLAComputation)
+
+
+def parse_module(data, wrapper=None):
+  """Decode an HloModuleProto, or one wrapped in an HloProto/HloSnapshot/
+  XLAComputation."""
+  if wrapper is XLAComputation:
+    return XLAComputation.parse(data).hlo_snapshot.hlo.hlo_module
+  if wrapper is HloSnapshot:
+    return HloSnapshot.parse(data).hlo.hlo_module
+  if wrapper is HloProto:
+    return HloProto.parse(data).hlo_module
+  return HloModuleProto.parse(data)
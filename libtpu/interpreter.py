@@ -0,0 +1,909 @@
+"""Runs HLO modules with NumPy.
+
+compile() turns an HloModuleProto (see hlo.py) into an Executable. Each
+computation becomes a flat plan of (slot, fn, operand slots) steps over
+whole arrays, with constants and iotas evaluated once up front, so running
+a program costs one NumPy call per HLO instruction:
+
+    exe = interpreter.compile(hlo.parse_module(data))
+    exe.run(args, result)             # device buffer trees, see below
+    exe.evaluate(*arrays)             # host arrays in, host arrays out
+
+Device buffers are addressed the way the C API hands them over: a leaf is
+a buffer address, and a tuple is (address, [children]) whose buffer holds
+the children's addresses as its index table. Arrays are stored in their
+layout's minor_to_major order (tile padding is trailing, see
+tpu_layout.c); BF16 is computed in float32 and rounded to bfloat16 after
+every op that produces one.
+
+infeed and outfeed move records through the queues of the device whose
+stream runs the program (tpu_feed.c): a record is the value's array
+leaves back to back in preorder, each in its layout's order with no tile
+padding. Like a TPU, a program waits at an infeed until the host feeds
+it, and at an outfeed until the host has made room.
+
+Opcodes with no NumPy lowering raise Unimplemented at compile time.
+"""
+import ctypes
+import functools
+import hashlib
+import threading
+
+import numpy as np
+
+import libtpujesus
+
+from . import hlo, profiler
+
+(PRED, S8, S16, S32, S64, U8, U16, U32, U64, F16, F32, F64,
+ TUPLE, OPAQUE_TYPE, C64, BF16, TOKEN, C128) = range(1, 19)
+
+# What arrays of each type are computed in, and stored as.
+DTYPES = {
+  PRED: np.bool_, S8: np.int8, S16: np.int16, S32: np.int32, S64: np.int64,
+  U8: np.uint8, U16: np.uint16, U32: np.uint32, U64: np.uint64,
+  F16: np.float16, F32: np.float32, F64: np.float64, BF16: np.float32,
+  C64: np.complex64, C128: np.complex128,
+}
+STORAGE = {**DTYPES, BF16: np.uint16}
+
+
+class Unimplemented(Exception):
+  pass
+
+
+def dtype_of(shape):
+  try:
+    return DTYPES[shape.element_type]
+  except KeyError:
+    raise Unimplemented(f'element type {shape.element_type}') from None
+
+
+def to_bf16(x):
+  """Round float32 values to bfloat16 precision (nearest even)."""
+  u = np.asarray(x, np.float32).view(np.uint32)
+  r = (u + (0x7fff + ((u >> 16) & 1))) & np.uint32(0xffff0000)
+  r = np.where(np.isnan(np.asarray(x, np.float32)), u | np.uint32(0x400000), r)
+  return r.astype(np.uint32).view(np.float32)
+
+
+def bf16_bits(x):
+  return (to_bf16(x).view(np.uint32) >> 16).astype(np.uint16)
+
+
+def from_bf16_bits(bits):
+  return (np.asarray(bits, np.uint32) << 16).view(np.float32)
+
+
+#
+# Literals
+#
+
+LITERAL_FIELDS = {
+  PRED: 'preds', S32: 's32s', S64: 's64s', U32: 'u32s', U64: 'u64s',
+  F32: 'f32s', F64: 'f64s', C64: 'c64s', C128: 'c128s',
+}
+LITERAL_BYTES = {U8: 'u8s', S8: 's8s', F16: 'f16s', U16: 'u16s', S16: 's16s', BF16: 'bf16s'}
+
+
+def to_logical(flat, shape):
+  """Reshape flat physical-order data to the shape's logical dims."""
+  dims = tuple(shape.dimensions)
+  m2m = list(shape.layout.minor_to_major) if shape.layout else []
+  if len(m2m) != len(dims) or m2m == list(range(len(dims) - 1, -1, -1)):
+    return flat.reshape(dims)
+  major = m2m[::-1]
+  arr = flat.reshape([dims[d] for d in major])
+  return arr.transpose([major.index(d) for d in range(len(dims))])
+
+
+def to_physical(value, shape):
+  dims = tuple(shape.dimensions)
+  m2m = list(shape.layout.minor_to_major) if shape.layout else []
+  value = np.broadcast_to(value, dims)
+  if len(m2m) != len(dims) or m2m == list(range(len(dims) - 1, -1, -1)):
+    return value
+  return value.transpose(m2m[::-1])
+
+
+def literal(lit):
+  shape = lit.shape
+  t = shape.element_type
+  if t == TUPLE:
+    return tuple(literal(sub) for sub in lit.tuple_literals)
+  if t == TOKEN:
+    return None
+  if t in LITERAL_FIELDS:
+    values = getattr(lit, LITERAL_FIELDS[t])
+    if t in (C64, C128):
+      flat = np.array(values[0::2], DTYPES[t]) + 1j * np.array(values[1::2], DTYPES[t])
+      flat = flat.astype(DTYPES[t])
+    else:
+      flat = np.array(values, DTYPES[t])
+  elif t in LITERAL_BYTES:
+    flat = np.frombuffer(getattr(lit, LITERAL_BYTES[t]), STORAGE[t]).copy()
+    if t == BF16:
+      flat = from_bf16_bits(flat)
+  else:
+    raise Unimplemented(f'literal of element type {t}')
+  return to_logical(flat, shape)
+
+
+#
+# Elementwise ops
+#
+
+def int_divide(a, b):
+  q = np.floor_divide(a, b)
+  # XLA truncates toward zero
+  return np.where((np.remainder(a, b) != 0) & ((a < 0) != (b < 0)), q + 1, q)
+
+
+def int_power(a, b):
+  r = np.power(a, np.maximum(b, 0))
+  neg = np.where(a == 1, 1, np.where(a == -1, np.where(b % 2 == 0, 1, -1), 0))
+  return np.where(b < 0, neg, r).astype(np.result_type(a))
+
+
+def shift_left(a, b):
+  bits = np.dtype(np.result_type(a)).itemsize * 8
+  big = (b < 0) | (b >= bits)
+  return np.where(big, 0, np.left_shift(a, np.where(big, 0, b))).astype(np.result_type(a))
+
+
+def shift_right_logical(a, b):
+  dt = np.dtype(np.result_type(a))
+  unsigned = np.dtype(f'u{dt.itemsize}')
+  bits = dt.itemsize * 8
+  big = (b < 0) | (b >= bits)
+  ua = np.asarray(a).view(unsigned)
+  r = np.right_shift(ua, np.where(big, 0, b).astype(unsigned))
+  return np.where(big, 0, r).astype(unsigned).view(dt)
+
+
+def shift_right_arithmetic(a, b):
+  bits = np.dtype(np.result_type(a)).itemsize * 8
+  return np.right_shift(a, np.clip(b, 0, bits - 1)).astype(np.result_type(a))
+
+
+def round_afz(x):
+  return np.copysign(np.floor(np.abs(x) + np.asarray(0.5, np.result_type(x))), x)
+
+
+def logical_not(x):
+  return np.logical_not(x) if np.result_type(x) == np.bool_ else np.invert(x)
+
+
+BINARY = {
+  'add': np.add, 'subtract': np.subtract, 'multiply': np.multiply,
+  'divide': np.divide, 'remainder': np.fmod, 'power': np.power,
+  'maximum': np.maximum, 'minimum': np.minimum, 'atan2': np.arctan2,
+  'and': np.bitwise_and, 'or': np.bitwise_or, 'xor': np.bitwise_xor,
+  'shift-left': shift_left, 'shift-right-logical': shift_right_logical,
+  'shift-right-arithmetic': shift_right_arithmetic,
+  'complex': lambda a, b: a + 1j * b,
+}
+INTEGER_BINARY = {'divide': int_divide, 'power': int_power}
+
+UNARY = {
+  'abs': np.abs, 'negate': np.negative, 'sign': np.sign,
+  'exponential': np.exp, 'exponential-minus-one': np.expm1,
+  'log': np.log, 'log-plus-one': np.log1p,
+  'sqrt': np.sqrt, 'rsqrt': lambda x: np.reciprocal(np.sqrt(x)), 'cbrt': np.cbrt,
+  'tanh': np.tanh, 'cosine': np.cos, 'sine': np.sin, 'tan': np.tan,
+  'logistic': lambda x: np.reciprocal(np.exp(-x) + np.asarray(1, np.result_type(x))),
+  'floor': np.floor, 'ceil': np.ceil,
+  'round-nearest-afz': round_afz, 'round-nearest-even': np.rint,
+  'not': logical_not, 'is-finite': np.isfinite,
+  'real': np.real, 'imag': np.imag, 'popcnt': np.bitwise_count,
+}
+
+COMPARE = {
+  'EQ': np.equal, 'NE': np.not_equal, 'LT': np.less,
+  'LE': np.less_equal, 'GT': np.greater, 'GE': np.greater_equal,
+}
+
+# Binary ops that make a computation a plain NumPy reduction.
+REDUCERS = {
+  'add': np.add, 'multiply': np.multiply, 'maximum': np.maximum,
+  'minimum': np.minimum, 'and': np.bitwise_and, 'or': np.bitwise_or,
+  'xor': np.bitwise_xor,
+}
+
+
+def convert(x, src, dst):
+  """XLA's convert: floats saturate and NaN becomes 0 going to ints."""
+  x = np.asarray(x)
+  dt = DTYPES[dst]
+  if dst == PRED:
+    return x != 0
+  if np.iscomplexobj(x) and dst not in (C64, C128):
+    x = x.real
+  if np.issubdtype(dt, np.integer) and np.issubdtype(x.dtype, np.floating):
+    info = np.iinfo(dt)
+    x = np.clip(np.nan_to_num(x, nan=0), info.min, info.max)
+    return np.where(x >= info.max, info.max, x.astype(dt)).astype(dt)
+  if dst == BF16:
+    return to_bf16(x.astype(np.float32))
+  return x.astype(dt)
+
+
+def bitcast_convert(x, src, dst):
+  x = np.asarray(x)
+  if src == BF16:
+    x = bf16_bits(x)
+  if dst == BF16:
+    return from_bf16_bits(x.view(np.uint16))
+  return x.view(STORAGE[dst])
+
+
+#
+# Structural ops
+#
+
+def pad(x, value, config):
+  x = np.asarray(x)
+  lows, highs, interiors = zip(*[(d.edge_padding_low, d.edge_padding_high, d.interior_padding)
+                                 for d in config.dimensions]) if x.ndim else ((), (), ())
+  if any(interiors):
+    dims = [n + max(n - 1, 0) * k for n, k in zip(x.shape, interiors)]
+    spread = np.full(dims, value, x.dtype)
+    spread[tuple(slice(None, None, k + 1) for k in interiors)] = x
+    x = spread
+  x = np.pad(x, [(max(lo, 0), max(hi, 0)) for lo, hi in zip(lows, highs)],
+             constant_values=value)
+  crop = tuple(slice(-min(lo, 0), n + min(hi, 0)) for lo, hi, n in zip(lows, highs, x.shape))
+  return x[crop]
+
+
+def broadcast(x, dims, out):
+  x = np.asarray(x)
+  shape = [1] * len(out)
+  for i, d in enumerate(dims):
+    shape[d] = x.shape[i]
+  return np.broadcast_to(x.reshape(shape), out)
+
+
+def clamp_starts(starts, dims, sizes):
+  return tuple(min(max(int(s), 0), n - k) for s, n, k in zip(starts, dims, sizes))
+
+
+def dynamic_slice(x, *starts, sizes):
+  x = np.asarray(x)
+  starts = clamp_starts(starts, x.shape, sizes)
+  return x[tuple(slice(s, s + k) for s, k in zip(starts, sizes))]
+
+
+def dynamic_update_slice(x, update, *starts):
+  out = np.array(x, copy=True)
+  update = np.asarray(update)
+  starts = clamp_starts(starts, out.shape, update.shape)
+  out[tuple(slice(s, s + k) for s, k in zip(starts, update.shape))] = update
+  return out
+
+
+def dot(lhs, rhs, dnums, dt):
+  lhs, rhs = np.asarray(lhs), np.asarray(rhs)
+  lb, rb = list(dnums.lhs_batch_dimensions), list(dnums.rhs_batch_dimensions)
+  lc, rc = list(dnums.lhs_contracting_dimensions), list(dnums.rhs_contracting_dimensions)
+  lf = [d for d in range(lhs.ndim) if d not in lb and d not in lc]
+  rf = [d for d in range(rhs.ndim) if d not in rb and d not in rc]
+  batch = [lhs.shape[d] for d in lb]
+  lfree, rfree = [lhs.shape[d] for d in lf], [rhs.shape[d] for d in rf]
+  k = int(np.prod([lhs.shape[d] for d in lc], dtype=np.int64))
+  a = lhs.transpose(lb + lf + lc).reshape(batch + [int(np.prod(lfree, dtype=np.int64)), k])
+  b = rhs.transpose(rb + rc + rf).reshape(batch + [k, int(np.prod(rfree, dtype=np.int64))])
+  if dt == np.bool_:
+    r = np.matmul(a.astype(np.int32), b.astype(np.int32)) != 0
+  else:
+    r = np.matmul(a.astype(dt, copy=False), b.astype(dt, copy=False))
+  return r.reshape(batch + lfree + rfree)
+
+
+def convolution(lhs, rhs, window, dnums, groups, dt):
+  lhs, rhs = np.asarray(lhs, dt), np.asarray(rhs, dt)
+  ls, ks, os_ = (list(dnums.input_spatial_dimensions), list(dnums.kernel_spatial_dimensions),
+                 list(dnums.output_spatial_dimensions))
+  x = lhs.transpose([dnums.input_batch_dimension, dnums.input_feature_dimension] + ls)
+  w = rhs.transpose([dnums.kernel_output_feature_dimension, dnums.kernel_input_feature_dimension] + ks)
+  wins = list(window.dimensions) if window else []
+  # Base dilation and padding turn into one pad of the input.
+  config = hlo.PaddingConfig()
+  config.dimensions = [hlo.PaddingConfigDimension() for _ in range(x.ndim)]
+  for d, win in zip(config.dimensions[2:], wins):
+    d.edge_padding_low, d.edge_padding_high = win.padding_low, win.padding_high
+    d.interior_padding = max(win.base_dilation, 1) - 1
+  x = pad(x, np.zeros((), dt), config)
+  for i, win in enumerate(wins):
+    if win.window_reversal:
+      w = np.flip(w, 2 + i)
+  strides = [max(win.stride, 1) for win in wins] or [1] * len(ls)
+  dilations = [max(win.window_dilation, 1) for win in wins] or [1] * len(ls)
+  ksizes = w.shape[2:]
+  out_sizes = [(n - (k - 1) * d - 1) // s + 1
+               for n, k, d, s in zip(x.shape[2:], ksizes, dilations, strides)]
+  n, c = x.shape[:2]
+  o, cg = w.shape[:2]
+  g = max(groups, 1)
+  out = np.zeros([n, g, o // g] + out_sizes, dt)
+  xg = x.reshape([n, g, c // g] + list(x.shape[2:]))
+  wg = w.reshape([g, o // g, cg] + list(ksizes))
+  for offset in np.ndindex(*ksizes):
+    window_slices = tuple(slice(p * d, p * d + (m - 1) * s + 1, s)
+                          for p, d, m, s in zip(offset, dilations, out_sizes, strides))
+    patch = xg[(slice(None), slice(None), slice(None)) + window_slices]
+    kernel = wg[(slice(None), slice(None), slice(None)) + offset]
+    out += np.einsum('ngc...,goc->ngo...', patch, kernel)
+  out = out.reshape([n, o] + out_sizes)
+  positions = [dnums.output_batch_dimension, dnums.output_feature_dimension] + os_
+  return out.transpose([positions.index(p) for p in range(out.ndim)])
+
+
+def gather(operand, indices, dnums, slice_sizes):
+  operand, indices = np.asarray(operand), np.asarray(indices)
+  ivd = dnums.index_vector_dim
+  if ivd == indices.ndim:
+    indices = indices[..., None]
+  else:
+    indices = np.moveaxis(indices, ivd, -1)
+  batch = indices.shape[:-1]
+  idx = indices.reshape(-1, indices.shape[-1]).astype(np.int64)
+  starts = np.zeros((idx.shape[0], operand.ndim), np.int64)
+  for k, d in enumerate(dnums.start_index_map):
+    starts[:, d] = np.clip(idx[:, k], 0, operand.shape[d] - slice_sizes[d])
+  grids = []
+  for d in range(operand.ndim):
+    shape = [idx.shape[0]] + [1] * operand.ndim
+    shape[1 + d] = slice_sizes[d]
+    grids.append(starts[:, d].reshape([-1] + [1] * operand.ndim)
+                 + np.arange(slice_sizes[d]).reshape(shape[1:]))
+  window = operand[tuple(grids)]
+  keep = [d for d in range(operand.ndim) if d not in dnums.collapsed_slice_dims]
+  window = window.reshape(list(batch) + [slice_sizes[d] for d in keep])
+  rank = window.ndim
+  offset_dims = list(dnums.offset_dims)
+  batch_positions = [p for p in range(rank) if p not in offset_dims]
+  source = [0] * rank
+  for i, p in enumerate(batch_positions):
+    source[p] = i
+  for i, p in enumerate(offset_dims):
+    source[p] = len(batch) + i
+  return window.transpose(source)
+
+
+def scatter(operand, indices, updates, dnums, combine, ufunc):
+  out = np.array(operand, copy=True)
+  indices, updates = np.asarray(indices), np.asarray(updates)
+  ivd = dnums.index_vector_dim
+  if ivd == indices.ndim:
+    indices = indices[..., None]
+  else:
+    indices = np.moveaxis(indices, ivd, -1)
+  window_dims = list(dnums.update_window_dims)
+  scatter_dims = [d for d in range(updates.ndim) if d not in window_dims]
+  updates = updates.transpose(scatter_dims + window_dims)
+  nbatch = int(np.prod([updates.shape[i] for i in range(len(scatter_dims))], dtype=np.int64))
+  window_shape = updates.shape[len(scatter_dims):]
+  updates = updates.reshape((nbatch,) + window_shape)
+  idx = indices.reshape(-1, indices.shape[-1]).astype(np.int64)
+  operand_window_dims = [d for d in range(out.ndim) if d not in dnums.inserted_window_dims]
+  full_window = [1] * out.ndim
+  for d, n in zip(operand_window_dims, window_shape):
+    full_window[d] = n
+  starts = np.zeros((nbatch, out.ndim), np.int64)
+  for k, d in enumerate(dnums.scatter_dims_to_operand_dims):
+    starts[:, d] = idx[:, k]
+  # Windows that would fall off the operand are skipped, not clamped.
+  ok = np.all((starts >= 0) & (starts + np.array(full_window) <= np.array(out.shape)), axis=1)
+  starts, updates = starts[ok], updates[ok]
+  grids = []
+  for d in range(out.ndim):
+    shape = [1] * len(window_shape)
+    if d in operand_window_dims:
+      shape[operand_window_dims.index(d)] = full_window[d]
+      offsets = np.arange(full_window[d]).reshape(shape)
+    else:
+      offsets = np.zeros(shape, np.int64)
+    grids.append(starts[:, d].reshape([-1] + [1] * len(window_shape)) + offsets[None])
+  grids = [np.broadcast_to(g, updates.shape) for g in grids]
+  if ufunc is not None:
+    ufunc.at(out, tuple(grids), updates)
+  elif combine is None:
+    out[tuple(grids)] = updates
+  else:
+    for i in np.ndindex(*updates.shape):
+      at = tuple(g[i] for g in grids)
+      out[at] = combine(out[at], updates[i])
+  return out
+
+
+def reduce_window(x, init, window, fn):
+  x = np.asarray(x)
+  wins = list(window.dimensions)
+  config = hlo.PaddingConfig()
+  config.dimensions = [hlo.PaddingConfigDimension() for _ in range(x.ndim)]
+  for d, win in zip(config.dimensions, wins):
+    d.edge_padding_low, d.edge_padding_high = win.padding_low, win.padding_high
+    d.interior_padding = max(win.base_dilation, 1) - 1
+  x = pad(x, init, config)
+  sizes = [win.size for win in wins]
+  strides = [max(win.stride, 1) for win in wins]
+  dilations = [max(win.window_dilation, 1) for win in wins]
+  out_sizes = [(n - (k - 1) * d - 1) // s + 1 if n >= (k - 1) * d + 1 else 0
+               for n, k, d, s in zip(x.shape, sizes, dilations, strides)]
+  acc = np.broadcast_to(init, out_sizes)
+  for offset in np.ndindex(*sizes):
+    view = x[tuple(slice(p * d, p * d + (m - 1) * s + 1, s)
+                   for p, d, m, s in zip(offset, dilations, out_sizes, strides))]
+    acc = fn(acc, view)
+  return acc
+
+
+#
+# Computations
+#
+
+class Computation:
+  """One HLO computation as a flat plan over a list of value slots."""
+
+  def __init__(self, proto, module):
+    self.name = proto.name
+    self.proto = proto
+    slots = {inst.id: i for i, inst in enumerate(proto.instructions)}
+    self.init = [None] * len(proto.instructions)
+    self.params = {}
+    self.steps = []
+    for i, inst in enumerate(proto.instructions):
+      operands = [slots[o] for o in inst.operand_ids]
+      if inst.opcode == 'parameter':
+        self.params[inst.parameter_number] = i
+        continue
+      fn = lower(inst, module, [proto.instructions[o] for o in operands])
+      if not operands and inst.opcode in ('constant', 'iota'):
+        self.init[i] = fn()
+      else:
+        self.steps.append((i, fn, operands))
+    self.params = [self.params[n] for n in range(len(self.params))]
+    self.root = slots[proto.root_id]
+    self.root_inst = proto.instructions[self.root]
+
+  def __call__(self, *args):
+    vals = list(self.init)
+    for slot, arg in zip(self.params, args):
+      vals[slot] = arg
+    for slot, fn, operands in self.steps:
+      vals[slot] = fn(*[vals[o] for o in operands])
+    return vals[self.root]
+
+  def reducer(self):
+    """The ufunc this computation is, if it's just op(param0, param1)."""
+    insts = {inst.id: inst for inst in self.proto.instructions}
+    root = self.root_inst
+    if len(self.params) != 2 or root.opcode not in REDUCERS or len(root.operand_ids) != 2:
+      return None
+    ops = [insts[o] for o in root.operand_ids]
+    if sorted(op.parameter_number for op in ops if op.opcode == 'parameter') != [0, 1]:
+      return None
+    return REDUCERS[root.opcode]
+
+  def assigns(self):
+    """True if this computation just returns its second parameter."""
+    return self.root_inst.opcode == 'parameter' and self.root_inst.parameter_number == 1
+
+
+class Module:
+  def __init__(self, proto, constants=None):
+    self.proto = proto
+    self.protos = {c.id: c for c in proto.computations}
+    self.computations = {}
+    # instruction id -> value, for constants whose literal was cut out of
+    # the proto (see tpuprog.py); filled in as the rest are decoded
+    self.constants = {} if constants is None else constants
+    entry = proto.entry_computation_id
+    if entry not in self.protos:
+      entry = next(c.id for c in proto.computations if c.name == proto.entry_computation_name)
+    self.entry = self.computation(entry)
+
+  def computation(self, id):
+    comp = self.computations.get(id)
+    if comp is None:
+      comp = self.computations[id] = Computation(self.protos[id], self)
+    return comp
+
+  def constant(self, inst):
+    value = self.constants.get(inst.id)
+    if value is None and inst.id not in self.constants:
+      value = self.constants[inst.id] = literal(inst.literal)
+    return value
+
+
+def lower(inst, module, operands):
+  """fn(*operand values) -> value for one instruction."""
+  op = inst.opcode
+  shape = inst.shape
+  t = shape.element_type
+  out = tuple(shape.dimensions)
+  called = [module.computation(c) for c in inst.called_computation_ids]
+  fn = None
+  if op in BINARY:
+    dt = DTYPES.get(t)
+    fn = INTEGER_BINARY.get(op) if dt is not None and np.issubdtype(dt, np.integer) else None
+    fn = fn or BINARY[op]
+  elif op in UNARY:
+    fn = UNARY[op]
+  elif op == 'compare':
+    fn = COMPARE[inst.comparison_direction]
+  elif op == 'select':
+    fn = np.where
+  elif op == 'clamp':
+    fn = lambda lo, x, hi: np.minimum(np.maximum(x, lo), hi)
+  elif op == 'convert':
+    src = operands[0].shape.element_type
+    return lambda x: convert(x, src, t)
+  elif op == 'bitcast-convert':
+    src = operands[0].shape.element_type
+    return lambda x: bitcast_convert(x, src, t)
+  elif op == 'constant':
+    value = module.constant(inst)
+    return lambda: value
+  elif op == 'iota':
+    dt = dtype_of(shape)
+    dim = inst.dimensions[0]
+    return lambda: broadcast(np.arange(out[dim], dtype=dt), [dim], out)
+  elif op in ('copy', 'domain', 'add-dependency', 'set-dimension-size', 'reduce-precision'):
+    return lambda x, *_: x
+  elif op in ('reshape', 'bitcast'):
+    return lambda x: np.reshape(x, out)
+  elif op == 'broadcast':
+    dims = list(inst.dimensions)
+    return lambda x: broadcast(x, dims, out)
+  elif op == 'transpose':
+    dims = list(inst.dimensions)
+    return lambda x: np.transpose(x, dims)
+  elif op == 'reverse':
+    dims = tuple(inst.dimensions)
+    return lambda x: np.flip(x, dims)
+  elif op == 'slice':
+    index = tuple(slice(d.start, d.limit, d.stride or 1) for d in inst.slice_dimensions)
+    return lambda x: np.asarray(x)[index]
+  elif op == 'dynamic-slice':
+    return functools.partial(dynamic_slice, sizes=list(inst.dynamic_slice_sizes))
+  elif op == 'dynamic-update-slice':
+    return dynamic_update_slice
+  elif op == 'concatenate':
+    axis = inst.dimensions[0]
+    return lambda *xs: np.concatenate(xs, axis)
+  elif op == 'pad':
+    config = inst.padding_config
+    return lambda x, value: pad(x, value, config)
+  elif op == 'dot':
+    dnums, dt = inst.dot_dimension_numbers, dtype_of(shape)
+    fn = lambda a, b: dot(a, b, dnums, dt)
+  elif op == 'convolution':
+    if inst.batch_group_count > 1:
+      raise Unimplemented('convolution with batch_group_count > 1')
+    window, dnums, groups = inst.window, inst.convolution_dimension_numbers, inst.feature_group_count
+    dt = dtype_of(shape)
+    fn = lambda a, b: convolution(a, b, window, dnums, groups, dt)
+  elif op == 'gather':
+    dnums, sizes = inst.gather_dimension_numbers, list(inst.gather_slice_sizes)
+    return lambda x, i: gather(x, i, dnums, sizes)
+  elif op == 'scatter':
+    dnums, combine = inst.scatter_dimension_numbers, called[0]
+    ufunc = combine.reducer()
+    combine = None if combine.assigns() else combine
+    return lambda x, i, u: scatter(x, i, u, dnums, combine, ufunc)
+  elif op == 'tuple':
+    return lambda *xs: xs
+  elif op == 'get-tuple-element':
+    index = inst.tuple_index
+    return lambda x: x[index]
+  elif op in ('call', 'fusion', 'map'):
+    return called[0]
+  elif op == 'while':
+    body, cond = called[0], called[1]
+    def loop(state):
+      while cond(state):
+        state = body(state)
+      return state
+    return loop
+  elif op == 'conditional':
+    def branch(index, *args):
+      index = np.asarray(index)
+      if index.dtype == np.bool_:
+        i = 0 if index else 1
+      else:
+        i = int(index)
+        i = i if 0 <= i < len(called) else len(called) - 1
+      return called[i](args[i])
+    return branch
+  elif op == 'reduce':
+    return lower_reduce(inst, called[0], len(operands) // 2, shape)
+  elif op == 'reduce-window':
+    if len(operands) != 2:
+      raise Unimplemented('variadic reduce-window')
+    window, comp = inst.window, called[0]
+    combine = comp.reducer() or comp
+    fn = lambda x, init: reduce_window(x, init, window, combine)
+  elif op == 'sort':
+    return lower_sort(inst, called[0], len(operands))
+  elif op == 'rng':
+    rng = np.random.default_rng()
+    dt = dtype_of(shape)
+    if inst.distribution == 2:  # RNG_NORMAL
+      return lambda mu, sigma: rng.normal(mu, sigma, out).astype(dt)
+    return lambda a, b: (rng.uniform(a, b, out) if np.issubdtype(dt, np.floating)
+                         else rng.integers(a, b, out)).astype(dt)
+  elif op == 'infeed':
+    data = shape.tuple_shapes[0]
+    return lambda token: (infeed(data), None)
+  elif op == 'outfeed':
+    data = operands[0].shape
+    return lambda x, token: outfeed(data, x)
+  elif op == 'after-all':
+    return lambda *_: None
+  elif op in ('partition-id', 'replica-id'):
+    return lambda: np.uint32(0)
+  elif op in ('all-reduce', 'all-gather', 'all-to-all', 'collective-permute'):
+    # A single replica: every collective is the identity.
+    return lambda *xs: xs[0] if len(xs) == 1 else xs
+  elif op == 'get-dimension-size':
+    size = np.int32(operands[0].shape.dimensions[inst.dimensions[0]])
+    return lambda x: size
+  if fn is None:
+    raise Unimplemented(f'HLO opcode {op!r} ({inst.name})')
+  if t == BF16:
+    inner = fn
+    fn = lambda *xs: to_bf16(inner(*xs))
+  return fn
+
+
+def lower_reduce(inst, comp, n, shape):
+  axes = tuple(inst.dimensions)
+  ufunc = comp.reducer() if n == 1 else None
+  if ufunc is not None:
+    dt = dtype_of(shape)
+    def reduce(x, init):
+      x = np.asarray(x)
+      if x.size == 0:
+        return np.broadcast_to(np.asarray(init, dt), shape.dimensions)
+      return ufunc(init, ufunc.reduce(x, axis=axes)).astype(dt, copy=False)
+    return reduce
+  # Anything else folds pairwise, which is exact for the associative
+  # reducers XLA assumes and takes log2(n) calls of the computation.
+  def reduce(*args):
+    xs, inits = args[:n], args[n:]
+    xs = [np.asarray(x) for x in xs]
+    keep = [d for d in range(xs[0].ndim) if d not in axes]
+    outer = [xs[0].shape[d] for d in keep]
+    xs = [x.transpose(keep + list(axes)).reshape(outer + [-1]) for x in xs]
+    while xs[0].shape[-1] > 1:
+      m = xs[0].shape[-1]
+      half = m // 2
+      combined = comp(*[x[..., :half] for x in xs], *[x[..., half:2 * half] for x in xs])
+      combined = combined if n > 1 else (combined,)
+      xs = [np.concatenate([c, x[..., 2 * half:]], -1) if m % 2 else c
+            for c, x in zip(combined, xs)]
+    if xs[0].shape[-1] == 0:
+      acc = [np.broadcast_to(i, outer) for i in inits]
+    else:
+      acc = comp(*[np.broadcast_to(i, outer) for i in inits], *[x[..., 0] for x in xs])
+      acc = acc if n > 1 else (acc,)
+    return tuple(acc) if n > 1 else acc[0]
+  return reduce
+
+
+def lower_sort(inst, comp, n):
+  axis = inst.dimensions[0]
+  root = comp.root_inst
+  insts = {i.id: i for i in comp.proto.instructions}
+  ops = [insts[o] for o in root.operand_ids]
+  simple = (root.opcode == 'compare' and root.comparison_direction in ('LT', 'GT')
+            and [op.opcode for op in ops] == ['parameter', 'parameter']
+            and [op.parameter_number for op in ops] in ([0, 1], [1, 0]))
+  if simple:
+    descending = (root.comparison_direction == 'GT') == ([op.parameter_number for op in ops] == [0, 1])
+    def sort(*xs):
+      key = np.asarray(xs[0])
+      if descending:
+        # ~ reverses integer and bool order without overflowing like - does
+        key = -key if np.issubdtype(key.dtype, np.inexact) else ~key
+      order = np.argsort(key, axis=axis, kind='stable')
+      out = tuple(np.take_along_axis(np.asarray(x), order, axis) for x in xs)
+      return out if n > 1 else out[0]
+    return sort
+  def sort(*xs):
+    xs = [np.moveaxis(np.asarray(x), axis, -1) for x in xs]
+    out = [np.empty_like(x) for x in xs]
+    for row in np.ndindex(*xs[0].shape[:-1]):
+      cols = [x[row] for x in xs]
+      def less(i, j):
+        if comp(*[v for c in cols for v in (c[i], c[j])]):
+          return -1
+        return 1 if comp(*[v for c in cols for v in (c[j], c[i])]) else 0
+      order = sorted(range(cols[0].shape[0]), key=functools.cmp_to_key(less))
+      for o, c in zip(out, cols):
+        o[row] = c[order]
+    out = tuple(np.moveaxis(o, -1, axis) for o in out)
+    return out if n > 1 else out[0]
+  return sort
+
+
+#
+# Device buffers
+#
+
+def read_array(addr, shape):
+  t = shape.element_type
+  dims = tuple(shape.dimensions)
+  count = int(np.prod(dims, dtype=np.int64))
+  storage = np.dtype(STORAGE[t])
+  if count == 0:
+    return np.zeros(dims, DTYPES[t])
+  buf = (ctypes.c_char * (count * storage.itemsize)).from_address(addr)
+  flat = np.frombuffer(buf, storage, count)
+  if t == BF16:
+    flat = from_bf16_bits(flat)
+  return to_logical(flat, shape)
+
+
+def write_array(addr, shape, value):
+  t = shape.element_type
+  dims = tuple(shape.dimensions)
+  count = int(np.prod(dims, dtype=np.int64))
+  storage = np.dtype(STORAGE[t])
+  if count == 0:
+    return
+  value = np.asarray(value)
+  if t == BF16:
+    value = bf16_bits(value)
+  buf = (ctypes.c_char * (count * storage.itemsize)).from_address(addr)
+  dst = np.frombuffer(buf, storage, count)
+  phys = to_physical(value, shape)
+  np.copyto(dst.reshape(phys.shape), phys, casting='unsafe')
+
+
+def read_tree(shape, tree):
+  if shape.element_type == TUPLE:
+    addr, children = tree
+    return tuple(read_tree(s, c) for s, c in zip(shape.tuple_shapes, children))
+  if shape.element_type == TOKEN:
+    return None
+  return read_array(tree, shape)
+
+
+def write_tree(shape, tree, value):
+  if shape.element_type == TUPLE:
+    addr, children = tree
+    write_index_table(addr, [root(c) for c in children])
+    for s, c, v in zip(shape.tuple_shapes, children, value):
+      write_tree(s, c, v)
+  elif shape.element_type != TOKEN:
+    write_array(tree, shape, value)
+
+
+def root(tree):
+  return tree[0] if isinstance(tree, tuple) else tree
+
+
+def write_index_table(addr, children):
+  if addr and children:
+    (ctypes.c_uint64 * len(children)).from_address(addr)[:] = children
+
+
+def tree_from_table(shape, addr):
+  """A buffer tree found by following tuple index tables in device memory."""
+  if shape.element_type != TUPLE:
+    return addr
+  n = len(shape.tuple_shapes)
+  children = (ctypes.c_uint64 * n).from_address(addr)[:] if n else []
+  return (addr, [tree_from_table(s, c) for s, c in zip(shape.tuple_shapes, children)])
+
+
+def tree_from_preorder(shape, addrs):
+  """A buffer tree from an iterator over its buffers in preorder, the way
+  ShapeTree and ShapedBuffer list them."""
+  addr = next(addrs)
+  if shape.element_type != TUPLE:
+    return addr
+  return (addr, [tree_from_preorder(s, addrs) for s in shape.tuple_shapes])
+
+
+def from_record(shape, data):
+  """A value from a feed record; see the module docstring."""
+  offset = 0
+  def value(shape):
+    nonlocal offset
+    t = shape.element_type
+    if t == TUPLE:
+      return tuple(value(s) for s in shape.tuple_shapes)
+    if t == TOKEN:
+      return None
+    count = int(np.prod(shape.dimensions, dtype=np.int64))
+    storage = np.dtype(STORAGE[t])
+    if offset + count * storage.itemsize > len(data):
+      raise ValueError(f'feed record of {len(data)} bytes is too short for its shape')
+    flat = np.frombuffer(data, storage, count, offset).copy()
+    offset += count * storage.itemsize
+    if t == BF16:
+      flat = from_bf16_bits(flat)
+    return to_logical(flat, shape)
+  result = value(shape)
+  if offset != len(data):
+    raise ValueError(f'feed record of {len(data)} bytes for a shape of {offset}')
+  return result
+
+
+def to_record(shape, value):
+  parts = []
+  def add(shape, value):
+    t = shape.element_type
+    if t == TUPLE:
+      for s, v in zip(shape.tuple_shapes, value):
+        add(s, v)
+    elif t != TOKEN:
+      value = bf16_bits(value) if t == BF16 else np.asarray(value)
+      parts.append(np.ascontiguousarray(to_physical(value, shape), STORAGE[t]).tobytes())
+  add(shape, value)
+  return b''.join(parts)
+
+
+# The device whose stream is running a program on this thread.
+running = threading.local()
+
+
+def infeed(shape):
+  return from_record(shape, libtpujesus.infeed_dequeue(getattr(running, 'device', 0)))
+
+
+def outfeed(shape, value):
+  libtpujesus.outfeed_enqueue(getattr(running, 'device', 0), to_record(shape, value))
+
+
+def subshapes(shape):
+  """The shape and its subshapes, in preorder."""
+  yield shape
+  if shape.element_type == TUPLE:
+    for s in shape.tuple_shapes:
+      yield from subshapes(s)
+
+
+class Executable:
+  def __init__(self, proto, data=b'', constants=None, fingerprint=None):
+    self.proto = proto
+    self.module = Module(proto, constants)
+    entry = self.module.entry
+    insts = entry.proto.instructions
+    self.parameter_shapes = [insts[slot].shape for slot in entry.params]
+    self.result_shape = entry.root_inst.shape
+    self.fingerprint = fingerprint or hashlib.sha256(data).hexdigest().encode()
+    self.image = None  # tpuprog.dumps(self), once asked for
+
+  @property
+  def name(self):
+    return self.proto.name
+
+  def evaluate(self, *args):
+    with np.errstate(all='ignore'):
+      return self.module.entry(*args)
+
+  def run(self, args, result, device=0):
+    """Run on device buffer trees; see the module docstring. `device` is
+    the ordinal whose feed queues infeed and outfeed use."""
+    with profiler.span(self.name, profiler.EXEC):
+      running.device = device
+      values = [read_tree(s, a) for s, a in zip(self.parameter_shapes, args)]
+      write_tree(self.result_shape, result, self.evaluate(*values))
+
+  def run_roots(self, args, result, device=0):
+    """Run with only each buffer tree's root address; the rest is found
+    through the tuple index tables."""
+    self.run([tree_from_table(s, a) for s, a in zip(self.parameter_shapes, args)],
+             tree_from_table(self.result_shape, result), device)
+
+
+def compile(proto, data=b'', constants=None, fingerprint=None):
+  """Build an Executable from an HloModuleProto; `data` is its serialized
+  form, for fingerprinting. `constants` maps instruction ids to values for
+  constants that have no literal in the proto."""
+  return Executable(proto, data, constants, fingerprint)
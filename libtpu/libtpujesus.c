@@ -116,360 +116,497 @@ local_repository(
 // Or you can roll the dice by emailing me at shawnpresser@gmail.com.
 // I occasionally check it.
 
-#include <Python.h>
+#include "libtpujesus.h"
 
 static PyObject *my_callback = NULL;
 
-#include <stdio.h>
-#include <stdlib.h>
+const char *const api_names[SYM_COUNT] = {
+#define TFTPU_SET_FN(api_fn, name) #name,
+#define TFTPU_SET_NATIVE_FN(api_fn, name) #name,
+#include "tpu_library_init_fns.inc"
+#include "tpu_executor_init_fns.inc"
+#undef TFTPU_SET_FN
+#undef TFTPU_SET_NATIVE_FN
+};
 
-#if 0
-// this is libtpu.h from tensorflow. Not strictly necessary yet.
-#include "libtpu.h"
-#else
-typedef int bool;
-#endif
+static const char api_native[SYM_COUNT] = {
+#define TFTPU_SET_FN(api_fn, name) 0,
+#define TFTPU_SET_NATIVE_FN(api_fn, name) 1,
+#include "tpu_library_init_fns.inc"
+#include "tpu_executor_init_fns.inc"
+#undef TFTPU_SET_FN
+#undef TFTPU_SET_NATIVE_FN
+};
+
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+// Tracing
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+//
+// Off by default. Turn it on with e.g.
+//
+//   LIBTPU_TRACE=1                          every API call, raw arguments
+//   LIBTPU_TRACE=2:TpuExecutor_*,TpuStatus_Ok   decoded Python-side args too
+//   LIBTPU_TRACE=3                          plus libtpu's own debug messages
+//   LIBTPU_TRACE_FILE=/tmp/libtpu.trace     write there instead of stderr
+//
+// or libtpujesus.set_trace(level, filter), or the libtpu_trace option of
+// TpuPlatform_Initialize. When tracing is off, the only cost on the call
+// path is the trace_level check; nothing is formatted.
+//
+// Output goes into a 64KB buffer that is written out when it fills up,
+// on trace_flush(), and at exit. A trace file is opened O_NONBLOCK, and
+// if the sink can't keep up the buffered lines are dropped and counted
+// rather than stalling the caller.
+
+volatile int trace_level = TRACE_OFF;
+unsigned char trace_on[SYM_COUNT];
+
+static int trace_fd = 2;
+static char trace_buf[1 << 16];
+static size_t trace_len = 0;
+static uint64_t trace_dropped = 0;
+static pthread_mutex_t trace_mu = PTHREAD_MUTEX_INITIALIZER;
+
+static void
+trace_flush_locked(void)
+{
+    size_t off = 0;
+    while (off < trace_len) {
+        ssize_t n = write(trace_fd, trace_buf + off, trace_len - off);
+        if (n > 0) {
+            off += n;
+        } else if (n < 0 && errno == EINTR) {
+            continue;
+        } else {
+            trace_dropped += trace_len - off;
+            break;
+        }
+    }
+    trace_len = 0;
+}
+
+static void
+trace_flush(void)
+{
+    pthread_mutex_lock(&trace_mu);
+    trace_flush_locked();
+    pthread_mutex_unlock(&trace_mu);
+}
+
+static void
+trace_write(const char *s, size_t n)
+{
+    pthread_mutex_lock(&trace_mu);
+    if (trace_len + n > sizeof(trace_buf)) {
+        trace_flush_locked();
+    }
+    if (n > sizeof(trace_buf)) {
+        n = sizeof(trace_buf);
+    }
+    memcpy(trace_buf + trace_len, s, n);
+    trace_len += n;
+    pthread_mutex_unlock(&trace_mu);
+}
+
+void
+trace_printf(const char *fmt, ...)
+{
+    char line[1024];
+    va_list ap;
+    int n;
+
+    va_start(ap, fmt);
+    n = vsnprintf(line, sizeof(line), fmt, ap);
+    va_end(ap);
+    if (n < 0)
+        return;
+    if ((size_t)n >= sizeof(line))
+        n = sizeof(line) - 1;
+    trace_write(line, n);
+}
+
+static int
+trace_match(const char *name, const char *filter)
+{
+    const char *tok = filter;
+    while (*tok) {
+        const char *end = strchr(tok, ',');
+        size_t len = end ? (size_t)(end - tok) : strlen(tok);
+        if (len > 0 && tok[len - 1] == '*') {
+            if (strncmp(name, tok, len - 1) == 0)
+                return 1;
+        } else if (len > 0 && strlen(name) == len && strncmp(name, tok, len) == 0) {
+            return 1;
+        }
+        if (!end)
+            break;
+        tok = end + 1;
+    }
+    return 0;
+}
+
+static void
+trace_set(int level, const char *filter)
+{
+    int i;
+    for (i = 0; i < SYM_COUNT; i++) {
+        trace_on[i] = (!filter || !*filter || trace_match(api_names[i], filter));
+    }
+    trace_level = level;
+}
+
+static void
+trace_init(void)
+{
+    static int initialized = 0;
+    const char *spec;
+    const char *path;
+
+    if (initialized)
+        return;
+    initialized = 1;
+    path = getenv("LIBTPU_TRACE_FILE");
+    if (path && *path) {
+        int fd = open(path, O_WRONLY | O_CREAT | O_APPEND | O_NONBLOCK | O_CLOEXEC, 0644);
+        if (fd >= 0) {
+            trace_fd = fd;
+        } else {
+            fprintf(stderr, "libtpujesus: can't open LIBTPU_TRACE_FILE %s: %s\n", path, strerror(errno));
+        }
+    }
+    spec = getenv("LIBTPU_TRACE");
+    if (spec && *spec) {
+        const char *colon = strchr(spec, ':');
+        trace_set(atoi(spec), colon ? colon + 1 : NULL);
+    } else {
+        trace_set(TRACE_OFF, NULL);
+    }
+    atexit(trace_flush);
+}
+
+
+//
+// Stats
+//
+// Every api_call bumps per-symbol counters and two log2-bucketed latency
+// histograms: one for the whole call as seen from C (argument boxing,
+// the Python call, result unboxing) and one for just the Python side.
+// Bucket b counts calls that took [2^b, 2^(b+1)) ns. Updates are relaxed
+// atomics, so readers may see a call counted in one field but not yet in
+// another; nothing takes a lock on the hot path.
+//
+// LIBTPU_STATS_DUMP=<path> (or "-" for stderr) writes a table sorted by
+// total time at exit.
+
+#define STATS_BUCKETS 40
+
+typedef struct {
+  uint64_t calls;
+  uint64_t errors;
+  uint64_t total_ns;
+  uint64_t python_ns;
+  uint64_t max_ns;
+  uint64_t hist[STATS_BUCKETS];
+  uint64_t python_hist[STATS_BUCKETS];
+} api_stat_t;
+
+static api_stat_t api_stats[SYM_COUNT];
+static const char *stats_dump_path = NULL;
+
+static inline int
+stats_bucket(uint64_t ns)
+{
+    int b = 63 - __builtin_clzll(ns | 1);
+    return b < STATS_BUCKETS ? b : STATS_BUCKETS - 1;
+}
+
+void
+stats_record(int sym, uint64_t total_ns, uint64_t python_ns)
+{
+    api_stat_t *st = &api_stats[sym];
+    uint64_t max = STAT_GET(st->max_ns);
+
+    STAT_ADD(st->calls, 1);
+    STAT_ADD(st->total_ns, total_ns);
+    STAT_ADD(st->python_ns, python_ns);
+    STAT_ADD(st->hist[stats_bucket(total_ns)], 1);
+    STAT_ADD(st->python_hist[stats_bucket(python_ns)], 1);
+    while (total_ns > max &&
+           !__atomic_compare_exchange_n(&st->max_ns, &max, total_ns, 1,
+                                        __ATOMIC_RELAXED, __ATOMIC_RELAXED)) {
+    }
+}
+
+static void
+stats_reset(void)
+{
+    int i, b;
+    for (i = 0; i < SYM_COUNT; i++) {
+        api_stat_t *st = &api_stats[i];
+        __atomic_store_n(&st->calls, 0, __ATOMIC_RELAXED);
+        __atomic_store_n(&st->errors, 0, __ATOMIC_RELAXED);
+        __atomic_store_n(&st->total_ns, 0, __ATOMIC_RELAXED);
+        __atomic_store_n(&st->python_ns, 0, __ATOMIC_RELAXED);
+        __atomic_store_n(&st->max_ns, 0, __ATOMIC_RELAXED);
+        for (b = 0; b < STATS_BUCKETS; b++) {
+            __atomic_store_n(&st->hist[b], 0, __ATOMIC_RELAXED);
+            __atomic_store_n(&st->python_hist[b], 0, __ATOMIC_RELAXED);
+        }
+    }
+}
+
+/* Upper bound of the bucket holding the q-th quantile, in ns. */
+static uint64_t
+stats_quantile(const uint64_t *hist, uint64_t calls, double q)
+{
+    uint64_t seen = 0, want = (uint64_t)(calls * q);
+    int b;
+    for (b = 0; b < STATS_BUCKETS; b++) {
+        seen += STAT_GET(hist[b]);
+        if (seen > want)
+            return 2ull << b;
+    }
+    return 2ull << (STATS_BUCKETS - 1);
+}
+
+static int
+stats_cmp(const void *a, const void *b)
+{
+    uint64_t x = STAT_GET(api_stats[*(const int *)a].total_ns);
+    uint64_t y = STAT_GET(api_stats[*(const int *)b].total_ns);
+    return x < y ? 1 : x > y ? -1 : 0;
+}
+
+static void
+stats_dump(void)
+{
+    int order[SYM_COUNT];
+    int i, n = 0;
+    FILE *out;
+
+    if (!stats_dump_path)
+        return;
+    if (strcmp(stats_dump_path, "-") == 0) {
+        out = stderr;
+    } else if (!(out = fopen(stats_dump_path, "w"))) {
+        fprintf(stderr, "libtpujesus: can't open LIBTPU_STATS_DUMP %s: %s\n", stats_dump_path, strerror(errno));
+        return;
+    }
+    for (i = 0; i < SYM_COUNT; i++) {
+        if (STAT_GET(api_stats[i].calls))
+            order[n++] = i;
+    }
+    qsort(order, n, sizeof(order[0]), stats_cmp);
+    fprintf(out, "%-48s %10s %6s %12s %12s %10s %10s %10s %10s\n",
+            "symbol", "calls", "errors", "total_ms", "python_ms", "mean_us", "p50_us", "p99_us", "max_us");
+    for (i = 0; i < n; i++) {
+        api_stat_t *st = &api_stats[order[i]];
+        uint64_t calls = STAT_GET(st->calls);
+        fprintf(out, "%-48s %10" PRIu64 " %6" PRIu64 " %12.3f %12.3f %10.2f %10.2f %10.2f %10.2f\n",
+                api_names[order[i]], calls, STAT_GET(st->errors),
+                STAT_GET(st->total_ns) / 1e6, STAT_GET(st->python_ns) / 1e6,
+                STAT_GET(st->total_ns) / 1e3 / calls,
+                stats_quantile(st->hist, calls, 0.50) / 1e3,
+                stats_quantile(st->hist, calls, 0.99) / 1e3,
+                STAT_GET(st->max_ns) / 1e3);
+    }
+    pool_dump(out);
+    if (out == stderr) {
+        fflush(out);
+    } else {
+        fclose(out);
+    }
+}
+
+static void
+stats_init(void)
+{
+    static int initialized = 0;
+    const char *path;
+
+    if (initialized)
+        return;
+    initialized = 1;
+    path = getenv("LIBTPU_STATS_DUMP");
+    if (path && *path) {
+        stats_dump_path = strdup(path);
+        atexit(stats_dump);
+    }
+}
 
 //void TpuDriver_Initialize(struct TpuDriverFn* driver_fn, bool initialize) { printf("TpuDriver_Initialize\n"); }
 
-void import_libtpu() {
-  /* 1st: Import the module */
-  PyObject *pylibtpu = PyImport_ImportModule("libtpu");
-  if (!pylibtpu) {
-    PyErr_Print();
-    printf("libtpujesus: Error importing libtpu\n");
-  }
-#if 0
-  PyObject* ModuleString = PyString_FromString((char*) "libtpu");
-  if (!ModuleString) {
-    PyErr_Print();
-    printf("libtpujesus: Error importing libtpu\n");
-  }
+static int libtpu_import_failed;
 
-  PyObject* Module = PyImport_Import(ModuleString);
-  if (!Module) {
-    PyErr_Print();
-    printf("libtpujesus: Error importing libtpu\n");
-  }
+/* Import libtpu, which registers the Python implementations through
+   set_callback. Needs the GIL. */
+static int
+import_libtpu(void)
+{
+    PyObject *pylibtpu = PyImport_ImportModule("libtpu");
 
-  /* 2nd: Getting reference to the function */
-  PyObject* Function = PyObject_GetAttrString(Module, (char*)"link_list");
-  if (!Function) {
-    PyErr_Print();
-    printf("libtpujesus: Error getting link_list()\n");
-  }
-#endif
+    if (!pylibtpu) {
+        PyErr_Print();
+        fprintf(stderr, "libtpujesus: Error importing libtpu\n");
+        return -1;
+    }
+    Py_DECREF(pylibtpu);
+    return 0;
 }
 
 // tensorflow/core/tpu/tpu_api_dlsym_initializer.cc:64
 void TfTpu_Initialize(bool init_library, int num_args, const char** args) {
-  printf("TfTpu_Initialize(init_library=%d, num_args=%d)\n", init_library, num_args);
+  trace_init();
+  stats_init();
+  TRACE(TRACE_CALLS, "TfTpu_Initialize(init_library=%d, num_args=%d)\n", init_library, num_args);
   for (int i = 0; i < num_args; i++) {
-    printf("  args[%d] = \"%s\"\n", i, args[i]);
+    TRACE(TRACE_CALLS, "  args[%d] = \"%s\"\n", i, args[i]);
   }
-  import_libtpu();
-}
-
-
-#include <inttypes.h>
-
-typedef ssize_t ret_t;
-
-#define STUB(x) ret_t x(ret_t arg1, ret_t arg2, ret_t arg3, ret_t arg4, ret_t arg5) { \
-    void* p = NULL; \
-    void* arg = (void*)&p; \
-    void** argv = &p; \
-    ret_t ret = 0; \
-    printf("libtpujesus.so: " #x " called(%"PRId64",%"PRId64",%"PRId64",%"PRId64",%"PRId64")\n", arg1, arg2, arg3, arg4, arg5); \
-    if (my_callback) { \
-        printf("libtpujesus.so: " #x " building...\n"); \
-        /* Time to call the callback */ \
-        /*PyObject* arglist = Py_BuildValue("(s, L, L, L, L, L, L, L)", #x, argv, arg, arg1, arg2, arg3, arg4, arg5);*/ \
-        PyObject* arglist = Py_BuildValue("(s, L, L, L, L, L, L, L)", #x, 0, 0, arg1, arg2, arg3, arg4, arg5); \
-        printf("libtpujesus.so: " #x " calling...\n"); \
-        PyObject* result = PyObject_CallObject(my_callback, arglist); \
-        printf("libtpujesus.so: " #x " returned\n"); \
-        Py_DECREF(arglist); \
-        if (result) { \
-          ret_t i = 0; \
-          if (PyArg_ParseTuple(result, "L", &i)) { \
-            ret = i; \
-          } else { \
-            printf("libtpujesus.so: " #x " FAILED TO PARSE RESULT\n"); \
-          } \
-          Py_DECREF(result); \
-        } \
-    } \
-    printf("libtpujesus.so: returning %"PRId64" from " #x " callback\n", (long long)ret); \
-    /*return Py_BuildValue("i", 42);*/ \
-    return ret; \
-}
-
-//STUB(ConfigureDistributedTpuOp_DoWork)
-
-#if 0
-tensorflow::Status SetTpuOpsStructFns(void* library_handle) {
-  // Constant cast so that we can initialize the functions. The functions are
-  // mutable here because this is the only place where they are initialized.
-  auto* ops_api_fn = const_cast<TfTpu_OpsApiFn*>(tensorflow::tpu::OpsApiFn());
-#endif
+  if (Py_IsInitialized()) {
+    PyGILState_STATE gil = PyGILState_Ensure();
+    import_libtpu();
+    PyGILState_Release(gil);
+  }
+}
 
-#define TFTPU_SET_FN(api_fn, name) STUB(name)
-  TFTPU_SET_FN(ops_api_fn, ConfigureDistributedTpuOp_DoWork);
-  TFTPU_SET_FN(ops_api_fn, WaitForDistributedTpuOp_DoWork);
-  TFTPU_SET_FN(ops_api_fn, InitializeHostForDistributedTpuOp_DoWork);
-  TFTPU_SET_FN(ops_api_fn, SetGlobalTPUArrayOp_DoWork);
-  TFTPU_SET_FN(ops_api_fn, DisconnectDistributedTpuChipsOp_DoWork);
-  TFTPU_SET_FN(ops_api_fn, TpuConfigurationApi_FreeCharArray);
-  TFTPU_SET_FN(ops_api_fn, TpuConfigurationApi_FreeInt32Array);
-  TFTPU_SET_FN(ops_api_fn, TpuConfigurationApi_HasTPUPodState);
-  TFTPU_SET_FN(ops_api_fn, TpuConfigurationApi_TpusPerHost);
-  TFTPU_SET_FN(ops_api_fn, TpuConfigurationApi_TpuMemoryLimit);
-  TFTPU_SET_FN(ops_api_fn,
-               TpuConfigurationApi_RemoteCompilationCacheSizeInBytes);
-  TFTPU_SET_FN(ops_api_fn,
-               TpuConfigurationApi_CompilationCacheServerAddressFromConfig);
-  TFTPU_SET_FN(ops_api_fn, TpuConfigurationApi_GetServerAddressAndPort);
-
-  TFTPU_SET_FN(ops_api_fn, TpuMeshState_Create);
-  TFTPU_SET_FN(ops_api_fn, TpuMeshState_Free);
-  TFTPU_SET_FN(ops_api_fn, TpuMeshState_MeshCommonState);
-
-  TFTPU_SET_FN(ops_api_fn, TpuCompile_CompileAndBuild);
-  TFTPU_SET_FN(ops_api_fn, TpuCompile_XrtCompileAndBuild);
-
-  TFTPU_SET_FN(ops_api_fn, TpuExecutable_LoadProgramAndEnqueueToStream);
-  TFTPU_SET_FN(ops_api_fn, HardwareLayout_HostShapeToDeviceShape);
-  TFTPU_SET_FN(ops_api_fn, HardwareLayout_ShapeSize);
-  TFTPU_SET_FN(ops_api_fn, HardwareLayout_ShapeSizeCompact);
-  TFTPU_SET_FN(ops_api_fn, HardwareLayout_ShapeSizeCompactRaw);
-
-  TFTPU_SET_FN(ops_api_fn, TpuExecute_RuntimeInputToPaddedData);
-
-  TFTPU_SET_FN(ops_api_fn, TpuProgram_New);
-  TFTPU_SET_FN(ops_api_fn, TpuProgram_Free);
-  TFTPU_SET_FN(ops_api_fn, TpuProgram_NewArray);
-  TFTPU_SET_FN(ops_api_fn, TpuProgram_FreeArray);
-  TFTPU_SET_FN(ops_api_fn, TpuProgram_UnloadAndDestroy);
-  TFTPU_SET_FN(ops_api_fn, TpuProgram_GetProgramSize);
-  TFTPU_SET_FN(ops_api_fn, TpuProgram_LogProgramMemorySummary);
-  TFTPU_SET_FN(ops_api_fn, TpuProgram_GetExecutableInfo);
-  TFTPU_SET_FN(ops_api_fn, TpuProgram_GetHostTransferInfo);
-  TFTPU_SET_FN(ops_api_fn, TpuProgram_GetHloMetadata);
-  TFTPU_SET_FN(ops_api_fn, TpuProgram_GetMayModifyVariables);
-  TFTPU_SET_FN(ops_api_fn, TpuProgram_HasSharding);
-  TFTPU_SET_FN(ops_api_fn, TpuProgram_GetTpuProgram);
-  TFTPU_SET_FN(ops_api_fn, TpuProgram_SerializeTpuExecutable);
-  TFTPU_SET_FN(ops_api_fn, TpuProgram_SerializeCompilerMetadata);
-  TFTPU_SET_FN(ops_api_fn,
-               TpuProgram_DeserializeFromGetTpuProgramResponseProto);
-  TFTPU_SET_FN(ops_api_fn, TpuProgram_GetFingerprint);
-  TFTPU_SET_FN(ops_api_fn, TpuProgram_DestroyFingerprint);
-
-  TFTPU_SET_FN(ops_api_fn, TpuNodeContext_Create);
-  TFTPU_SET_FN(ops_api_fn, TpuNodeContext_Free);
-  TFTPU_SET_FN(ops_api_fn, TpuNodeContext_Initialize);
-  TFTPU_SET_FN(ops_api_fn, TpuNodeContext_StopChipHeartbeats);
-  TFTPU_SET_FN(ops_api_fn, TpuNodeContext_CloseTpuHost);
-  TFTPU_SET_FN(ops_api_fn, TpuNodeContext_CompactionSupported);
-
-  TFTPU_SET_FN(ops_api_fn, TpuTopology_AvailableCoreCount);
-  TFTPU_SET_FN(ops_api_fn, TpuNetUtil_RecycleUnusedPort);
-  TFTPU_SET_FN(ops_api_fn, TpuCompile_IsTpuCompilationEnabled);
-  TFTPU_SET_FN(ops_api_fn, TpuCompile_ShouldTpuCompileOpIgnoreCancellation);
-  TFTPU_SET_FN(ops_api_fn, TpuCompile_CreateCompilationCacheKey);
-  TFTPU_SET_FN(ops_api_fn, TpuCompile_DestroyCompilationCacheKey);
-  TFTPU_SET_FN(ops_api_fn, TpuCompile_CreateGuaranteedConstFingerprint);
-
-  TFTPU_SET_FN(ops_api_fn, TpuProfiler_Create);
-  TFTPU_SET_FN(ops_api_fn, TpuProfiler_Destroy);
-  TFTPU_SET_FN(ops_api_fn, TpuProfiler_Start);
-  TFTPU_SET_FN(ops_api_fn, TpuProfiler_Stop);
-  TFTPU_SET_FN(ops_api_fn, TpuProfiler_CollectData);
-
-  TFTPU_SET_FN(ops_api_fn, TfTpu_InitializeTpuModelServer);
-
-  TFTPU_SET_FN(ops_api_fn, TfTpuOrdinalSelector_Create);
-  TFTPU_SET_FN(ops_api_fn, TfTpuOrdinalSelector_Destroy);
-  TFTPU_SET_FN(ops_api_fn, TfTpuOrdinalSelector_GetOrdinal);
-  TFTPU_SET_FN(ops_api_fn, TfTpuOrdinalSelector_DequeueFromCoreSelector);
-  TFTPU_SET_FN(ops_api_fn, TfTpu_GetTpuPartitionedCallParams);
-#undef TFTPU_SET_FN
 
-#if 0
-  return tensorflow::Status::OK();
-}
+static PyObject *api_fns[SYM_COUNT];
+static PyObject *api_traced[SYM_COUNT];  /* callable.traced, used at TRACE_ARGS */
+static char api_warned[SYM_COUNT];
+
+#if PY_VERSION_HEX >= 0x03090000
+#define api_vectorcall(fn, args, nargs) PyObject_Vectorcall(fn, args, nargs, NULL)
+#elif PY_VERSION_HEX >= 0x03080000
+#define api_vectorcall(fn, args, nargs) _PyObject_Vectorcall(fn, args, nargs, NULL)
+#else
+#define api_vectorcall(fn, args, nargs) _PyObject_FastCall(fn, args, nargs)
 #endif
 
+static PyObject *
+symbols_tuple(void)
+{
+    static PyObject *names = NULL;
+    int i;
 
-#if 0
-tensorflow::Status SetExecutorStructFn(void* library_handle) {
-  auto* executor_fn = tensorflow::tpu::ExecutorApiFn();
-#endif
+    if (!names) {
+        names = PyTuple_New(SYM_COUNT);
+        if (!names)
+            return NULL;
+        for (i = 0; i < SYM_COUNT; i++) {
+            PyObject *name = PyUnicode_InternFromString(api_names[i]);
+            if (!name) {
+                Py_CLEAR(names);
+                return NULL;
+            }
+            PyTuple_SET_ITEM(names, i, name);
+        }
+    }
+    return names;
+}
 
-#define TFTPU_SET_FN(api_fn, name) STUB(name)
-  TFTPU_SET_FN(executor_fn, TpuPlatform_New);
-  TFTPU_SET_FN(executor_fn, TpuPlatform_Free);
-  TFTPU_SET_FN(executor_fn, TpuPlatform_Initialize);
-  TFTPU_SET_FN(executor_fn, TpuPlatform_Initialized);
-  TFTPU_SET_FN(executor_fn, TpuPlatform_GetExecutor);
-  TFTPU_SET_FN(executor_fn, TpuPlatform_Id);
-  TFTPU_SET_FN(executor_fn, TpuPlatform_VisibleDeviceCount);
-  TFTPU_SET_FN(executor_fn, TpuPlatform_TpuMemoryLimit);
-  TFTPU_SET_FN(executor_fn, TpuPlatform_ShouldRegisterTpuDeviceToDeviceCopy);
-  TFTPU_SET_FN(executor_fn, TpuPlatform_GetTopologyPtr);
-  TFTPU_SET_FN(executor_fn, TpuPlatform_GetHostLocation);
-  TFTPU_SET_FN(executor_fn, TpuPlatform_GetRuntimeVersion);
-
-  TFTPU_SET_FN(executor_fn, TpuExecutor_Init);
-  TFTPU_SET_FN(executor_fn, TpuExecutor_Free);
-  TFTPU_SET_FN(executor_fn, TpuExecutor_PlatformDeviceCount);
-  TFTPU_SET_FN(executor_fn, TpuExecutor_Allocate);
-  TFTPU_SET_FN(executor_fn, TpuExecutor_Deallocate);
-  TFTPU_SET_FN(executor_fn, TpuExecutor_GetAllocatorStats);
-  TFTPU_SET_FN(executor_fn, TpuExecutor_DeviceMemoryUsage);
-  TFTPU_SET_FN(executor_fn, TpuExecutor_AllocateStream);
-  TFTPU_SET_FN(executor_fn, TpuExecutor_DeallocateStream);
-  TFTPU_SET_FN(executor_fn, TpuExecutor_CreateStreamDependency);
-  TFTPU_SET_FN(executor_fn, TpuExecutor_GetStatus);
-  TFTPU_SET_FN(executor_fn, TpuExecutor_GetCoreLocation);
-  TFTPU_SET_FN(executor_fn, TpuExecutor_AllocateEvent);
-  TFTPU_SET_FN(executor_fn, TpuExecutor_DeallocateEvent);
-  TFTPU_SET_FN(executor_fn, TpuExecutor_PollForEventStatus);
-  TFTPU_SET_FN(executor_fn, TpuExecutor_RecordEvent);
-  TFTPU_SET_FN(executor_fn, TpuExecutor_WaitForEvent);
-  TFTPU_SET_FN(executor_fn, TpuExecutor_AllocateTimer);
-  TFTPU_SET_FN(executor_fn, TpuExecutor_DeallocateTimer);
-  TFTPU_SET_FN(executor_fn, TpuExecutor_StartTimer);
-  TFTPU_SET_FN(executor_fn, TpuExecutor_StopTimer);
-  TFTPU_SET_FN(executor_fn, TpuExecutor_SynchronousMemcpyToHost);
-  TFTPU_SET_FN(executor_fn, TpuExecutor_SynchronousMemcpyFromHost);
-  TFTPU_SET_FN(executor_fn, TpuExecutor_MemcpyToHost);
-  TFTPU_SET_FN(executor_fn, TpuExecutor_MemcpyFromHost);
-  TFTPU_SET_FN(executor_fn, TpuExecutor_EnqueueInfeed);
-  TFTPU_SET_FN(executor_fn, TpuExecutor_DequeueOutfeed);
-  TFTPU_SET_FN(executor_fn, TpuExecutor_WaitForInfeedReady);
-  TFTPU_SET_FN(executor_fn, TpuExecutor_WaitForOutfeedReady);
-  TFTPU_SET_FN(executor_fn, TpuExecutor_BlockHostUntilDone);
-  TFTPU_SET_FN(executor_fn, TpuExecutor_BlockUntilDoneOrFailed);
-  TFTPU_SET_FN(executor_fn, TpuExecutor_SyncAndForgetFailedStreams);
-  TFTPU_SET_FN(executor_fn, TpuExecutor_SynchronizeAllActivity);
-  TFTPU_SET_FN(executor_fn, TpuExecutor_UnloadAllPrograms);
-  TFTPU_SET_FN(executor_fn, TpuExecutor_EnqueueCompactionOnStreamForHbm);
-
-  TFTPU_SET_FN(executor_fn, TpuStream_New);
-  TFTPU_SET_FN(executor_fn, TpuStream_Free);
-  TFTPU_SET_FN(executor_fn, TpuStream_Stream);
-  TFTPU_SET_FN(executor_fn, TpuStream_Status);
-  TFTPU_SET_FN(executor_fn, TpuStream_IsSameSharedMemoryLocation);
-  TFTPU_SET_FN(executor_fn, TpuStream_EnqueueTransferHostToDevice);
-  TFTPU_SET_FN(executor_fn, TpuStream_EnqueueTransferDeviceToHost);
-  TFTPU_SET_FN(executor_fn, TpuStream_TpuEnqueueOnDeviceSendRecvLocal);
-
-  TFTPU_SET_FN(executor_fn, TpuEvent_New);
-  TFTPU_SET_FN(executor_fn, TpuEvent_Free);
-
-  TFTPU_SET_FN(executor_fn, TpuTimer_New);
-  TFTPU_SET_FN(executor_fn, TpuTimer_Free);
-  TFTPU_SET_FN(executor_fn, TpuTimer_Nanoseconds);
-  TFTPU_SET_FN(executor_fn, TpuTimer_Microseconds);
-
-  TFTPU_SET_FN(executor_fn, TpuStatus_New);
-  TFTPU_SET_FN(executor_fn, TpuStatus_Create);
-  TFTPU_SET_FN(executor_fn, TpuStatus_Set);
-  TFTPU_SET_FN(executor_fn, TpuStatus_Free);
-  TFTPU_SET_FN(executor_fn, TpuStatus_Message);
-  TFTPU_SET_FN(executor_fn, TpuStatus_Code);
-  TFTPU_SET_FN(executor_fn, TpuStatus_Ok);
-
-  TFTPU_SET_FN(executor_fn, TpuStreamExecutorConfig_Default);
-  TFTPU_SET_FN(executor_fn, TpuStreamExecutorConfig_SetOrdinal);
-  TFTPU_SET_FN(executor_fn, TpuStreamExecutorConfig_Free);
-
-  TFTPU_SET_FN(executor_fn, TpuDeviceDescription_New);
-  TFTPU_SET_FN(executor_fn, TpuDeviceDescription_Free);
-
-  TFTPU_SET_FN(executor_fn, TpuExecutor_CreateDeviceDescription);
-  TFTPU_SET_FN(executor_fn, TpuExecutor_NewDeviceOptions);
-  TFTPU_SET_FN(executor_fn, TpuExecutor_FreeDeviceOptions);
-  TFTPU_SET_FN(executor_fn, TpuExecutor_HostCallback);
-
-  TFTPU_SET_FN(executor_fn, TpuTransferManager_New);
-  TFTPU_SET_FN(executor_fn, TpuTransferManager_Free);
-  TFTPU_SET_FN(executor_fn, TpuTransferManager_PlatformId);
-  TFTPU_SET_FN(executor_fn, TpuTransferManager_HostShapeToDeviceShape);
-  TFTPU_SET_FN(executor_fn, TpuTransferManager_TransferLiteralToDeviceAsync);
-  TFTPU_SET_FN(executor_fn, TpuTransferManager_TransferLiteralFromDevice);
-  TFTPU_SET_FN(executor_fn, TpuTransferManager_GetByteSizeRequirement);
-  TFTPU_SET_FN(executor_fn, TpuTransferManager_ChooseCompactLayoutForShape);
-  TFTPU_SET_FN(executor_fn, TpuTransferManager_CanShapedBufferBeAccessedNow);
-  TFTPU_SET_FN(executor_fn, TpuTransferManager_CanBufferBeAccessedNow);
-  TFTPU_SET_FN(executor_fn, TpuTransferManager_WriteSingleTupleIndexTable);
-  TFTPU_SET_FN(executor_fn, TpuTransferManager_GetInfeedLayout);
-  TFTPU_SET_FN(executor_fn, TpuTransferManager_LinearizeToBuffers);
-  TFTPU_SET_FN(executor_fn, TpuTransferManager_FreeBuffers);
-  TFTPU_SET_FN(executor_fn, TpuTransferManager_TransferLiteralToInfeed);
-  TFTPU_SET_FN(executor_fn, TpuTransferManager_TransferBuffersToInfeed);
-  TFTPU_SET_FN(executor_fn, TpuTransferManager_TransferLiteralFromOutfeed);
-  TFTPU_SET_FN(executor_fn, TpuTransferManager_ResetDevices);
-  TFTPU_SET_FN(executor_fn, TpuTransferManager_ReadDynamicShapes);
-
-  TFTPU_SET_FN(executor_fn, TpuComputationPlacer_New);
-  TFTPU_SET_FN(executor_fn, TpuComputationPlacer_Free);
-  TFTPU_SET_FN(executor_fn, TpuComputationPlacer_AssignDevices);
-  TFTPU_SET_FN(executor_fn, TpuComputationPlacer_AssignLocalDevices);
-
-  TFTPU_SET_FN(executor_fn, TpuTopology_LogicalDevicesPerHost);
-  TFTPU_SET_FN(executor_fn, TpuTopology_LogicalDevicesPerChip);
-  TFTPU_SET_FN(executor_fn, TpuTopology_HostCount);
-  TFTPU_SET_FN(executor_fn, TpuTopology_ChipsPerHost);
-  TFTPU_SET_FN(executor_fn, TpuTopology_ChipBounds_X);
-  TFTPU_SET_FN(executor_fn, TpuTopology_ChipBounds_Y);
-  TFTPU_SET_FN(executor_fn, TpuTopology_ChipBounds_Z);
-  TFTPU_SET_FN(executor_fn, TpuTopology_HasChip);
-  TFTPU_SET_FN(executor_fn, TpuTopology_CoreForId);
-  TFTPU_SET_FN(executor_fn, TpuTopology_Core);
-  TFTPU_SET_FN(executor_fn, TpuTopology_NumCores);
-  TFTPU_SET_FN(executor_fn, TpuTopology_Cores);
-  TFTPU_SET_FN(executor_fn, TpuTopology_IdForHost);
-  TFTPU_SET_FN(executor_fn, TpuTopology_Version);
-
-  TFTPU_SET_FN(executor_fn, TpuCoreLocation_ChipCoordinates);
-  TFTPU_SET_FN(executor_fn, TpuCoreLocation_HostCoordinates);
-  TFTPU_SET_FN(executor_fn, TpuCoreLocation_Index);
-  TFTPU_SET_FN(executor_fn, TpuCoreLocation_Id);
-
-  TFTPU_SET_FN(executor_fn, TpuHostLocation_Id);
-  TFTPU_SET_FN(executor_fn, TpuHostLocation_NumCores);
-  TFTPU_SET_FN(executor_fn, TpuHostLocation_Cores);
-
-  TFTPU_SET_FN(executor_fn, TpuCompiler_New);
-  TFTPU_SET_FN(executor_fn, TpuCompiler_Free);
-
-  TFTPU_SET_FN(executor_fn, TpuCompiler_RunHloPasses);
-  TFTPU_SET_FN(executor_fn, TpuCompiler_RunBackend);
-  TFTPU_SET_FN(executor_fn, TpuCompiler_Compile);
-  TFTPU_SET_FN(executor_fn, TpuCompiler_ShapeSize);
-  TFTPU_SET_FN(executor_fn, TpuExecutable_ExecuteAsyncOnStream);
-  TFTPU_SET_FN(executor_fn, TpuExecutable_FreeXlaShapeIndexArray);
-  TFTPU_SET_FN(executor_fn, TpuExecutable_FreeMaybeOwningDeviceMemoryArray);
-  TFTPU_SET_FN(executor_fn, TpuExecutable_Fingerprint);
-  TFTPU_SET_FN(executor_fn, TpuExecutable_Serialize);
-  TFTPU_SET_FN(executor_fn, TpuExecutableSerialize_GetByteSize);
-  TFTPU_SET_FN(executor_fn, TpuExecutableSerialize_WriteToArray);
-  TFTPU_SET_FN(executor_fn, TpuExecutableSerialize_FreeHandle);
-  TFTPU_SET_FN(executor_fn, TpuExecutable_Deserialize);
-  TFTPU_SET_FN(executor_fn, TpuExecutable_HloModule);
-  TFTPU_SET_FN(executor_fn, TpuExecutable_Free);
-
-  TFTPU_SET_FN(executor_fn, XlaShapeToTpuShapeRepresentation);
-  TFTPU_SET_FN(executor_fn, XlaShapeToTpuPaddedShape);
-#undef TFTPU_SET_FN
+// The widest functions in the API, TpuExecutable_ExecuteAsyncOnStream and
+// TpuCompiler_Compile, take seven arguments; the eighth is spare, and
+// carries a struct result's address ahead of them. Trampolines pass 0 for
+// the arguments their symbol doesn't have.
+#define API_NARGS 8
+
+// Callers may be any thread: jaxlib calls the executor API from its own
+// workers, which don't hold the GIL, while ctypes.PyDLL callers do. So
+// every call takes the GIL (PyGILState_Ensure is reentrant) for as long as
+// it touches Python, and the Python side assumes only that it runs under
+// the GIL, not that calls arrive one at a time; see handles.py.
+static ret_t
+api_call(int sym, ret_t arg1, ret_t arg2, ret_t arg3, ret_t arg4, ret_t arg5, ret_t arg6,
+         ret_t arg7, ret_t arg8)
+{
+    PyGILState_STATE gil;
+    PyObject *fn;
+    PyObject *argv[API_NARGS];
+    PyObject *result;
+    ret_t ret = 0;
+    uint64_t t0, t1, t2, t3;
+    uint32_t outer = PROF_NOT_ENTERED;
+    int i;
+
+    t0 = stats_now();
+    if (!Py_IsInitialized()) {
+        STAT_ADD(api_stats[sym].calls, 1);
+        STAT_ADD(api_stats[sym].errors, 1);
+        return 0;
+    }
+    gil = PyGILState_Ensure();
+    // Loaded as a Python extension, nothing has imported libtpu yet if
+    // the caller went straight to the C API.
+    if (!my_callback && !libtpu_import_failed && import_libtpu() < 0)
+        libtpu_import_failed = 1;
+    fn = api_fns[sym];
+    if (!fn) {
+        STAT_ADD(api_stats[sym].calls, 1);
+        STAT_ADD(api_stats[sym].errors, 1);
+        if (!api_warned[sym]) {
+            api_warned[sym] = 1;
+            fprintf(stderr, "libtpujesus.so: %s is not implemented\n", api_names[sym]);
+        }
+        PyGILState_Release(gil);
+        return 0;
+    }
+    if (TRACING_SYM(TRACE_ARGS, sym)) {
+        fn = api_traced[sym];
+    }
+    if (PROFILING())
+        outer = prof_enter(sym);
+    argv[0] = PyLong_FromSsize_t(arg1);
+    argv[1] = PyLong_FromSsize_t(arg2);
+    argv[2] = PyLong_FromSsize_t(arg3);
+    argv[3] = PyLong_FromSsize_t(arg4);
+    argv[4] = PyLong_FromSsize_t(arg5);
+    argv[5] = PyLong_FromSsize_t(arg6);
+    argv[6] = PyLong_FromSsize_t(arg7);
+    argv[7] = PyLong_FromSsize_t(arg8);
+    t1 = stats_now();
+    if (argv[0] && argv[1] && argv[2] && argv[3] && argv[4] && argv[5] && argv[6] && argv[7]) {
+        result = api_vectorcall(fn, argv, API_NARGS);
+    } else {
+        result = NULL;
+    }
+    t2 = stats_now();
+    for (i = 0; i < API_NARGS; i++) {
+        Py_XDECREF(argv[i]);
+    }
+    if (result) {
+        ret = (ret_t)PyLong_AsUnsignedLongLongMask(result);
+        Py_DECREF(result);
+    }
+    if (PyErr_Occurred()) {
+        fprintf(stderr, "libtpujesus.so: %s raised\n", api_names[sym]);
+        PyErr_Print();
+        STAT_ADD(api_stats[sym].errors, 1);
+        ret = 0;
+    }
+    PyGILState_Release(gil);
+    t3 = stats_now();
+    stats_record(sym, t3 - t0, t2 - t1);
+    if (outer != PROF_NOT_ENTERED) {
+        prof_record(PROF_API, sym, t0, t3, 0);
+        prof_record(PROF_PYTHON, sym, t1, t2, 0);
+        prof_leave(outer);
+    }
+    if (TRACING_SYM(TRACE_CALLS, sym)) {
+        trace_printf("%s(%zd, %zd, %zd, %zd, %zd, %zd, %zd, %zd) -> %zd\n",
+                     api_names[sym], arg1, arg2, arg3, arg4, arg5, arg6, arg7, arg8, ret);
+    }
+    return ret;
+}
 
-#if 0
-  return tensorflow::Status::OK();
+// Each TFTPU_SET_FN symbol's trampoline, generated from its prototype in
+// tpu_api.h by genapi.py. Symbols with no usable C prototype get STUB:
+// eight untyped words, forwarded whatever the caller left in them.
+#define STUB(x) ret_t x(ret_t arg1, ret_t arg2, ret_t arg3, ret_t arg4, ret_t arg5, ret_t arg6, \
+                       ret_t arg7, ret_t arg8) { \
+    return api_call(SYM_##x, arg1, arg2, arg3, arg4, arg5, arg6, arg7, arg8); \
 }
-#endif
+
+#include "tpu_trampolines.inc"
 
 static PyObject *
 get_answer(PyObject *self, PyObject *args)
@@ -532,30 +669,643 @@ libtpujesus_malloc(PyObject *self, PyObject *args)
 static PyObject *
 libtpujesus_set_callback(PyObject *self, PyObject *args)
 {
-    PyObject *result = NULL;
     PyObject *temp;
+    PyObject *names;
+    PyObject *missing;
+    PyObject *fn;
+    int i;
+
+    if (!PyArg_ParseTuple(args, "O:set_callback", &temp))
+        return NULL;
+    names = symbols_tuple();
+    if (!names)
+        return NULL;
+    if (!PyCallable_Check(temp)) {
+        PyErr_SetString(PyExc_TypeError, "parameter must be callable");
+        return NULL;
+    }
+    missing = PyList_New(0);
+    if (!missing)
+        return NULL;
+    Py_XINCREF(temp);         /* Add a reference to new callback */
+    Py_XDECREF(my_callback);  /* Dispose of previous callback */
+    my_callback = temp;       /* Remember new callback */
+
+    /* Resolve every symbol once: callback(name) -> callable or None */
+    for (i = 0; i < SYM_COUNT; i++) {
+        Py_CLEAR(api_fns[i]);
+        Py_CLEAR(api_traced[i]);
+        api_warned[i] = 0;
+        fn = PyObject_CallFunction(my_callback, "s", api_names[i]);
+        if (!fn) {
+            Py_DECREF(missing);
+            return NULL;
+        }
+        if (fn == Py_None) {
+            Py_DECREF(fn);
+            // natives don't need a Python implementation
+            if (api_native[i])
+                continue;
+            if (PyList_Append(missing, PyTuple_GET_ITEM(names, i)) < 0) {
+                Py_DECREF(missing);
+                return NULL;
+            }
+            continue;
+        }
+        if (!PyCallable_Check(fn)) {
+            PyErr_Format(PyExc_TypeError, "callback returned a non-callable for %s", api_names[i]);
+            Py_DECREF(fn);
+            Py_DECREF(missing);
+            return NULL;
+        }
+        api_fns[i] = fn;
+        api_traced[i] = PyObject_GetAttrString(fn, "traced");
+        if (!api_traced[i]) {
+            PyErr_Clear();
+            Py_INCREF(fn);
+            api_traced[i] = fn;
+        }
+    }
+    return missing;
+}
+
+static PyObject *
+libtpujesus_symbols(PyObject *self, PyObject *args)
+{
+    PyObject *names = symbols_tuple();
+    Py_XINCREF(names);
+    return names;
+}
+
+static PyObject *
+libtpujesus_set_trace(PyObject *self, PyObject *args)
+{
+    int level = TRACE_OFF;
+    const char *filter = NULL;
+
+    if (!PyArg_ParseTuple(args, "i|z:set_trace", &level, &filter))
+        return NULL;
+    trace_set(level, filter);
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+libtpujesus_trace_level(PyObject *self, PyObject *args)
+{
+    return PyLong_FromLong(trace_level);
+}
+
+static PyObject *
+libtpujesus_trace(PyObject *self, PyObject *args)
+{
+    const char *msg;
+    Py_ssize_t len;
 
-    if (PyArg_ParseTuple(args, "O:set_callback", &temp)) {
-        if (!PyCallable_Check(temp)) {
-            /*
-            PyErr_SetString(PyExc_TypeError, "parameter must be callable");
+    if (!PyArg_ParseTuple(args, "s#:trace", &msg, &len))
+        return NULL;
+    trace_write(msg, len);
+    trace_write("\n", 1);
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+libtpujesus_trace_flush(PyObject *self, PyObject *args)
+{
+    trace_flush();
+    return PyLong_FromUnsignedLongLong(trace_dropped);
+}
+
+static PyObject *
+stats_hist(const uint64_t *hist)
+{
+    PyObject *t = PyTuple_New(STATS_BUCKETS);
+    int b;
+
+    if (!t)
+        return NULL;
+    for (b = 0; b < STATS_BUCKETS; b++) {
+        PyObject *v = PyLong_FromUnsignedLongLong(STAT_GET(hist[b]));
+        if (!v) {
+            Py_DECREF(t);
             return NULL;
-            */
         }
-        Py_XINCREF(temp);         /* Add a reference to new callback */
-        Py_XDECREF(my_callback);  /* Dispose of previous callback */
-        my_callback = temp;       /* Remember new callback */
-        /* Boilerplate to return "None" */
-        Py_INCREF(Py_None);
-        result = Py_None;
+        PyTuple_SET_ITEM(t, b, v);
+    }
+    return t;
+}
+
+static PyObject *
+libtpujesus_stats(PyObject *self, PyObject *args)
+{
+    PyObject *names = symbols_tuple();
+    PyObject *d;
+    int i;
+
+    if (!names)
+        return NULL;
+    if (!(d = PyDict_New()))
+        return NULL;
+    for (i = 0; i < SYM_COUNT; i++) {
+        api_stat_t *st = &api_stats[i];
+        PyObject *hist, *python_hist, *entry;
+        if (!STAT_GET(st->calls))
+            continue;
+        hist = stats_hist(st->hist);
+        python_hist = stats_hist(st->python_hist);
+        entry = (hist && python_hist) ? Py_BuildValue("{sKsKsKsKsKsOsO}",
+            "calls", (unsigned long long)STAT_GET(st->calls),
+            "errors", (unsigned long long)STAT_GET(st->errors),
+            "total_ns", (unsigned long long)STAT_GET(st->total_ns),
+            "python_ns", (unsigned long long)STAT_GET(st->python_ns),
+            "max_ns", (unsigned long long)STAT_GET(st->max_ns),
+            "hist", hist,
+            "python_hist", python_hist) : NULL;
+        Py_XDECREF(hist);
+        Py_XDECREF(python_hist);
+        if (!entry || PyDict_SetItem(d, PyTuple_GET_ITEM(names, i), entry) < 0) {
+            Py_XDECREF(entry);
+            Py_DECREF(d);
+            return NULL;
+        }
+        Py_DECREF(entry);
+    }
+    return d;
+}
+
+static PyObject *
+libtpujesus_reset_stats(PyObject *self, PyObject *args)
+{
+    stats_reset();
+    pool_reset_stats();
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+libtpujesus_pool_stats(PyObject *self, PyObject *args)
+{
+    return pool_stats();
+}
+
+static PyObject *
+libtpujesus_profiler_start(PyObject *self, PyObject *args)
+{
+    return PyBool_FromLong(prof_start() == 0);
+}
+
+static PyObject *
+libtpujesus_profiler_stop(PyObject *self, PyObject *args)
+{
+    prof_stop();
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+libtpujesus_profiler_collect(PyObject *self, PyObject *args)
+{
+    return prof_collect();
+}
+
+static PyObject *
+libtpujesus_profiling(PyObject *self, PyObject *args)
+{
+    return PyBool_FromLong(prof_active);
+}
+
+static PyObject *
+libtpujesus_profile_intern(PyObject *self, PyObject *args)
+{
+    const char *name;
+    uint32_t id;
+
+    if (!PyArg_ParseTuple(args, "s:profile_intern", &name))
+        return NULL;
+    if ((id = prof_intern(name)) == PROF_NO_NAME)
+        return PyErr_NoMemory();
+    return PyLong_FromUnsignedLong(id);
+}
+
+static PyObject *
+libtpujesus_profile_event(PyObject *self, PyObject *args)
+{
+    unsigned int name;
+    int kind;
+    unsigned long long start_ns, end_ns, arg = 0;
+
+    if (!PyArg_ParseTuple(args, "IiKK|K:profile_event", &name, &kind, &start_ns, &end_ns, &arg))
+        return NULL;
+    prof_record(kind, name, start_ns, end_ns, arg);
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+libtpujesus_dump_stats(PyObject *self, PyObject *args)
+{
+    const char *path = NULL;
+    const char *saved = stats_dump_path;
+
+    if (!PyArg_ParseTuple(args, "|z:dump_stats", &path))
+        return NULL;
+    stats_dump_path = path ? path : "-";
+    stats_dump();
+    stats_dump_path = saved;
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+libtpujesus_bind_executor(PyObject *self, PyObject *args)
+{
+    unsigned long long executor;
+    unsigned long long memory_limit;
+    unsigned long long release_threshold = 1 << 20;
+    unsigned long long feed_capacity = 64 << 20;
+    const char *path = NULL;
+    int ordinal;
+
+    if (!PyArg_ParseTuple(args, "KiK|zKK:bind_executor", &executor, &ordinal, &memory_limit,
+                          &path, &release_threshold, &feed_capacity))
+        return NULL;
+    if (!device_bind((SE_StreamExecutor *)(uintptr_t)executor, ordinal, memory_limit,
+                     path, release_threshold, feed_capacity)) {
+        PyErr_Format(PyExc_MemoryError, "can't reserve %llu bytes of device memory for device %d", memory_limit, ordinal);
+        return NULL;
     }
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+libtpujesus_stream_enqueue(PyObject *self, PyObject *args)
+{
+    unsigned long long stream;
+    PyObject *fn;
+
+    if (!PyArg_ParseTuple(args, "KO:stream_enqueue", &stream, &fn))
+        return NULL;
+    if (!stream || !PyCallable_Check(fn)) {
+        PyErr_SetString(PyExc_TypeError, "stream_enqueue(stream, fn) needs a stream and a callable");
+        return NULL;
+    }
+    if (stream_push_python((SE_Stream *)(uintptr_t)stream, fn) < 0)
+        return PyErr_NoMemory();
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+libtpujesus_stream_wait(PyObject *self, PyObject *args)
+{
+    unsigned long long stream;
+
+    if (!PyArg_ParseTuple(args, "K:stream_wait", &stream))
+        return NULL;
+    if (!stream) {
+        PyErr_SetString(PyExc_ValueError, "null stream");
+        return NULL;
+    }
+    return PyLong_FromLong(stream_wait((SE_Stream *)(uintptr_t)stream));
+}
+
+static PyObject *
+libtpujesus_stream_device(PyObject *self, PyObject *args)
+{
+    unsigned long long stream;
+    SE_Stream *s;
+
+    if (!PyArg_ParseTuple(args, "K:stream_device", &stream))
+        return NULL;
+    if (!(s = (SE_Stream *)(uintptr_t)stream)) {
+        PyErr_SetString(PyExc_ValueError, "null stream");
+        return NULL;
+    }
+    return PyLong_FromLong(s->dev ? s->dev->ordinal : 0);
+}
+
+static feed_t *
+feed_arg(int ordinal, int kind, int index)
+{
+    tpu_device_t *dev = device_for_ordinal(ordinal);
+    feed_t *f;
+
+    if (!dev) {
+        PyErr_Format(PyExc_KeyError, "no device %d", ordinal);
+        return NULL;
+    }
+    if (!(f = feed_get(dev, kind, index))) {
+        if (index < 0 || index >= MAX_FEED_QUEUES)
+            PyErr_Format(PyExc_IndexError, "feed queue index %d out of range", index);
+        else
+            PyErr_NoMemory();
+    }
+    return f;
+}
+
+static int64_t
+timeout_arg(PyObject *timeout)
+{
+    return timeout == Py_None ? -1 : (int64_t)(PyFloat_AsDouble(timeout) * 1e9);
+}
+
+static PyObject *
+libtpujesus_infeed_dequeue(PyObject *self, PyObject *args)
+{
+    PyObject *timeout = Py_None, *result;
+    int ordinal, index = 0, rc;
+    void *data = NULL;
+    size_t size = 0;
+    feed_t *f;
+
+    if (!PyArg_ParseTuple(args, "i|iO:infeed_dequeue", &ordinal, &index, &timeout))
+        return NULL;
+    if (!(f = feed_arg(ordinal, FEED_INFEED, index)))
+        return NULL;
+    if ((rc = feed_pop(f, NULL, 0, &data, &size, timeout_arg(timeout))) == -2)
+        Py_RETURN_NONE;
+    if (rc < 0)
+        return PyErr_NoMemory();
+    result = PyBytes_FromStringAndSize(data, size);
+    free(data);
     return result;
 }
 
+static PyObject *
+libtpujesus_outfeed_enqueue(PyObject *self, PyObject *args)
+{
+    PyObject *timeout = Py_None;
+    int ordinal, index = 0, rc;
+    feed_iovec_t iov;
+    Py_buffer buf;
+    feed_t *f;
+
+    if (!PyArg_ParseTuple(args, "iy*|iO:outfeed_enqueue", &ordinal, &buf, &index, &timeout))
+        return NULL;
+    if (!(f = feed_arg(ordinal, FEED_OUTFEED, index))) {
+        PyBuffer_Release(&buf);
+        return NULL;
+    }
+    iov.base = buf.buf;
+    iov.len = buf.len;
+    rc = feed_push(f, &iov, 1, timeout_arg(timeout));
+    PyBuffer_Release(&buf);
+    if (rc == -1) {
+        PyErr_Format(PyExc_ValueError, "outfeed record of %zd bytes doesn't fit a %zu byte queue",
+                     iov.len, f->capacity);
+        return NULL;
+    }
+    return PyBool_FromLong(rc == 0);
+}
+
+static PyObject *
+libtpujesus_feed_stats(PyObject *self, PyObject *args)
+{
+    tpu_device_t *dev;
+    int ordinal;
+
+    if (!PyArg_ParseTuple(args, "i:feed_stats", &ordinal))
+        return NULL;
+    if (!(dev = device_for_ordinal(ordinal))) {
+        PyErr_Format(PyExc_KeyError, "no device %d", ordinal);
+        return NULL;
+    }
+    return feed_stats(dev);
+}
+
+typedef int (*shape_copy_fn)(void *, const void *);
+typedef void (*shape_free_fn)(void *);
+
+static const struct {
+    const char *name;
+    shape_copy_fn copy;
+    shape_free_fn free;
+} shape_kinds[] = {
+    {"Int64List", (shape_copy_fn)int64list_copy, (shape_free_fn)int64list_free},
+    {"BoolList", (shape_copy_fn)boollist_copy, (shape_free_fn)boollist_free},
+    {"TileList", (shape_copy_fn)tilelist_copy, (shape_free_fn)tilelist_free},
+    {"XLA_Layout", (shape_copy_fn)layout_copy, (shape_free_fn)layout_free},
+    {"XLA_Shape", (shape_copy_fn)shape_copy, (shape_free_fn)shape_free},
+};
+
+static int
+shape_kind(const char *name)
+{
+    size_t i;
+
+    for (i = 0; i < sizeof(shape_kinds) / sizeof(shape_kinds[0]); i++) {
+        if (!strcmp(shape_kinds[i].name, name))
+            return i;
+    }
+    PyErr_Format(PyExc_ValueError, "no native copy for %s", name);
+    return -1;
+}
+
+static PyObject *
+libtpujesus_shape_copy(PyObject *self, PyObject *args)
+{
+    unsigned long long dst, src;
+    const char *name;
+    int kind;
+
+    if (!PyArg_ParseTuple(args, "sKK:shape_copy", &name, &dst, &src))
+        return NULL;
+    if ((kind = shape_kind(name)) < 0)
+        return NULL;
+    if (!dst || !src) {
+        PyErr_SetString(PyExc_ValueError, "null pointer");
+        return NULL;
+    }
+    if (shape_kinds[kind].copy((void *)(uintptr_t)dst, (const void *)(uintptr_t)src) < 0)
+        return PyErr_NoMemory();
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+libtpujesus_shape_free(PyObject *self, PyObject *args)
+{
+    unsigned long long ptr;
+    const char *name;
+    int kind;
+
+    if (!PyArg_ParseTuple(args, "sK:shape_free", &name, &ptr))
+        return NULL;
+    if ((kind = shape_kind(name)) < 0)
+        return NULL;
+    if (ptr)
+        shape_kinds[kind].free((void *)(uintptr_t)ptr);
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+libtpujesus_status_new(PyObject *self, PyObject *args)
+{
+    TF_Status *status = status_new();
+
+    if (!status)
+        return PyErr_NoMemory();
+    return PyLong_FromVoidPtr(status);
+}
+
+static PyObject *
+libtpujesus_status_set(PyObject *self, PyObject *args)
+{
+    unsigned long long ptr;
+    const char *msg = NULL;
+    Py_ssize_t len = 0;
+    int code;
+
+    if (!PyArg_ParseTuple(args, "Ki|z#:status_set", &ptr, &code, &msg, &len))
+        return NULL;
+    if (!ptr) {
+        PyErr_SetString(PyExc_ValueError, "null pointer");
+        return NULL;
+    }
+    status_set_message((TF_Status *)(uintptr_t)ptr, code, msg, len);
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+libtpujesus_status_free(PyObject *self, PyObject *args)
+{
+    unsigned long long ptr;
+
+    if (!PyArg_ParseTuple(args, "K:status_free", &ptr))
+        return NULL;
+    status_free((TF_Status *)(uintptr_t)ptr);
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+libtpujesus_shape_fingerprint(PyObject *self, PyObject *args)
+{
+    unsigned long long ptr;
+
+    if (!PyArg_ParseTuple(args, "K:shape_fingerprint", &ptr))
+        return NULL;
+    if (!ptr) {
+        PyErr_SetString(PyExc_ValueError, "null pointer");
+        return NULL;
+    }
+    return PyLong_FromUnsignedLongLong(shape_fingerprint((const XLA_Shape *)(uintptr_t)ptr));
+}
+
+static const char *layout_policies[] = {"tiled", "compact"};
+
+static PyObject *
+libtpujesus_layout_policy(PyObject *self, PyObject *args)
+{
+    const char *name = NULL;
+    int i, old;
+
+    if (!PyArg_ParseTuple(args, "|z:layout_policy", &name))
+        return NULL;
+    if (!name)
+        return PyUnicode_FromString(layout_policies[layout_get_policy()]);
+    for (i = 0; i < 2; i++)
+        if (!strcmp(name, layout_policies[i]))
+            break;
+    if (i == 2) {
+        PyErr_Format(PyExc_ValueError, "unknown layout policy %R (expected tiled or compact)", PyTuple_GET_ITEM(args, 0));
+        return NULL;
+    }
+    old = layout_set_policy(i);
+    return PyUnicode_FromString(layout_policies[old]);
+}
+
+static PyObject *
+libtpujesus_shape_size(PyObject *self, PyObject *args)
+{
+    unsigned long long ptr;
+    int mode = SIZE_PADDED;
+
+    if (!PyArg_ParseTuple(args, "K|i:shape_size", &ptr, &mode))
+        return NULL;
+    if (!ptr) {
+        PyErr_SetString(PyExc_ValueError, "null pointer");
+        return NULL;
+    }
+    return PyLong_FromLongLong(layout_shape_size((const XLA_Shape *)(uintptr_t)ptr, mode));
+}
+
+static PyObject *
+libtpujesus_device_shape(PyObject *self, PyObject *args)
+{
+    unsigned long long dst, src;
+    int policy = -1;
+
+    if (!PyArg_ParseTuple(args, "KK|i:device_shape", &dst, &src, &policy))
+        return NULL;
+    if (!dst || !src) {
+        PyErr_SetString(PyExc_ValueError, "null pointer");
+        return NULL;
+    }
+    if (layout_device_shape((XLA_Shape *)(uintptr_t)dst, (const XLA_Shape *)(uintptr_t)src,
+                            policy < 0 ? layout_get_policy() : policy) < 0)
+        return PyErr_NoMemory();
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+libtpujesus_device_stats(PyObject *self, PyObject *args)
+{
+    SE_AllocatorStats st;
+    int64_t largest_free, bytes_free;
+    tpu_device_t *dev;
+    int ordinal;
+
+    if (!PyArg_ParseTuple(args, "i:device_stats", &ordinal))
+        return NULL;
+    if (!(dev = device_for_ordinal(ordinal))) {
+        PyErr_Format(PyExc_KeyError, "no device %d", ordinal);
+        return NULL;
+    }
+    bfc_stats(&dev->allocator, &st, &largest_free, &bytes_free);
+    return Py_BuildValue("{sLsLsLsLsLsLsLsdsLsLsLsO}",
+        "num_allocs", (long long)st.num_allocs,
+        "bytes_in_use", (long long)st.bytes_in_use,
+        "peak_bytes_in_use", (long long)st.peak_bytes_in_use,
+        "largest_alloc_size", (long long)st.largest_alloc_size,
+        "bytes_limit", (long long)st.bytes_limit,
+        "bytes_free", (long long)bytes_free,
+        "largest_free_block_bytes", (long long)largest_free,
+        "fragmentation", bytes_free ? 1.0 - (double)largest_free / bytes_free : 0.0,
+        "committed_bytes", (long long)device_committed(dev),
+        "peak_committed_bytes", (long long)__atomic_load_n(&dev->peak_committed, __ATOMIC_RELAXED),
+        "reserved_bytes", (long long)dev->memory_limit,
+        "file_backed", dev->memory_fd >= 0 ? Py_True : Py_False);
+}
+
 static PyMethodDef LibTpuJesusMethods[] = {
     {"get_answer",  get_answer, METH_VARARGS, "The meaning of life."},
     {"system",  libtpujesus_system, METH_VARARGS, "Execute a shell command."},
-    {"set_callback",  libtpujesus_set_callback, METH_VARARGS, "Set the libtpu callback."},
+    {"set_callback",  libtpujesus_set_callback, METH_VARARGS, "set_callback(resolve) -> list of unimplemented symbol names"},
+    {"symbols",  libtpujesus_symbols, METH_NOARGS, "symbols() -> tuple of API symbol names, indexed by symbol id"},
+    {"set_trace",  libtpujesus_set_trace, METH_VARARGS, "set_trace(level, filter=None)"},
+    {"trace_level",  libtpujesus_trace_level, METH_NOARGS, "trace_level() -> current trace level"},
+    {"trace",  libtpujesus_trace, METH_VARARGS, "trace(msg): append a line to the trace buffer"},
+    {"trace_flush",  libtpujesus_trace_flush, METH_NOARGS, "trace_flush() -> number of bytes dropped so far"},
+    {"bind_executor",  libtpujesus_bind_executor, METH_VARARGS, "bind_executor(executor, ordinal, memory_limit, path=None, release_threshold=1M, feed_capacity=64M): give an executor handle its own device memory, backed by a file in path (a directory) or at path.<ordinal> if given"},
+    {"stream_enqueue",  libtpujesus_stream_enqueue, METH_VARARGS, "stream_enqueue(stream, fn): run fn() on the stream's worker, in order"},
+    {"stream_wait",  libtpujesus_stream_wait, METH_VARARGS, "stream_wait(stream) -> error code after everything queued so far has run"},
+    {"stream_device",  libtpujesus_stream_device, METH_VARARGS, "stream_device(stream) -> ordinal of the device the stream runs on"},
+    {"device_stats",  libtpujesus_device_stats, METH_VARARGS, "device_stats(ordinal) -> allocator stats for a device"},
+    {"infeed_dequeue",  libtpujesus_infeed_dequeue, METH_VARARGS, "infeed_dequeue(ordinal, index=0, timeout=None) -> next infeed record as bytes, or None on timeout"},
+    {"outfeed_enqueue",  libtpujesus_outfeed_enqueue, METH_VARARGS, "outfeed_enqueue(ordinal, data, index=0, timeout=None) -> False on timeout"},
+    {"feed_stats",  libtpujesus_feed_stats, METH_VARARGS, "feed_stats(ordinal) -> {'infeed': {index: stats}, 'outfeed': {index: stats}}"},
+    {"stats",  libtpujesus_stats, METH_NOARGS, "stats() -> {symbol: {calls, errors, total_ns, python_ns, max_ns, hist, python_hist}}"},
+    {"reset_stats",  libtpujesus_reset_stats, METH_NOARGS, "reset_stats(): zero all per-symbol and pool counters"},
+    {"profiler_start",  libtpujesus_profiler_start, METH_NOARGS, "profiler_start() -> False if a profiling session is already running"},
+    {"profiler_stop",  libtpujesus_profiler_stop, METH_NOARGS, "profiler_stop(): end the profiling session; its events stay collectable"},
+    {"profiler_collect",  libtpujesus_profiler_collect, METH_NOARGS, "profiler_collect() -> {start_ns, start_wall_ns, names, threads: [(tid, name, device, dropped, events)]}"},
+    {"profiling",  libtpujesus_profiling, METH_NOARGS, "profiling() -> whether a profiling session is running"},
+    {"profile_intern",  libtpujesus_profile_intern, METH_VARARGS, "profile_intern(name) -> event name id"},
+    {"profile_event",  libtpujesus_profile_event, METH_VARARGS, "profile_event(name_id, kind, start_ns, end_ns, arg=0): record an event on this thread (CLOCK_MONOTONIC times)"},
+    {"pool_stats",  libtpujesus_pool_stats, METH_NOARGS, "pool_stats() -> {type: {size, capacity, free, live, high_water, hits, misses, released, hit_rate}}"},
+    {"dump_stats",  libtpujesus_dump_stats, METH_VARARGS, "dump_stats(path=None): write the stats table to path, or stderr"},
+    {"shape_copy",  libtpujesus_shape_copy, METH_VARARGS, "shape_copy(kind, dst, src): deep copy a shape struct (XLA_Shape, XLA_Layout, TileList, BoolList, Int64List) between addresses"},
+    {"shape_fingerprint",  libtpujesus_shape_fingerprint, METH_VARARGS, "shape_fingerprint(ptr) -> 64-bit content hash of an XLA_Shape tree"},
+    {"shape_size",  libtpujesus_shape_size, METH_VARARGS, "shape_size(ptr, mode=0) -> bytes for an XLA_Shape: 0 padded (HardwareLayout_ShapeSize), 1 compact, 2 compact raw"},
+    {"device_shape",  libtpujesus_device_shape, METH_VARARGS, "device_shape(dst, src, policy=current): copy an XLA_Shape into dst with device layouts (0 tiled, 1 compact)"},
+    {"layout_policy",  libtpujesus_layout_policy, METH_VARARGS, "layout_policy(name=None) -> current policy, or set it ('tiled' or 'compact') and return the old one"},
+    {"shape_free",  libtpujesus_shape_free, METH_VARARGS, "shape_free(kind, ptr): free what a shape struct owns and zero it"},
+    {"status_new",  libtpujesus_status_new, METH_NOARGS, "status_new() -> address of a new TF_Status with code 0"},
+    {"status_set",  libtpujesus_status_set, METH_VARARGS, "status_set(ptr, code, message=None): set a TF_Status's code and message"},
+    {"status_free",  libtpujesus_status_free, METH_VARARGS, "status_free(ptr): free a TF_Status"},
     {"free",  libtpujesus_free, METH_VARARGS, "free(ptr)"},
     {"malloc",  libtpujesus_malloc, METH_VARARGS, "malloc(nbytes)"},
     {NULL, NULL, 0, NULL}
@@ -588,7 +1338,11 @@ PyInit_libtpujesus(void) {
         Py_DECREF(m);
         return NULL;
     }
-    import_libtpu();
+    trace_init();
+    stats_init();
+    // libtpu imports us, so it can't be imported from here: this module
+    // isn't in sys.modules until we return. It is imported by
+    // TfTpu_Initialize, or by the first API call that needs it.
 
     return m;
 }
\ No newline at end of file
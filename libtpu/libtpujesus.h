@@ -0,0 +1,686 @@
+/* libtpujesus.h
+Copyright 2021 Shawn Presser
+
+Declarations shared between libtpujesus.c (the Python trampolines) and
+the parts of the TPU C API that are implemented natively in C.
+*/
+
+#ifndef LIBTPUJESUS_H
+#define LIBTPUJESUS_H
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <stdarg.h>
+#include <stdint.h>
+#include <inttypes.h>
+#include <errno.h>
+#include <fcntl.h>
+#include <unistd.h>
+#include <pthread.h>
+#include <time.h>
+#include <stdbool.h>
+
+typedef ssize_t ret_t;
+
+// Internal helpers are shared between our own object files but must not
+// be exported from libtpu.so, where they could collide with jaxlib's.
+#define INTERNAL __attribute__((visibility("hidden")))
+
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+// Symbol table
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+//
+// Every symbol in the .inc files gets a stable integer id (its position
+// in the files). TFTPU_SET_FN symbols are trampolines into Python;
+// TFTPU_SET_NATIVE_FN symbols are implemented in C and only use their
+// id for stats and tracing.
+
+enum {
+#define TFTPU_SET_FN(api_fn, name) SYM_##name,
+#define TFTPU_SET_NATIVE_FN(api_fn, name) SYM_##name,
+#include "tpu_library_init_fns.inc"
+#include "tpu_executor_init_fns.inc"
+#undef TFTPU_SET_FN
+#undef TFTPU_SET_NATIVE_FN
+  SYM_COUNT
+};
+
+INTERNAL extern const char *const api_names[SYM_COUNT];
+
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+// Tracing (see libtpujesus.c)
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+enum {
+  TRACE_OFF = 0,
+  TRACE_CALLS = 1,
+  TRACE_ARGS = 2,
+  TRACE_DEBUG = 3,
+};
+
+INTERNAL extern volatile int trace_level;
+INTERNAL extern unsigned char trace_on[SYM_COUNT];
+
+#define TRACING(level) __builtin_expect(trace_level >= (level), 0)
+#define TRACING_SYM(level, sym) (TRACING(level) && trace_on[sym])
+
+INTERNAL void trace_printf(const char *fmt, ...) __attribute__((format(printf, 1, 2)));
+
+#define TRACE(level, ...) do { if (TRACING(level)) trace_printf(__VA_ARGS__); } while (0)
+
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+// Stats (see libtpujesus.c)
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+#define STAT_ADD(field, n) __atomic_fetch_add(&(field), (n), __ATOMIC_RELAXED)
+#define STAT_SUB(field, n) __atomic_fetch_sub(&(field), (n), __ATOMIC_RELAXED)
+#define STAT_GET(field) __atomic_load_n(&(field), __ATOMIC_RELAXED)
+
+static inline uint64_t
+stats_now(void)
+{
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return (uint64_t)ts.tv_sec * 1000000000ull + (uint64_t)ts.tv_nsec;
+}
+
+INTERNAL void stats_record(int sym, uint64_t total_ns, uint64_t python_ns);
+
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+// Profiler (tpu_profiler.c)
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+//
+// While a session runs, instrumented code appends events to a ring owned
+// by the calling thread. Names are symbol ids, then strings from
+// prof_intern. Nothing is recorded, and nothing but the PROFILING() test
+// is paid, outside a session.
+
+// Keep in sync with KINDS in profiler.py.
+enum {
+  PROF_API = 0,              // a Python-backed API call, as seen from C
+  PROF_PYTHON = 1,           // the Python part of one
+  PROF_NATIVE = 2,           // a native API call
+  PROF_STREAM = 3,           // a stream op, named for the API call that queued it
+  PROF_TRANSFER = 4,         // a stream memcpy; arg is its size
+  PROF_EXEC = 5,             // a program run
+  PROF_COMPILE = 6,          // a program compile
+  PROF_MEMORY = 7,           // a counter: arg is the device's bytes in use
+};
+
+#define PROF_NO_NAME 0xffffffffu
+#define PROF_NOT_ENTERED 0xfffffffeu   // what prof_enter wasn't called for
+
+typedef struct prof_event {
+  uint64_t start_ns;         // CLOCK_MONOTONIC
+  uint64_t end_ns;
+  uint64_t arg;
+  uint32_t name;
+  uint16_t kind;
+  int16_t device;            // ordinal, or -1 for the host
+} prof_event_t;
+
+INTERNAL extern volatile int prof_active;
+
+#define PROFILING() __builtin_expect(prof_active, 0)
+
+INTERNAL void prof_record(int kind, uint32_t name, uint64_t start_ns, uint64_t end_ns, uint64_t arg);
+INTERNAL void prof_counter(int device, uint32_t name, uint64_t value);
+INTERNAL uint32_t prof_intern(const char *name);
+// Events this thread records from now on belong to `device` (-1: host).
+INTERNAL void prof_name_thread(int device, const char *fmt, ...) __attribute__((format(printf, 2, 3)));
+// The innermost API call running on this thread, for naming the stream
+// ops it queues. prof_enter returns the previous one for prof_leave,
+// which must follow even if the session stopped in between.
+INTERNAL uint32_t prof_enter(uint32_t sym);
+INTERNAL void prof_leave(uint32_t outer);
+INTERNAL uint32_t prof_current(void);
+INTERNAL int prof_start(void);
+INTERNAL void prof_stop(void);
+INTERNAL PyObject *prof_collect(void);
+
+// Bracket the body of a native API function so it shows up in stats()
+// and profiles.
+#define NATIVE_ENTER(name) \
+    uint64_t native_t0_ = stats_now(); \
+    uint32_t native_outer_ = PROFILING() ? prof_enter(SYM_##name) : PROF_NOT_ENTERED
+#define NATIVE_LEAVE(name) do { \
+    uint64_t native_t1_ = stats_now(); \
+    stats_record(SYM_##name, native_t1_ - native_t0_, 0); \
+    if (native_outer_ != PROF_NOT_ENTERED) { \
+        prof_record(PROF_NATIVE, SYM_##name, native_t0_, native_t1_, 0); \
+        prof_leave(native_outer_); \
+    } \
+} while (0)
+
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+// Object pools (tpu_pool.c)
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+//
+// A free list per fixed-size type, so New/Free pairs stop reaching malloc
+// once a workload has hit its high-water mark. pool_get returns zeroed
+// memory whether the object is fresh or reused; pool_put keeps up to
+// `capacity` objects and frees the rest. Free objects are linked through
+// their first word.
+
+typedef struct pool {
+  const char *name;
+  size_t size;
+  int capacity;              // most free objects kept
+  pthread_mutex_t mu;
+  void *free;
+  int nfree;
+  uint64_t hits;             // gets served from the free list
+  uint64_t misses;           // gets that went to malloc
+  uint64_t released;         // puts that went to free, the pool being full
+  uint64_t live;             // handed out and not put back
+  uint64_t high_water;       // most live at once
+} pool_t;
+
+INTERNAL void *pool_get(pool_t *pool);
+INTERNAL void pool_put(pool_t *pool, void *obj);
+INTERNAL PyObject *pool_stats(void);
+INTERNAL void pool_reset_stats(void);
+INTERNAL void pool_dump(FILE *out);
+
+INTERNAL extern pool_t status_pool, config_pool, description_pool;
+INTERNAL extern pool_t stream_pool, op_pool, event_pool, timer_pool;
+
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+// C API types
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+//
+// From tensorflow/stream_executor/tpu/c_api_decl.h. Opaque types are
+// whatever libtpu handed out for them (usually a handle to a Python
+// object), so C code only compares or forwards them.
+
+typedef struct SE_StreamExecutor SE_StreamExecutor;
+typedef struct SE_Stream SE_Stream;
+typedef struct TF_Status TF_Status;
+typedef struct XLA_TransferManager XLA_TransferManager;
+typedef struct XLA_Shape XLA_Shape;
+
+typedef TF_Status* (*SE_StatusCallbackFn)(void*);
+
+typedef struct SE_DeviceMemoryBase {
+  void* opaque;
+  uint64_t size;
+  uint64_t payload;
+} SE_DeviceMemoryBase;
+
+// From tensorflow/core/tpu/tpu_ops_c_api.h.
+typedef struct XLA_TpuMeshState XLA_TpuMeshState;
+typedef struct XLA_TpuProgram XLA_TpuProgram;
+
+typedef struct TpuProgramFingerprint {
+  const char* bytes;
+  size_t size;
+} TpuProgramFingerprint;
+
+typedef struct CompilationCacheKeyProperty {
+  const char* config_prefix;
+  const char* shapes_prefix;
+  const char* function_name;
+  uint64_t mlir_module_fingerprint;
+  const int32_t* device_ids;
+  size_t device_ids_size;
+  int32_t guaranteed_constants_size;
+  uint64_t function_library_fingerprint;
+  int32_t num_cores_per_replica;
+  int32_t num_replicas;
+  const XLA_TpuMeshState* mesh_state;
+} CompilationCacheKeyProperty;
+
+typedef struct CompilationCacheKeyResult {
+  const char* key;
+  const char* debug_string;
+} CompilationCacheKeyResult;
+
+typedef struct SE_AllocatorStats {
+  int64_t num_allocs;
+  int64_t bytes_in_use;
+  int64_t peak_bytes_in_use;
+  int64_t largest_alloc_size;
+
+  _Bool has_bytes_limit;
+  int64_t bytes_limit;
+
+  int64_t bytes_reserved;
+  int64_t peak_bytes_reserved;
+
+  _Bool has_bytes_reservable_limit;
+  int64_t bytes_reservable_limit;
+
+  int64_t largest_free_block_bytes;
+} SE_AllocatorStats;
+
+#define TPU_C_API_MAX_INLINED 6
+
+// Lists keep up to TPU_C_API_MAX_INLINED elements inline and anything
+// longer in an owned heap array.
+typedef struct Int64List {
+  union {
+    int64_t* heap;  // owned
+    int64_t inlined[TPU_C_API_MAX_INLINED];
+  };
+  int64_t size;
+} Int64List;
+
+typedef struct BoolList {
+  union {
+    bool* heap;  // owned
+    bool inlined[TPU_C_API_MAX_INLINED];
+  };
+  int64_t size;
+} BoolList;
+
+typedef struct XLA_Tile {
+  Int64List dimensions;
+} XLA_Tile;
+
+typedef struct TileList {
+  union {
+    XLA_Tile* heap;  // owned
+    XLA_Tile inlined[TPU_C_API_MAX_INLINED];
+  };
+  int64_t size;
+} TileList;
+
+typedef struct XLA_Layout {
+  int format;
+  Int64List minor_to_major;
+  TileList tiles;
+  int64_t element_size_in_bits;
+  int64_t memory_space;
+} XLA_Layout;
+
+struct XLA_Shape {
+  int element_type;
+  Int64List dimensions;
+  BoolList dynamic_dimensions;
+  XLA_Shape* tuple_shapes;  // owned
+  int ntuple_shapes;
+  XLA_Layout layout;
+};
+
+typedef struct XLA_Literal {
+  char** buffers;
+  size_t* sizes;
+  size_t count;
+  XLA_Shape shape;
+} XLA_Literal;
+
+// Structs the Python side takes or returns by value; see tpu_api.h.
+typedef struct TpuSerializedProto {
+  const char* bytes;
+  size_t size;
+} TpuSerializedProto;
+
+typedef struct SE_PlatformId {
+  void* id;
+} SE_PlatformId;
+
+typedef struct TpuRuntimeVersion {
+  int version[3];
+  const char* metadata;
+  size_t metadata_size;
+} TpuRuntimeVersion;
+
+typedef struct XLA_ComputationLayout {
+  int parameter_count;
+  XLA_Shape* parameter_layouts;
+  XLA_Shape result_layout;
+} XLA_ComputationLayout;
+
+typedef struct XLA_HloModuleConfig {
+  uint64_t seed;
+  int32_t launch_id;
+  int64_t replica_count;
+  int64_t num_partitions;
+  bool use_spmd_partitioning;
+  TpuSerializedProto debug_options;
+  bool has_static_device_assignment;
+  TpuSerializedProto static_device_assignment;
+  bool has_entry_computation_layout;
+  XLA_ComputationLayout entry_computation_layout;
+} XLA_HloModuleConfig;
+
+typedef struct XLA_HloModule {
+  TpuSerializedProto proto;
+  XLA_HloModuleConfig module_config;
+} XLA_HloModule;
+
+// TF_Code values from tensorflow/c/tf_status.h.
+enum {
+  TF_OK = 0,
+  TF_INVALID_ARGUMENT = 3,
+  TF_NOT_FOUND = 5,
+  TF_RESOURCE_EXHAUSTED = 8,
+  TF_FAILED_PRECONDITION = 9,
+  TF_UNIMPLEMENTED = 12,
+  TF_INTERNAL = 13,
+};
+
+// Release the GIL, if this thread holds it, around a blocking wait. The
+// stream workers may need it to run Python work.
+#define BLOCKING_BEGIN { PyThreadState *blocking_save_ = \
+    (Py_IsInitialized() && PyGILState_Check()) ? PyEval_SaveThread() : NULL;
+#define BLOCKING_END if (blocking_save_) PyEval_RestoreThread(blocking_save_); }
+
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+// Statuses and other plain data (tpu_status.c)
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+//
+// libtpu.TF_Status mirrors the head of struct TF_Status. message points
+// at inline_message, or at a malloc'd copy when it doesn't fit.
+
+#define STATUS_MAGIC 0x53545553u
+
+struct TF_Status {
+  int32_t code;
+  uint32_t magic;            // STATUS_MAGIC while allocated
+  const char *message;
+  char inline_message[112];
+};
+
+typedef struct SE_StreamExecutorConfig {
+  int ordinal;
+} SE_StreamExecutorConfig;
+
+typedef struct SE_DeviceDescription {
+  char* device_vendor;
+  char* platform_version;
+  char* driver_version;
+  char* runtime_version;
+  char* pci_bus_id;
+  char* name;
+
+  int64_t thread_dim_limit_x;
+  int64_t thread_dim_limit_y;
+  int64_t thread_dim_limit_z;
+  int64_t block_dim_limit_x;
+  int64_t block_dim_limit_y;
+  int64_t block_dim_limit_z;
+
+  int64_t threads_per_core_limit;
+  int64_t threads_per_block_limit;
+  int64_t threads_per_warp;
+
+  int64_t registers_per_core_limit;
+  int64_t registers_per_block_limit;
+
+  int64_t device_address_bits;
+  int64_t device_memory_size;
+  int64_t memory_bandwidth;
+
+  int64_t shared_memory_per_core;
+  int64_t shared_memory_per_block;
+
+  float clock_rate_ghz;
+
+  int cuda_compute_capability_major;
+  int cuda_compute_capability_minor;
+
+  int rocm_amdgpu_isa_version;
+  char* rocm_amdgpu_gcn_arch_name;
+
+  int numa_node;
+  int core_count;
+  bool ecc_enabled;
+} SE_DeviceDescription;
+
+// A status with code TF_OK, or NULL if out of memory.
+INTERNAL TF_Status *status_new(void);
+INTERNAL void status_free(TF_Status *status);
+// msg need not be terminated; TF_OK drops it.
+INTERNAL void status_set_message(TF_Status *status, int code, const char *msg, size_t len);
+// Set an error on a TF_Status that libtpu handed out.
+INTERNAL void status_set(TF_Status *status, int code, const char *fmt, ...) __attribute__((format(printf, 3, 4)));
+// Read and free a TF_Status handed back to us (e.g. by a host callback).
+INTERNAL int status_consume(TF_Status *status, char *msg, size_t len);
+
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+// Shapes (tpu_shape.c)
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+//
+// Deep copy and free with the ownership rules of ApiConverter in
+// tensorflow/stream_executor/tpu/c_api_conversions.cc. A copy overwrites
+// dst without freeing it: output shapes from jaxlib arrive uninitialized.
+// Copies return -1 if malloc fails, leaving dst empty.
+
+INTERNAL int int64list_copy(Int64List *dst, const Int64List *src);
+INTERNAL void int64list_free(Int64List *list);
+INTERNAL int boollist_copy(BoolList *dst, const BoolList *src);
+INTERNAL void boollist_free(BoolList *list);
+INTERNAL int tilelist_copy(TileList *dst, const TileList *src);
+INTERNAL void tilelist_free(TileList *list);
+INTERNAL int layout_copy(XLA_Layout *dst, const XLA_Layout *src);
+INTERNAL void layout_free(XLA_Layout *layout);
+INTERNAL int shape_copy(XLA_Shape *dst, const XLA_Shape *src);
+INTERNAL void shape_free(XLA_Shape *shape);
+// Content hash of a shape tree; equal shapes hash equal.
+INTERNAL uint64_t shape_fingerprint(const XLA_Shape *shape);
+
+#define FNV_OFFSET 0xcbf29ce484222325ull
+#define FNV_PRIME 0x100000001b3ull
+
+// 64-bit FNV-1a of n bytes, continuing from h (start from FNV_OFFSET).
+INTERNAL uint64_t fnv(uint64_t h, const void *data, size_t n);
+
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+// Layouts (tpu_layout.c)
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+enum { LAYOUT_TILED = 0, LAYOUT_COMPACT = 1 };
+enum { SIZE_PADDED = 0, SIZE_COMPACT = 1, SIZE_COMPACT_RAW = 2 };
+
+// Returns the previous policy.
+INTERNAL int layout_set_policy(int policy);
+INTERNAL int layout_get_policy(void);
+// Bytes for a shape under its own layout; -1 for an unknown element type.
+INTERNAL int64_t layout_shape_size(const XLA_Shape *shape, int mode);
+// Copy src into dst with the policy's device layouts.
+INTERNAL int layout_device_shape(XLA_Shape *dst, const XLA_Shape *src, int policy);
+
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+// Device memory (tpu_allocator.c)
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+typedef struct bfc_chunk bfc_chunk_t;
+
+#define BFC_BINS 21
+
+typedef struct bfc_allocator {
+  pthread_mutex_t mu;
+  char *base;
+  size_t size;
+  bfc_chunk_t *chunks;     // chunk records, indexed by chunk id
+  int32_t nchunks;         // records in use or on the record freelist
+  int32_t cap;
+  int32_t free_records;    // freelist of unused chunk records
+  int32_t bins[BFC_BINS];  // free chunks, bin i holds sizes in [256<<i, 256<<(i+1))
+  int32_t *owner;          // chunk id of the chunk starting at each 256-byte unit
+  int64_t num_allocs;
+  int64_t bytes_in_use;
+  int64_t peak_bytes_in_use;
+  int64_t largest_alloc_size;
+} bfc_t;
+
+INTERNAL int bfc_init(bfc_t *a, void *base, size_t size);
+INTERNAL void bfc_destroy(bfc_t *a);
+INTERNAL void *bfc_alloc(bfc_t *a, size_t size);
+INTERNAL int bfc_free(bfc_t *a, void *ptr);
+INTERNAL size_t bfc_size(bfc_t *a, void *ptr);
+INTERNAL void bfc_stats(bfc_t *a, SE_AllocatorStats *stats, int64_t *largest_free, int64_t *bytes_free);
+
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+// Devices (tpu_device.c)
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+//
+// Each SE_StreamExecutor the platform hands out is bound to a device
+// slot, which owns the device's memory region and allocator.
+
+#define MAX_DEVICES 64
+#define MAX_FEED_QUEUES 16
+
+enum { FEED_INFEED = 0, FEED_OUTFEED = 1 };
+
+typedef struct feed feed_t;
+
+typedef struct tpu_device {
+  SE_StreamExecutor *executor;
+  int ordinal;
+  size_t memory_limit;
+  void *memory;
+  int memory_fd;             // backing file, or -1 for anonymous memory
+  size_t release_threshold;  // frees at least this big give their pages back
+  uint64_t *committed_pages; // a bit per page, set from allocation until release
+  int page_shift;
+  int64_t committed;         // bytes in those pages
+  int64_t peak_committed;
+  bfc_t allocator;
+  pthread_mutex_t streams_mu;
+  SE_Stream *streams;        // allocated streams, for SynchronizeAllActivity
+  size_t feed_capacity;      // bytes per infeed/outfeed ring
+  pthread_mutex_t feeds_mu;
+  feed_t *feeds[2][MAX_FEED_QUEUES];  // [FEED_INFEED/FEED_OUTFEED][queue index], made on first use
+} tpu_device_t;
+
+INTERNAL tpu_device_t *device_bind(SE_StreamExecutor *executor, int ordinal, size_t memory_limit,
+                                   const char *path, size_t release_threshold, size_t feed_capacity);
+INTERNAL int64_t device_committed(tpu_device_t *dev);
+INTERNAL tpu_device_t *device_for_executor(SE_StreamExecutor *executor);
+INTERNAL tpu_device_t *device_for_ordinal(int ordinal);
+
+// Copy between host and device memory, splitting big copies across the
+// memcpy pool (tpu_memcpy.c). Doesn't touch the GIL.
+INTERNAL void device_memcpy(void *dst, const void *src, size_t size);
+
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+// Streams (tpu_stream.c)
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+//
+// A stream is an ordered queue of ops drained by its own worker thread.
+// Op records are recycled through a per-stream freelist.
+
+typedef struct stream_op stream_op_t;
+typedef void (*stream_fn_t)(SE_Stream *stream, stream_op_t *op);
+
+struct stream_op {
+  stream_fn_t fn;
+  void *dst;
+  const void *src;
+  size_t size;
+  void *ctx;
+  uint32_t prof_name;        // the API call that queued it, when profiling
+  stream_op_t *next;
+};
+
+struct SE_Stream {
+  tpu_device_t *dev;
+  pthread_mutex_t mu;
+  pthread_cond_t work_cv;    // ops were queued, or stopping
+  pthread_cond_t idle_cv;    // the queue drained
+  pthread_t thread;
+  int running;
+  int stopping;
+  stream_op_t *head, *tail;
+  stream_op_t *free_ops;
+  uint64_t enqueued;
+  uint64_t completed;
+  int error_code;            // sticky: the first failure on this stream
+  char error[256];
+  SE_Stream *next;           // in dev->streams
+};
+
+INTERNAL int stream_push(SE_Stream *stream, stream_fn_t fn, void *dst, const void *src, size_t size, void *ctx);
+INTERNAL void stream_fail(SE_Stream *stream, int code, const char *fmt, ...) __attribute__((format(printf, 3, 4)));
+INTERNAL int stream_push_python(SE_Stream *stream, PyObject *fn);
+INTERNAL int stream_wait(SE_Stream *stream);
+INTERNAL int device_wait(tpu_device_t *dev, SE_Stream **failed);
+
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+// Events and timers (tpu_event.c)
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+//
+// Both are marks a stream's worker sets when it reaches them. Queued ops
+// hold a reference, so freeing one with work still in flight is safe.
+
+typedef struct SE_Event SE_Event;
+typedef struct SE_Timer SE_Timer;
+
+// stream_executor::Event::Status
+enum {
+  EVENT_UNKNOWN = 0,
+  EVENT_ERROR = 1,
+  EVENT_PENDING = 2,
+  EVENT_COMPLETE = 3,
+};
+
+struct SE_Event {
+  int refs;
+  pthread_mutex_t mu;
+  pthread_cond_t cv;
+  uint64_t recorded;         // records queued so far
+  uint64_t completed;        // records the worker has reached
+  int error_code;            // the recording stream's error at the last record
+};
+
+struct SE_Timer {
+  int refs;
+  uint64_t start_ns;         // CLOCK_MONOTONIC, stamped by the worker
+  uint64_t stop_ns;
+};
+
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+// Infeed and outfeed (tpu_feed.c)
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+//
+// Each queue is a bounded byte ring of length-prefixed records. The host
+// produces infeed and consumes outfeed; the "device" (Python running a
+// program) does the opposite through libtpujesus.infeed_dequeue and
+// outfeed_enqueue.
+
+struct feed {
+  pthread_mutex_t mu;
+  pthread_cond_t not_full;
+  pthread_cond_t not_empty;
+  char *ring;
+  size_t capacity;
+  uint64_t head, tail;       // bytes consumed / produced, ever
+  uint64_t records;          // records in the ring
+  uint64_t peak_bytes;
+  uint64_t pushed, popped;   // records, ever
+  uint64_t bytes_pushed;
+  uint64_t push_stall_ns;    // producers blocked on a full ring
+  uint64_t pop_stall_ns;     // consumers blocked on an empty ring
+};
+
+typedef struct feed_iovec {
+  void *base;
+  size_t len;
+} feed_iovec_t;
+
+INTERNAL feed_t *feed_get(tpu_device_t *dev, int kind, int index);
+// Both return 0, -1 if the record doesn't fit (the ring, or the caller's
+// buffers), or -2 on timeout. timeout_ns < 0 waits forever. The GIL is
+// released while blocked.
+//
+// A push gathers its buffers into one record. A pop scatters the next
+// record across iov, or, if alloc is set, returns it in a malloc'd
+// buffer; either way *size gets the record size.
+INTERNAL int feed_push(feed_t *f, const feed_iovec_t *iov, int n, int64_t timeout_ns);
+INTERNAL int feed_pop(feed_t *f, const feed_iovec_t *iov, int n, void **alloc, size_t *size,
+                      int64_t timeout_ns);
+INTERNAL PyObject *feed_stats(tpu_device_t *dev);
+
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+// The C API itself
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+#include "tpu_api.h"
+
+#endif /* LIBTPUJESUS_H */
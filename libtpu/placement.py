@@ -0,0 +1,94 @@
+"""Device placement for TpuComputationPlacer.
+
+A strategy orders the topology's cores; replica r, computation c of an
+assignment then gets the (r * computation_count + c)th core in that order,
+so each replica's computations sit next to each other and consecutive
+replicas are neighbours:
+
+    ring    core id order
+    snake   boustrophedon over the chip grid: x runs forward then back on
+            alternate rows, y likewise on alternate z planes, so
+            consecutive chips are always one hop apart; a chip's cores
+            stay together
+    host    snake order restricted to this host's cores first, then the
+            rest, so small jobs never leave the host
+
+Choose one with the libtpu_placement option or $LIBTPU_PLACEMENT (default
+"host"). report() scores each strategy by how many of the links a ring
+all-reduce over the assignment would use are neighbour links (same chip,
+or one hop on the torus).
+"""
+
+STRATEGIES = ('ring', 'snake', 'host')
+
+
+def snake_order(topology):
+  bx, by, bz = topology.bounds
+  k = topology.cores_per_chip
+  order = []
+  for z in range(bz):
+    ys = range(by) if z % 2 == 0 else range(by - 1, -1, -1)
+    for row, y in enumerate(ys):
+      xs = range(bx) if (z * by + row) % 2 == 0 else range(bx - 1, -1, -1)
+      for x in xs:
+        i = topology.grid_index(x, y, z)
+        order.extend(topology.grid[i:i + k])
+  return order
+
+
+def device_order(topology, strategy='host', host=None, local=False):
+  """The topology's cores in placement order. `host` is the one the
+  "host" strategy favours; with local=True only its cores are returned."""
+  if strategy not in STRATEGIES:
+    raise ValueError(f'unknown placement strategy {strategy!r} (expected one of {", ".join(STRATEGIES)})')
+  if strategy == 'ring':
+    order = sorted(topology.cores, key=lambda core: core.id)
+  else:
+    order = snake_order(topology)
+  if host is not None and (local or strategy == 'host'):
+    mine = set(id(core) for core in host.cores)
+    first = [core for core in order if id(core) in mine]
+    order = first if local else first + [core for core in order if id(core) not in mine]
+  return order
+
+
+def assign(cores, replica_count, computation_count):
+  """Device ids for a replica_count x computation_count assignment,
+  row-major."""
+  if replica_count < 1 or computation_count < 1:
+    raise ValueError(f'replica_count and computation_count must be positive, '
+                     f'got {replica_count} and {computation_count}')
+  n = replica_count * computation_count
+  if n > len(cores):
+    raise ValueError(f'requested {replica_count} replicas x {computation_count} computations '
+                     f'= {n} cores, but only {len(cores)} are available')
+  return [core.id for core in cores[:n]]
+
+
+def hops(topology, a, b):
+  """Torus distance between the chips of two cores."""
+  total = 0
+  for p, q, n in zip((a.x, a.y, a.z), (b.x, b.y, b.z), topology.bounds):
+    d = abs(p - q)
+    total += min(d, n - d)
+  return total
+
+
+def ring_links(topology, cores):
+  """(neighbour links, total links) of a ring through `cores` in order."""
+  n = len(cores)
+  if n < 2:
+    return 0, 0
+  near = sum(hops(topology, cores[i], cores[(i + 1) % n]) <= 1 for i in range(n))
+  return near, n
+
+
+def report(topology, host=None, devices=None):
+  """{strategy: {'neighbor_links', 'links'}} for a ring over the first
+  `devices` cores (all of them by default) of each strategy's order."""
+  out = {}
+  for strategy in STRATEGIES:
+    cores = device_order(topology, strategy, host)[:devices]
+    near, total = ring_links(topology, cores)
+    out[strategy] = dict(neighbor_links=near, links=total)
+  return out
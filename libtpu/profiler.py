@@ -0,0 +1,305 @@
+"""Profiles of libtpu as XSpace protos and Chrome trace JSON.
+
+tpu_profiler.c records events into per-thread rings while a session runs
+(TpuProfiler_Start/Stop, or start()/stop() here). collect() turns the
+session into an XSpace, the proto TpuProfiler_CollectData hands to
+TensorFlow's profiler:
+
+  /host:CPU          one line per host thread: API calls as C sees them,
+                     their Python side nested inside, native calls, and
+                     Python spans (compiles)
+  /device:TPU:<n>    one line per stream worker: queued ops named after the
+                     API call that queued them, transfers, program runs;
+                     and a "Memory" line of device bytes in use
+
+chrome_trace() converts an XSpace (or its serialized bytes) to the Chrome
+trace event format, which chrome://tracing and ui.perfetto.dev open:
+
+    profiler.start()
+    ...
+    profiler.stop()
+    profiler.write_chrome_trace('trace.json', profiler.collect())
+
+$LIBTPU_PROFILE=<path> (or the libtpu_profile option) profiles the whole
+process and writes <path> at exit.
+
+Python code adds its own events with span():
+
+    with profiler.span('compile', profiler.COMPILE):
+      ...
+"""
+import json
+import struct
+import time
+
+import libtpujesus
+
+from . import hlo
+
+# Event kinds; keep in sync with PROF_* in libtpujesus.h
+KINDS = ('api', 'python', 'native', 'stream', 'transfer', 'exec', 'compile', 'memory')
+API, PYTHON, NATIVE, STREAM, TRANSFER, EXEC, COMPILE, MEMORY = range(len(KINDS))
+
+# prof_event_t
+EVENT = struct.Struct('<QQQIHh')
+NO_NAME = 0xffffffff
+
+# tensorflow/core/profiler/protobuf/xplane.proto
+XStat = hlo.message('XStat', {
+  1: ('metadata_id', 'int'),
+  2: ('double_value', 'f64'),
+  3: ('uint64_value', 'uint'),
+  4: ('int64_value', 'int'),
+  5: ('str_value', 'str'),
+})
+XEvent = hlo.message('XEvent', {
+  1: ('metadata_id', 'int'),
+  2: ('offset_ps', 'int'),
+  3: ('duration_ps', 'int'),
+  4: ('stats', 'XStat', True),
+})
+XLine = hlo.message('XLine', {
+  1: ('id', 'int'),
+  2: ('name', 'str'),
+  3: ('timestamp_ns', 'int'),
+  4: ('events', 'XEvent', True),
+  9: ('duration_ps', 'int'),
+  10: ('display_id', 'int'),
+  11: ('display_name', 'str'),
+})
+XEventMetadata = hlo.message('XEventMetadata', {
+  1: ('id', 'int'),
+  2: ('name', 'str'),
+  4: ('display_name', 'str'),
+  5: ('stats', 'XStat', True),
+})
+XStatMetadata = hlo.message('XStatMetadata', {
+  1: ('id', 'int'),
+  2: ('name', 'str'),
+})
+# map<int64, XEventMetadata> and map<int64, XStatMetadata>
+XEventMetadataEntry = hlo.message('XEventMetadataEntry', {
+  1: ('key', 'int'),
+  2: ('value', 'XEventMetadata'),
+})
+XStatMetadataEntry = hlo.message('XStatMetadataEntry', {
+  1: ('key', 'int'),
+  2: ('value', 'XStatMetadata'),
+})
+XPlane = hlo.message('XPlane', {
+  1: ('id', 'int'),
+  2: ('name', 'str'),
+  3: ('lines', 'XLine', True),
+  4: ('event_metadata', 'XEventMetadataEntry', True),
+  5: ('stat_metadata', 'XStatMetadataEntry', True),
+  6: ('stats', 'XStat', True),
+})
+XSpace = hlo.message('XSpace', {
+  1: ('planes', 'XPlane', True),
+  2: ('errors', 'str', True),
+  3: ('warnings', 'str', True),
+  4: ('hostnames', 'str', True),
+})
+hlo.link(XStat, XEvent, XLine, XEventMetadata, XStatMetadata, XEventMetadataEntry,
+         XStatMetadataEntry, XPlane, XSpace)
+
+HOST_PLANE = '/host:CPU'
+DEVICE_PLANE = '/device:TPU:{}'
+MEMORY_LINE = -1
+
+# Stat metadata ids, the same in every plane.
+STAT_KIND, STAT_BYTES, STAT_BYTES_IN_USE = 1, 2, 3
+STAT_NAMES = {STAT_KIND: 'kind', STAT_BYTES: 'bytes', STAT_BYTES_IN_USE: 'bytes_in_use'}
+
+#
+# Recording
+#
+
+def start():
+  """Start a session; False if one is already running."""
+  return libtpujesus.profiler_start()
+
+def stop():
+  libtpujesus.profiler_stop()
+
+def collect():
+  """The latest session's events, as an XSpace."""
+  return xspace(libtpujesus.profiler_collect())
+
+names = {}
+
+def intern(name):
+  id = names.get(name)
+  if id is None:
+    id = names[name] = libtpujesus.profile_intern(name)
+  return id
+
+class span:
+  """Record the body of a with statement as one event on this thread.
+  Costs one call into libtpujesus outside a session."""
+  __slots__ = ('name', 'kind', 'arg', 'start')
+
+  def __init__(self, name, kind=PYTHON, arg=0):
+    self.name = name
+    self.kind = kind
+    self.arg = arg
+
+  def __enter__(self):
+    self.start = time.monotonic_ns() if libtpujesus.profiling() else 0
+    return self
+
+  def __exit__(self, *exc):
+    if self.start:
+      libtpujesus.profile_event(intern(self.name), self.kind, self.start,
+                                time.monotonic_ns(), self.arg)
+
+#
+# XSpace
+#
+
+class PlaneBuilder:
+  def __init__(self, id, name):
+    self.plane = XPlane()
+    self.plane.id = id
+    self.plane.name = name
+    self.metadata = {}
+    for stat_id, stat_name in STAT_NAMES.items():
+      entry = XStatMetadataEntry()
+      entry.key = stat_id
+      entry.value = XStatMetadata()
+      entry.value.id, entry.value.name = stat_id, stat_name
+      self.plane.stat_metadata.append(entry)
+
+  def metadata_id(self, name, kind):
+    """Event metadata per (name, kind); the kind rides along as a stat."""
+    id = self.metadata.get((name, kind))
+    if id is None:
+      id = self.metadata[name, kind] = len(self.metadata) + 1
+      entry = XEventMetadataEntry()
+      entry.key = id
+      entry.value = XEventMetadata()
+      entry.value.id, entry.value.name = id, name
+      entry.value.stats.append(stat(STAT_KIND, str_value=KINDS[kind]))
+      self.plane.event_metadata.append(entry)
+    return id
+
+  def line(self, id, name, timestamp_ns):
+    line = XLine()
+    line.id = line.display_id = id
+    line.name = line.display_name = name
+    line.timestamp_ns = timestamp_ns
+    self.plane.lines.append(line)
+    return line
+
+def stat(metadata_id, **value):
+  s = XStat()
+  s.metadata_id = metadata_id
+  for k, v in value.items():
+    setattr(s, k, v)
+  return s
+
+def event_name(names, name, kind):
+  if name == NO_NAME or name >= len(names):
+    return KINDS[kind]
+  return names[name]
+
+def xspace(snapshot):
+  """Build an XSpace from libtpujesus.profiler_collect(). Every line's
+  timestamp is the session's wall-clock start; events are offsets from it."""
+  start, wall = snapshot['start_ns'], snapshot['start_wall_ns']
+  names = snapshot['names']
+  planes = {}
+
+  def plane(device):
+    p = planes.get(device)
+    if p is None:
+      name = HOST_PLANE if device < 0 else DEVICE_PLANE.format(device)
+      p = planes[device] = PlaneBuilder(len(planes) + 1, name)
+    return p
+
+  lines = {}
+
+  def line(device, id, name):
+    l = lines.get((device, id))
+    if l is None:
+      l = lines[device, id] = plane(device).line(id, name, wall)
+    return l
+
+  for tid, thread, device, dropped, data in snapshot['threads']:
+    for start_ns, end_ns, arg, name, kind, ev_device in EVENT.iter_unpack(data):
+      if kind == MEMORY:
+        l = line(ev_device, MEMORY_LINE, 'Memory')
+      else:
+        l = line(ev_device, tid, thread)
+      ev = XEvent()
+      ev.metadata_id = plane(ev_device).metadata_id(event_name(names, name, kind), kind)
+      ev.offset_ps = (start_ns - start) * 1000
+      ev.duration_ps = (end_ns - start_ns) * 1000
+      if kind == TRANSFER:
+        ev.stats.append(stat(STAT_BYTES, uint64_value=arg))
+      elif kind == MEMORY:
+        ev.stats.append(stat(STAT_BYTES_IN_USE, uint64_value=arg))
+      l.events.append(ev)
+  space = XSpace()
+  # host first, then devices in order
+  space.planes = [planes[d].plane for d in sorted(planes)]
+  for l in lines.values():
+    l.events.sort(key=lambda ev: ev.offset_ps)
+    if l.events:
+      last = max(ev.offset_ps + ev.duration_ps for ev in l.events)
+      l.duration_ps = last - min(ev.offset_ps for ev in l.events)
+  return space
+
+#
+# Chrome trace
+#
+
+def chrome_trace(space):
+  """The Chrome trace event format (a dict to json.dump) for an XSpace or
+  serialized XSpace. Planes are processes and lines are threads; times are
+  microseconds from the earliest line's timestamp."""
+  if isinstance(space, (bytes, bytearray, memoryview)):
+    space = XSpace.parse(space)
+  base = min((l.timestamp_ns for p in space.planes for l in p.lines), default=0)
+  events = []
+  for pid, plane in enumerate(space.planes, 1):
+    metadata = {e.key: e.value for e in plane.event_metadata}
+    stat_names = {e.key: e.value.name for e in plane.stat_metadata}
+    events.append({'ph': 'M', 'name': 'process_name', 'pid': pid, 'args': {'name': plane.name}})
+    events.append({'ph': 'M', 'name': 'process_sort_index', 'pid': pid, 'args': {'sort_index': pid}})
+    for line in plane.lines:
+      tid = line.id & 0xffffffff
+      events.append({'ph': 'M', 'name': 'thread_name', 'pid': pid, 'tid': tid,
+                     'args': {'name': line.display_name or line.name}})
+      origin_ps = (line.timestamp_ns - base) * 1000
+      for ev in line.events:
+        md = metadata.get(ev.metadata_id)
+        name = md.name if md else str(ev.metadata_id)
+        kind = next((s.str_value for s in md.stats if stat_names.get(s.metadata_id) == 'kind'), '') if md else ''
+        args = {stat_names.get(s.metadata_id, str(s.metadata_id)): stat_value(s) for s in ev.stats}
+        ts = (origin_ps + ev.offset_ps) / 1e6
+        if kind == 'memory':
+          events.append({'ph': 'C', 'name': f'{plane.name} memory', 'pid': pid, 'ts': ts,
+                         'args': args})
+        else:
+          events.append({'ph': 'X', 'name': name, 'cat': kind, 'pid': pid, 'tid': tid, 'ts': ts,
+                         'dur': ev.duration_ps / 1e6, 'args': args})
+  return {'displayTimeUnit': 'ns', 'traceEvents': events}
+
+def stat_value(s):
+  return s.str_value or s.uint64_value or s.int64_value or s.double_value
+
+def write_chrome_trace(path, space):
+  with open(path, 'w') as f:
+    json.dump(chrome_trace(space), f)
+
+def trace_to(path):
+  """Profile from now until exit, then write a Chrome trace to `path`."""
+  import atexit
+  if not start():
+    return False
+  def finish():
+    stop()
+    write_chrome_trace(path, collect())
+  atexit.register(finish)
+  return True
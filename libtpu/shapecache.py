@@ -0,0 +1,86 @@
+"""Content-addressed cache of per-shape results for the transfer manager.
+
+JAX asks for the byte size, device shape and compact layout of the same
+few shapes over and over. Entries are keyed by
+libtpujesus.shape_fingerprint, a 64-bit hash of the whole shape tree
+computed in C, and hold whatever has been computed for that shape so far:
+
+    cache.get(fp, 'bytes')            -> value, or None on a miss
+    cache.put(fp, 'bytes', value)
+
+Cached shapes are owned copies (XLA_Shape.Set); the cache frees them when
+the entry is evicted or flushed, so a caller copying one out holds `lock`
+until it's done. Entries are evicted least recently used first once there
+are more than `capacity`.
+"""
+import threading
+from collections import OrderedDict
+
+
+class ShapeCache:
+  __slots__ = ('entries', 'capacity', 'hits', 'misses', 'evictions', 'flushes', 'lock')
+
+  def __init__(self, capacity=1024):
+    self.entries = OrderedDict()  # fingerprint -> {kind: value}
+    self.capacity = capacity
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.flushes = 0
+    self.lock = threading.RLock()
+
+  def get(self, fp, kind):
+    with self.lock:
+      entry = self.entries.get(fp)
+      if entry is not None and kind in entry:
+        self.entries.move_to_end(fp)
+        self.hits += 1
+        return entry[kind]
+      self.misses += 1
+      return None
+
+  def put(self, fp, kind, value):
+    if self.capacity <= 0:
+      return value  # caching is off; the caller keeps ownership
+    with self.lock:
+      entry = self.entries.get(fp)
+      if entry is None:
+        entry = self.entries[fp] = {}
+        self.trim(self.capacity)
+      else:
+        self.entries.move_to_end(fp)
+        release(entry.get(kind))
+      entry[kind] = value
+      return value
+
+  def trim(self, capacity):
+    with self.lock:
+      while len(self.entries) > max(capacity, 0):
+        _, entry = self.entries.popitem(last=False)
+        for value in entry.values():
+          release(value)
+        self.evictions += 1
+
+  def resize(self, capacity):
+    self.capacity = capacity
+    self.trim(capacity)
+
+  def flush(self):
+    """Drop everything, e.g. because the layout policy changed."""
+    self.trim(0)
+    self.flushes += 1
+
+  def stats(self):
+    lookups = self.hits + self.misses
+    return dict(size=len(self.entries), capacity=self.capacity, hits=self.hits,
+                misses=self.misses, hit_rate=self.hits / lookups if lookups else 0.0,
+                evictions=self.evictions, flushes=self.flushes)
+
+
+def release(value):
+  free = getattr(value, 'Free', None)
+  if free is not None:
+    free()
+
+
+cache = ShapeCache()
@@ -0,0 +1,291 @@
+/* tpu_allocator.c
+Copyright 2021 Shawn Presser
+
+Best-fit-with-coalescing allocator for fake device memory, after
+tensorflow/core/common_runtime/bfc_allocator.cc.
+
+The allocator manages one fixed region. The region is carved into chunks
+that tile it exactly, linked by address. Free chunks also sit in one of
+BFC_BINS size-class bins. An allocation takes the smallest free chunk
+that fits (lowest address on ties) and splits off the remainder. A free
+merges the chunk with free neighbours before binning it.
+
+Chunk bookkeeping lives outside the region: a growable array of chunk
+records, plus an `owner` map from each 256-byte unit to the chunk that
+starts there. The owner map makes a free O(1) without a hash table, and
+since it is mmap'd lazily only the units that are actually used cost
+memory. Once the record array has grown to the peak number of chunks,
+alloc and free don't touch malloc.
+*/
+
+#include "libtpujesus.h"
+
+#include <sys/mman.h>
+
+#define BFC_MIN_ALLOC 256
+#define BFC_UNIT_SHIFT 8
+
+struct bfc_chunk {
+  size_t offset;
+  size_t size;
+  size_t requested;
+  int32_t prev, next;          // neighbours by address, -1 at the ends
+  int32_t bin_prev, bin_next;  // bin links while free; bin_next links unused records
+  int8_t bin;                  // -1 while in use
+};
+
+static inline int
+bfc_bin(size_t size)
+{
+    size_t units = size >> BFC_UNIT_SHIFT;
+    int b = 63 - __builtin_clzll(units | 1);
+    return b < BFC_BINS ? b : BFC_BINS - 1;
+}
+
+static int32_t
+bfc_new_chunk(bfc_t *a)
+{
+    int32_t id = a->free_records;
+    if (id >= 0) {
+        a->free_records = a->chunks[id].bin_next;
+        return id;
+    }
+    if (a->nchunks == a->cap) {
+        int32_t cap = a->cap ? a->cap * 2 : 1024;
+        bfc_chunk_t *chunks = realloc(a->chunks, cap * sizeof(*chunks));
+        if (!chunks)
+            return -1;
+        a->chunks = chunks;
+        a->cap = cap;
+    }
+    return a->nchunks++;
+}
+
+static void
+bfc_release_chunk(bfc_t *a, int32_t id)
+{
+    a->chunks[id].bin = -1;
+    a->chunks[id].bin_next = a->free_records;
+    a->free_records = id;
+}
+
+static void
+bfc_bin_insert(bfc_t *a, int32_t id)
+{
+    bfc_chunk_t *c = &a->chunks[id];
+    int b = bfc_bin(c->size);
+    c->bin = b;
+    c->bin_prev = -1;
+    c->bin_next = a->bins[b];
+    if (c->bin_next >= 0)
+        a->chunks[c->bin_next].bin_prev = id;
+    a->bins[b] = id;
+}
+
+static void
+bfc_bin_remove(bfc_t *a, int32_t id)
+{
+    bfc_chunk_t *c = &a->chunks[id];
+    if (c->bin_prev >= 0)
+        a->chunks[c->bin_prev].bin_next = c->bin_next;
+    else
+        a->bins[c->bin] = c->bin_next;
+    if (c->bin_next >= 0)
+        a->chunks[c->bin_next].bin_prev = c->bin_prev;
+    c->bin = -1;
+}
+
+int
+bfc_init(bfc_t *a, void *base, size_t size)
+{
+    size_t owner_bytes;
+    int32_t id;
+    int i;
+
+    memset(a, 0, sizeof(*a));
+    pthread_mutex_init(&a->mu, NULL);
+    a->base = base;
+    a->size = size & ~(size_t)(BFC_MIN_ALLOC - 1);
+    a->free_records = -1;
+    for (i = 0; i < BFC_BINS; i++)
+        a->bins[i] = -1;
+    owner_bytes = (a->size >> BFC_UNIT_SHIFT) * sizeof(int32_t);
+    if (owner_bytes) {
+        a->owner = mmap(NULL, owner_bytes, PROT_READ | PROT_WRITE,
+                        MAP_PRIVATE | MAP_ANONYMOUS | MAP_NORESERVE, -1, 0);
+        if (a->owner == MAP_FAILED) {
+            a->owner = NULL;
+            return -1;
+        }
+        if ((id = bfc_new_chunk(a)) < 0)
+            return -1;
+        a->chunks[id] = (bfc_chunk_t){ .offset = 0, .size = a->size, .prev = -1, .next = -1 };
+        bfc_bin_insert(a, id);
+    }
+    return 0;
+}
+
+void
+bfc_destroy(bfc_t *a)
+{
+    if (a->owner)
+        munmap(a->owner, (a->size >> BFC_UNIT_SHIFT) * sizeof(int32_t));
+    free(a->chunks);
+    pthread_mutex_destroy(&a->mu);
+    memset(a, 0, sizeof(*a));
+}
+
+void *
+bfc_alloc(bfc_t *a, size_t size)
+{
+    size_t rounded = (size + BFC_MIN_ALLOC - 1) & ~(size_t)(BFC_MIN_ALLOC - 1);
+    int32_t best = -1;
+    bfc_chunk_t *c;
+    int b;
+
+    if (rounded == 0)
+        rounded = BFC_MIN_ALLOC;
+    pthread_mutex_lock(&a->mu);
+    // Every chunk in a bin above bfc_bin(rounded) fits, so the first
+    // non-empty bin with a fitting chunk holds the best fit.
+    for (b = bfc_bin(rounded); b < BFC_BINS && best < 0; b++) {
+        int32_t id;
+        for (id = a->bins[b]; id >= 0; id = a->chunks[id].bin_next) {
+            c = &a->chunks[id];
+            if (c->size >= rounded &&
+                (best < 0 || c->size < a->chunks[best].size ||
+                 (c->size == a->chunks[best].size && c->offset < a->chunks[best].offset)))
+                best = id;
+        }
+    }
+    if (best < 0) {
+        pthread_mutex_unlock(&a->mu);
+        return NULL;
+    }
+    bfc_bin_remove(a, best);
+    if (a->chunks[best].size - rounded >= BFC_MIN_ALLOC) {
+        int32_t rest = bfc_new_chunk(a);  // may move a->chunks
+        if (rest >= 0) {
+            bfc_chunk_t *r = &a->chunks[rest];
+            c = &a->chunks[best];
+            r->offset = c->offset + rounded;
+            r->size = c->size - rounded;
+            r->requested = 0;
+            r->prev = best;
+            r->next = c->next;
+            if (r->next >= 0)
+                a->chunks[r->next].prev = rest;
+            c->next = rest;
+            c->size = rounded;
+            bfc_bin_insert(a, rest);
+        }
+    }
+    c = &a->chunks[best];
+    c->requested = size;
+    a->owner[c->offset >> BFC_UNIT_SHIFT] = best;
+    a->num_allocs++;
+    a->bytes_in_use += c->size;
+    if (a->bytes_in_use > a->peak_bytes_in_use)
+        a->peak_bytes_in_use = a->bytes_in_use;
+    if ((int64_t)size > a->largest_alloc_size)
+        a->largest_alloc_size = size;
+    pthread_mutex_unlock(&a->mu);
+    return a->base + c->offset;
+}
+
+/* Chunk id of the in-use chunk at ptr, or -1. Call with a->mu held. */
+static int32_t
+bfc_find(bfc_t *a, void *ptr)
+{
+    size_t offset = (char *)ptr - a->base;
+    int32_t id;
+
+    if ((char *)ptr < a->base || offset >= a->size || (offset & (BFC_MIN_ALLOC - 1)))
+        return -1;
+    id = a->owner[offset >> BFC_UNIT_SHIFT];
+    if (id < 0 || id >= a->nchunks || a->chunks[id].offset != offset || a->chunks[id].bin >= 0)
+        return -1;
+    return id;
+}
+
+int
+bfc_free(bfc_t *a, void *ptr)
+{
+    int32_t id, n, p;
+    bfc_chunk_t *c;
+
+    pthread_mutex_lock(&a->mu);
+    if ((id = bfc_find(a, ptr)) < 0) {
+        pthread_mutex_unlock(&a->mu);
+        return -1;
+    }
+    c = &a->chunks[id];
+    a->bytes_in_use -= c->size;
+    a->owner[c->offset >> BFC_UNIT_SHIFT] = -1;
+    c->requested = 0;
+    // Merge with the next chunk, then let the previous one absorb us.
+    n = c->next;
+    if (n >= 0 && a->chunks[n].bin >= 0) {
+        bfc_bin_remove(a, n);
+        c->size += a->chunks[n].size;
+        c->next = a->chunks[n].next;
+        if (c->next >= 0)
+            a->chunks[c->next].prev = id;
+        bfc_release_chunk(a, n);
+    }
+    p = c->prev;
+    if (p >= 0 && a->chunks[p].bin >= 0) {
+        bfc_bin_remove(a, p);
+        a->chunks[p].size += c->size;
+        a->chunks[p].next = c->next;
+        if (c->next >= 0)
+            a->chunks[c->next].prev = p;
+        bfc_release_chunk(a, id);
+        id = p;
+    }
+    bfc_bin_insert(a, id);
+    pthread_mutex_unlock(&a->mu);
+    return 0;
+}
+
+size_t
+bfc_size(bfc_t *a, void *ptr)
+{
+    size_t size = 0;
+    int32_t id;
+
+    pthread_mutex_lock(&a->mu);
+    if ((id = bfc_find(a, ptr)) >= 0)
+        size = a->chunks[id].size;
+    pthread_mutex_unlock(&a->mu);
+    return size;
+}
+
+void
+bfc_stats(bfc_t *a, SE_AllocatorStats *stats, int64_t *largest_free, int64_t *bytes_free)
+{
+    int64_t largest = 0;
+    int b;
+
+    pthread_mutex_lock(&a->mu);
+    for (b = BFC_BINS - 1; b >= 0 && !largest; b--) {
+        int32_t id;
+        for (id = a->bins[b]; id >= 0; id = a->chunks[id].bin_next) {
+            if ((int64_t)a->chunks[id].size > largest)
+                largest = a->chunks[id].size;
+        }
+    }
+    memset(stats, 0, sizeof(*stats));
+    stats->num_allocs = a->num_allocs;
+    stats->bytes_in_use = a->bytes_in_use;
+    stats->peak_bytes_in_use = a->peak_bytes_in_use;
+    stats->largest_alloc_size = a->largest_alloc_size;
+    stats->has_bytes_limit = 1;
+    stats->bytes_limit = a->size;
+    stats->largest_free_block_bytes = largest;
+    if (largest_free)
+        *largest_free = largest;
+    if (bytes_free)
+        *bytes_free = a->size - a->bytes_in_use;
+    pthread_mutex_unlock(&a->mu);
+}
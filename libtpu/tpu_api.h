@@ -0,0 +1,519 @@
+/* tpu_api.h
+Copyright 2021 Shawn Presser
+
+Prototypes of every C API function in the .inc files, as declared by
+tensorflow/core/tpu/libtpu.h and the headers it pulls in
+(tpu_ops_c_api.h, tpu_executor_c_api.h, tpu_profiler_c_api.h, ...),
+with C++ references spelled as pointers.
+
+This is the one place the signatures live. libtpujesus.h includes it, so
+the compiler checks every native definition against it, and genapi.py
+reads it to generate the typed trampolines (tpu_trampolines.inc) and the
+signature table the Python dispatchers are built from (capi.py). After
+editing it, run
+
+    python3 libtpu/genapi.py
+
+Symbols left out take the untyped fallback stub; see genapi.py.
+
+Struct types passed or returned by value are defined in libtpujesus.h.
+Everything else is opaque here.
+*/
+
+#ifndef TPU_API_H
+#define TPU_API_H
+
+typedef struct SE_Platform SE_Platform;
+typedef struct SE_StreamExecutor SE_StreamExecutor;
+typedef struct SE_Stream SE_Stream;
+typedef struct SE_Event SE_Event;
+typedef struct SE_Timer SE_Timer;
+typedef struct SE_DeviceOptions SE_DeviceOptions;
+typedef struct SE_TpuTopology SE_TpuTopology;
+typedef struct SE_TpuTopology_Core SE_TpuTopology_Core;
+typedef struct SE_TpuTopology_Host SE_TpuTopology_Host;
+typedef struct SE_ShapedBuffer XLA_ShapedBuffer;
+typedef struct SE_DeviceMemoryAllocator SE_DeviceMemoryAllocator;
+typedef struct SE_StreamExecutorList SE_StreamExecutorList;
+typedef struct SE_Executable SE_Executable;
+typedef struct SE_ExecutableRunOptions SE_ExecutableRunOptions;
+typedef struct SE_ExecutionInput SE_ExecutionInput;
+typedef struct SE_ExecutionOutput SE_ExecutionOutput;
+typedef struct SE_HloExecutionProfile SE_HloExecutionProfile;
+typedef struct SE_MaybeOwningDeviceMemory SE_MaybeOwningDeviceMemory;
+typedef struct SE_ExecutableSerializationHandle SE_ExecutableSerializationHandle;
+typedef struct XLA_ShapeIndex XLA_ShapeIndex;
+typedef struct XLA_ComputationPlacer XLA_ComputationPlacer;
+typedef struct XLA_HloModuleGroup XLA_HloModuleGroup;
+typedef struct XLA_TpuNodeContext XLA_TpuNodeContext;
+typedef struct Tpu_Compiler Tpu_Compiler;
+typedef struct TpuExecutableSerializedProto TpuExecutableSerializedProto;
+typedef struct CompilerMetadataSerializedProto CompilerMetadataSerializedProto;
+typedef struct TpuExecutable_LoadProgramAndEnqueueToStream_Params
+    TpuExecutable_LoadProgramAndEnqueueToStream_Params;
+typedef struct TpuPartitionedCall_Params TpuPartitionedCall_Params;
+typedef struct TpuProfiler TpuProfiler;
+typedef struct TfTpuOrdinalSelector TfTpuOrdinalSelector;
+typedef struct TpuMeshCommonState TpuMeshCommonState;
+
+typedef void (*XLA_StatusCallbackFn)(void*, TF_Status*);
+
+typedef enum TpuCoreTypeEnum {
+  kTensorCore,
+  kEmbeddingV1,
+  kEmbeddingV2,
+} TpuCoreTypeEnum;
+
+typedef enum TpuVersionEnum {
+  kUnknownTpuVersion,
+  kTpuV2,
+  kTpuV3,
+  kTpuV4,
+} TpuVersionEnum;
+
+typedef enum TpuProgramShardingType {
+  kInvalid = 0,
+  kMain,
+  kRemote,
+} TpuProgramShardingType;
+
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+// tpu_library_init_fns.inc
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+void ConfigureDistributedTpuOp_DoWork(
+    const size_t num_cores_per_host_size, const int32_t* num_cores_per_host,
+    size_t server_address_size, const char* server_address,
+    size_t* host_config_output_size, char** host_config_output,
+    TF_Status* status);
+void WaitForDistributedTpuOp_DoWork(
+    const size_t num_hosts, const size_t num_cores_per_host,
+    const int32_t** host_ordinal_to_global_core_id_map,
+    TpuMeshCommonState* tpu_mesh_common_state,
+    size_t* tpu_topology_output_size, char** tpu_topology_output,
+    TF_Status* status);
+void InitializeHostForDistributedTpuOp_DoWork(
+    const size_t tpu_host_config_size, const char* tpu_host_config,
+    const bool enable_whole_mesh_compilations, bool is_master_worker,
+    size_t* core_id_output_size, int32_t** core_id_output, TF_Status* status);
+void SetGlobalTPUArrayOp_DoWork(const size_t tpu_topology_size,
+                                const char* tpu_topology, TF_Status* status);
+void DisconnectDistributedTpuChipsOp_DoWork(int32_t* number_of_chips_output,
+                                            TF_Status* status);
+void TpuConfigurationApi_FreeCharArray(char* output);
+void TpuConfigurationApi_FreeInt32Array(int32_t* output);
+bool TpuConfigurationApi_HasTPUPodState();
+void TpuConfigurationApi_TpusPerHost(int32_t* tpus, TF_Status* status);
+void TpuConfigurationApi_TpuMemoryLimit(int64_t* memory_limit,
+                                        TF_Status* status);
+void TpuConfigurationApi_RemoteCompilationCacheSizeInBytes(
+    int64_t* cache_size_in_bytes);
+void TpuConfigurationApi_CompilationCacheServerAddressFromConfig(
+    size_t tpu_host_config_size, const char* tpu_host_config,
+    size_t* server_address_output_size, char** server_address_output,
+    TF_Status* status);
+void TpuConfigurationApi_GetServerAddressAndPort(
+    size_t* server_address_output_size, char** server_address_output,
+    int* port_output, TF_Status* status);
+
+XLA_TpuMeshState* TpuMeshState_Create();
+void TpuMeshState_Free(XLA_TpuMeshState* mesh_state);
+void* TpuMeshState_MeshCommonState(XLA_TpuMeshState* mesh_state);
+
+void TpuCompile_CompileAndBuild(
+    TpuSerializedProto compilation_request, const XLA_TpuMeshState* mesh_state,
+    XLA_TpuProgram** tpu_programs[], size_t* count, TF_Status* status);
+void TpuCompile_XrtCompileAndBuild(
+    TpuSerializedProto xrt_computation, const XLA_TpuMeshState* mesh_state,
+    XLA_TpuProgram** tpu_programs[], size_t* count, TF_Status* status);
+
+void TpuExecutable_LoadProgramAndEnqueueToStream(
+    TpuExecutable_LoadProgramAndEnqueueToStream_Params* params);
+void HardwareLayout_HostShapeToDeviceShape(XLA_Shape* host_shape,
+                                           XLA_Shape* device_shape);
+int64_t HardwareLayout_ShapeSize(XLA_Shape* shape);
+int64_t HardwareLayout_ShapeSizeCompact(XLA_Shape* shape);
+int64_t HardwareLayout_ShapeSizeCompactRaw(XLA_Shape* shape);
+
+void TpuExecute_RuntimeInputToPaddedData(
+    uint32_t* runtime_input_ptr, size_t runtime_input_size,
+    int8_t* padded_data_ptr, size_t padded_data_size, XLA_Shape* runtime_shape,
+    XLA_Shape* compile_time_shape, TF_Status* status);
+
+XLA_TpuProgram* TpuProgram_New();
+void TpuProgram_Free(XLA_TpuProgram* tpu_program);
+XLA_TpuProgram** TpuProgram_NewArray(size_t count);
+void TpuProgram_FreeArray(XLA_TpuProgram* tpu_program[]);
+void TpuProgram_UnloadAndDestroy(XLA_TpuProgram* program, TF_Status* status);
+int64_t TpuProgram_GetProgramSize(const XLA_TpuProgram* tpu_program);
+void TpuProgram_LogProgramMemorySummary(const XLA_TpuProgram* tpu_program);
+void TpuProgram_GetExecutableInfo(const XLA_TpuProgram* tpu_program,
+                                  TpuSerializedProto* executable_info,
+                                  TF_Status* status);
+void TpuProgram_GetHostTransferInfo(const XLA_TpuProgram* tpu_program,
+                                    TpuSerializedProto* host_transfer_info,
+                                    TF_Status* status);
+void TpuProgram_GetHloMetadata(const XLA_TpuProgram* tpu_program,
+                               TpuSerializedProto* hlo_metadata,
+                               TF_Status* status);
+void TpuProgram_GetMayModifyVariables(const XLA_TpuProgram* tpu_program,
+                                      bool* may_modify_variables);
+bool TpuProgram_HasSharding(const XLA_TpuProgram* tpu_program);
+XLA_TpuProgram* TpuProgram_GetTpuProgram(XLA_TpuProgram* tpu_program,
+                                         TpuProgramShardingType type);
+void TpuProgram_SerializeTpuExecutable(
+    const XLA_TpuProgram* tpu_program, TpuExecutableSerializedProto* executable,
+    TF_Status* status);
+void TpuProgram_SerializeCompilerMetadata(
+    const XLA_TpuProgram* tpu_program,
+    CompilerMetadataSerializedProto* compiler_metadata, TF_Status* status);
+void TpuProgram_DeserializeFromGetTpuProgramResponseProto(
+    TpuSerializedProto get_tpu_program_response, XLA_TpuProgram* tpu_program,
+    TF_Status* status);
+TpuProgramFingerprint TpuProgram_GetFingerprint(const XLA_TpuProgram* tpu_program);
+void TpuProgram_DestroyFingerprint(TpuProgramFingerprint fingerprint);
+
+XLA_TpuNodeContext* TpuNodeContext_Create(int device_ordinal,
+                                          TF_Status* status);
+void TpuNodeContext_Free(XLA_TpuNodeContext* node_context);
+void TpuNodeContext_Initialize(int device_ordinal, TF_Status* status);
+void TpuNodeContext_StopChipHeartbeats(TF_Status* status);
+void TpuNodeContext_CloseTpuHost(TF_Status* status);
+bool TpuNodeContext_CompactionSupported(int device_ordinal);
+
+int TpuTopology_AvailableCoreCount(const XLA_TpuMeshState* mesh_state,
+                                   TpuCoreTypeEnum tpu_core_type);
+void TpuNetUtil_RecycleUnusedPort(int port);
+bool TpuCompile_IsTpuCompilationEnabled();
+bool TpuCompile_ShouldTpuCompileOpIgnoreCancellation();
+CompilationCacheKeyResult TpuCompile_CreateCompilationCacheKey(
+    CompilationCacheKeyProperty property);
+void TpuCompile_DestroyCompilationCacheKey(CompilationCacheKeyResult result);
+uint64_t TpuCompile_CreateGuaranteedConstFingerprint(uint64_t fingerprint,
+                                                     const char* data,
+                                                     size_t size);
+
+void TpuProfiler_Create(TpuProfiler** tpu_profiler, TF_Status* status);
+void TpuProfiler_Destroy(TpuProfiler* tpu_profiler);
+void TpuProfiler_Start(TpuProfiler* tpu_profiler, TF_Status* status);
+void TpuProfiler_Stop(TpuProfiler* tpu_profiler, TF_Status* status);
+void TpuProfiler_CollectData(TpuProfiler* tpu_profiler, TF_Status* status,
+                             uint8_t* buffer, size_t* size_in_bytes);
+
+// TfTpu_InitializeTpuModelServer: its params struct changes between
+// releases, so it keeps the fallback stub.
+
+void TfTpuOrdinalSelector_Create(TfTpuOrdinalSelector** ordinal_selector,
+                                 int num_cores_per_replica);
+void TfTpuOrdinalSelector_Destroy(TfTpuOrdinalSelector* ordinal_selector);
+// TfTpuOrdinalSelector_GetOrdinal takes an absl::optional<uint64_t>,
+// which has no C spelling.
+void TfTpuOrdinalSelector_DequeueFromCoreSelector(
+    TfTpuOrdinalSelector* ordinal_selector, int32_t device_ordinal,
+    int64_t req_id);
+void TfTpu_GetTpuPartitionedCallParams(TpuPartitionedCall_Params* params);
+
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+// tpu_executor_init_fns.inc
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+SE_Platform* TpuPlatform_New();
+void TpuPlatform_Free(SE_Platform* platform);
+void TpuPlatform_Initialize(SE_Platform* platform, size_t options_size,
+                            const char** options_key,
+                            const char** options_value, TF_Status* status);
+bool TpuPlatform_Initialized(SE_Platform* platform);
+SE_StreamExecutor* TpuPlatform_GetExecutor(SE_Platform* platform,
+                                           SE_StreamExecutorConfig* config,
+                                           TF_Status* status);
+SE_PlatformId TpuPlatform_Id(SE_Platform* platform);
+int64_t TpuPlatform_VisibleDeviceCount(SE_Platform* platform);
+int64_t TpuPlatform_TpuMemoryLimit(SE_Platform* platform);
+bool TpuPlatform_ShouldRegisterTpuDeviceToDeviceCopy(SE_Platform* platform);
+SE_TpuTopology* TpuPlatform_GetTopologyPtr(SE_Platform* platform);
+SE_TpuTopology_Host* TpuPlatform_GetHostLocation(SE_Platform* platform);
+TpuRuntimeVersion TpuPlatform_GetRuntimeVersion(SE_Platform* platform);
+
+void TpuExecutor_Init(SE_StreamExecutor* executor, int device_ordinal,
+                      SE_DeviceOptions* device_options, TF_Status* status);
+void TpuExecutor_Free(SE_StreamExecutor* executor);
+int TpuExecutor_PlatformDeviceCount(SE_StreamExecutor* executor);
+SE_DeviceMemoryBase TpuExecutor_Allocate(SE_StreamExecutor* executor,
+                                         uint64_t size, int64_t memory_space);
+void TpuExecutor_Deallocate(SE_StreamExecutor* executor,
+                            SE_DeviceMemoryBase* memory);
+bool TpuExecutor_GetAllocatorStats(SE_StreamExecutor* executor,
+                                   SE_AllocatorStats* stats);
+bool TpuExecutor_DeviceMemoryUsage(SE_StreamExecutor* executor, int64_t* free,
+                                   int64_t* total);
+bool TpuExecutor_AllocateStream(SE_StreamExecutor* executor, SE_Stream* stream);
+void TpuExecutor_DeallocateStream(SE_StreamExecutor* executor,
+                                  SE_Stream* stream);
+bool TpuExecutor_CreateStreamDependency(SE_StreamExecutor* executor,
+                                        SE_Stream* dependent, SE_Stream* other);
+void TpuExecutor_GetStatus(SE_StreamExecutor* executor, SE_Stream* stream,
+                           TF_Status* status);
+SE_TpuTopology_Core* TpuExecutor_GetCoreLocation(SE_StreamExecutor* executor);
+void TpuExecutor_AllocateEvent(SE_StreamExecutor* executor, SE_Event* event,
+                               TF_Status* status);
+void TpuExecutor_DeallocateEvent(SE_StreamExecutor* executor, SE_Event* event,
+                                 TF_Status* status);
+int TpuExecutor_PollForEventStatus(SE_StreamExecutor* executor,
+                                   SE_Event* event);
+void TpuExecutor_RecordEvent(SE_StreamExecutor* executor, SE_Stream* stream,
+                             SE_Event* event, TF_Status* status);
+void TpuExecutor_WaitForEvent(SE_StreamExecutor* executor, SE_Stream* stream,
+                              SE_Event* event, TF_Status* status);
+bool TpuExecutor_AllocateTimer(SE_StreamExecutor* executor, SE_Timer* timer);
+void TpuExecutor_DeallocateTimer(SE_StreamExecutor* executor, SE_Timer* timer);
+bool TpuExecutor_StartTimer(SE_StreamExecutor* executor, SE_Stream* stream,
+                            SE_Timer* timer);
+bool TpuExecutor_StopTimer(SE_StreamExecutor* executor, SE_Stream* stream,
+                           SE_Timer* timer);
+void TpuExecutor_SynchronousMemcpyToHost(SE_StreamExecutor* executor,
+                                         void* host_dst,
+                                         const SE_DeviceMemoryBase* device_src,
+                                         uint64_t size, TF_Status* status);
+void TpuExecutor_SynchronousMemcpyFromHost(SE_StreamExecutor* executor,
+                                           SE_DeviceMemoryBase* device_dst,
+                                           const void* host_src, uint64_t size,
+                                           TF_Status* status);
+bool TpuExecutor_MemcpyToHost(SE_StreamExecutor* executor, SE_Stream* stream,
+                              void* host_dst,
+                              const SE_DeviceMemoryBase* device_src,
+                              uint64_t size);
+bool TpuExecutor_MemcpyFromHost(SE_StreamExecutor* executor, SE_Stream* stream,
+                                SE_DeviceMemoryBase* device_dst,
+                                const void* host_src, uint64_t size);
+void TpuExecutor_EnqueueInfeed(SE_StreamExecutor* executor,
+                               int32_t infeed_queue_index, const uint8_t* data,
+                               int64_t size, TF_Status* status);
+void TpuExecutor_DequeueOutfeed(SE_StreamExecutor* executor,
+                                int32_t outfeed_queue_index, uint8_t* data,
+                                int64_t size, TF_Status* status);
+void TpuExecutor_WaitForInfeedReady(SE_StreamExecutor* executor,
+                                    int32_t infeed_queue_index,
+                                    TF_Status* status);
+void TpuExecutor_WaitForOutfeedReady(SE_StreamExecutor* executor,
+                                     int32_t outfeed_queue_index,
+                                     TF_Status* status);
+void TpuExecutor_BlockHostUntilDone(SE_StreamExecutor* executor,
+                                    SE_Stream* stream, TF_Status* status);
+void TpuExecutor_BlockUntilDoneOrFailed(SE_StreamExecutor* executor,
+                                        TF_Status* status);
+void TpuExecutor_SyncAndForgetFailedStreams(SE_StreamExecutor* executor);
+bool TpuExecutor_SynchronizeAllActivity(SE_StreamExecutor* executor);
+void TpuExecutor_UnloadAllPrograms(SE_StreamExecutor* executor,
+                                   TF_Status* status);
+void TpuExecutor_EnqueueCompactionOnStreamForHbm(SE_StreamExecutor* executor,
+                                                 SE_Stream* compaction_stream,
+                                                 TF_Status* status);
+
+SE_Stream* TpuStream_New(SE_StreamExecutor* parent);
+void TpuStream_Free(SE_Stream*);
+void* TpuStream_Stream(SE_Stream*);
+bool TpuStream_Status(SE_Stream*);
+bool TpuStream_IsSameSharedMemoryLocation(SE_Stream*, SE_Stream*);
+void TpuStream_EnqueueTransferHostToDevice(SE_Stream* stream,
+                                           SE_DeviceMemoryBase device_dst,
+                                           void* host_src, uint64_t size,
+                                           TF_Status* status);
+void TpuStream_EnqueueTransferDeviceToHost(SE_Stream* stream,
+                                           SE_DeviceMemoryBase device_src,
+                                           void* host_dst, uint64_t size,
+                                           TF_Status* status);
+void TpuStream_TpuEnqueueOnDeviceSendRecvLocal(SE_Stream* stream,
+                                               SE_DeviceMemoryBase send_buffer,
+                                               SE_DeviceMemoryBase recv_buffer,
+                                               TF_Status* status);
+
+SE_Event* TpuEvent_New(SE_StreamExecutor* parent);
+void TpuEvent_Free(SE_Event*);
+
+SE_Timer* TpuTimer_New(SE_StreamExecutor* parent);
+void TpuTimer_Free(SE_Timer*);
+int64_t TpuTimer_Nanoseconds(SE_Timer*);
+int64_t TpuTimer_Microseconds(SE_Timer*);
+
+TF_Status* TpuStatus_New();
+TF_Status* TpuStatus_Create(int32_t code, const char* msg);
+void TpuStatus_Set(TF_Status* status, int code, const char* msg, int32_t len);
+void TpuStatus_Free(TF_Status* status);
+const char* TpuStatus_Message(TF_Status* status);
+int TpuStatus_Code(TF_Status* status);
+bool TpuStatus_Ok(TF_Status* status);
+
+SE_StreamExecutorConfig* TpuStreamExecutorConfig_Default();
+void TpuStreamExecutorConfig_SetOrdinal(SE_StreamExecutorConfig*, int ordinal);
+void TpuStreamExecutorConfig_Free(SE_StreamExecutorConfig*);
+
+SE_DeviceDescription* TpuDeviceDescription_New();
+void TpuDeviceDescription_Free(SE_DeviceDescription* description);
+
+void TpuExecutor_CreateDeviceDescription(SE_StreamExecutor* executor,
+                                         SE_DeviceDescription* description,
+                                         TF_Status* status);
+SE_DeviceOptions* TpuExecutor_NewDeviceOptions(unsigned flags);
+void TpuExecutor_FreeDeviceOptions(SE_DeviceOptions* options);
+bool TpuExecutor_HostCallback(SE_StreamExecutor* executor, SE_Stream* stream,
+                              SE_StatusCallbackFn callback_fn, void* ctx);
+
+XLA_TransferManager* TpuTransferManager_New();
+void TpuTransferManager_Free(XLA_TransferManager* manager);
+SE_PlatformId TpuTransferManager_PlatformId(XLA_TransferManager* manager);
+void TpuTransferManager_HostShapeToDeviceShape(XLA_TransferManager* manager,
+                                               XLA_Shape* host_shape,
+                                               XLA_Shape* device_shape);
+void TpuTransferManager_TransferLiteralToDeviceAsync(
+    XLA_TransferManager* manager, SE_Stream* stream, XLA_Literal* literal,
+    XLA_ShapedBuffer* device_buffer, TF_Status* status);
+void TpuTransferManager_TransferLiteralFromDevice(
+    XLA_TransferManager* manager, SE_Stream* stream,
+    XLA_ShapedBuffer* device_buffer, XLA_Literal* literal,
+    XLA_StatusCallbackFn callback, void* ctx);
+int64_t TpuTransferManager_GetByteSizeRequirement(XLA_TransferManager* manager,
+                                                  XLA_Shape* shape);
+void TpuTransferManager_ChooseCompactLayoutForShape(
+    XLA_TransferManager* manager, XLA_Shape* host_shape, XLA_Shape* output,
+    TF_Status* status);
+bool TpuTransferManager_CanShapedBufferBeAccessedNow(
+    XLA_TransferManager* manager, SE_StreamExecutor* executor,
+    XLA_ShapedBuffer* device_buffer);
+bool TpuTransferManager_CanBufferBeAccessedNow(
+    XLA_TransferManager* manager, SE_StreamExecutor* executor,
+    SE_DeviceMemoryBase* device_buffer);
+void TpuTransferManager_WriteSingleTupleIndexTable(
+    XLA_TransferManager* manager, SE_Stream* stream,
+    SE_DeviceMemoryBase* elements, size_t elements_len, XLA_Shape* shape,
+    SE_DeviceMemoryBase* region, TF_Status* status);
+void TpuTransferManager_GetInfeedLayout(XLA_Shape* shape,
+                                        XLA_Shape* infeed_shape);
+void TpuTransferManager_LinearizeToBuffers(
+    XLA_TransferManager* manager, XLA_Literal* c_literal, char*** buffers_array,
+    int64_t** buffers_size, int64_t* buffers_array_size, TF_Status* status);
+void TpuTransferManager_FreeBuffers(char** buffers_array, int64_t* buffers_size,
+                                    int64_t buffers_array_size);
+void TpuTransferManager_TransferLiteralToInfeed(XLA_TransferManager* manager,
+                                                SE_StreamExecutor* executor,
+                                                XLA_Literal* c_literal,
+                                                TF_Status* status);
+void TpuTransferManager_TransferBuffersToInfeed(
+    XLA_TransferManager* manager, SE_StreamExecutor* executor,
+    uint32_t** buffers_array, int64_t* buffers_size_in_uint32,
+    int64_t buffers_array_size, TF_Status* status);
+void TpuTransferManager_TransferLiteralFromOutfeed(
+    XLA_TransferManager* manager, SE_StreamExecutor* executor,
+    XLA_Shape* shape /*deprecated*/, XLA_Literal* c_literal,
+    TF_Status* status);
+void TpuTransferManager_ResetDevices(XLA_TransferManager* manager,
+                                     SE_StreamExecutor** executors,
+                                     int64_t num_executors, TF_Status* status);
+void TpuTransferManager_ReadDynamicShapes(SE_Stream* stream,
+                                          XLA_ShapedBuffer* buffer,
+                                          const XLA_Shape* original_shape,
+                                          XLA_Shape* updated_shape,
+                                          TF_Status* status);
+
+XLA_ComputationPlacer* TpuComputationPlacer_New();
+void TpuComputationPlacer_Free(XLA_ComputationPlacer* placer);
+void TpuComputationPlacer_AssignDevices(XLA_ComputationPlacer* placer,
+                                        int replica_count,
+                                        int computation_count, int* assignment,
+                                        TF_Status* status);
+void TpuComputationPlacer_AssignLocalDevices(SE_TpuTopology_Host* host,
+                                             int replica_count,
+                                             int computation_count,
+                                             int* assignment,
+                                             TF_Status* status);
+
+int TpuTopology_LogicalDevicesPerHost(SE_TpuTopology* tpu_topology,
+                                      TpuCoreTypeEnum tpu_core_type);
+int TpuTopology_LogicalDevicesPerChip(SE_TpuTopology* tpu_topology,
+                                      TpuCoreTypeEnum tpu_core_type);
+int TpuTopology_HostCount(SE_TpuTopology* tpu_topology);
+int TpuTopology_ChipsPerHost(SE_TpuTopology* tpu_topology);
+int TpuTopology_ChipBounds_X(SE_TpuTopology* tpu_topology);
+int TpuTopology_ChipBounds_Y(SE_TpuTopology* tpu_topology);
+int TpuTopology_ChipBounds_Z(SE_TpuTopology* tpu_topology);
+bool TpuTopology_HasChip(SE_TpuTopology* tpu_topology, int x, int y, int z);
+SE_TpuTopology_Core* TpuTopology_CoreForId(SE_TpuTopology* tpu_topology,
+                                           TpuCoreTypeEnum tpu_core_type,
+                                           int id);
+SE_TpuTopology_Core* TpuTopology_Core(SE_TpuTopology* tpu_topology,
+                                      TpuCoreTypeEnum tpu_core_type, int x,
+                                      int y, int z, int index);
+int TpuTopology_NumCores(SE_TpuTopology* tpu_topology,
+                         TpuCoreTypeEnum tpu_core_type);
+void TpuTopology_Cores(SE_TpuTopology* tpu_topology,
+                       TpuCoreTypeEnum tpu_core_type,
+                       SE_TpuTopology_Core** cores);
+int TpuTopology_IdForHost(SE_TpuTopology* tpu_topology, int x, int y, int z);
+TpuVersionEnum TpuTopology_Version(SE_TpuTopology* tpu_topology);
+
+void TpuCoreLocation_ChipCoordinates(SE_TpuTopology_Core* tpu_core_location,
+                                     int* x, int* y, int* z);
+void TpuCoreLocation_HostCoordinates(SE_TpuTopology_Core* tpu_core_location,
+                                     int* x, int* y, int* z);
+int TpuCoreLocation_Index(SE_TpuTopology_Core* tpu_core_location);
+int TpuCoreLocation_Id(SE_TpuTopology_Core* tpu_core_location);
+
+int TpuHostLocation_Id(SE_TpuTopology_Host* tpu_host_location);
+int TpuHostLocation_NumCores(SE_TpuTopology_Host* tpu_host_location,
+                             TpuCoreTypeEnum tpu_core_type);
+void TpuHostLocation_Cores(SE_TpuTopology_Host* tpu_host_location,
+                           TpuCoreTypeEnum tpu_core_type,
+                           SE_TpuTopology_Core** cores);
+
+Tpu_Compiler* TpuCompiler_New();
+void TpuCompiler_Free(Tpu_Compiler* compiler);
+
+void TpuCompiler_RunHloPasses(Tpu_Compiler* compiler,
+                              XLA_HloModule* se_hlo_module,
+                              SE_StreamExecutor* stream_executor,
+                              SE_DeviceMemoryAllocator* allocator,
+                              XLA_HloModule* result, TF_Status* status);
+void TpuCompiler_RunBackend(Tpu_Compiler* compiler,
+                            XLA_HloModule* se_hlo_module,
+                            SE_StreamExecutor* stream_executor,
+                            SE_DeviceMemoryAllocator* allocator,
+                            SE_Executable** result, TF_Status* status);
+void TpuCompiler_Compile(Tpu_Compiler* compiler,
+                         XLA_HloModuleGroup* se_hlo_module_group,
+                         SE_StreamExecutorList* stream_exec_lists,
+                         int num_lists, SE_DeviceMemoryAllocator* allocator,
+                         SE_Executable** executables, TF_Status* status);
+int64_t TpuCompiler_ShapeSize(Tpu_Compiler* compiler, XLA_Shape* c_shape);
+void TpuExecutable_ExecuteAsyncOnStream(
+    SE_Executable* executable, SE_ExecutableRunOptions* se_options,
+    SE_ExecutionInput** se_arguments, int se_arguments_size,
+    SE_HloExecutionProfile* hlo_execution_profile,
+    SE_ExecutionOutput* se_output, TF_Status* status);
+void TpuExecutable_FreeXlaShapeIndexArray(XLA_ShapeIndex* array);
+void TpuExecutable_FreeMaybeOwningDeviceMemoryArray(
+    SE_MaybeOwningDeviceMemory* array);
+void TpuExecutable_Fingerprint(SE_Executable* executable,
+                               const char** fingerprint, size_t* size);
+void TpuExecutable_Serialize(
+    SE_Executable* executable,
+    SE_ExecutableSerializationHandle** serialization_handle,
+    TF_Status* status);
+int TpuExecutableSerialize_GetByteSize(
+    SE_ExecutableSerializationHandle* serialization_handle);
+void TpuExecutableSerialize_WriteToArray(
+    SE_ExecutableSerializationHandle* serialization_handle,
+    int serialized_size, uint8_t* serialized, TF_Status* status);
+void TpuExecutableSerialize_FreeHandle(
+    SE_ExecutableSerializationHandle* serialization_handle);
+void TpuExecutable_Deserialize(int serialized_size, const uint8_t* serialized,
+                               SE_Executable** executable, TF_Status* status);
+XLA_HloModule TpuExecutable_HloModule(SE_Executable* executable);
+void TpuExecutable_Free(SE_Executable*);
+
+void XlaShapeToTpuShapeRepresentation(XLA_Shape* serialized_xla_shape,
+                                      int data_type, bool use_fast_memory,
+                                      XLA_Shape* serialized_tensor_shape,
+                                      TF_Status* status);
+void XlaShapeToTpuPaddedShape(XLA_Shape* serialized_xla_shape,
+                              XLA_Shape* padded_shape, TF_Status* status);
+
+#endif /* TPU_API_H */
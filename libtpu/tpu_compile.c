@@ -0,0 +1,128 @@
+/* tpu_compile.c
+Copyright 2021 Shawn Presser
+
+Compilation cache keys for TF's TPU compile op, and freeing program
+fingerprints.
+
+TpuCompile_CreateCompilationCacheKey needs nothing from Python, so it is
+computed here. The key is
+
+    <config_prefix>_<shapes_prefix>_<fingerprint>
+
+where the fingerprint is a 64-bit FNV-1a hash of everything else that
+changes the compiled program: function name, MLIR and function library
+fingerprints, device ids, replica and core counts, guaranteed constant
+count and the layout policy. The mesh state is a per-process pointer and
+is left out. debug_string spells the same fields out.
+
+Programs compiled from a key are cached on disk by libtpu
+(compilecache.py), under their own content key.
+*/
+
+#include "libtpujesus.h"
+
+static uint64_t
+fnv_str(uint64_t h, const char *s)
+{
+    s = s ? s : "";
+    // the terminator keeps ("ab", "c") and ("a", "bc") apart
+    return fnv(h, s, strlen(s) + 1);
+}
+
+static uint64_t
+fnv_u64(uint64_t h, uint64_t v)
+{
+    return fnv(h, &v, sizeof(v));
+}
+
+static uint64_t
+cache_key_fingerprint(const CompilationCacheKeyProperty *p)
+{
+    uint64_t h = FNV_OFFSET;
+
+    h = fnv_str(h, p->function_name);
+    h = fnv_u64(h, p->mlir_module_fingerprint);
+    h = fnv_u64(h, p->device_ids_size);
+    if (p->device_ids && p->device_ids_size)
+        h = fnv(h, p->device_ids, p->device_ids_size * sizeof(int32_t));
+    h = fnv_u64(h, p->guaranteed_constants_size);
+    h = fnv_u64(h, p->function_library_fingerprint);
+    h = fnv_u64(h, p->num_cores_per_replica);
+    h = fnv_u64(h, p->num_replicas);
+    h = fnv_u64(h, layout_get_policy());
+    return h;
+}
+
+static char *
+format_debug_string(const CompilationCacheKeyProperty *p)
+{
+    size_t cap = 512 + 12 * p->device_ids_size;
+    size_t i, n;
+    char *s;
+
+    if (p->config_prefix)
+        cap += strlen(p->config_prefix);
+    if (p->shapes_prefix)
+        cap += strlen(p->shapes_prefix);
+    if (p->function_name)
+        cap += strlen(p->function_name);
+    if (!(s = malloc(cap)))
+        return NULL;
+    n = snprintf(s, cap,
+                 "config_prefix=%s shapes_prefix=%s function_name=%s "
+                 "mlir_module_fingerprint=%016" PRIx64 " function_library_fingerprint=%016" PRIx64 " "
+                 "guaranteed_constants=%d replicas=%d cores_per_replica=%d layout=%s devices=[",
+                 p->config_prefix ? p->config_prefix : "", p->shapes_prefix ? p->shapes_prefix : "",
+                 p->function_name ? p->function_name : "", p->mlir_module_fingerprint,
+                 p->function_library_fingerprint, p->guaranteed_constants_size, p->num_replicas,
+                 p->num_cores_per_replica, layout_get_policy() == LAYOUT_TILED ? "tiled" : "compact");
+    for (i = 0; i < p->device_ids_size && p->device_ids && n < cap; i++)
+        n += snprintf(s + n, cap - n, i ? ",%d" : "%d", p->device_ids[i]);
+    if (n < cap)
+        snprintf(s + n, cap - n, "]");
+    return s;
+}
+
+// C API signature
+// CompilationCacheKeyResult TpuCompile_CreateCompilationCacheKey(
+//     CompilationCacheKeyProperty property);
+CompilationCacheKeyResult
+TpuCompile_CreateCompilationCacheKey(CompilationCacheKeyProperty property)
+{
+    CompilationCacheKeyResult result = { NULL, NULL };
+    const char *config = property.config_prefix ? property.config_prefix : "";
+    const char *shapes = property.shapes_prefix ? property.shapes_prefix : "";
+    size_t cap = strlen(config) + strlen(shapes) + 20;
+    char *key;
+
+    NATIVE_ENTER(TpuCompile_CreateCompilationCacheKey);
+    if ((key = malloc(cap)) != NULL) {
+        snprintf(key, cap, "%s_%s_%016" PRIx64, config, shapes, cache_key_fingerprint(&property));
+        result.key = key;
+        result.debug_string = format_debug_string(&property);
+    }
+    TRACE(TRACE_DEBUG, "compilation cache key %s\n", result.key ? result.key : "(oom)");
+    NATIVE_LEAVE(TpuCompile_CreateCompilationCacheKey);
+    return result;
+}
+
+// C API signature
+// void TpuCompile_DestroyCompilationCacheKey(CompilationCacheKeyResult result);
+void
+TpuCompile_DestroyCompilationCacheKey(CompilationCacheKeyResult result)
+{
+    NATIVE_ENTER(TpuCompile_DestroyCompilationCacheKey);
+    free((void *)result.key);
+    free((void *)result.debug_string);
+    NATIVE_LEAVE(TpuCompile_DestroyCompilationCacheKey);
+}
+
+// C API signature
+// void TpuProgram_DestroyFingerprint(TpuProgramFingerprint fingerprint);
+void
+TpuProgram_DestroyFingerprint(TpuProgramFingerprint fingerprint)
+{
+    NATIVE_ENTER(TpuProgram_DestroyFingerprint);
+    free((void *)fingerprint.bytes);
+    NATIVE_LEAVE(TpuProgram_DestroyFingerprint);
+}
@@ -0,0 +1,334 @@
+/* tpu_device.c
+Copyright 2021 Shawn Presser
+
+Native parts of the TpuExecutor API: per-device memory regions and the
+allocator entry points jaxlib calls for every buffer.
+
+libtpu's TpuPlatform_GetExecutor binds each executor handle it returns to
+a device slot here (libtpujesus.bind_executor). The slot reserves
+memory_limit bytes of address space up front with MAP_NORESERVE, so
+pages only cost memory once a buffer actually touches them. A BFC
+allocator (tpu_allocator.c) hands that region out.
+
+The region is either anonymous memory or, to let working sets bigger
+than RAM page out to disk instead of getting OOM-killed, a shared
+mapping of a sparse file. Each device has its own file: an anonymous one
+in the directory it's given, or <path>.<ordinal> for any other path.
+The file only helps if it lives on disk; one on tmpfs (often /tmp) is
+in RAM anyway. Freeing a buffer of at least release_threshold
+bytes hands its whole pages back to the kernel (MADV_DONTNEED, or
+MADV_REMOVE to punch a hole in the file), so "committed" tracks what is
+really in use rather than the high-water mark. Committed memory is
+counted a page at a time as buffers are allocated and pages released,
+so stats cost nothing and the peak is exact.
+*/
+
+#include "libtpujesus.h"
+
+#include <sys/mman.h>
+#include <sys/stat.h>
+
+static tpu_device_t devices[MAX_DEVICES];
+static int num_devices = 0;
+static pthread_mutex_t devices_mu = PTHREAD_MUTEX_INITIALIZER;
+
+tpu_device_t *
+device_for_executor(SE_StreamExecutor *executor)
+{
+    int i, n = __atomic_load_n(&num_devices, __ATOMIC_ACQUIRE);
+    for (i = 0; i < n; i++) {
+        if (devices[i].executor == executor)
+            return &devices[i];
+    }
+    return NULL;
+}
+
+tpu_device_t *
+device_for_ordinal(int ordinal)
+{
+    int i, n = __atomic_load_n(&num_devices, __ATOMIC_ACQUIRE);
+    for (i = 0; i < n; i++) {
+        if (devices[i].ordinal == ordinal)
+            return &devices[i];
+    }
+    return NULL;
+}
+
+/* Open the backing file for a device. A directory gets an anonymous
+   spill file that disappears with the process; any other path is suffixed
+   with the ordinal, so devices never share a file. */
+static int
+device_open_file(const char *path, int ordinal, size_t size)
+{
+    struct stat st;
+    char name[4096];
+    int fd;
+
+    if (stat(path, &st) == 0 && S_ISDIR(st.st_mode)) {
+        snprintf(name, sizeof(name), "%s/libtpu-device%d-XXXXXX", path, ordinal);
+        if ((fd = mkstemp(name)) >= 0)
+            unlink(name);
+    } else if (snprintf(name, sizeof(name), "%s.%d", path, ordinal) >= (int)sizeof(name)) {
+        errno = ENAMETOOLONG;
+        return -1;
+    } else {
+        fd = open(name, O_RDWR | O_CREAT | O_CLOEXEC, 0600);
+    }
+    if (fd < 0)
+        return -1;
+    if (ftruncate(fd, size) < 0) {
+        close(fd);
+        return -1;
+    }
+    return fd;
+}
+
+/* Set or clear the bits for pages [first, last); returns how many
+   changed. Neighbouring buffers can share a page, so this is atomic. */
+static int64_t
+pages_mark(uint64_t *map, size_t first, size_t last, int set)
+{
+    int64_t changed = 0;
+
+    while (first < last) {
+        size_t lo = first & 63;
+        size_t n = last - first < 64 - lo ? last - first : 64 - lo;
+        uint64_t mask = (n == 64 ? ~0ull : (1ull << n) - 1) << lo;
+        uint64_t *word = &map[first >> 6];
+        uint64_t old;
+
+        if (set) {
+            old = __atomic_fetch_or(word, mask, __ATOMIC_RELAXED);
+            changed += __builtin_popcountll(mask & ~old);
+        } else {
+            old = __atomic_fetch_and(word, ~mask, __ATOMIC_RELAXED);
+            changed += __builtin_popcountll(mask & old);
+        }
+        first += n;
+    }
+    return changed;
+}
+
+/* Count the pages a new buffer covers as committed. */
+static void
+device_commit(tpu_device_t *dev, void *ptr, size_t size)
+{
+    size_t offset = (char *)ptr - (char *)dev->memory;
+    size_t page = (size_t)1 << dev->page_shift;
+    int64_t n, committed, peak;
+
+    if (!dev->committed_pages)
+        return;
+    n = pages_mark(dev->committed_pages, offset >> dev->page_shift,
+                   (offset + size + page - 1) >> dev->page_shift, 1);
+    if (!n)
+        return;
+    committed = __atomic_add_fetch(&dev->committed, n << dev->page_shift, __ATOMIC_RELAXED);
+    peak = __atomic_load_n(&dev->peak_committed, __ATOMIC_RELAXED);
+    while (committed > peak &&
+           !__atomic_compare_exchange_n(&dev->peak_committed, &peak, committed, 1,
+                                        __ATOMIC_RELAXED, __ATOMIC_RELAXED))
+        ;
+}
+
+/* Give the whole pages of a freed buffer back to the kernel. */
+static void
+device_release(tpu_device_t *dev, void *ptr, size_t size)
+{
+    uintptr_t page = (uintptr_t)1 << dev->page_shift;
+    uintptr_t start = ((uintptr_t)ptr + page - 1) & ~(page - 1);
+    uintptr_t end = ((uintptr_t)ptr + size) & ~(page - 1);
+    size_t first = (start - (uintptr_t)dev->memory) >> dev->page_shift;
+
+    if (end <= start)
+        return;
+    if (dev->memory_fd < 0 || madvise((void *)start, end - start, MADV_REMOVE) < 0)
+        madvise((void *)start, end - start, MADV_DONTNEED);
+    if (dev->committed_pages) {
+        int64_t n = pages_mark(dev->committed_pages, first, first + ((end - start) >> dev->page_shift), 0);
+        __atomic_sub_fetch(&dev->committed, n << dev->page_shift, __ATOMIC_RELAXED);
+    }
+}
+
+/* Bytes in pages that buffers have used and that haven't been released. */
+int64_t
+device_committed(tpu_device_t *dev)
+{
+    return __atomic_load_n(&dev->committed, __ATOMIC_RELAXED);
+}
+
+tpu_device_t *
+device_bind(SE_StreamExecutor *executor, int ordinal, size_t memory_limit,
+            const char *path, size_t release_threshold, size_t feed_capacity)
+{
+    tpu_device_t *dev;
+    void *memory;
+    int fd = -1;
+
+    pthread_mutex_lock(&devices_mu);
+    if ((dev = device_for_executor(executor)) || (dev = device_for_ordinal(ordinal))) {
+        dev->executor = executor;
+        pthread_mutex_unlock(&devices_mu);
+        return dev;
+    }
+    if (num_devices == MAX_DEVICES) {
+        pthread_mutex_unlock(&devices_mu);
+        return NULL;
+    }
+    if (path && *path) {
+        if ((fd = device_open_file(path, ordinal, memory_limit)) < 0) {
+            fprintf(stderr, "libtpujesus: can't create device memory file in %s: %s\n", path, strerror(errno));
+            pthread_mutex_unlock(&devices_mu);
+            return NULL;
+        }
+        memory = mmap(NULL, memory_limit, PROT_READ | PROT_WRITE, MAP_SHARED | MAP_NORESERVE, fd, 0);
+    } else {
+        memory = mmap(NULL, memory_limit, PROT_READ | PROT_WRITE,
+                      MAP_PRIVATE | MAP_ANONYMOUS | MAP_NORESERVE, -1, 0);
+    }
+    if (memory == MAP_FAILED) {
+        if (fd >= 0)
+            close(fd);
+        pthread_mutex_unlock(&devices_mu);
+        return NULL;
+    }
+    dev = &devices[num_devices];
+    dev->executor = executor;
+    dev->ordinal = ordinal;
+    dev->memory_limit = memory_limit;
+    dev->memory = memory;
+    dev->memory_fd = fd;
+    dev->release_threshold = release_threshold;
+    dev->page_shift = __builtin_ctzl(sysconf(_SC_PAGESIZE));
+    dev->committed = dev->peak_committed = 0;
+    // 256 KB per 8 GB of device memory, mapped lazily like the region
+    dev->committed_pages = mmap(NULL, ((memory_limit >> dev->page_shift) / 64 + 1) * sizeof(uint64_t),
+                                PROT_READ | PROT_WRITE, MAP_PRIVATE | MAP_ANONYMOUS | MAP_NORESERVE, -1, 0);
+    if (dev->committed_pages == MAP_FAILED)
+        dev->committed_pages = NULL;
+    dev->streams = NULL;
+    pthread_mutex_init(&dev->streams_mu, NULL);
+    dev->feed_capacity = feed_capacity;
+    pthread_mutex_init(&dev->feeds_mu, NULL);
+    if (bfc_init(&dev->allocator, memory, memory_limit) < 0) {
+        munmap(memory, memory_limit);
+        if (dev->committed_pages)
+            munmap(dev->committed_pages, ((memory_limit >> dev->page_shift) / 64 + 1) * sizeof(uint64_t));
+        if (fd >= 0)
+            close(fd);
+        memset(dev, 0, sizeof(*dev));
+        pthread_mutex_unlock(&devices_mu);
+        return NULL;
+    }
+    __atomic_store_n(&num_devices, num_devices + 1, __ATOMIC_RELEASE);
+    pthread_mutex_unlock(&devices_mu);
+    TRACE(TRACE_DEBUG, "device %d: %zu bytes at %p (%s)\n", ordinal, memory_limit, memory,
+          fd >= 0 ? path : "anonymous");
+    return dev;
+}
+
+// SE_DeviceMemoryBase TpuExecutor_Allocate(SE_StreamExecutor* executor,
+//                                          uint64_t size, int64_t memory_space);
+//
+// memory_space 1 (host memory) comes out of the same region; nothing on
+// the fake device can tell the difference.
+SE_DeviceMemoryBase
+TpuExecutor_Allocate(SE_StreamExecutor *executor, uint64_t size, int64_t memory_space)
+{
+    SE_DeviceMemoryBase mem = { NULL, 0, 0 };
+    tpu_device_t *dev;
+    NATIVE_ENTER(TpuExecutor_Allocate);
+
+    if ((dev = device_for_executor(executor)) && size > 0) {
+        mem.opaque = bfc_alloc(&dev->allocator, size);
+        if (mem.opaque) {
+            mem.size = size;
+            device_commit(dev, mem.opaque, size);
+            if (PROFILING())
+                prof_counter(dev->ordinal, SYM_TpuExecutor_Allocate,
+                             __atomic_load_n(&dev->allocator.bytes_in_use, __ATOMIC_RELAXED));
+        } else {
+            TRACE(TRACE_CALLS, "TpuExecutor_Allocate: device %d out of memory allocating %" PRIu64 " bytes\n",
+                  dev->ordinal, size);
+        }
+    } else if (!dev) {
+        TRACE(TRACE_CALLS, "TpuExecutor_Allocate: unknown executor %p\n", (void *)executor);
+    }
+    if (TRACING_SYM(TRACE_CALLS, SYM_TpuExecutor_Allocate))
+        trace_printf("TpuExecutor_Allocate(%p, %" PRIu64 ", %" PRId64 ") -> %p\n",
+                     (void *)executor, size, memory_space, mem.opaque);
+    NATIVE_LEAVE(TpuExecutor_Allocate);
+    return mem;
+}
+
+// void TpuExecutor_Deallocate(SE_StreamExecutor* executor,
+//                             SE_DeviceMemoryBase* memory);
+void
+TpuExecutor_Deallocate(SE_StreamExecutor *executor, SE_DeviceMemoryBase *memory)
+{
+    tpu_device_t *dev;
+    NATIVE_ENTER(TpuExecutor_Deallocate);
+
+    if (memory && memory->opaque) {
+        size_t size;
+        if (!(dev = device_for_executor(executor))) {
+            fprintf(stderr, "libtpujesus: TpuExecutor_Deallocate: unknown executor %p\n", (void *)executor);
+        } else if ((size = bfc_size(&dev->allocator, memory->opaque)) >= dev->release_threshold &&
+                   size > 0) {
+            // Still ours until bfc_free, so nobody else can be using the pages.
+            device_release(dev, memory->opaque, size);
+        }
+        if (dev && bfc_free(&dev->allocator, memory->opaque) < 0) {
+            fprintf(stderr, "libtpujesus: TpuExecutor_Deallocate: %p was not allocated on device %d\n",
+                    memory->opaque, dev->ordinal);
+        } else if (dev && PROFILING()) {
+            prof_counter(dev->ordinal, SYM_TpuExecutor_Deallocate,
+                         __atomic_load_n(&dev->allocator.bytes_in_use, __ATOMIC_RELAXED));
+        }
+        if (TRACING_SYM(TRACE_CALLS, SYM_TpuExecutor_Deallocate))
+            trace_printf("TpuExecutor_Deallocate(%p, %p)\n", (void *)executor, memory->opaque);
+        memory->opaque = NULL;
+        memory->size = 0;
+    }
+    NATIVE_LEAVE(TpuExecutor_Deallocate);
+}
+
+// bool TpuExecutor_GetAllocatorStats(SE_StreamExecutor* executor,
+//                                    SE_AllocatorStats* stats);
+bool
+TpuExecutor_GetAllocatorStats(SE_StreamExecutor *executor, SE_AllocatorStats *stats)
+{
+    tpu_device_t *dev = device_for_executor(executor);
+    NATIVE_ENTER(TpuExecutor_GetAllocatorStats);
+
+    if (dev && stats) {
+        bfc_stats(&dev->allocator, stats, NULL, NULL);
+        stats->bytes_reserved = device_committed(dev);
+        stats->peak_bytes_reserved = __atomic_load_n(&dev->peak_committed, __ATOMIC_RELAXED);
+        stats->has_bytes_reservable_limit = 1;
+        stats->bytes_reservable_limit = dev->memory_limit;
+    }
+    NATIVE_LEAVE(TpuExecutor_GetAllocatorStats);
+    return dev && stats;
+}
+
+// bool TpuExecutor_DeviceMemoryUsage(SE_StreamExecutor* executor, int64_t* free,
+//                                    int64_t* total);
+bool
+TpuExecutor_DeviceMemoryUsage(SE_StreamExecutor *executor, int64_t *free, int64_t *total)
+{
+    tpu_device_t *dev = device_for_executor(executor);
+    SE_AllocatorStats stats;
+    int64_t bytes_free = 0;
+    NATIVE_ENTER(TpuExecutor_DeviceMemoryUsage);
+
+    if (dev) {
+        bfc_stats(&dev->allocator, &stats, NULL, &bytes_free);
+        if (free)
+            *free = bytes_free;
+        if (total)
+            *total = stats.bytes_limit;
+    }
+    NATIVE_LEAVE(TpuExecutor_DeviceMemoryUsage);
+    return dev != NULL;
+}
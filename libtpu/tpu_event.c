@@ -0,0 +1,328 @@
+/* tpu_event.c
+Copyright 2021 Shawn Presser
+
+Native SE_Event and SE_Timer.
+
+Recording an event queues a mark on a stream; the event completes when
+that stream's worker reaches it. Waiting on an event queues an op on the
+waiting stream whose worker blocks until the event catches up with the
+record it saw at enqueue time, so one stream can depend on another
+without the host blocking at all. CreateStreamDependency is just that
+with a throwaway event.
+
+Timers are two marks stamped with CLOCK_MONOTONIC by the worker, so
+TpuTimer_Nanoseconds measures the time the stream actually spent between
+them, not the time it took to queue the work.
+*/
+
+#include "libtpujesus.h"
+
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+// Events
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+static SE_Event *
+event_new(void)
+{
+    SE_Event *ev = pool_get(&event_pool);
+
+    if (ev) {
+        ev->refs = 1;
+        pthread_mutex_init(&ev->mu, NULL);
+        pthread_cond_init(&ev->cv, NULL);
+    }
+    return ev;
+}
+
+static void
+event_unref(SE_Event *ev)
+{
+    if (__atomic_sub_fetch(&ev->refs, 1, __ATOMIC_ACQ_REL) == 0) {
+        pthread_cond_destroy(&ev->cv);
+        pthread_mutex_destroy(&ev->mu);
+        pool_put(&event_pool, ev);
+    }
+}
+
+static void
+op_event_record(SE_Stream *s, stream_op_t *op)
+{
+    SE_Event *ev = op->ctx;
+    uint64_t gen = op->size;
+    int code;
+
+    pthread_mutex_lock(&s->mu);
+    code = s->error_code;
+    pthread_mutex_unlock(&s->mu);
+
+    pthread_mutex_lock(&ev->mu);
+    if (gen > ev->completed) {
+        ev->completed = gen;
+        ev->error_code = code;
+    }
+    pthread_cond_broadcast(&ev->cv);
+    pthread_mutex_unlock(&ev->mu);
+    event_unref(ev);
+}
+
+static void
+op_event_wait(SE_Stream *s, stream_op_t *op)
+{
+    SE_Event *ev = op->ctx;
+    uint64_t gen = op->size;
+
+    pthread_mutex_lock(&ev->mu);
+    while (ev->completed < gen)
+        pthread_cond_wait(&ev->cv, &ev->mu);
+    pthread_mutex_unlock(&ev->mu);
+    event_unref(ev);
+}
+
+static int
+event_record(SE_Stream *s, SE_Event *ev)
+{
+    uint64_t gen;
+
+    // Take the generation and queue the mark under ev->mu, so records of
+    // one event on several streams complete in the order they were made.
+    pthread_mutex_lock(&ev->mu);
+    gen = ++ev->recorded;
+    __atomic_add_fetch(&ev->refs, 1, __ATOMIC_RELAXED);
+    if (stream_push(s, op_event_record, NULL, NULL, gen, ev) < 0) {
+        ev->recorded--;
+        pthread_mutex_unlock(&ev->mu);
+        event_unref(ev);
+        return -1;
+    }
+    pthread_mutex_unlock(&ev->mu);
+    return 0;
+}
+
+static int
+event_wait(SE_Stream *s, SE_Event *ev)
+{
+    uint64_t gen;
+
+    pthread_mutex_lock(&ev->mu);
+    gen = ev->recorded;
+    pthread_mutex_unlock(&ev->mu);
+    if (gen == 0)
+        return 0;  // never recorded: nothing to wait for
+    __atomic_add_fetch(&ev->refs, 1, __ATOMIC_RELAXED);
+    if (stream_push(s, op_event_wait, NULL, NULL, gen, ev) < 0) {
+        event_unref(ev);
+        return -1;
+    }
+    return 0;
+}
+
+// SE_Event* TpuEvent_New(SE_StreamExecutor* parent);
+SE_Event *
+TpuEvent_New(SE_StreamExecutor *parent)
+{
+    SE_Event *ev;
+    NATIVE_ENTER(TpuEvent_New);
+    ev = event_new();
+    NATIVE_LEAVE(TpuEvent_New);
+    return ev;
+}
+
+// void TpuEvent_Free(SE_Event*);
+void
+TpuEvent_Free(SE_Event *ev)
+{
+    NATIVE_ENTER(TpuEvent_Free);
+    if (ev)
+        event_unref(ev);
+    NATIVE_LEAVE(TpuEvent_Free);
+}
+
+// void TpuExecutor_AllocateEvent(SE_StreamExecutor* executor, SE_Event* event,
+//                                TF_Status* status);
+void
+TpuExecutor_AllocateEvent(SE_StreamExecutor *executor, SE_Event *ev, TF_Status *status)
+{
+}
+
+// void TpuExecutor_DeallocateEvent(SE_StreamExecutor* executor, SE_Event* event,
+//                                  TF_Status* status);
+void
+TpuExecutor_DeallocateEvent(SE_StreamExecutor *executor, SE_Event *ev, TF_Status *status)
+{
+}
+
+// int TpuExecutor_PollForEventStatus(SE_StreamExecutor* executor,
+//                                    SE_Event* event);
+int
+TpuExecutor_PollForEventStatus(SE_StreamExecutor *executor, SE_Event *ev)
+{
+    int result;
+    NATIVE_ENTER(TpuExecutor_PollForEventStatus);
+
+    pthread_mutex_lock(&ev->mu);
+    if (ev->completed < ev->recorded)
+        result = EVENT_PENDING;
+    else
+        result = ev->error_code ? EVENT_ERROR : EVENT_COMPLETE;
+    pthread_mutex_unlock(&ev->mu);
+    NATIVE_LEAVE(TpuExecutor_PollForEventStatus);
+    return result;
+}
+
+// void TpuExecutor_RecordEvent(SE_StreamExecutor* executor, SE_Stream* stream,
+//                              SE_Event* event, TF_Status* status);
+void
+TpuExecutor_RecordEvent(SE_StreamExecutor *executor, SE_Stream *s, SE_Event *ev, TF_Status *status)
+{
+    NATIVE_ENTER(TpuExecutor_RecordEvent);
+    if (event_record(s, ev) < 0)
+        status_set(status, TF_RESOURCE_EXHAUSTED, "can't queue event record");
+    NATIVE_LEAVE(TpuExecutor_RecordEvent);
+}
+
+// void TpuExecutor_WaitForEvent(SE_StreamExecutor* executor, SE_Stream* stream,
+//                               SE_Event* event, TF_Status* status);
+void
+TpuExecutor_WaitForEvent(SE_StreamExecutor *executor, SE_Stream *s, SE_Event *ev, TF_Status *status)
+{
+    NATIVE_ENTER(TpuExecutor_WaitForEvent);
+    if (event_wait(s, ev) < 0)
+        status_set(status, TF_RESOURCE_EXHAUSTED, "can't queue event wait");
+    NATIVE_LEAVE(TpuExecutor_WaitForEvent);
+}
+
+// bool TpuExecutor_CreateStreamDependency(SE_StreamExecutor* executor,
+//                                         SE_Stream* dependent, SE_Stream* other);
+bool
+TpuExecutor_CreateStreamDependency(SE_StreamExecutor *executor, SE_Stream *dependent, SE_Stream *other)
+{
+    SE_Event *ev;
+    int ok = 0;
+    NATIVE_ENTER(TpuExecutor_CreateStreamDependency);
+
+    if (dependent == other) {
+        ok = 1;  // a stream already runs in order
+    } else if ((ev = event_new())) {
+        ok = event_record(other, ev) == 0 && event_wait(dependent, ev) == 0;
+        event_unref(ev);
+    }
+    NATIVE_LEAVE(TpuExecutor_CreateStreamDependency);
+    return ok;
+}
+
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+// Timers
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+static void
+timer_unref(SE_Timer *t)
+{
+    if (__atomic_sub_fetch(&t->refs, 1, __ATOMIC_ACQ_REL) == 0)
+        pool_put(&timer_pool, t);
+}
+
+static void
+op_timer_start(SE_Stream *s, stream_op_t *op)
+{
+    SE_Timer *t = op->ctx;
+    __atomic_store_n(&t->start_ns, stats_now(), __ATOMIC_RELEASE);
+    timer_unref(t);
+}
+
+static void
+op_timer_stop(SE_Stream *s, stream_op_t *op)
+{
+    SE_Timer *t = op->ctx;
+    __atomic_store_n(&t->stop_ns, stats_now(), __ATOMIC_RELEASE);
+    timer_unref(t);
+}
+
+static int
+timer_push(SE_Stream *s, SE_Timer *t, stream_fn_t fn)
+{
+    __atomic_add_fetch(&t->refs, 1, __ATOMIC_RELAXED);
+    if (stream_push(s, fn, NULL, NULL, 0, t) < 0) {
+        timer_unref(t);
+        return -1;
+    }
+    return 0;
+}
+
+// SE_Timer* TpuTimer_New(SE_StreamExecutor* parent);
+SE_Timer *
+TpuTimer_New(SE_StreamExecutor *parent)
+{
+    SE_Timer *t;
+    NATIVE_ENTER(TpuTimer_New);
+    if ((t = pool_get(&timer_pool)))
+        t->refs = 1;
+    NATIVE_LEAVE(TpuTimer_New);
+    return t;
+}
+
+// void TpuTimer_Free(SE_Timer*);
+void
+TpuTimer_Free(SE_Timer *t)
+{
+    NATIVE_ENTER(TpuTimer_Free);
+    if (t)
+        timer_unref(t);
+    NATIVE_LEAVE(TpuTimer_Free);
+}
+
+// int64_t TpuTimer_Nanoseconds(SE_Timer*);
+//
+// 0 until both marks have been reached.
+int64_t
+TpuTimer_Nanoseconds(SE_Timer *t)
+{
+    uint64_t start = __atomic_load_n(&t->start_ns, __ATOMIC_ACQUIRE);
+    uint64_t stop = __atomic_load_n(&t->stop_ns, __ATOMIC_ACQUIRE);
+    return start && stop > start ? (int64_t)(stop - start) : 0;
+}
+
+// int64_t TpuTimer_Microseconds(SE_Timer*);
+int64_t
+TpuTimer_Microseconds(SE_Timer *t)
+{
+    return TpuTimer_Nanoseconds(t) / 1000;
+}
+
+// bool TpuExecutor_AllocateTimer(SE_StreamExecutor* executor, SE_Timer* timer);
+bool
+TpuExecutor_AllocateTimer(SE_StreamExecutor *executor, SE_Timer *t)
+{
+    return t != NULL;
+}
+
+// void TpuExecutor_DeallocateTimer(SE_StreamExecutor* executor, SE_Timer* timer);
+void
+TpuExecutor_DeallocateTimer(SE_StreamExecutor *executor, SE_Timer *t)
+{
+}
+
+// bool TpuExecutor_StartTimer(SE_StreamExecutor* executor, SE_Stream* stream,
+//                             SE_Timer* timer);
+bool
+TpuExecutor_StartTimer(SE_StreamExecutor *executor, SE_Stream *s, SE_Timer *t)
+{
+    int ok;
+    NATIVE_ENTER(TpuExecutor_StartTimer);
+    // Restarting a timer starts a new measurement.
+    __atomic_store_n(&t->stop_ns, 0, __ATOMIC_RELAXED);
+    ok = timer_push(s, t, op_timer_start) == 0;
+    NATIVE_LEAVE(TpuExecutor_StartTimer);
+    return ok;
+}
+
+// bool TpuExecutor_StopTimer(SE_StreamExecutor* executor, SE_Stream* stream,
+//                            SE_Timer* timer);
+bool
+TpuExecutor_StopTimer(SE_StreamExecutor *executor, SE_Stream *s, SE_Timer *t)
+{
+    int ok;
+    NATIVE_ENTER(TpuExecutor_StopTimer);
+    ok = timer_push(s, t, op_timer_stop) == 0;
+    NATIVE_LEAVE(TpuExecutor_StopTimer);
+    return ok;
+}
@@ -0,0 +1,493 @@
+/* tpu_feed.c
+Copyright 2021 Shawn Presser
+
+Infeed and outfeed queues. Every executor owns up to MAX_FEED_QUEUES of
+each, indexed by infeed_queue_index / outfeed_queue_index and created on
+first use. A queue is a ring of feed_capacity bytes holding records, each
+an 8-byte length followed by the payload, wrapping around the end.
+
+A producer that finds the ring full blocks until a consumer makes room,
+and a consumer blocks until there is a record, so a fast input pipeline
+can't run away with memory and a fast program waits for its input. Both
+sides release the GIL while they wait. The time each side spends blocked
+is counted (feed_stats): producers stalling means the device is the
+bottleneck, consumers stalling means the host is.
+
+Multi-buffer transfers (TransferBuffersToInfeed, literals with several
+leaves) are gathered straight into the ring, so data is copied exactly
+once on the way in and once on the way out.
+*/
+
+#include "libtpujesus.h"
+
+#define FEED_HEADER sizeof(uint64_t)
+
+static void
+feed_init(feed_t *f, size_t capacity)
+{
+    pthread_condattr_t attr;
+
+    pthread_mutex_init(&f->mu, NULL);
+    pthread_condattr_init(&attr);
+    pthread_condattr_setclock(&attr, CLOCK_MONOTONIC);
+    pthread_cond_init(&f->not_full, &attr);
+    pthread_cond_init(&f->not_empty, &attr);
+    pthread_condattr_destroy(&attr);
+    f->capacity = capacity;
+}
+
+feed_t *
+feed_get(tpu_device_t *dev, int kind, int index)
+{
+    feed_t *f;
+
+    if (index < 0 || index >= MAX_FEED_QUEUES)
+        return NULL;
+    if ((f = __atomic_load_n(&dev->feeds[kind][index], __ATOMIC_ACQUIRE)))
+        return f;
+    pthread_mutex_lock(&dev->feeds_mu);
+    if (!(f = dev->feeds[kind][index]) && (f = calloc(1, sizeof(*f)))) {
+        if (!(f->ring = malloc(dev->feed_capacity))) {
+            free(f);
+            f = NULL;
+        } else {
+            feed_init(f, dev->feed_capacity);
+            __atomic_store_n(&dev->feeds[kind][index], f, __ATOMIC_RELEASE);
+        }
+    }
+    pthread_mutex_unlock(&dev->feeds_mu);
+    return f;
+}
+
+static void
+ring_write(feed_t *f, uint64_t pos, const void *src, size_t n)
+{
+    size_t at = pos % f->capacity;
+    size_t first = n < f->capacity - at ? n : f->capacity - at;
+
+    memcpy(f->ring + at, src, first);
+    memcpy(f->ring, (const char *)src + first, n - first);
+}
+
+static void
+ring_read(feed_t *f, uint64_t pos, void *dst, size_t n)
+{
+    size_t at = pos % f->capacity;
+    size_t first = n < f->capacity - at ? n : f->capacity - at;
+
+    memcpy(dst, f->ring + at, first);
+    memcpy((char *)dst + first, f->ring, n - first);
+}
+
+static void
+feed_lock(feed_t *f)
+{
+    // A thread holding mu never waits for the GIL (feed_cond_wait lets go
+    // of mu first), and a thread that has the GIL shouldn't sit on it
+    // while another one copies a big record.
+    if (pthread_mutex_trylock(&f->mu) != 0) {
+        BLOCKING_BEGIN
+        pthread_mutex_lock(&f->mu);
+        BLOCKING_END
+    }
+}
+
+/* Wait on cv until the deadline; returns nonzero on timeout. Callers
+   recheck their condition, since mu may be dropped and retaken. */
+static int
+feed_cond_wait(feed_t *f, pthread_cond_t *cv, const struct timespec *deadline)
+{
+    PyThreadState *save = (Py_IsInitialized() && PyGILState_Check()) ? PyEval_SaveThread() : NULL;
+    int rc;
+
+    if (deadline)
+        rc = pthread_cond_timedwait(cv, &f->mu, deadline);
+    else
+        rc = pthread_cond_wait(cv, &f->mu);
+    if (save) {
+        // Don't wait for the GIL with mu held: whoever has the GIL may be
+        // waiting for mu.
+        pthread_mutex_unlock(&f->mu);
+        PyEval_RestoreThread(save);
+        feed_lock(f);
+    }
+    return rc == ETIMEDOUT;
+}
+
+static struct timespec *
+feed_deadline(struct timespec *ts, int64_t timeout_ns)
+{
+    uint64_t t;
+
+    if (timeout_ns < 0)
+        return NULL;
+    t = stats_now() + timeout_ns;
+    ts->tv_sec = t / 1000000000ull;
+    ts->tv_nsec = t % 1000000000ull;
+    return ts;
+}
+
+int
+feed_push(feed_t *f, const feed_iovec_t *iov, int n, int64_t timeout_ns)
+{
+    struct timespec ts, *deadline = feed_deadline(&ts, timeout_ns);
+    uint64_t len = 0, pos, t0 = 0;
+    int i;
+
+    for (i = 0; i < n; i++)
+        len += iov[i].len;
+    if (len + FEED_HEADER > f->capacity)
+        return -1;
+    feed_lock(f);
+    while (f->capacity - (f->tail - f->head) < len + FEED_HEADER) {
+        if (!t0)
+            t0 = stats_now();
+        if (feed_cond_wait(f, &f->not_full, deadline)) {
+            f->push_stall_ns += stats_now() - t0;
+            pthread_mutex_unlock(&f->mu);
+            return -2;
+        }
+    }
+    if (t0)
+        f->push_stall_ns += stats_now() - t0;
+    // Copy with the lock held: there's only room for one writer anyway,
+    // and a consumer can't use the record until it's complete.
+    pos = f->tail;
+    ring_write(f, pos, &len, FEED_HEADER);
+    pos += FEED_HEADER;
+    for (i = 0; i < n; i++) {
+        ring_write(f, pos, iov[i].base, iov[i].len);
+        pos += iov[i].len;
+    }
+    f->tail = pos;
+    f->records++;
+    f->pushed++;
+    f->bytes_pushed += len;
+    if (f->tail - f->head > f->peak_bytes)
+        f->peak_bytes = f->tail - f->head;
+    pthread_cond_signal(&f->not_empty);
+    pthread_mutex_unlock(&f->mu);
+    return 0;
+}
+
+int
+feed_pop(feed_t *f, const feed_iovec_t *iov, int n, void **alloc, size_t *size, int64_t timeout_ns)
+{
+    struct timespec ts, *deadline = feed_deadline(&ts, timeout_ns);
+    uint64_t len, pos, t0 = 0, room = 0;
+    int i;
+
+    feed_lock(f);
+    while (!f->records) {
+        if (!t0)
+            t0 = stats_now();
+        if (feed_cond_wait(f, &f->not_empty, deadline)) {
+            f->pop_stall_ns += stats_now() - t0;
+            pthread_mutex_unlock(&f->mu);
+            return -2;
+        }
+    }
+    if (t0)
+        f->pop_stall_ns += stats_now() - t0;
+    ring_read(f, f->head, &len, FEED_HEADER);
+    *size = len;
+    pos = f->head + FEED_HEADER;
+    if (alloc) {
+        if (!(*alloc = malloc(len ? len : 1))) {
+            pthread_mutex_unlock(&f->mu);
+            return -1;
+        }
+        ring_read(f, pos, *alloc, len);
+    } else {
+        for (i = 0; i < n; i++)
+            room += iov[i].len;
+        if (room < len) {
+            // Leave it for a consumer that expects the right shape.
+            pthread_mutex_unlock(&f->mu);
+            return -1;
+        }
+        for (i = 0; i < n && pos < f->head + FEED_HEADER + len; i++) {
+            size_t take = iov[i].len;
+            if (take > f->head + FEED_HEADER + len - pos)
+                take = f->head + FEED_HEADER + len - pos;
+            ring_read(f, pos, iov[i].base, take);
+            pos += take;
+        }
+    }
+    f->head += FEED_HEADER + len;
+    f->records--;
+    f->popped++;
+    pthread_cond_broadcast(&f->not_full);
+    pthread_mutex_unlock(&f->mu);
+    return 0;
+}
+
+/* Block until an infeed queue has drained, or an outfeed queue has a
+   record. */
+static int
+feed_wait_ready(feed_t *f, int kind)
+{
+    feed_lock(f);
+    if (kind == FEED_INFEED) {
+        while (f->records)
+            feed_cond_wait(f, &f->not_full, NULL);
+    } else {
+        while (!f->records)
+            feed_cond_wait(f, &f->not_empty, NULL);
+    }
+    pthread_mutex_unlock(&f->mu);
+    return 0;
+}
+
+PyObject *
+feed_stats(tpu_device_t *dev)
+{
+    static const char *names[2] = { "infeed", "outfeed" };
+    PyObject *result = PyDict_New(), *queues, *item, *key;
+    int kind, i;
+
+    if (!result)
+        return NULL;
+    for (kind = 0; kind < 2; kind++) {
+        if (!(queues = PyDict_New()))
+            goto error;
+        if (PyDict_SetItemString(result, names[kind], queues) < 0) {
+            Py_DECREF(queues);
+            goto error;
+        }
+        Py_DECREF(queues);
+        for (i = 0; i < MAX_FEED_QUEUES; i++) {
+            feed_t *f = __atomic_load_n(&dev->feeds[kind][i], __ATOMIC_ACQUIRE);
+            if (!f)
+                continue;
+            feed_lock(f);
+            item = Py_BuildValue("{sKsKsKsKsKsKsKsKsK}",
+                "depth", (unsigned long long)f->records,
+                "depth_bytes", (unsigned long long)(f->tail - f->head),
+                "capacity", (unsigned long long)f->capacity,
+                "peak_bytes", (unsigned long long)f->peak_bytes,
+                "pushed", (unsigned long long)f->pushed,
+                "popped", (unsigned long long)f->popped,
+                "bytes_pushed", (unsigned long long)f->bytes_pushed,
+                "push_stall_ns", (unsigned long long)f->push_stall_ns,
+                "pop_stall_ns", (unsigned long long)f->pop_stall_ns);
+            pthread_mutex_unlock(&f->mu);
+            if (!item || !(key = PyLong_FromLong(i))) {
+                Py_XDECREF(item);
+                goto error;
+            }
+            if (PyDict_SetItem(queues, key, item) < 0) {
+                Py_DECREF(key);
+                Py_DECREF(item);
+                goto error;
+            }
+            Py_DECREF(key);
+            Py_DECREF(item);
+        }
+    }
+    return result;
+error:
+    Py_DECREF(result);
+    return NULL;
+}
+
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+// TpuExecutor_* feed functions
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+static feed_t *
+feed_for(SE_StreamExecutor *executor, int kind, int index, TF_Status *status)
+{
+    tpu_device_t *dev = device_for_executor(executor);
+    feed_t *f;
+
+    if (!dev) {
+        status_set(status, TF_FAILED_PRECONDITION, "unknown executor %p", (void *)executor);
+        return NULL;
+    }
+    if (!(f = feed_get(dev, kind, index))) {
+        status_set(status, index < 0 || index >= MAX_FEED_QUEUES ? TF_INVALID_ARGUMENT : TF_RESOURCE_EXHAUSTED,
+                   "can't open %s queue %d on device %d", kind == FEED_INFEED ? "infeed" : "outfeed",
+                   index, dev->ordinal);
+    }
+    return f;
+}
+
+static void
+feed_push_status(feed_t *f, const feed_iovec_t *iov, int n, TF_Status *status)
+{
+    size_t len = 0;
+    int i;
+
+    if (feed_push(f, iov, n, -1) < 0) {
+        for (i = 0; i < n; i++)
+            len += iov[i].len;
+        status_set(status, TF_RESOURCE_EXHAUSTED, "infeed record of %zu bytes doesn't fit a %zu byte queue",
+                   len, f->capacity);
+    }
+}
+
+static void
+feed_pop_status(feed_t *f, const feed_iovec_t *iov, int n, TF_Status *status)
+{
+    size_t len = 0, room = 0;
+    int i;
+
+    if (feed_pop(f, iov, n, NULL, &len, -1) < 0) {
+        for (i = 0; i < n; i++)
+            room += iov[i].len;
+        status_set(status, TF_INVALID_ARGUMENT, "outfeed record of %zu bytes doesn't fit %zu bytes", len, room);
+    }
+}
+
+// void TpuExecutor_EnqueueInfeed(SE_StreamExecutor* executor,
+//                                int32_t infeed_queue_index, const uint8_t* data,
+//                                int64_t size, TF_Status* status);
+void
+TpuExecutor_EnqueueInfeed(SE_StreamExecutor *executor, int32_t infeed_queue_index, const uint8_t *data,
+                          int64_t size, TF_Status *status)
+{
+    feed_iovec_t iov = { (void *)data, size };
+    feed_t *f;
+    NATIVE_ENTER(TpuExecutor_EnqueueInfeed);
+
+    if ((f = feed_for(executor, FEED_INFEED, infeed_queue_index, status)))
+        feed_push_status(f, &iov, 1, status);
+    NATIVE_LEAVE(TpuExecutor_EnqueueInfeed);
+}
+
+// void TpuExecutor_DequeueOutfeed(SE_StreamExecutor* executor,
+//                                 int32_t outfeed_queue_index, uint8_t* data,
+//                                 int64_t size, TF_Status* status);
+void
+TpuExecutor_DequeueOutfeed(SE_StreamExecutor *executor, int32_t outfeed_queue_index, uint8_t *data,
+                           int64_t size, TF_Status *status)
+{
+    feed_iovec_t iov = { data, size };
+    feed_t *f;
+    NATIVE_ENTER(TpuExecutor_DequeueOutfeed);
+
+    if ((f = feed_for(executor, FEED_OUTFEED, outfeed_queue_index, status)))
+        feed_pop_status(f, &iov, 1, status);
+    NATIVE_LEAVE(TpuExecutor_DequeueOutfeed);
+}
+
+// void TpuExecutor_WaitForInfeedReady(SE_StreamExecutor* executor,
+//                                     int32_t infeed_queue_index,
+//                                     TF_Status* status);
+void
+TpuExecutor_WaitForInfeedReady(SE_StreamExecutor *executor, int32_t infeed_queue_index, TF_Status *status)
+{
+    feed_t *f;
+    NATIVE_ENTER(TpuExecutor_WaitForInfeedReady);
+
+    if ((f = feed_for(executor, FEED_INFEED, infeed_queue_index, status)))
+        feed_wait_ready(f, FEED_INFEED);
+    NATIVE_LEAVE(TpuExecutor_WaitForInfeedReady);
+}
+
+// void TpuExecutor_WaitForOutfeedReady(SE_StreamExecutor* executor,
+//                                      int32_t outfeed_queue_index,
+//                                      TF_Status* status);
+void
+TpuExecutor_WaitForOutfeedReady(SE_StreamExecutor *executor, int32_t outfeed_queue_index, TF_Status *status)
+{
+    feed_t *f;
+    NATIVE_ENTER(TpuExecutor_WaitForOutfeedReady);
+
+    if ((f = feed_for(executor, FEED_OUTFEED, outfeed_queue_index, status)))
+        feed_wait_ready(f, FEED_OUTFEED);
+    NATIVE_LEAVE(TpuExecutor_WaitForOutfeedReady);
+}
+
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+// TpuTransferManager_* feed functions
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+//
+// These always use queue 0. A literal's leaf buffers travel as a single
+// record, so the device sees one infeed per literal.
+
+#define FEED_MAX_IOV 64
+
+static int
+literal_iov(XLA_Literal *literal, feed_iovec_t *iov, TF_Status *status)
+{
+    size_t i;
+
+    if (literal->count > FEED_MAX_IOV) {
+        status_set(status, TF_UNIMPLEMENTED, "literal with %zu buffers (at most %d)",
+                   literal->count, FEED_MAX_IOV);
+        return -1;
+    }
+    for (i = 0; i < literal->count; i++) {
+        iov[i].base = literal->buffers[i];
+        iov[i].len = literal->sizes[i];
+    }
+    return literal->count;
+}
+
+// void TpuTransferManager_TransferLiteralToInfeed(XLA_TransferManager* manager,
+//                                                 SE_StreamExecutor* executor,
+//                                                 XLA_Literal* c_literal,
+//                                                 TF_Status* status);
+void
+TpuTransferManager_TransferLiteralToInfeed(XLA_TransferManager *manager, SE_StreamExecutor *executor,
+                                           XLA_Literal *c_literal, TF_Status *status)
+{
+    feed_iovec_t iov[FEED_MAX_IOV];
+    feed_t *f;
+    int n;
+    NATIVE_ENTER(TpuTransferManager_TransferLiteralToInfeed);
+
+    if ((n = literal_iov(c_literal, iov, status)) >= 0 &&
+        (f = feed_for(executor, FEED_INFEED, 0, status)))
+        feed_push_status(f, iov, n, status);
+    NATIVE_LEAVE(TpuTransferManager_TransferLiteralToInfeed);
+}
+
+// void TpuTransferManager_TransferBuffersToInfeed(XLA_TransferManager* manager,
+//                                                 SE_StreamExecutor* executor,
+//                                                 uint32_t** buffers_array,
+//                                                 int64_t* buffers_size_in_uint32,
+//                                                 int64_t buffers_array_size,
+//                                                 TF_Status* status);
+void
+TpuTransferManager_TransferBuffersToInfeed(XLA_TransferManager *manager, SE_StreamExecutor *executor,
+                                           uint32_t **buffers_array, int64_t *buffers_size_in_uint32,
+                                           int64_t buffers_array_size, TF_Status *status)
+{
+    feed_iovec_t iov[FEED_MAX_IOV];
+    feed_t *f;
+    int64_t i;
+    NATIVE_ENTER(TpuTransferManager_TransferBuffersToInfeed);
+
+    if (buffers_array_size > FEED_MAX_IOV) {
+        status_set(status, TF_UNIMPLEMENTED, "infeed of %" PRId64 " buffers (at most %d)",
+                   buffers_array_size, FEED_MAX_IOV);
+    } else if ((f = feed_for(executor, FEED_INFEED, 0, status))) {
+        for (i = 0; i < buffers_array_size; i++) {
+            iov[i].base = buffers_array[i];
+            iov[i].len = buffers_size_in_uint32[i] * sizeof(uint32_t);
+        }
+        feed_push_status(f, iov, buffers_array_size, status);
+    }
+    NATIVE_LEAVE(TpuTransferManager_TransferBuffersToInfeed);
+}
+
+// void TpuTransferManager_TransferLiteralFromOutfeed(
+//     XLA_TransferManager* manager, SE_StreamExecutor* executor,
+//     XLA_Shape* shape /*deprecated*/, XLA_Literal* c_literal, TF_Status* status);
+void
+TpuTransferManager_TransferLiteralFromOutfeed(XLA_TransferManager *manager, SE_StreamExecutor *executor,
+                                              XLA_Shape *shape, XLA_Literal *c_literal, TF_Status *status)
+{
+    feed_iovec_t iov[FEED_MAX_IOV];
+    feed_t *f;
+    int n;
+    NATIVE_ENTER(TpuTransferManager_TransferLiteralFromOutfeed);
+
+    if ((n = literal_iov(c_literal, iov, status)) >= 0 &&
+        (f = feed_for(executor, FEED_OUTFEED, 0, status)))
+        feed_pop_status(f, iov, n, status);
+    NATIVE_LEAVE(TpuTransferManager_TransferLiteralFromOutfeed);
+}
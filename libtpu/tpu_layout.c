@@ -0,0 +1,303 @@
+/* tpu_layout.c
+Copyright 2021 Shawn Presser
+
+Device layouts and shape sizes for the fake device.
+
+With the "tiled" policy (the default) HostShapeToDeviceShape gives arrays
+TPU-style tiles, so every buffer is padded out to whole vector-width
+chunks:
+
+    rank 0    no tiling
+    rank 1    (4096 / bits)              one 512-byte vector per tile
+    rank 2+   (8 * 32 / bits, 128)       on the two minor-most dimensions
+
+(sub-32-bit types pack more rows per tile, like bf16 on a real TPU). The
+"compact" policy uses the plain major-to-minor layout with no padding.
+Changing the policy invalidates cached device shapes, so libtpu flushes
+its shape cache when it does.
+
+Sizes follow XLA's conventions:
+
+    ShapeSize            bytes the device buffer needs: tiles, padding
+                         and sub-byte element_size_in_bits applied
+    ShapeSizeCompact     the same elements with no tile padding, rounded
+                         up to a 32-bit word
+    ShapeSizeCompactRaw  ... not rounded
+
+A tuple's size is its index table (one 8-byte pointer per element; the
+elements are separate buffers), a token is 0 bytes, an opaque value is a
+pointer.
+
+Element order within a buffer is the compact order; tile padding is
+trailing space the device may use for whole-vector reads and writes.
+*/
+
+#include "libtpujesus.h"
+
+enum {
+  PRIMITIVE_TYPE_INVALID = 0, PRED = 1, S8 = 2, S16 = 3, S32 = 4, S64 = 5,
+  U8 = 6, U16 = 7, U32 = 8, U64 = 9, F16 = 10, F32 = 11, F64 = 12,
+  TUPLE = 13, OPAQUE_TYPE = 14, C64 = 15, BF16 = 16, TOKEN = 17, C128 = 18,
+};
+
+enum { INVALID_FORMAT = 0, DENSE = 1 };
+
+#define POINTER_SIZE 8
+#define VECTOR_BITS 4096
+#define LANES 128
+#define SUBLANES 8
+
+static volatile int layout_policy = LAYOUT_TILED;
+
+int
+layout_set_policy(int policy)
+{
+    int old = layout_policy;
+    layout_policy = policy;
+    return old;
+}
+
+int
+layout_get_policy(void)
+{
+    return layout_policy;
+}
+
+static int
+element_bits(int type)
+{
+    switch (type) {
+    case PRED: case S8: case U8:
+        return 8;
+    case S16: case U16: case F16: case BF16:
+        return 16;
+    case S32: case U32: case F32:
+        return 32;
+    case S64: case U64: case F64: case C64:
+        return 64;
+    case C128:
+        return 128;
+    default:
+        return -1;
+    }
+}
+
+static const int64_t *
+list_items(const Int64List *list)
+{
+    return list->size > TPU_C_API_MAX_INLINED ? list->heap : list->inlined;
+}
+
+/* Physical dimensions, major to minor. */
+static void
+physical_dims(const XLA_Shape *shape, int64_t *dims)
+{
+    const int64_t *d = list_items(&shape->dimensions);
+    const int64_t *m2m = list_items(&shape->layout.minor_to_major);
+    int64_t rank = shape->dimensions.size, i;
+
+    if (shape->layout.minor_to_major.size == rank) {
+        for (i = 0; i < rank; i++)
+            dims[rank - 1 - i] = d[m2m[i]];
+    } else {
+        memcpy(dims, d, rank * sizeof(int64_t));
+    }
+}
+
+static int64_t
+round_up(int64_t n, int64_t m)
+{
+    return m > 1 ? (n + m - 1) / m * m : n;
+}
+
+/* Pad the trailing dims to multiples of the tile's dims. A tile dimension
+   of -1 (XLA's "combine") leaves that dimension alone. */
+static void
+pad_to_tile(int64_t *dims, int64_t rank, const Int64List *tile)
+{
+    const int64_t *t = list_items(tile);
+    int64_t k = tile->size, j;
+
+    for (j = 0; j < k && j < rank; j++)
+        dims[rank - 1 - j] = round_up(dims[rank - 1 - j], t[k - 1 - j]);
+}
+
+static int64_t
+array_elements(const XLA_Shape *shape, int padded)
+{
+    int64_t rank = shape->dimensions.size;
+    int64_t dims[rank > 0 ? rank : 1];
+    const XLA_Tile *tiles = shape->layout.tiles.size > TPU_C_API_MAX_INLINED ?
+        shape->layout.tiles.heap : shape->layout.tiles.inlined;
+    int64_t n = 1, i, j;
+
+    physical_dims(shape, dims);
+    if (padded && shape->layout.tiles.size > 0)
+        pad_to_tile(dims, rank, &tiles[0].dimensions);
+    for (i = 0; i < rank; i++)
+        n *= dims[i];
+    // Tiles after the first tile the previous tile; they only add padding
+    // when they don't divide it evenly.
+    for (i = 1; padded && i < shape->layout.tiles.size; i++) {
+        const Int64List *prev = &tiles[i - 1].dimensions;
+        int64_t k = prev->size, before = 1, after = 1;
+        int64_t pdims[k > 0 ? k : 1];
+        memcpy(pdims, list_items(prev), k * sizeof(int64_t));
+        for (j = 0; j < k; j++)
+            before *= pdims[j] > 0 ? pdims[j] : 1;
+        pad_to_tile(pdims, k, &tiles[i].dimensions);
+        for (j = 0; j < k; j++)
+            after *= pdims[j] > 0 ? pdims[j] : 1;
+        n = n / before * after;
+    }
+    return n;
+}
+
+int64_t
+layout_shape_size(const XLA_Shape *shape, int mode)
+{
+    int64_t bits, bytes;
+
+    switch (shape->element_type) {
+    case TUPLE:
+        return (int64_t)shape->ntuple_shapes * POINTER_SIZE;
+    case TOKEN:
+        return 0;
+    case OPAQUE_TYPE:
+        return POINTER_SIZE;
+    }
+    if ((bits = element_bits(shape->element_type)) < 0)
+        return -1;
+    if (shape->layout.element_size_in_bits > 0)
+        bits = shape->layout.element_size_in_bits;
+    bytes = (array_elements(shape, mode == SIZE_PADDED) * bits + 7) / 8;
+    if (mode == SIZE_COMPACT)
+        bytes = round_up(bytes, 4);
+    return bytes;
+}
+
+static void
+set_minor_to_major(XLA_Layout *layout, int64_t rank)
+{
+    int64_t *m2m;
+    int64_t i;
+
+    int64list_free(&layout->minor_to_major);
+    if (rank > TPU_C_API_MAX_INLINED) {
+        // Only fails under memory pressure; leaving it empty means "default".
+        if (!(layout->minor_to_major.heap = malloc(rank * sizeof(int64_t))))
+            return;
+    }
+    m2m = rank > TPU_C_API_MAX_INLINED ? layout->minor_to_major.heap : layout->minor_to_major.inlined;
+    for (i = 0; i < rank; i++)
+        m2m[i] = rank - 1 - i;
+    layout->minor_to_major.size = rank;
+}
+
+static void
+set_tile(XLA_Layout *layout, int64_t rank, int bits)
+{
+    Int64List *tile;
+
+    tilelist_free(&layout->tiles);
+    if (rank == 0)
+        return;
+    layout->tiles.size = 1;
+    tile = &layout->tiles.inlined[0].dimensions;
+    if (rank == 1) {
+        tile->inlined[0] = VECTOR_BITS / bits > 0 ? VECTOR_BITS / bits : 1;
+        tile->size = 1;
+    } else {
+        tile->inlined[0] = bits < 32 ? SUBLANES * 32 / bits : SUBLANES;
+        tile->inlined[1] = LANES;
+        tile->size = 2;
+    }
+}
+
+/* Rewrite a shape's layouts, in place, for the given policy. */
+static void
+relayout(XLA_Shape *shape, int policy)
+{
+    int64_t rank = shape->dimensions.size;
+    int bits, i;
+
+    for (i = 0; i < shape->ntuple_shapes; i++)
+        relayout(&shape->tuple_shapes[i], policy);
+    if ((bits = element_bits(shape->element_type)) < 0)
+        return;
+    shape->layout.format = DENSE;
+    if (shape->layout.minor_to_major.size != rank)
+        set_minor_to_major(&shape->layout, rank);
+    if (policy == LAYOUT_TILED) {
+        if (shape->layout.element_size_in_bits > 0)
+            bits = shape->layout.element_size_in_bits;
+        set_tile(&shape->layout, rank, bits);
+    } else {
+        tilelist_free(&shape->layout.tiles);
+        shape->layout.element_size_in_bits = 0;
+    }
+}
+
+int
+layout_device_shape(XLA_Shape *dst, const XLA_Shape *src, int policy)
+{
+    if (shape_copy(dst, src) < 0)
+        return -1;
+    relayout(dst, policy);
+    return 0;
+}
+
+// void HardwareLayout_HostShapeToDeviceShape(XLA_Shape* host_shape,
+//                                            XLA_Shape* device_shape);
+void
+HardwareLayout_HostShapeToDeviceShape(XLA_Shape *host_shape, XLA_Shape *device_shape)
+{
+    NATIVE_ENTER(HardwareLayout_HostShapeToDeviceShape);
+    if (layout_device_shape(device_shape, host_shape, layout_policy) < 0)
+        memset(device_shape, 0, sizeof(*device_shape));
+    NATIVE_LEAVE(HardwareLayout_HostShapeToDeviceShape);
+}
+
+// int64_t HardwareLayout_ShapeSize(XLA_Shape* shape);
+int64_t
+HardwareLayout_ShapeSize(XLA_Shape *shape)
+{
+    int64_t size;
+    NATIVE_ENTER(HardwareLayout_ShapeSize);
+    size = layout_shape_size(shape, SIZE_PADDED);
+    NATIVE_LEAVE(HardwareLayout_ShapeSize);
+    return size;
+}
+
+// int64_t HardwareLayout_ShapeSizeCompact(XLA_Shape* shape);
+int64_t
+HardwareLayout_ShapeSizeCompact(XLA_Shape *shape)
+{
+    int64_t size;
+    NATIVE_ENTER(HardwareLayout_ShapeSizeCompact);
+    size = layout_shape_size(shape, SIZE_COMPACT);
+    NATIVE_LEAVE(HardwareLayout_ShapeSizeCompact);
+    return size;
+}
+
+// int64_t HardwareLayout_ShapeSizeCompactRaw(XLA_Shape* shape);
+int64_t
+HardwareLayout_ShapeSizeCompactRaw(XLA_Shape *shape)
+{
+    int64_t size;
+    NATIVE_ENTER(HardwareLayout_ShapeSizeCompactRaw);
+    size = layout_shape_size(shape, SIZE_COMPACT_RAW);
+    NATIVE_LEAVE(HardwareLayout_ShapeSizeCompactRaw);
+    return size;
+}
+
+// int64_t TpuCompiler_ShapeSize(Tpu_Compiler* compiler, XLA_Shape* c_shape);
+int64_t
+TpuCompiler_ShapeSize(Tpu_Compiler *compiler, XLA_Shape *c_shape)
+{
+    int64_t size;
+    NATIVE_ENTER(TpuCompiler_ShapeSize);
+    size = layout_shape_size(c_shape, SIZE_PADDED);
+    NATIVE_LEAVE(TpuCompiler_ShapeSize);
+    return size;
+}
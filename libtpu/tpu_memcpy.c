@@ -0,0 +1,222 @@
+/* tpu_memcpy.c
+Copyright 2021 Shawn Presser
+
+Host <-> device copies. Device memory is ordinary host memory here, so a
+transfer is a memcpy straight between the caller's pointer and the
+buffer's opaque region; nothing goes through Python.
+
+One thread can't saturate memory bandwidth on a big machine, so copies
+of at least MEMCPY_SPLIT bytes are cut into chunks that a small pool of
+helper threads and the caller copy together. The pool has
+LIBTPU_MEMCPY_THREADS threads (default: one per CPU, at most 8) counting
+the caller; 1 turns splitting off.
+*/
+
+#include "libtpujesus.h"
+
+#define MEMCPY_SPLIT (4 << 20)
+#define MEMCPY_CHUNK (1 << 20)
+#define MEMCPY_MAX_THREADS 8
+
+typedef struct copy_job {
+  char *dst;
+  const char *src;
+  size_t size;
+  size_t chunk;
+  int nchunks;
+  int claimed;               // chunks handed out so far
+  int done;                  // chunks finished
+  pthread_cond_t done_cv;
+  struct copy_job *next;
+} copy_job_t;
+
+static struct {
+  pthread_mutex_t mu;
+  pthread_cond_t work_cv;
+  copy_job_t *head, *tail;   // jobs that still have unclaimed chunks
+  int nthreads;              // including the caller
+} pool = { PTHREAD_MUTEX_INITIALIZER, PTHREAD_COND_INITIALIZER, NULL, NULL, 1 };
+
+static pthread_once_t pool_once = PTHREAD_ONCE_INIT;
+
+/* Take the next chunk of `job`, unlinking it once all are handed out.
+   Call with pool.mu held. */
+static int
+pool_claim(copy_job_t *job)
+{
+    copy_job_t **p;
+    int i;
+
+    if (job->claimed == job->nchunks)
+        return -1;
+    i = job->claimed++;
+    if (job->claimed == job->nchunks) {
+        for (p = &pool.head; *p; p = &(*p)->next) {
+            if (*p == job) {
+                *p = job->next;
+                if (pool.tail == job) {
+                    pool.tail = NULL;
+                    for (job = pool.head; job; job = job->next)
+                        pool.tail = job;
+                }
+                break;
+            }
+        }
+    }
+    return i;
+}
+
+static void
+pool_copy(copy_job_t *job, int i)
+{
+    size_t offset = i * job->chunk;
+    size_t n = job->size - offset < job->chunk ? job->size - offset : job->chunk;
+    memcpy(job->dst + offset, job->src + offset, n);
+}
+
+/* Mark a chunk finished. Call with pool.mu held. */
+static void
+pool_finish(copy_job_t *job)
+{
+    if (++job->done == job->nchunks)
+        pthread_cond_signal(&job->done_cv);
+}
+
+static void *
+pool_worker(void *arg)
+{
+    copy_job_t *job;
+    int i;
+
+    pthread_mutex_lock(&pool.mu);
+    for (;;) {
+        while (!pool.head)
+            pthread_cond_wait(&pool.work_cv, &pool.mu);
+        job = pool.head;
+        i = pool_claim(job);
+        pthread_mutex_unlock(&pool.mu);
+        pool_copy(job, i);
+        pthread_mutex_lock(&pool.mu);
+        pool_finish(job);
+    }
+    return NULL;
+}
+
+static void
+pool_init(void)
+{
+    const char *env = getenv("LIBTPU_MEMCPY_THREADS");
+    long n = env ? atol(env) : sysconf(_SC_NPROCESSORS_ONLN);
+    pthread_attr_t attr;
+    pthread_t thread;
+    int i;
+
+    if (n < 1)
+        n = 1;
+    if (n > MEMCPY_MAX_THREADS)
+        n = MEMCPY_MAX_THREADS;
+    pthread_attr_init(&attr);
+    pthread_attr_setdetachstate(&attr, PTHREAD_CREATE_DETACHED);
+    for (i = 1; i < n; i++) {
+        if (pthread_create(&thread, &attr, pool_worker, NULL) != 0)
+            break;
+    }
+    pthread_attr_destroy(&attr);
+    pool.nthreads = i;
+    TRACE(TRACE_DEBUG, "memcpy pool: %d threads\n", pool.nthreads);
+}
+
+void
+device_memcpy(void *dst, const void *src, size_t size)
+{
+    copy_job_t job;
+    int i;
+
+    if (size < MEMCPY_SPLIT) {
+        memcpy(dst, src, size);
+        return;
+    }
+    pthread_once(&pool_once, pool_init);
+    if (pool.nthreads == 1) {
+        memcpy(dst, src, size);
+        return;
+    }
+    job.dst = dst;
+    job.src = src;
+    job.size = size;
+    // One chunk per thread, but no smaller than MEMCPY_CHUNK.
+    job.chunk = (size + pool.nthreads - 1) / pool.nthreads;
+    if (job.chunk < MEMCPY_CHUNK)
+        job.chunk = MEMCPY_CHUNK;
+    job.chunk = (job.chunk + 63) & ~(size_t)63;
+    job.nchunks = (size + job.chunk - 1) / job.chunk;
+    job.claimed = 0;
+    job.done = 0;
+    job.next = NULL;
+    pthread_cond_init(&job.done_cv, NULL);
+
+    pthread_mutex_lock(&pool.mu);
+    if (pool.tail)
+        pool.tail->next = &job;
+    else
+        pool.head = &job;
+    pool.tail = &job;
+    pthread_cond_broadcast(&pool.work_cv);
+    while ((i = pool_claim(&job)) >= 0) {
+        pthread_mutex_unlock(&pool.mu);
+        pool_copy(&job, i);
+        pthread_mutex_lock(&pool.mu);
+        pool_finish(&job);
+    }
+    while (job.done < job.nchunks)
+        pthread_cond_wait(&job.done_cv, &pool.mu);
+    pthread_mutex_unlock(&pool.mu);
+    pthread_cond_destroy(&job.done_cv);
+}
+
+// void TpuExecutor_SynchronousMemcpyToHost(SE_StreamExecutor* executor,
+//                                          void* host_dst,
+//                                          const SE_DeviceMemoryBase* device_src,
+//                                          uint64_t size, TF_Status* status);
+void
+TpuExecutor_SynchronousMemcpyToHost(SE_StreamExecutor *executor, void *host_dst,
+                                    const SE_DeviceMemoryBase *device_src, uint64_t size,
+                                    TF_Status *status)
+{
+    NATIVE_ENTER(TpuExecutor_SynchronousMemcpyToHost);
+    if (size > device_src->size) {
+        status_set(status, TF_INVALID_ARGUMENT, "copy of %" PRIu64 " bytes out of a %" PRIu64 " byte buffer",
+                   size, device_src->size);
+    } else {
+        BLOCKING_BEGIN
+        device_memcpy(host_dst, device_src->opaque, size);
+        BLOCKING_END
+    }
+    if (TRACING_SYM(TRACE_CALLS, SYM_TpuExecutor_SynchronousMemcpyToHost))
+        trace_printf("TpuExecutor_SynchronousMemcpyToHost(%p, %p, %p, %" PRIu64 ")\n",
+                     (void *)executor, host_dst, device_src->opaque, size);
+    NATIVE_LEAVE(TpuExecutor_SynchronousMemcpyToHost);
+}
+
+// void TpuExecutor_SynchronousMemcpyFromHost(SE_StreamExecutor* executor,
+//                                            SE_DeviceMemoryBase* device_dst,
+//                                            const void* host_src, uint64_t size,
+//                                            TF_Status* status);
+void
+TpuExecutor_SynchronousMemcpyFromHost(SE_StreamExecutor *executor, SE_DeviceMemoryBase *device_dst,
+                                      const void *host_src, uint64_t size, TF_Status *status)
+{
+    NATIVE_ENTER(TpuExecutor_SynchronousMemcpyFromHost);
+    if (size > device_dst->size) {
+        status_set(status, TF_INVALID_ARGUMENT, "copy of %" PRIu64 " bytes into a %" PRIu64 " byte buffer",
+                   size, device_dst->size);
+    } else {
+        BLOCKING_BEGIN
+        device_memcpy(device_dst->opaque, host_src, size);
+        BLOCKING_END
+    }
+    if (TRACING_SYM(TRACE_CALLS, SYM_TpuExecutor_SynchronousMemcpyFromHost))
+        trace_printf("TpuExecutor_SynchronousMemcpyFromHost(%p, %p, %p, %" PRIu64 ")\n",
+                     (void *)executor, device_dst->opaque, host_src, size);
+    NATIVE_LEAVE(TpuExecutor_SynchronousMemcpyFromHost);
+}
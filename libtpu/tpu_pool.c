@@ -0,0 +1,154 @@
+/* tpu_pool.c
+Copyright 2021 Shawn Presser
+
+Free-list pools for the objects the C API creates and frees around every
+step: statuses, executor configs, device descriptions, streams and their
+queued ops, events and timers.
+
+Each pool has one mutex, held only to pop or push the free list. Objects
+come back zeroed, so a reused one is indistinguishable from a fresh one
+and each New only sets what it needs. Objects whose ownership leaves the
+shim (XLA_Shape tuple arrays, which callers free themselves) can't be
+pooled and still use malloc.
+
+libtpujesus.pool_stats() reports each pool, and dump_stats() appends them
+to the per-symbol table.
+*/
+
+#include "libtpujesus.h"
+
+#define POOL(var, type, cap) \
+    pool_t var = { .name = #type, .size = sizeof(type), .capacity = (cap), \
+                   .mu = PTHREAD_MUTEX_INITIALIZER }
+
+// Capacities are about twice what one busy process holds at once; past
+// that, objects go back to malloc.
+POOL(status_pool, TF_Status, 1024);
+POOL(config_pool, SE_StreamExecutorConfig, 64);
+POOL(description_pool, SE_DeviceDescription, 16);
+POOL(stream_pool, SE_Stream, 256);
+POOL(op_pool, stream_op_t, 4096);
+POOL(event_pool, SE_Event, 1024);
+POOL(timer_pool, SE_Timer, 256);
+
+static pool_t *const pools[] = {
+    &status_pool, &config_pool, &description_pool, &stream_pool, &op_pool, &event_pool,
+    &timer_pool,
+};
+
+#define NPOOLS ((int)(sizeof(pools) / sizeof(pools[0])))
+
+void *
+pool_get(pool_t *pool)
+{
+    void *obj;
+
+    pthread_mutex_lock(&pool->mu);
+    if ((obj = pool->free)) {
+        pool->free = *(void **)obj;
+        pool->nfree--;
+        pool->hits++;
+    } else {
+        pool->misses++;
+    }
+    if (++pool->live > pool->high_water)
+        pool->high_water = pool->live;
+    pthread_mutex_unlock(&pool->mu);
+    if (obj) {
+        memset(obj, 0, pool->size);
+    } else if (!(obj = calloc(1, pool->size))) {
+        pthread_mutex_lock(&pool->mu);
+        pool->live--;
+        pthread_mutex_unlock(&pool->mu);
+    }
+    return obj;
+}
+
+void
+pool_put(pool_t *pool, void *obj)
+{
+    if (!obj)
+        return;
+    pthread_mutex_lock(&pool->mu);
+    pool->live--;
+    if (pool->nfree < pool->capacity) {
+        *(void **)obj = pool->free;
+        pool->free = obj;
+        pool->nfree++;
+        obj = NULL;
+    } else {
+        pool->released++;
+    }
+    pthread_mutex_unlock(&pool->mu);
+    free(obj);
+}
+
+PyObject *
+pool_stats(void)
+{
+    PyObject *result = PyDict_New();
+    int i;
+
+    if (!result)
+        return NULL;
+    for (i = 0; i < NPOOLS; i++) {
+        pool_t *pool = pools[i];
+        PyObject *stats;
+        uint64_t gets;
+
+        pthread_mutex_lock(&pool->mu);
+        gets = pool->hits + pool->misses;
+        stats = Py_BuildValue("{s:n,s:i,s:i,s:K,s:K,s:K,s:K,s:K,s:d}",
+                              "size", (Py_ssize_t)pool->size,
+                              "capacity", pool->capacity,
+                              "free", pool->nfree,
+                              "live", (unsigned long long)pool->live,
+                              "high_water", (unsigned long long)pool->high_water,
+                              "hits", (unsigned long long)pool->hits,
+                              "misses", (unsigned long long)pool->misses,
+                              "released", (unsigned long long)pool->released,
+                              "hit_rate", gets ? (double)pool->hits / gets : 0.0);
+        pthread_mutex_unlock(&pool->mu);
+        if (!stats || PyDict_SetItemString(result, pool->name, stats) < 0) {
+            Py_XDECREF(stats);
+            Py_DECREF(result);
+            return NULL;
+        }
+        Py_DECREF(stats);
+    }
+    return result;
+}
+
+void
+pool_reset_stats(void)
+{
+    int i;
+
+    for (i = 0; i < NPOOLS; i++) {
+        pool_t *pool = pools[i];
+        pthread_mutex_lock(&pool->mu);
+        pool->hits = pool->misses = pool->released = 0;
+        pool->high_water = pool->live;
+        pthread_mutex_unlock(&pool->mu);
+    }
+}
+
+void
+pool_dump(FILE *out)
+{
+    int i;
+
+    fprintf(out, "\n%-48s %10s %10s %10s %10s %10s %10s %8s\n",
+            "pool", "live", "high", "free", "hits", "misses", "released", "hit_%");
+    for (i = 0; i < NPOOLS; i++) {
+        pool_t *pool = pools[i];
+        uint64_t gets;
+
+        pthread_mutex_lock(&pool->mu);
+        gets = pool->hits + pool->misses;
+        fprintf(out, "%-48s %10" PRIu64 " %10" PRIu64 " %10d %10" PRIu64 " %10" PRIu64 " %10" PRIu64 " %8.2f\n",
+                pool->name, pool->live, pool->high_water, pool->nfree, pool->hits, pool->misses,
+                pool->released, gets ? 100.0 * pool->hits / gets : 0.0);
+        pthread_mutex_unlock(&pool->mu);
+    }
+}
@@ -0,0 +1,323 @@
+/* tpu_profiler.c
+Copyright 2021 Shawn Presser
+
+The in-process profiler behind TpuProfiler_*. A session records API
+calls (C and Python sides), native calls, stream ops, transfers, program
+runs and compiles, and device memory in use, so host Python, the shim
+and the stream workers that stand in for the device share one timeline.
+
+Each thread appends fixed-size events to its own ring. The owner is the
+only writer and publishes each event by bumping the ring's head with a
+release store, so recording takes no lock; when a ring fills, the oldest
+events are overwritten. A session has an epoch, and a ring left over
+from an earlier one is reset by its owner on the next record, so
+prof_start doesn't touch other threads' rings. prof_collect copies the
+current session's events out under the registry lock; profiler.py turns
+them into an XSpace and Chrome trace JSON.
+*/
+
+#include "libtpujesus.h"
+
+#include <sys/syscall.h>
+
+#define PROF_RING_EVENTS (1 << 16)   // per thread: 2 MB
+
+typedef struct prof_ring {
+  struct prof_ring *next;    // in rings
+  uint64_t head;             // events recorded this epoch, ever
+  unsigned epoch;
+  int exited;                // its thread is gone; freed by the next prof_start
+  long tid;
+  int device;
+  char name[64];
+  prof_event_t events[PROF_RING_EVENTS];
+} prof_ring_t;
+
+volatile int prof_active = 0;
+static unsigned prof_epoch = 0;
+static uint64_t session_start_ns;      // CLOCK_MONOTONIC
+static uint64_t session_start_wall_ns; // CLOCK_REALTIME, at the same instant
+
+static pthread_mutex_t rings_mu = PTHREAD_MUTEX_INITIALIZER;
+static prof_ring_t *rings;
+static pthread_key_t ring_key;
+static pthread_once_t ring_key_once = PTHREAD_ONCE_INIT;
+
+static __thread prof_ring_t *my_ring;
+static __thread uint32_t my_api = PROF_NO_NAME;
+static __thread int my_device = -1;
+static __thread char my_name[64];
+
+static pthread_mutex_t names_mu = PTHREAD_MUTEX_INITIALIZER;
+static char **names;
+static uint32_t nnames, names_cap;
+
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+// Rings
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+static void
+ring_thread_exit(void *arg)
+{
+    prof_ring_t *ring = arg;
+    __atomic_store_n(&ring->exited, 1, __ATOMIC_RELEASE);
+}
+
+static void
+ring_key_init(void)
+{
+    pthread_key_create(&ring_key, ring_thread_exit);
+}
+
+static prof_ring_t *
+ring_new(void)
+{
+    prof_ring_t *ring = calloc(1, sizeof(*ring));
+
+    if (!ring)
+        return NULL;
+    ring->tid = syscall(SYS_gettid);
+    ring->device = my_device;
+    ring->epoch = __atomic_load_n(&prof_epoch, __ATOMIC_ACQUIRE);
+    if (my_name[0])
+        snprintf(ring->name, sizeof(ring->name), "%s", my_name);
+    else if (pthread_getname_np(pthread_self(), ring->name, sizeof(ring->name)) != 0)
+        snprintf(ring->name, sizeof(ring->name), "thread %ld", ring->tid);
+    pthread_once(&ring_key_once, ring_key_init);
+    pthread_setspecific(ring_key, ring);
+    pthread_mutex_lock(&rings_mu);
+    ring->next = rings;
+    rings = ring;
+    pthread_mutex_unlock(&rings_mu);
+    return ring;
+}
+
+static inline prof_event_t *
+ring_slot(void)
+{
+    prof_ring_t *ring = my_ring;
+    unsigned epoch = __atomic_load_n(&prof_epoch, __ATOMIC_ACQUIRE);
+
+    if (!ring && !(ring = my_ring = ring_new()))
+        return NULL;
+    if (ring->epoch != epoch) {
+        // Left from an earlier session. Readers check the epoch before
+        // the head, so clear the head first.
+        __atomic_store_n(&ring->head, 0, __ATOMIC_RELEASE);
+        __atomic_store_n(&ring->epoch, epoch, __ATOMIC_RELEASE);
+    }
+    return &ring->events[ring->head & (PROF_RING_EVENTS - 1)];
+}
+
+static inline void
+ring_publish(void)
+{
+    __atomic_store_n(&my_ring->head, my_ring->head + 1, __ATOMIC_RELEASE);
+}
+
+void
+prof_record(int kind, uint32_t name, uint64_t start_ns, uint64_t end_ns, uint64_t arg)
+{
+    prof_event_t *ev;
+
+    if (!prof_active || !(ev = ring_slot()))
+        return;
+    ev->start_ns = start_ns;
+    ev->end_ns = end_ns;
+    ev->arg = arg;
+    ev->name = name;
+    ev->kind = kind;
+    ev->device = my_ring->device;
+    ring_publish();
+}
+
+void
+prof_counter(int device, uint32_t name, uint64_t value)
+{
+    prof_event_t *ev;
+    uint64_t now = stats_now();
+
+    if (!prof_active || !(ev = ring_slot()))
+        return;
+    ev->start_ns = ev->end_ns = now;
+    ev->arg = value;
+    ev->name = name;
+    ev->kind = PROF_MEMORY;
+    ev->device = device;
+    ring_publish();
+}
+
+void
+prof_name_thread(int device, const char *fmt, ...)
+{
+    va_list ap;
+
+    va_start(ap, fmt);
+    vsnprintf(my_name, sizeof(my_name), fmt, ap);
+    va_end(ap);
+    my_device = device;
+    if (my_ring) {
+        pthread_mutex_lock(&rings_mu);
+        snprintf(my_ring->name, sizeof(my_ring->name), "%s", my_name);
+        my_ring->device = device;
+        pthread_mutex_unlock(&rings_mu);
+    }
+}
+
+uint32_t
+prof_enter(uint32_t sym)
+{
+    uint32_t outer = my_api;
+    my_api = sym;
+    return outer;
+}
+
+void
+prof_leave(uint32_t outer)
+{
+    my_api = outer;
+}
+
+uint32_t
+prof_current(void)
+{
+    return my_api;
+}
+
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+// Names
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+/* Ids past SYM_COUNT; the same string always gets the same id. Callers
+   keep the ids they use often (profiler.py caches them by name). */
+uint32_t
+prof_intern(const char *name)
+{
+    uint32_t i, id = PROF_NO_NAME;
+
+    pthread_mutex_lock(&names_mu);
+    for (i = 0; i < nnames; i++) {
+        if (strcmp(names[i], name) == 0) {
+            id = SYM_COUNT + i;
+            goto done;
+        }
+    }
+    if (nnames == names_cap) {
+        uint32_t cap = names_cap ? names_cap * 2 : 64;
+        char **grown = realloc(names, cap * sizeof(*names));
+        if (!grown)
+            goto done;
+        names = grown;
+        names_cap = cap;
+    }
+    if ((names[nnames] = strdup(name)))
+        id = SYM_COUNT + nnames++;
+done:
+    pthread_mutex_unlock(&names_mu);
+    return id;
+}
+
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+// Sessions
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+/* Returns -1 if a session is already running. */
+int
+prof_start(void)
+{
+    prof_ring_t **p, *ring;
+    struct timespec wall;
+
+    pthread_mutex_lock(&rings_mu);
+    if (prof_active) {
+        pthread_mutex_unlock(&rings_mu);
+        return -1;
+    }
+    for (p = &rings; (ring = *p);) {
+        if (__atomic_load_n(&ring->exited, __ATOMIC_ACQUIRE)) {
+            *p = ring->next;
+            free(ring);
+        } else {
+            p = &ring->next;
+        }
+    }
+    clock_gettime(CLOCK_REALTIME, &wall);
+    session_start_ns = stats_now();
+    session_start_wall_ns = (uint64_t)wall.tv_sec * 1000000000ull + (uint64_t)wall.tv_nsec;
+    __atomic_add_fetch(&prof_epoch, 1, __ATOMIC_RELEASE);
+    __atomic_store_n(&prof_active, 1, __ATOMIC_RELEASE);
+    pthread_mutex_unlock(&rings_mu);
+    return 0;
+}
+
+void
+prof_stop(void)
+{
+    __atomic_store_n(&prof_active, 0, __ATOMIC_RELEASE);
+}
+
+/* {start_ns, start_wall_ns, names, threads: [(tid, name, device, dropped,
+   events), ...]}, where events packs prof_event_t records oldest first.
+   names holds every symbol name and interned string, indexed by id. */
+PyObject *
+prof_collect(void)
+{
+    PyObject *threads = NULL, *name_list = NULL, *result = NULL;
+    prof_ring_t *ring;
+    unsigned epoch = __atomic_load_n(&prof_epoch, __ATOMIC_ACQUIRE);
+    uint32_t i, n;
+
+    pthread_mutex_lock(&names_mu);
+    n = nnames;
+    name_list = PyList_New(SYM_COUNT + n);
+    for (i = 0; name_list && i < SYM_COUNT + n; i++) {
+        PyObject *s = PyUnicode_FromString(i < SYM_COUNT ? api_names[i] : names[i - SYM_COUNT]);
+        if (!s) {
+            Py_CLEAR(name_list);
+            break;
+        }
+        PyList_SET_ITEM(name_list, i, s);
+    }
+    pthread_mutex_unlock(&names_mu);
+    if (!name_list || !(threads = PyList_New(0)))
+        goto done;
+
+    pthread_mutex_lock(&rings_mu);
+    for (ring = rings; ring; ring = ring->next) {
+        uint64_t head, count, first, j;
+        PyObject *events, *item;
+        prof_event_t *out;
+
+        if (__atomic_load_n(&ring->epoch, __ATOMIC_ACQUIRE) != epoch)
+            continue;
+        head = __atomic_load_n(&ring->head, __ATOMIC_ACQUIRE);
+        // Once the ring has wrapped, the slot after the newest event may
+        // be mid-overwrite if the owner is still recording; skip it.
+        count = head < PROF_RING_EVENTS ? head : PROF_RING_EVENTS - 1;
+        first = head - count;
+        if (!(events = PyBytes_FromStringAndSize(NULL, count * sizeof(prof_event_t))))
+            break;
+        out = (prof_event_t *)PyBytes_AS_STRING(events);
+        for (j = 0; j < count; j++)
+            out[j] = ring->events[(first + j) & (PROF_RING_EVENTS - 1)];
+        item = Py_BuildValue("(lsiKN)", ring->tid, ring->name, ring->device,
+                             (unsigned long long)first, events);
+        if (!item || PyList_Append(threads, item) < 0) {
+            Py_XDECREF(item);
+            Py_CLEAR(threads);
+            break;
+        }
+        Py_DECREF(item);
+    }
+    pthread_mutex_unlock(&rings_mu);
+    if (threads)
+        result = Py_BuildValue("{s:K,s:K,s:O,s:O}",
+                               "start_ns", (unsigned long long)session_start_ns,
+                               "start_wall_ns", (unsigned long long)session_start_wall_ns,
+                               "names", name_list,
+                               "threads", threads);
+done:
+    Py_XDECREF(name_list);
+    Py_XDECREF(threads);
+    return result;
+}
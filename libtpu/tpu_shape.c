@@ -0,0 +1,250 @@
+/* tpu_shape.c
+Copyright 2021 Shawn Presser
+
+Deep copy and free for the C API's shape structs (Int64List, BoolList,
+TileList, XLA_Layout, XLA_Shape).
+
+Lists hold up to TPU_C_API_MAX_INLINED elements inline; longer ones own
+a heap array. A copy is one memcpy per list, plus one allocation per
+list that spills to the heap and one per level of tuple shapes.
+
+jaxlib's ApiConverter allocates with new[] and frees with delete[]; we
+use malloc/free. These are all trivially destructible C structs, so the
+two are interchangeable with the allocators jaxlib links against.
+*/
+
+#include "libtpujesus.h"
+
+/* Copy an inline-or-heap list of n elements of `elem` bytes. The union
+   is the first member, so `inlined` and the heap pointer share storage. */
+static int
+list_copy(void *dst, const void *src, int64_t n, size_t elem)
+{
+    void *heap;
+
+    if (n <= TPU_C_API_MAX_INLINED) {
+        memcpy(dst, src, n * elem);
+        return 0;
+    }
+    if (!(heap = malloc(n * elem)))
+        return -1;
+    memcpy(heap, *(void *const *)src, n * elem);
+    *(void **)dst = heap;
+    return 0;
+}
+
+int
+int64list_copy(Int64List *dst, const Int64List *src)
+{
+    memset(dst, 0, sizeof(*dst));
+    if (list_copy(dst, src, src->size, sizeof(int64_t)) < 0)
+        return -1;
+    dst->size = src->size;
+    return 0;
+}
+
+void
+int64list_free(Int64List *list)
+{
+    if (list->size > TPU_C_API_MAX_INLINED)
+        free(list->heap);
+    memset(list, 0, sizeof(*list));
+}
+
+int
+boollist_copy(BoolList *dst, const BoolList *src)
+{
+    memset(dst, 0, sizeof(*dst));
+    if (list_copy(dst, src, src->size, sizeof(_Bool)) < 0)
+        return -1;
+    dst->size = src->size;
+    return 0;
+}
+
+void
+boollist_free(BoolList *list)
+{
+    if (list->size > TPU_C_API_MAX_INLINED)
+        free(list->heap);
+    memset(list, 0, sizeof(*list));
+}
+
+int
+tilelist_copy(TileList *dst, const TileList *src)
+{
+    const XLA_Tile *from;
+    XLA_Tile *to;
+    int64_t i;
+
+    memset(dst, 0, sizeof(*dst));
+    if (list_copy(dst, src, src->size, sizeof(XLA_Tile)) < 0)
+        return -1;
+    dst->size = src->size;
+    // The memcpy shared any tile dimensions that spilled to the heap.
+    from = src->size > TPU_C_API_MAX_INLINED ? src->heap : src->inlined;
+    to = dst->size > TPU_C_API_MAX_INLINED ? dst->heap : dst->inlined;
+    for (i = 0; i < src->size; i++) {
+        if (from[i].dimensions.size > TPU_C_API_MAX_INLINED &&
+            int64list_copy(&to[i].dimensions, &from[i].dimensions) < 0) {
+            while (i-- > 0)
+                int64list_free(&to[i].dimensions);
+            dst->size = 0;  // the rest still point at src's arrays
+            if (src->size > TPU_C_API_MAX_INLINED)
+                free(dst->heap);
+            memset(dst, 0, sizeof(*dst));
+            return -1;
+        }
+    }
+    return 0;
+}
+
+void
+tilelist_free(TileList *list)
+{
+    XLA_Tile *tiles = list->size > TPU_C_API_MAX_INLINED ? list->heap : list->inlined;
+    int64_t i;
+
+    for (i = 0; i < list->size; i++)
+        int64list_free(&tiles[i].dimensions);
+    if (list->size > TPU_C_API_MAX_INLINED)
+        free(list->heap);
+    memset(list, 0, sizeof(*list));
+}
+
+int
+layout_copy(XLA_Layout *dst, const XLA_Layout *src)
+{
+    dst->format = src->format;
+    dst->element_size_in_bits = src->element_size_in_bits;
+    dst->memory_space = src->memory_space;
+    if (int64list_copy(&dst->minor_to_major, &src->minor_to_major) < 0) {
+        memset(&dst->tiles, 0, sizeof(dst->tiles));
+        return -1;
+    }
+    if (tilelist_copy(&dst->tiles, &src->tiles) < 0) {
+        int64list_free(&dst->minor_to_major);
+        return -1;
+    }
+    return 0;
+}
+
+void
+layout_free(XLA_Layout *layout)
+{
+    int64list_free(&layout->minor_to_major);
+    tilelist_free(&layout->tiles);
+}
+
+int
+shape_copy(XLA_Shape *dst, const XLA_Shape *src)
+{
+    int i;
+
+    memset(dst, 0, sizeof(*dst));
+    dst->element_type = src->element_type;
+    if (int64list_copy(&dst->dimensions, &src->dimensions) < 0 ||
+        boollist_copy(&dst->dynamic_dimensions, &src->dynamic_dimensions) < 0 ||
+        layout_copy(&dst->layout, &src->layout) < 0)
+        goto error;
+    if (src->ntuple_shapes > 0) {
+        if (!(dst->tuple_shapes = calloc(src->ntuple_shapes, sizeof(XLA_Shape))))
+            goto error;
+        for (i = 0; i < src->ntuple_shapes; i++) {
+            if (shape_copy(&dst->tuple_shapes[i], &src->tuple_shapes[i]) < 0) {
+                dst->ntuple_shapes = i;
+                goto error;
+            }
+        }
+        dst->ntuple_shapes = src->ntuple_shapes;
+    }
+    return 0;
+error:
+    shape_free(dst);
+    return -1;
+}
+
+void
+shape_free(XLA_Shape *shape)
+{
+    int i;
+
+    int64list_free(&shape->dimensions);
+    boollist_free(&shape->dynamic_dimensions);
+    if (shape->tuple_shapes) {
+        for (i = 0; i < shape->ntuple_shapes; i++)
+            shape_free(&shape->tuple_shapes[i]);
+        free(shape->tuple_shapes);
+    }
+    shape->tuple_shapes = NULL;
+    shape->ntuple_shapes = 0;
+    layout_free(&shape->layout);
+}
+
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+// Fingerprints
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+//
+// A 64-bit FNV-1a hash over everything that makes two shapes different:
+// element type, dimensions, dynamic dimensions, layout and tuple
+// children, in order. Unused inline slots don't contribute, so equal
+// shapes hash equal however they were built.
+
+uint64_t
+fnv(uint64_t h, const void *data, size_t n)
+{
+    const unsigned char *p = data;
+    size_t i;
+
+    for (i = 0; i < n; i++)
+        h = (h ^ p[i]) * FNV_PRIME;
+    return h;
+}
+
+static uint64_t
+fnv64(uint64_t h, int64_t v)
+{
+    return fnv(h, &v, sizeof(v));
+}
+
+static uint64_t
+hash_int64list(uint64_t h, const Int64List *list)
+{
+    h = fnv64(h, list->size);
+    return fnv(h, list->size > TPU_C_API_MAX_INLINED ? list->heap : list->inlined,
+               list->size * sizeof(int64_t));
+}
+
+static uint64_t
+hash_shape(uint64_t h, const XLA_Shape *shape)
+{
+    const XLA_Tile *tiles;
+    const _Bool *dynamic;
+    int64_t i;
+
+    h = fnv64(h, shape->element_type);
+    h = hash_int64list(h, &shape->dimensions);
+    dynamic = shape->dynamic_dimensions.size > TPU_C_API_MAX_INLINED ?
+        shape->dynamic_dimensions.heap : shape->dynamic_dimensions.inlined;
+    h = fnv64(h, shape->dynamic_dimensions.size);
+    for (i = 0; i < shape->dynamic_dimensions.size; i++)
+        h = fnv64(h, dynamic[i] != 0);
+    h = fnv64(h, shape->layout.format);
+    h = hash_int64list(h, &shape->layout.minor_to_major);
+    tiles = shape->layout.tiles.size > TPU_C_API_MAX_INLINED ?
+        shape->layout.tiles.heap : shape->layout.tiles.inlined;
+    h = fnv64(h, shape->layout.tiles.size);
+    for (i = 0; i < shape->layout.tiles.size; i++)
+        h = hash_int64list(h, &tiles[i].dimensions);
+    h = fnv64(h, shape->layout.element_size_in_bits);
+    h = fnv64(h, shape->layout.memory_space);
+    h = fnv64(h, shape->ntuple_shapes);
+    for (i = 0; i < shape->ntuple_shapes; i++)
+        h = hash_shape(h, &shape->tuple_shapes[i]);
+    return h;
+}
+
+uint64_t
+shape_fingerprint(const XLA_Shape *shape)
+{
+    return hash_shape(FNV_OFFSET, shape);
+}
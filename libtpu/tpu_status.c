@@ -0,0 +1,276 @@
+/* tpu_status.c
+Copyright 2021 Shawn Presser
+
+Native TF_Status, SE_StreamExecutorConfig and SE_DeviceDescription, and
+the array free helpers.
+
+These are plain data that jaxlib creates, reads and frees around nearly
+every other call, so they never touch Python or the GIL, and come from
+the pools in tpu_pool.c. A status keeps short messages inline; Python
+sees one as a TF_Status struct view and sets it through
+libtpujesus.status_set.
+
+A message pointer from TpuStatus_Message stays valid until the status is
+next set or freed.
+*/
+
+#include "libtpujesus.h"
+
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+// Statuses
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+static void
+status_clear_message(TF_Status *status)
+{
+    if (status->message != status->inline_message)
+        free((void *)status->message);
+    status->inline_message[0] = '\0';
+    status->message = status->inline_message;
+}
+
+TF_Status *
+status_new(void)
+{
+    TF_Status *status = pool_get(&status_pool);
+
+    if (!status)
+        return NULL;
+    status->code = TF_OK;
+    status->magic = STATUS_MAGIC;
+    status->message = status->inline_message;
+    return status;
+}
+
+void
+status_set_message(TF_Status *status, int code, const char *msg, size_t len)
+{
+    char *heap;
+
+    status_clear_message(status);
+    status->code = code;
+    if (code == TF_OK || !msg)
+        return;
+    if (len < sizeof(status->inline_message)) {
+        memcpy(status->inline_message, msg, len);
+        status->inline_message[len] = '\0';
+    } else if ((heap = malloc(len + 1))) {
+        memcpy(heap, msg, len);
+        heap[len] = '\0';
+        status->message = heap;
+    } else {
+        // keep the code; lose the message rather than the error
+        snprintf(status->inline_message, sizeof(status->inline_message), "%.*s",
+                 (int)sizeof(status->inline_message) - 1, msg);
+    }
+}
+
+void
+status_free(TF_Status *status)
+{
+    if (!status)
+        return;
+    if (status->magic != STATUS_MAGIC) {
+        fprintf(stderr, "libtpujesus.so: TpuStatus_Free of a bad or freed status %p\n", (void *)status);
+        return;
+    }
+    status_clear_message(status);
+    status->magic = 0;
+    pool_put(&status_pool, status);
+}
+
+void
+status_set(TF_Status *status, int code, const char *fmt, ...)
+{
+    char msg[512];
+    va_list ap;
+    int n;
+
+    va_start(ap, fmt);
+    n = vsnprintf(msg, sizeof(msg), fmt, ap);
+    va_end(ap);
+    if (n < 0)
+        n = 0;
+    if ((size_t)n >= sizeof(msg))
+        n = sizeof(msg) - 1;
+    TRACE(TRACE_CALLS, "status %d: %s\n", code, msg);
+    if (status)
+        status_set_message(status, code, msg, n);
+}
+
+int
+status_consume(TF_Status *status, char *msg, size_t len)
+{
+    int code = status->code;
+
+    if (msg && len)
+        snprintf(msg, len, "%s", status->message);
+    status_free(status);
+    return code;
+}
+
+// TF_Status* TpuStatus_New();
+TF_Status *
+TpuStatus_New(void)
+{
+    NATIVE_ENTER(TpuStatus_New);
+    TF_Status *status = status_new();
+    NATIVE_LEAVE(TpuStatus_New);
+    return status;
+}
+
+// TF_Status* TpuStatus_Create(int32_t code, const char* msg);
+TF_Status *
+TpuStatus_Create(int32_t code, const char *msg)
+{
+    NATIVE_ENTER(TpuStatus_Create);
+    TF_Status *status = status_new();
+
+    if (status)
+        status_set_message(status, code, msg, msg ? strlen(msg) : 0);
+    NATIVE_LEAVE(TpuStatus_Create);
+    return status;
+}
+
+// void TpuStatus_Set(TF_Status* status, int code, const char* msg,
+//                    int32_t len);
+void
+TpuStatus_Set(TF_Status *status, int code, const char *msg, int32_t len)
+{
+    NATIVE_ENTER(TpuStatus_Set);
+    if (status)
+        status_set_message(status, code, msg, len >= 0 ? (size_t)len : msg ? strlen(msg) : 0);
+    NATIVE_LEAVE(TpuStatus_Set);
+}
+
+// void TpuStatus_Free(TF_Status* status);
+void
+TpuStatus_Free(TF_Status *status)
+{
+    NATIVE_ENTER(TpuStatus_Free);
+    status_free(status);
+    NATIVE_LEAVE(TpuStatus_Free);
+}
+
+// const char* TpuStatus_Message(TF_Status* status);
+const char *
+TpuStatus_Message(TF_Status *status)
+{
+    return status ? status->message : "";
+}
+
+// int TpuStatus_Code(TF_Status* status);
+int
+TpuStatus_Code(TF_Status *status)
+{
+    return status ? status->code : TF_OK;
+}
+
+// bool TpuStatus_Ok(TF_Status* status);
+bool
+TpuStatus_Ok(TF_Status *status)
+{
+    return !status || status->code == TF_OK;
+}
+
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+// Stream executor configs
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+// SE_StreamExecutorConfig* TpuStreamExecutorConfig_Default();
+SE_StreamExecutorConfig *
+TpuStreamExecutorConfig_Default(void)
+{
+    SE_StreamExecutorConfig *config = pool_get(&config_pool);
+
+    // no ordinal yet: GetExecutor picks device 0
+    if (config)
+        config->ordinal = -1;
+    return config;
+}
+
+// void TpuStreamExecutorConfig_SetOrdinal(SE_StreamExecutorConfig*,
+//                                         int ordinal);
+void
+TpuStreamExecutorConfig_SetOrdinal(SE_StreamExecutorConfig *config, int ordinal)
+{
+    TRACE(TRACE_CALLS, "TpuStreamExecutorConfig_SetOrdinal %d\n", ordinal);
+    if (config)
+        config->ordinal = ordinal;
+}
+
+// void TpuStreamExecutorConfig_Free(SE_StreamExecutorConfig*);
+void
+TpuStreamExecutorConfig_Free(SE_StreamExecutorConfig *config)
+{
+    pool_put(&config_pool, config);
+}
+
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+// Device descriptions
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+//
+// ApiConverter copies the strings out before freeing the description, so
+// each one is malloc'd and owned by it, and starts out empty.
+
+#define DEVICE_DESCRIPTION_STRINGS(X) \
+    X(device_vendor) X(platform_version) X(driver_version) X(runtime_version) \
+    X(pci_bus_id) X(name) X(rocm_amdgpu_gcn_arch_name)
+
+// void TpuDeviceDescription_Free(SE_DeviceDescription* description);
+void
+TpuDeviceDescription_Free(SE_DeviceDescription *description)
+{
+    if (!description)
+        return;
+#define X(field) free(description->field);
+    DEVICE_DESCRIPTION_STRINGS(X)
+#undef X
+    pool_put(&description_pool, description);
+}
+
+// SE_DeviceDescription* TpuDeviceDescription_New();
+SE_DeviceDescription *
+TpuDeviceDescription_New(void)
+{
+    SE_DeviceDescription *description = pool_get(&description_pool);
+
+    if (!description)
+        return NULL;
+#define X(field) if (!(description->field = strdup(""))) goto fail;
+    DEVICE_DESCRIPTION_STRINGS(X)
+#undef X
+    return description;
+fail:
+    TpuDeviceDescription_Free(description);
+    return NULL;
+}
+
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+// Arrays handed out by libtpu
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+//
+// All of these come from malloc (libtpujesus.malloc on the Python side),
+// and free only the array, not what it points to.
+
+// void TpuExecutable_FreeXlaShapeIndexArray(XLA_ShapeIndex* array);
+void
+TpuExecutable_FreeXlaShapeIndexArray(XLA_ShapeIndex *array)
+{
+    free(array);
+}
+
+// void TpuExecutable_FreeMaybeOwningDeviceMemoryArray(
+//     SE_MaybeOwningDeviceMemory* array);
+void
+TpuExecutable_FreeMaybeOwningDeviceMemoryArray(SE_MaybeOwningDeviceMemory *array)
+{
+    free(array);
+}
+
+// void TpuProgram_FreeArray(XLA_TpuProgram* tpu_program[]);
+void
+TpuProgram_FreeArray(XLA_TpuProgram **array)
+{
+    free(array);
+}
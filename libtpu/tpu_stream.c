@@ -0,0 +1,589 @@
+/* tpu_stream.c
+Copyright 2021 Shawn Presser
+
+Native SE_Stream: each stream owns an ordered queue of ops and a worker
+thread that drains it, so transfers and launches run off the caller's
+thread and overlap with host-side Python.
+
+Errors are sticky. The first failing op records its code and message,
+later ops still run, and BlockHostUntilDone / TpuStream_Status /
+TpuExecutor_GetStatus report that first failure until
+SyncAndForgetFailedStreams clears it.
+
+Python work (e.g. a program launch) is queued with
+libtpujesus.stream_enqueue(stream, fn); the worker takes the GIL to run
+it. Waits release the GIL so that can happen, and no thread waits for
+the GIL while holding a stream's mu, since callers with the GIL lock it.
+*/
+
+#include "libtpujesus.h"
+
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+// Queue
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+static void op_memcpy(SE_Stream *s, stream_op_t *op);
+
+static int worker_count;
+
+/* Profiles show a worker as a line on its device, and each op under the
+   name of the API call that queued it. */
+static void
+stream_run_profiled(SE_Stream *s, stream_op_t *op)
+{
+    uint64_t t0 = stats_now();
+    int transfer = op->fn == op_memcpy;
+
+    op->fn(s, op);
+    prof_record(transfer ? PROF_TRANSFER : PROF_STREAM, op->prof_name, t0, stats_now(),
+                transfer ? op->size : 0);
+}
+
+static void *
+stream_worker(void *arg)
+{
+    SE_Stream *s = arg;
+    stream_op_t *op;
+
+    prof_name_thread(s->dev ? s->dev->ordinal : 0, "Stream #%d",
+                     __atomic_add_fetch(&worker_count, 1, __ATOMIC_RELAXED));
+    pthread_mutex_lock(&s->mu);
+    for (;;) {
+        while (!s->head && !s->stopping)
+            pthread_cond_wait(&s->work_cv, &s->mu);
+        if (!s->head)
+            break;
+        op = s->head;
+        pthread_mutex_unlock(&s->mu);
+        if (PROFILING())
+            stream_run_profiled(s, op);
+        else
+            op->fn(s, op);
+        pthread_mutex_lock(&s->mu);
+        s->head = op->next;
+        if (!s->head)
+            s->tail = NULL;
+        op->next = s->free_ops;
+        s->free_ops = op;
+        s->completed++;
+        if (!s->head)
+            pthread_cond_broadcast(&s->idle_cv);
+    }
+    pthread_mutex_unlock(&s->mu);
+    return NULL;
+}
+
+static int
+stream_start_locked(SE_Stream *s)
+{
+    if (s->running)
+        return 0;
+    s->stopping = 0;
+    if (pthread_create(&s->thread, NULL, stream_worker, s) != 0)
+        return -1;
+    s->running = 1;
+    return 0;
+}
+
+static void
+stream_stop(SE_Stream *s)
+{
+    pthread_mutex_lock(&s->mu);
+    if (!s->running) {
+        pthread_mutex_unlock(&s->mu);
+        return;
+    }
+    s->stopping = 1;
+    pthread_cond_broadcast(&s->work_cv);
+    pthread_mutex_unlock(&s->mu);
+    BLOCKING_BEGIN
+    pthread_join(s->thread, NULL);
+    BLOCKING_END
+    s->running = 0;
+}
+
+int
+stream_push(SE_Stream *s, stream_fn_t fn, void *dst, const void *src, size_t size, void *ctx)
+{
+    stream_op_t *op;
+
+    pthread_mutex_lock(&s->mu);
+    if ((op = s->free_ops)) {
+        s->free_ops = op->next;
+    } else if (!(op = pool_get(&op_pool))) {
+        pthread_mutex_unlock(&s->mu);
+        return -1;
+    }
+    if (stream_start_locked(s) < 0) {
+        op->next = s->free_ops;
+        s->free_ops = op;
+        pthread_mutex_unlock(&s->mu);
+        return -1;
+    }
+    op->fn = fn;
+    op->dst = dst;
+    op->src = src;
+    op->size = size;
+    op->ctx = ctx;
+    op->prof_name = PROFILING() ? prof_current() : PROF_NO_NAME;
+    op->next = NULL;
+    // The worker leaves the running op at the head until it finishes.
+    if (s->tail)
+        s->tail->next = op;
+    else
+        s->head = op;
+    s->tail = op;
+    s->enqueued++;
+    pthread_cond_signal(&s->work_cv);
+    pthread_mutex_unlock(&s->mu);
+    return 0;
+}
+
+void
+stream_fail(SE_Stream *s, int code, const char *fmt, ...)
+{
+    va_list ap;
+
+    pthread_mutex_lock(&s->mu);
+    if (!s->error_code) {
+        s->error_code = code;
+        va_start(ap, fmt);
+        vsnprintf(s->error, sizeof(s->error), fmt, ap);
+        va_end(ap);
+    }
+    pthread_mutex_unlock(&s->mu);
+    TRACE(TRACE_CALLS, "stream %p failed: %d\n", (void *)s, code);
+}
+
+/* Wait for everything queued so far; returns the stream's error code. */
+int
+stream_wait(SE_Stream *s)
+{
+    uint64_t target;
+    int code;
+
+    pthread_mutex_lock(&s->mu);
+    if (!s->head) {
+        code = s->error_code;
+        pthread_mutex_unlock(&s->mu);
+        return code;
+    }
+    target = s->enqueued;
+    pthread_mutex_unlock(&s->mu);
+    // mu has to be free again before the GIL is taken back: stream_push
+    // locks it with the GIL held.
+    BLOCKING_BEGIN
+    pthread_mutex_lock(&s->mu);
+    while (s->completed < target)
+        pthread_cond_wait(&s->idle_cv, &s->mu);
+    code = s->error_code;
+    pthread_mutex_unlock(&s->mu);
+    BLOCKING_END
+    return code;
+}
+
+/* Wait for every stream on a device; returns the first error code. */
+int
+device_wait(tpu_device_t *dev, SE_Stream **failed)
+{
+    SE_Stream *s;
+    int code = 0;
+
+    BLOCKING_BEGIN
+    pthread_mutex_lock(&dev->streams_mu);
+    BLOCKING_END
+    for (s = dev->streams; s; s = s->next) {
+        int c = stream_wait(s);
+        if (c && !code) {
+            code = c;
+            if (failed)
+                *failed = s;
+        }
+    }
+    pthread_mutex_unlock(&dev->streams_mu);
+    return code;
+}
+
+static void
+stream_report(SE_Stream *s, TF_Status *status)
+{
+    int code;
+    char msg[sizeof(s->error)];
+
+    pthread_mutex_lock(&s->mu);
+    code = s->error_code;
+    memcpy(msg, s->error, sizeof(msg));
+    pthread_mutex_unlock(&s->mu);
+    if (code && status)
+        status_set(status, code, "%s", msg);
+}
+
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+// Ops
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+static void
+op_memcpy(SE_Stream *s, stream_op_t *op)
+{
+    if (op->size)
+        device_memcpy(op->dst, op->src, op->size);
+}
+
+static void
+op_host_callback(SE_Stream *s, stream_op_t *op)
+{
+    SE_StatusCallbackFn fn = (SE_StatusCallbackFn)op->dst;
+    TF_Status *status = fn(op->ctx);
+    char msg[256];
+    int code;
+
+    if (status && (code = status_consume(status, msg, sizeof(msg))))
+        stream_fail(s, code, "%s", msg);
+}
+
+static void
+op_python(SE_Stream *s, stream_op_t *op)
+{
+    PyGILState_STATE gil = PyGILState_Ensure();
+    PyObject *fn = op->ctx;
+    PyObject *result = PyObject_CallObject(fn, NULL);
+
+    if (!result) {
+        PyObject *type, *value, *tb, *str;
+        PyErr_Fetch(&type, &value, &tb);
+        str = value ? PyObject_Str(value) : NULL;
+        stream_fail(s, TF_INTERNAL, "%s: %s", type ? ((PyTypeObject *)type)->tp_name : "error",
+                    str ? PyUnicode_AsUTF8(str) : "");
+        if (!str)
+            PyErr_Clear();
+        Py_XDECREF(str);
+        PyErr_Restore(type, value, tb);
+        PyErr_Print();
+    }
+    Py_XDECREF(result);
+    Py_DECREF(fn);
+    PyGILState_Release(gil);
+}
+
+/* Queue a Python callable; takes its own reference. */
+int
+stream_push_python(SE_Stream *s, PyObject *fn)
+{
+    Py_INCREF(fn);
+    if (stream_push(s, op_python, NULL, NULL, 0, fn) < 0) {
+        Py_DECREF(fn);
+        return -1;
+    }
+    return 0;
+}
+
+/* Put a stream on its device's list, unless it's already there. */
+static void
+device_add_stream(tpu_device_t *dev, SE_Stream *s)
+{
+    SE_Stream *p;
+
+    // device_wait() can hold streams_mu while a worker needs the GIL.
+    BLOCKING_BEGIN
+    pthread_mutex_lock(&dev->streams_mu);
+    BLOCKING_END
+    for (p = dev->streams; p && p != s; p = p->next)
+        ;
+    if (!p) {
+        s->next = dev->streams;
+        dev->streams = s;
+    }
+    pthread_mutex_unlock(&dev->streams_mu);
+}
+
+static void
+device_remove_stream(tpu_device_t *dev, SE_Stream *s)
+{
+    SE_Stream **p;
+
+    BLOCKING_BEGIN
+    pthread_mutex_lock(&dev->streams_mu);
+    BLOCKING_END
+    for (p = &dev->streams; *p; p = &(*p)->next) {
+        if (*p == s) {
+            *p = s->next;
+            break;
+        }
+    }
+    pthread_mutex_unlock(&dev->streams_mu);
+}
+
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+// TpuStream_*
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+// SE_Stream* TpuStream_New(SE_StreamExecutor* parent);
+SE_Stream *
+TpuStream_New(SE_StreamExecutor *parent)
+{
+    SE_Stream *s;
+    NATIVE_ENTER(TpuStream_New);
+
+    if ((s = pool_get(&stream_pool))) {
+        s->dev = device_for_executor(parent);
+        pthread_mutex_init(&s->mu, NULL);
+        pthread_cond_init(&s->work_cv, NULL);
+        pthread_cond_init(&s->idle_cv, NULL);
+    }
+    NATIVE_LEAVE(TpuStream_New);
+    return s;
+}
+
+// void TpuStream_Free(SE_Stream*);
+void
+TpuStream_Free(SE_Stream *s)
+{
+    stream_op_t *op;
+    NATIVE_ENTER(TpuStream_Free);
+
+    if (s) {
+        stream_wait(s);
+        stream_stop(s);
+        if (s->dev)
+            device_remove_stream(s->dev, s);
+        while ((op = s->free_ops)) {
+            s->free_ops = op->next;
+            pool_put(&op_pool, op);
+        }
+        pthread_cond_destroy(&s->work_cv);
+        pthread_cond_destroy(&s->idle_cv);
+        pthread_mutex_destroy(&s->mu);
+        pool_put(&stream_pool, s);
+    }
+    NATIVE_LEAVE(TpuStream_Free);
+}
+
+// void* TpuStream_Stream(SE_Stream*);
+void *
+TpuStream_Stream(SE_Stream *s)
+{
+    return s;
+}
+
+// bool TpuStream_Status(SE_Stream*);
+bool
+TpuStream_Status(SE_Stream *s)
+{
+    int code;
+    NATIVE_ENTER(TpuStream_Status);
+
+    pthread_mutex_lock(&s->mu);
+    code = s->error_code;
+    pthread_mutex_unlock(&s->mu);
+    NATIVE_LEAVE(TpuStream_Status);
+    return code == 0;
+}
+
+// bool TpuStream_IsSameSharedMemoryLocation(SE_Stream*, SE_Stream*);
+bool
+TpuStream_IsSameSharedMemoryLocation(SE_Stream *a, SE_Stream *b)
+{
+    return a == b;
+}
+
+// void TpuStream_EnqueueTransferHostToDevice(SE_Stream* stream,
+//                                            SE_DeviceMemoryBase device_dst,
+//                                            void* host_src, uint64_t size,
+//                                            TF_Status* status);
+void
+TpuStream_EnqueueTransferHostToDevice(SE_Stream *s, SE_DeviceMemoryBase device_dst,
+                                      void *host_src, uint64_t size, TF_Status *status)
+{
+    NATIVE_ENTER(TpuStream_EnqueueTransferHostToDevice);
+    if (size > device_dst.size) {
+        status_set(status, TF_INVALID_ARGUMENT, "transfer of %" PRIu64 " bytes into a %" PRIu64 " byte buffer",
+                   size, device_dst.size);
+    } else if (stream_push(s, op_memcpy, device_dst.opaque, host_src, size, NULL) < 0) {
+        status_set(status, TF_RESOURCE_EXHAUSTED, "can't queue transfer");
+    }
+    NATIVE_LEAVE(TpuStream_EnqueueTransferHostToDevice);
+}
+
+// void TpuStream_EnqueueTransferDeviceToHost(SE_Stream* stream,
+//                                            SE_DeviceMemoryBase device_src,
+//                                            void* host_dst, uint64_t size,
+//                                            TF_Status* status);
+void
+TpuStream_EnqueueTransferDeviceToHost(SE_Stream *s, SE_DeviceMemoryBase device_src,
+                                      void *host_dst, uint64_t size, TF_Status *status)
+{
+    NATIVE_ENTER(TpuStream_EnqueueTransferDeviceToHost);
+    if (size > device_src.size) {
+        status_set(status, TF_INVALID_ARGUMENT, "transfer of %" PRIu64 " bytes out of a %" PRIu64 " byte buffer",
+                   size, device_src.size);
+    } else if (stream_push(s, op_memcpy, host_dst, device_src.opaque, size, NULL) < 0) {
+        status_set(status, TF_RESOURCE_EXHAUSTED, "can't queue transfer");
+    }
+    NATIVE_LEAVE(TpuStream_EnqueueTransferDeviceToHost);
+}
+
+// void TpuStream_TpuEnqueueOnDeviceSendRecvLocal(SE_Stream* stream,
+//                                                SE_DeviceMemoryBase send_buffer,
+//                                                SE_DeviceMemoryBase recv_buffer,
+//                                                TF_Status* status);
+void
+TpuStream_TpuEnqueueOnDeviceSendRecvLocal(SE_Stream *s, SE_DeviceMemoryBase send_buffer,
+                                          SE_DeviceMemoryBase recv_buffer, TF_Status *status)
+{
+    size_t size = send_buffer.size < recv_buffer.size ? send_buffer.size : recv_buffer.size;
+    NATIVE_ENTER(TpuStream_TpuEnqueueOnDeviceSendRecvLocal);
+    if (stream_push(s, op_memcpy, recv_buffer.opaque, send_buffer.opaque, size, NULL) < 0)
+        status_set(status, TF_RESOURCE_EXHAUSTED, "can't queue transfer");
+    NATIVE_LEAVE(TpuStream_TpuEnqueueOnDeviceSendRecvLocal);
+}
+
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+// TpuExecutor_* stream functions
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+// bool TpuExecutor_AllocateStream(SE_StreamExecutor* executor, SE_Stream* stream);
+bool
+TpuExecutor_AllocateStream(SE_StreamExecutor *executor, SE_Stream *s)
+{
+    int ok;
+    NATIVE_ENTER(TpuExecutor_AllocateStream);
+
+    if (!s->dev)
+        s->dev = device_for_executor(executor);
+    pthread_mutex_lock(&s->mu);
+    ok = stream_start_locked(s) == 0;
+    pthread_mutex_unlock(&s->mu);
+    if (ok && s->dev)
+        device_add_stream(s->dev, s);
+    NATIVE_LEAVE(TpuExecutor_AllocateStream);
+    return ok;
+}
+
+// void TpuExecutor_DeallocateStream(SE_StreamExecutor* executor,
+//                                   SE_Stream* stream);
+void
+TpuExecutor_DeallocateStream(SE_StreamExecutor *executor, SE_Stream *s)
+{
+    NATIVE_ENTER(TpuExecutor_DeallocateStream);
+    stream_wait(s);
+    stream_stop(s);
+    if (s->dev)
+        device_remove_stream(s->dev, s);
+    NATIVE_LEAVE(TpuExecutor_DeallocateStream);
+}
+
+// void TpuExecutor_GetStatus(SE_StreamExecutor* executor, SE_Stream* stream,
+//                            TF_Status* status);
+void
+TpuExecutor_GetStatus(SE_StreamExecutor *executor, SE_Stream *s, TF_Status *status)
+{
+    NATIVE_ENTER(TpuExecutor_GetStatus);
+    stream_report(s, status);
+    NATIVE_LEAVE(TpuExecutor_GetStatus);
+}
+
+// bool TpuExecutor_MemcpyToHost(SE_StreamExecutor* executor, SE_Stream* stream,
+//                               void* host_dst,
+//                               const SE_DeviceMemoryBase* device_src,
+//                               uint64_t size);
+bool
+TpuExecutor_MemcpyToHost(SE_StreamExecutor *executor, SE_Stream *s, void *host_dst,
+                         const SE_DeviceMemoryBase *device_src, uint64_t size)
+{
+    int ok;
+    NATIVE_ENTER(TpuExecutor_MemcpyToHost);
+    ok = size <= device_src->size &&
+         stream_push(s, op_memcpy, host_dst, device_src->opaque, size, NULL) == 0;
+    NATIVE_LEAVE(TpuExecutor_MemcpyToHost);
+    return ok;
+}
+
+// bool TpuExecutor_MemcpyFromHost(SE_StreamExecutor* executor, SE_Stream* stream,
+//                                 SE_DeviceMemoryBase* device_dst,
+//                                 const void* host_src, uint64_t size);
+bool
+TpuExecutor_MemcpyFromHost(SE_StreamExecutor *executor, SE_Stream *s, SE_DeviceMemoryBase *device_dst,
+                           const void *host_src, uint64_t size)
+{
+    int ok;
+    NATIVE_ENTER(TpuExecutor_MemcpyFromHost);
+    ok = size <= device_dst->size &&
+         stream_push(s, op_memcpy, device_dst->opaque, host_src, size, NULL) == 0;
+    NATIVE_LEAVE(TpuExecutor_MemcpyFromHost);
+    return ok;
+}
+
+// bool TpuExecutor_HostCallback(SE_StreamExecutor* executor, SE_Stream* stream,
+//                               SE_StatusCallbackFn callback_fn, void* ctx);
+bool
+TpuExecutor_HostCallback(SE_StreamExecutor *executor, SE_Stream *s, SE_StatusCallbackFn callback_fn, void *ctx)
+{
+    int ok;
+    NATIVE_ENTER(TpuExecutor_HostCallback);
+    ok = stream_push(s, op_host_callback, (void *)callback_fn, NULL, 0, ctx) == 0;
+    NATIVE_LEAVE(TpuExecutor_HostCallback);
+    return ok;
+}
+
+// void TpuExecutor_BlockHostUntilDone(SE_StreamExecutor* executor,
+//                                     SE_Stream* stream, TF_Status* status);
+void
+TpuExecutor_BlockHostUntilDone(SE_StreamExecutor *executor, SE_Stream *s, TF_Status *status)
+{
+    NATIVE_ENTER(TpuExecutor_BlockHostUntilDone);
+    stream_wait(s);
+    stream_report(s, status);
+    NATIVE_LEAVE(TpuExecutor_BlockHostUntilDone);
+}
+
+// void TpuExecutor_BlockUntilDoneOrFailed(SE_StreamExecutor* executor,
+//                                         TF_Status* status);
+void
+TpuExecutor_BlockUntilDoneOrFailed(SE_StreamExecutor *executor, TF_Status *status)
+{
+    tpu_device_t *dev = device_for_executor(executor);
+    SE_Stream *failed = NULL;
+    NATIVE_ENTER(TpuExecutor_BlockUntilDoneOrFailed);
+
+    if (dev && device_wait(dev, &failed))
+        stream_report(failed, status);
+    NATIVE_LEAVE(TpuExecutor_BlockUntilDoneOrFailed);
+}
+
+// void TpuExecutor_SyncAndForgetFailedStreams(SE_StreamExecutor* executor);
+void
+TpuExecutor_SyncAndForgetFailedStreams(SE_StreamExecutor *executor)
+{
+    tpu_device_t *dev = device_for_executor(executor);
+    SE_Stream *s;
+    NATIVE_ENTER(TpuExecutor_SyncAndForgetFailedStreams);
+
+    if (dev) {
+        device_wait(dev, NULL);
+        BLOCKING_BEGIN
+        pthread_mutex_lock(&dev->streams_mu);
+        BLOCKING_END
+        for (s = dev->streams; s; s = s->next) {
+            pthread_mutex_lock(&s->mu);
+            s->error_code = 0;
+            s->error[0] = 0;
+            pthread_mutex_unlock(&s->mu);
+        }
+        pthread_mutex_unlock(&dev->streams_mu);
+    }
+    NATIVE_LEAVE(TpuExecutor_SyncAndForgetFailedStreams);
+}
+
+// bool TpuExecutor_SynchronizeAllActivity(SE_StreamExecutor* executor);
+bool
+TpuExecutor_SynchronizeAllActivity(SE_StreamExecutor *executor)
+{
+    tpu_device_t *dev = device_for_executor(executor);
+    int code = 0;
+    NATIVE_ENTER(TpuExecutor_SynchronizeAllActivity);
+
+    if (dev)
+        code = device_wait(dev, NULL);
+    NATIVE_LEAVE(TpuExecutor_SynchronizeAllActivity);
+    return code == 0;
+}
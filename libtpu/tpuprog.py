@@ -0,0 +1,215 @@
+"""Serialized compiled programs.
+
+A program image is what TpuProgram_SerializeTpuExecutable hands out, what
+DeserializeFromGetTpuProgramResponseProto takes back, and what the compile
+cache (compilecache.py) keeps on disk. Everything is little-endian:
+
+    header    64 bytes
+                8s   magic b'TPUPROG\\0'
+                H    format version
+                H    header size
+                I    section count
+                Q    section index offset
+                Q    image size
+                32s  sha256 fingerprint of the HLO the program came from
+    sections  each 64-byte aligned; a POOL of a page or more is page
+              aligned
+                META  compiler metadata, UTF-8 JSON
+                OPS   op table: the HloModuleProto with the payload of every
+                      array constant cut out (hlo.py re-encodes it)
+                CONS  one (instruction id q, pool offset Q, size Q) record
+                      per constant that was cut out
+                POOL  the constants' values, each 64-byte aligned, C order,
+                      in the dtype the interpreter computes in
+    index     one (tag 4s, flags I, offset Q, size Q, count Q) entry per
+              section
+
+Loading decodes the op table only. Constants become read-only NumPy views
+of the image, so with load() a large program is paged in from the file as
+its constants are first touched instead of being parsed and copied.
+SerializeCompilerMetadata's image has the META section alone.
+"""
+import copy
+import ctypes
+import json
+import mmap
+import struct
+
+import numpy as np
+
+from . import hlo, interpreter
+
+MAGIC = b'TPUPROG\0'
+VERSION = 1
+HEADER = struct.Struct('<8sHHIQQ32s')
+SECTION = struct.Struct('<4sIQQQ')
+CONSTANT = struct.Struct('<qQQ')
+ALIGN = 64
+PAGE = mmap.PAGESIZE
+
+
+def align(n, to=ALIGN):
+  return -(-n // to) * to
+
+
+def pad(out, to=ALIGN):
+  out += bytes(align(len(out), to) - len(out))
+
+
+def shape_json(shape):
+  if shape.element_type == interpreter.TUPLE:
+    return [shape_json(s) for s in shape.tuple_shapes]
+  return dict(element_type=shape.element_type, dimensions=list(shape.dimensions))
+
+
+def metadata(program):
+  meta = dict(name=program.name,
+              fingerprint=program.fingerprint.decode(),
+              parameters=[shape_json(s) for s in program.parameter_shapes],
+              result=shape_json(program.result_shape))
+  return json.dumps(meta, separators=(',', ':')).encode()
+
+
+def pooled(inst):
+  """True if a constant's value can live in the pool."""
+  t = inst.shape.element_type
+  return inst.opcode == 'constant' and inst.literal is not None and t in interpreter.DTYPES
+
+
+def strip(proto, ids):
+  """A shallow copy of `proto` whose constants in `ids` keep only their
+  literal's shape."""
+  module = copy.copy(proto)
+  module.computations = []
+  for comp in proto.computations:
+    comp = copy.copy(comp)
+    insts = comp.instructions
+    comp.instructions = []
+    for inst in insts:
+      if inst.id in ids:
+        inst = copy.copy(inst)
+        lit = hlo.LiteralProto()
+        lit.shape = inst.literal.shape
+        inst.literal = lit
+      comp.instructions.append(inst)
+    module.computations.append(comp)
+  return module
+
+
+def dumps(program, metadata_only=False):
+  """The image of an interpreter.Executable."""
+  sections = [(b'META', metadata(program), 0)]
+  if not metadata_only:
+    table, pool = bytearray(), bytearray()
+    ids = set()
+    for comp in program.proto.computations:
+      for inst in comp.instructions:
+        if not pooled(inst):
+          continue
+        try:
+          value = program.module.constant(inst)
+        except interpreter.Unimplemented:
+          continue
+        value = np.ascontiguousarray(value, interpreter.DTYPES[inst.shape.element_type])
+        pad(pool)
+        table += CONSTANT.pack(inst.id, len(pool), value.nbytes)
+        pool += value.tobytes()
+        ids.add(inst.id)
+    sections += [(b'OPS ', strip(program.proto, ids).serialize(), 0),
+                 (b'CONS', table, len(ids)),
+                 (b'POOL', pool, len(ids))]
+  out = bytearray(HEADER.size)
+  index = bytearray()
+  for tag, data, count in sections:
+    pad(out, PAGE if tag == b'POOL' and len(data) >= PAGE else ALIGN)
+    index += SECTION.pack(tag, 0, len(out), len(data), count)
+    out += data
+  pad(out, 8)
+  index_offset = len(out)
+  out += index
+  HEADER.pack_into(out, 0, MAGIC, VERSION, HEADER.size, len(sections), index_offset, len(out),
+                   bytes.fromhex(program.fingerprint.decode()))
+  return bytes(out)
+
+
+def image(program):
+  """dumps(program), kept on the program."""
+  if program.image is None:
+    program.image = dumps(program)
+  return program.image
+
+
+def sections(buf):
+  """(fingerprint, {tag: (offset, size, count)}) of an image; raises
+  ValueError if it isn't one."""
+  if len(buf) < HEADER.size:
+    raise ValueError('truncated program image')
+  magic, version, header_size, count, index, size, fingerprint = HEADER.unpack_from(buf)
+  if magic != MAGIC:
+    raise ValueError('not a program image')
+  if version != VERSION:
+    raise ValueError(f'program image version {version}, expected {VERSION}')
+  if size > len(buf) or index + count * SECTION.size > size:
+    raise ValueError('truncated program image')
+  out = {}
+  for i in range(count):
+    tag, flags, offset, n, records = SECTION.unpack_from(buf, index + i * SECTION.size)
+    if offset + n > size:
+      raise ValueError(f'section {tag.decode()} runs past the end of the image')
+    out[tag.decode().strip()] = (offset, n, records)
+  return fingerprint.hex().encode(), out
+
+
+def loads(buf):
+  """An interpreter.Executable from an image, whose constants are views of
+  `buf`. Keep `buf` alive as long as the program."""
+  fingerprint, index = sections(buf)
+  if 'OPS' not in index:
+    raise ValueError('program image has no op table')
+  view = memoryview(buf)
+  offset, size, _ = index['OPS']
+  proto = hlo.HloModuleProto.parse(view[offset:offset + size])
+  shapes = {inst.id: inst.shape for comp in proto.computations for inst in comp.instructions}
+  constants = {}
+  table, table_size, count = index['CONS']
+  pool, pool_size, _ = index['POOL']
+  if count * CONSTANT.size > table_size:
+    raise ValueError('truncated constant table')
+  for i in range(count):
+    id, offset, size = CONSTANT.unpack_from(buf, table + i * CONSTANT.size)
+    shape = shapes[id]
+    dt = np.dtype(interpreter.DTYPES[shape.element_type])
+    n = int(np.prod(shape.dimensions, dtype=np.int64))
+    if offset + size > pool_size or size != n * dt.itemsize:
+      raise ValueError(f'constant {id} does not fit its shape')
+    constants[id] = np.frombuffer(buf, dt, n, pool + offset).reshape(tuple(shape.dimensions))
+  program = interpreter.compile(proto, constants=constants, fingerprint=fingerprint)
+  program.image = buf
+  return program
+
+
+def copy_from(address, size):
+  """A page-aligned copy of `size` bytes at `address`, for loads() to keep
+  the pool's alignment."""
+  buf = mmap.mmap(-1, max(size, 1))
+  if size:
+    ctypes.memmove(ctypes.addressof(ctypes.c_char.from_buffer(buf)), address, size)
+  return buf
+
+
+def load(path):
+  """loads() of a file, through mmap."""
+  with open(path, 'rb') as f:
+    return loads(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def summary(buf):
+  """{'name', 'size', 'sections': {tag: size}, 'constants'} of an image."""
+  _, index = sections(buf)
+  name = ''
+  if 'META' in index:
+    offset, size, _ = index['META']
+    name = json.loads(bytes(buf[offset:offset + size])).get('name', '')
+  return dict(name=name, size=HEADER.unpack_from(buf)[5],
+              sections={tag: size for tag, (_, size, _) in index.items()},
+              constants=index['CONS'][2] if 'CONS' in index else 0)
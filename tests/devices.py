@@ -0,0 +1,129 @@
+"""Device slots for tests that go through libtpujesus directly.
+
+Devices live as long as the process and keep the settings they were
+bound with, so every test that needs one gets a fresh ordinal.
+"""
+import ctypes
+import itertools
+import os
+import subprocess
+import sys
+import textwrap
+
+import libtpujesus
+
+ordinals = itertools.count(1)
+
+
+def bind(memory_limit=16 << 20, path=None, release_threshold=1 << 20, feed_capacity=1 << 16):
+  """Bind a made-up executor handle to an unused ordinal; returns
+  (ordinal, executor)."""
+  ordinal = next(ordinals)
+  executor = 0x7e570000 + ordinal
+  libtpujesus.bind_executor(executor, ordinal, memory_limit, path, release_threshold, feed_capacity)
+  return ordinal, executor
+
+
+class DeviceMemoryBase(ctypes.Structure):
+  _fields_ = [('opaque', ctypes.c_void_p), ('size', ctypes.c_uint64), ('payload', ctypes.c_uint64)]
+
+
+def capi():
+  """libtpujesus as the C library jaxlib sees."""
+  lib = ctypes.CDLL(libtpujesus.__file__)
+  lib.TpuExecutor_Allocate.argtypes = [ctypes.c_void_p, ctypes.c_uint64, ctypes.c_int64]
+  lib.TpuExecutor_Allocate.restype = DeviceMemoryBase
+  lib.TpuExecutor_Deallocate.argtypes = [ctypes.c_void_p, ctypes.POINTER(DeviceMemoryBase)]
+  for name in ('TpuExecutor_EnqueueInfeed', 'TpuExecutor_DequeueOutfeed'):
+    getattr(lib, name).argtypes = [ctypes.c_void_p, ctypes.c_int32, ctypes.c_void_p,
+                                   ctypes.c_int64, ctypes.c_void_p]
+  lib.TpuStatus_Code.argtypes = [ctypes.c_void_p]
+  lib.TpuStream_New.argtypes = [ctypes.c_void_p]
+  lib.TpuStream_New.restype = ctypes.c_void_p
+  lib.TpuStream_Free.argtypes = [ctypes.c_void_p]
+  lib.TpuStream_Status.argtypes = [ctypes.c_void_p]
+  lib.TpuStream_Status.restype = ctypes.c_bool
+  for name in ('TpuStream_EnqueueTransferHostToDevice', 'TpuStream_EnqueueTransferDeviceToHost'):
+    getattr(lib, name).argtypes = [ctypes.c_void_p, DeviceMemoryBase, ctypes.c_void_p,
+                                   ctypes.c_uint64, ctypes.c_void_p]
+  for name in ('TpuExecutor_AllocateStream', 'TpuExecutor_DeallocateStream'):
+    getattr(lib, name).argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+  lib.TpuExecutor_AllocateStream.restype = ctypes.c_bool
+  for name in ('TpuExecutor_BlockHostUntilDone', 'TpuExecutor_GetStatus'):
+    getattr(lib, name).argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]
+  for name in ('TpuExecutor_SynchronizeAllActivity', 'TpuExecutor_SyncAndForgetFailedStreams'):
+    getattr(lib, name).argtypes = [ctypes.c_void_p]
+  lib.TpuExecutor_SynchronizeAllActivity.restype = ctypes.c_bool
+  for name in ('TpuEvent_New', 'TpuTimer_New'):
+    getattr(lib, name).argtypes = [ctypes.c_void_p]
+    getattr(lib, name).restype = ctypes.c_void_p
+  for name in ('TpuEvent_Free', 'TpuTimer_Free'):
+    getattr(lib, name).argtypes = [ctypes.c_void_p]
+  for name in ('TpuTimer_Nanoseconds', 'TpuTimer_Microseconds'):
+    getattr(lib, name).argtypes = [ctypes.c_void_p]
+    getattr(lib, name).restype = ctypes.c_int64
+  mem_p = ctypes.POINTER(DeviceMemoryBase)
+  lib.TpuExecutor_SynchronousMemcpyToHost.argtypes = [ctypes.c_void_p, ctypes.c_void_p, mem_p,
+                                                      ctypes.c_uint64, ctypes.c_void_p]
+  lib.TpuExecutor_SynchronousMemcpyFromHost.argtypes = [ctypes.c_void_p, mem_p, ctypes.c_void_p,
+                                                        ctypes.c_uint64, ctypes.c_void_p]
+  lib.TpuExecutor_MemcpyToHost.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p,
+                                           mem_p, ctypes.c_uint64]
+  lib.TpuExecutor_MemcpyFromHost.argtypes = [ctypes.c_void_p, ctypes.c_void_p, mem_p,
+                                             ctypes.c_void_p, ctypes.c_uint64]
+  for name in ('TpuExecutor_MemcpyToHost', 'TpuExecutor_MemcpyFromHost'):
+    getattr(lib, name).restype = ctypes.c_bool
+  lib.TpuStream_TpuEnqueueOnDeviceSendRecvLocal.argtypes = [ctypes.c_void_p, DeviceMemoryBase,
+                                                            DeviceMemoryBase, ctypes.c_void_p]
+  lib.TpuExecutor_PollForEventStatus.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+  for name in ('TpuExecutor_RecordEvent', 'TpuExecutor_WaitForEvent'):
+    getattr(lib, name).argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]
+  for name in ('TpuExecutor_CreateStreamDependency', 'TpuExecutor_StartTimer', 'TpuExecutor_StopTimer'):
+    getattr(lib, name).argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]
+    getattr(lib, name).restype = ctypes.c_bool
+  return lib
+
+
+class Stream:
+  """A native stream on a fresh device, driven through the C API."""
+
+  def __init__(self, lib=None, executor=None):
+    self.lib = lib or capi()
+    if executor is None:
+      self.ordinal, executor = bind()
+    self.executor = executor
+    self.handle = self.lib.TpuStream_New(executor)
+    assert self.lib.TpuExecutor_AllocateStream(executor, self.handle)
+
+  def enqueue(self, fn):
+    libtpujesus.stream_enqueue(self.handle, fn)
+
+  def wait(self):
+    return libtpujesus.stream_wait(self.handle)
+
+  def block(self):
+    """TpuExecutor_BlockHostUntilDone; returns the status code."""
+    status = libtpujesus.status_new()
+    self.lib.TpuExecutor_BlockHostUntilDone(self.executor, self.handle, status)
+    code = self.lib.TpuStatus_Code(status)
+    self.lib.TpuStatus_Free(ctypes.c_void_p(status))
+    return code
+
+  def free(self):
+    self.lib.TpuExecutor_DeallocateStream(self.executor, self.handle)
+    self.lib.TpuStream_Free(self.handle)
+
+
+def isolated(code, timeout=60):
+  """Run `code` in a fresh interpreter and return its stdout. Tests of
+  thread interleavings go through here, so a deadlock fails the test
+  (with every thread's stack) instead of hanging the run."""
+  code = textwrap.dedent(f'''
+    import faulthandler, sys
+    faulthandler.dump_traceback_later({timeout}, exit=True)
+  ''') + textwrap.dedent(code)
+  root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+  proc = subprocess.run([sys.executable, '-c', code], cwd=root, capture_output=True,
+                        text=True, timeout=timeout + 10)
+  assert proc.returncode == 0, proc.stderr
+  return proc.stdout
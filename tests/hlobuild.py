@@ -0,0 +1,108 @@
+"""Hand-built HLO modules for the tests, through hlo.py's message types.
+
+    m = Module('add')
+    c = m.computation('main')
+    x = c.param(F32, [3])
+    c.op('add', F32, [3], x, x)
+    exe = m.compile(c)
+    exe.evaluate(np.arange(3, dtype=np.float32))
+"""
+from libtpu import hlo, interpreter
+from libtpu.interpreter import TUPLE, TOKEN, OPAQUE_TYPE
+
+
+def shape(t, dims=(), minor_to_major=None):
+  s = hlo.ShapeProto()
+  s.element_type = t
+  s.dimensions = list(dims)
+  if t not in (TUPLE, TOKEN, OPAQUE_TYPE):
+    s.layout = hlo.LayoutProto()
+    s.layout.minor_to_major = (list(range(len(dims) - 1, -1, -1)) if minor_to_major is None
+                               else list(minor_to_major))
+  return s
+
+
+def tuple_shape(*shapes):
+  s = hlo.ShapeProto()
+  s.element_type = TUPLE
+  s.tuple_shapes = list(shapes)
+  return s
+
+
+class Computation:
+  def __init__(self, module, name):
+    self.module = module
+    self.proto = hlo.HloComputationProto()
+    self.proto.name = name
+    self.proto.id = module.next_id()
+
+  @property
+  def id(self):
+    return self.proto.id
+
+  def add(self, opcode, s, operands=(), **fields):
+    inst = hlo.HloInstructionProto()
+    inst.id = self.module.next_id()
+    inst.name = f'{opcode}.{inst.id}'
+    inst.opcode = opcode
+    inst.shape = s
+    inst.operand_ids = [o.id for o in operands]
+    for k, v in fields.items():
+      setattr(inst, k, v)
+    self.proto.instructions.append(inst)
+    self.proto.root_id = inst.id
+    return inst
+
+  def op(self, opcode, t, dims, *operands, **fields):
+    return self.add(opcode, shape(t, dims), operands, **fields)
+
+  def param(self, t, dims=(), s=None):
+    return self.add('parameter', s or shape(t, dims),
+                    parameter_number=sum(i.opcode == 'parameter' for i in self.proto.instructions))
+
+  def constant(self, lit):
+    return self.add('constant', lit.shape, literal=lit)
+
+  def root(self, inst):
+    self.proto.root_id = inst.id
+    return inst
+
+
+class Module:
+  def __init__(self, name='test'):
+    self.proto = hlo.HloModuleProto()
+    self.proto.name = name
+    self.ids = 0
+
+  def next_id(self):
+    self.ids += 1
+    return self.ids
+
+  def computation(self, name):
+    c = Computation(self, name)
+    self.proto.computations.append(c.proto)
+    return c
+
+  def binary(self, opcode, t, name=None):
+    """A (x, y) -> opcode(x, y) scalar computation, for reduce and friends."""
+    c = self.computation(name or opcode)
+    x, y = c.param(t), c.param(t)
+    c.op(opcode, t, [], x, y)
+    return c
+
+  def entry(self, c):
+    self.proto.entry_computation_id = c.id
+    self.proto.entry_computation_name = c.proto.name
+    return self.proto
+
+  def compile(self, c):
+    # through the wire format, the way jaxlib hands modules over
+    data = self.entry(c).serialize()
+    return interpreter.compile(hlo.parse_module(data), data)
+
+
+def literal(t, field, values, dims=()):
+  lit = hlo.LiteralProto()
+  lit.shape = shape(t, dims)
+  setattr(lit, field, values)
+  return lit
@@ -0,0 +1,110 @@
+import pytest
+
+import libtpujesus
+
+from . import devices
+from .devices import DeviceMemoryBase
+
+LIMIT = 1 << 20
+
+
+class Device:
+  def __init__(self, memory_limit=LIMIT):
+    self.ordinal, self.executor = devices.bind(memory_limit)
+    self.lib = devices.capi()
+
+  def alloc(self, size):
+    """Address of a new buffer, or None."""
+    return self.lib.TpuExecutor_Allocate(self.executor, size, 0).opaque
+
+  def free(self, addr):
+    self.lib.TpuExecutor_Deallocate(self.executor, DeviceMemoryBase(addr, 0, 0))
+
+  def stats(self):
+    return libtpujesus.device_stats(self.ordinal)
+
+
+@pytest.fixture
+def dev():
+  return Device()
+
+
+def test_alignment(dev):
+  addrs = [dev.alloc(n) for n in (1, 255, 256, 257, 1000)]
+  assert all(a % 256 == 0 for a in addrs)
+  # sizes round up to 256-byte units, back to back from the start
+  base = addrs[0]
+  assert [a - base for a in addrs] == [0, 256, 512, 768, 1280]
+  assert dev.stats()['bytes_in_use'] == 256 * 3 + 512 + 1024
+
+
+def test_split_and_coalesce(dev):
+  a, b, c = dev.alloc(1024), dev.alloc(1024), dev.alloc(1024)
+  assert dev.stats()['largest_free_block_bytes'] == LIMIT - 3072
+  dev.free(b)
+  st = dev.stats()
+  assert st['bytes_free'] == LIMIT - 2048
+  assert st['fragmentation'] > 0
+  # a freed next to a free chunk merges with it
+  dev.free(a)
+  assert dev.alloc(2048) == a
+  dev.free(a)
+  dev.free(c)
+  # c merges with the hole before it and the rest after it
+  st = dev.stats()
+  assert st['largest_free_block_bytes'] == st['bytes_free'] == LIMIT
+  assert st['fragmentation'] == 0
+  assert st['bytes_in_use'] == 0
+
+
+def test_best_fit(dev):
+  a, _, b, _ = dev.alloc(4096), dev.alloc(256), dev.alloc(1024), dev.alloc(256)
+  dev.free(a)
+  dev.free(b)
+  # the 1024-byte hole fits best, though the 4096-byte one comes first
+  assert dev.alloc(1000) == b
+  assert dev.alloc(1000) == a
+
+
+def test_out_of_memory(dev):
+  assert dev.alloc(LIMIT + 1) is None
+  a = dev.alloc(LIMIT)
+  assert a is not None
+  assert dev.alloc(1) is None
+  dev.free(a)
+  assert dev.alloc(1) == a
+
+
+def test_double_free(dev, capfd):
+  a, b = dev.alloc(1024), dev.alloc(1024)
+  dev.free(a)
+  before = dev.stats()
+  dev.free(a)
+  dev.free(b + 256)  # inside a buffer, not at its start
+  assert capfd.readouterr().err.count('was not allocated') == 2
+  assert dev.stats() == before
+  assert dev.alloc(1024) == a
+  assert dev.stats()['bytes_in_use'] == 2048
+
+
+def test_stats(dev):
+  a = dev.alloc(3000)
+  b = dev.alloc(100)
+  st = dev.stats()
+  assert st['num_allocs'] == 2
+  assert st['bytes_in_use'] == 3072 + 256
+  assert st['largest_alloc_size'] == 3000
+  dev.free(a)
+  c = dev.alloc(500)
+  st = dev.stats()
+  assert st['num_allocs'] == 3
+  assert st['bytes_in_use'] == 256 + 512
+  assert st['peak_bytes_in_use'] == 3072 + 256
+  assert st['bytes_limit'] == LIMIT
+  dev.free(b)
+  dev.free(c)
+  assert dev.stats()['peak_bytes_in_use'] == 3072 + 256
+
+
+def test_unknown_executor(dev):
+  assert dev.lib.TpuExecutor_Allocate(0x1234, 256, 0).opaque is None
@@ -0,0 +1,36 @@
+import ctypes
+
+import pytest
+
+import libtpu
+import libtpujesus
+from libtpu import handles
+
+BAD = handles.MAGIC << 56 | 12345
+
+
+@pytest.fixture
+def lib():
+  lib = ctypes.CDLL(libtpujesus.__file__)
+  lib.TpuCompiler_Free.argtypes = [ctypes.c_void_p]
+  return lib
+
+
+def errors(sym):
+  return libtpujesus.stats().get(sym, {}).get('errors', 0)
+
+
+@pytest.mark.parametrize('level', [libtpu.TRACE_OFF, libtpu.TRACE_ARGS])
+def test_exception_counted(lib, capfd, monkeypatch, level):
+  monkeypatch.delenv('LIBTPU_DEBUG', raising=False)
+  before = errors('TpuCompiler_Free')
+  libtpu.set_trace(level)
+  try:
+    lib.TpuCompiler_Free(BAD)
+  finally:
+    libtpu.set_trace(libtpu.TRACE_OFF)
+    libtpujesus.trace_flush()
+  assert errors('TpuCompiler_Free') == before + 1
+  err = capfd.readouterr().err
+  assert 'TpuCompiler_Free raised' in err
+  assert f'HandleError: invalid handle {BAD:#x}' in err
@@ -0,0 +1,85 @@
+import os
+
+import pytest
+
+from libtpu import compilecache, tpuprog
+
+
+@pytest.fixture
+def cache(tmp_path):
+  c = compilecache.CompileCache()
+  c.open(str(tmp_path), budget=250)
+  return c
+
+
+def age(cache, key, seconds):
+  """Set an entry's mtime; the filesystem's clock is too coarse to order
+  back-to-back writes."""
+  os.utime(cache.file(key), ns=(seconds * 10**9, seconds * 10**9))
+
+
+def test_key():
+  assert compilecache.key(b'hlo', 'options') == compilecache.key('hlo', b'options')
+  assert compilecache.key('ab', 'c') != compilecache.key('a', 'bc')
+  assert len(compilecache.key()) == 64
+
+
+def test_put_get(cache):
+  assert cache.get('a', bytes) is None
+  cache.put('a', b'x' * 100)
+  assert cache.get('a', bytes) == b'x' * 100
+  cache.put('a', b'y' * 50)
+  assert cache.get('a', bytes) == b'y' * 50
+  st = cache.stats()
+  assert (st['hits'], st['misses'], st['writes'], st['entries'], st['bytes']) == (2, 1, 2, 1, 50)
+  # no temporary files left behind
+  assert os.listdir(cache.path) == ['a' + compilecache.SUFFIX]
+
+
+def test_disabled(tmp_path):
+  c = compilecache.CompileCache()
+  assert not c.enabled
+  c.put('a', b'data')
+  assert c.get('a', bytes) is None
+  c.open(str(tmp_path), budget=0)
+  c.put('a', b'data')
+  assert os.listdir(tmp_path) == []
+
+
+def test_lru_eviction(cache):
+  for i, key in enumerate('ab'):
+    cache.put(key, bytes(100))
+    age(cache, key, 1000 + i)
+  # a hit makes 'a' the most recently used
+  assert cache.get('a', bytes) is not None
+  cache.put('c', bytes(100))
+  assert cache.get('b', bytes) is None
+  assert cache.get('a', bytes) is not None
+  assert cache.get('c', bytes) is not None
+  st = cache.stats()
+  assert st['evictions'] == 1
+  assert st['bytes'] == 200 <= st['budget']
+
+
+def test_too_big_for_budget(cache):
+  cache.put('big', bytes(251))
+  assert cache.get('big', bytes) is None
+  assert os.listdir(cache.path) == []
+
+
+def test_open_trims_existing(tmp_path):
+  for i, key in enumerate('abc'):
+    (tmp_path / (key + compilecache.SUFFIX)).write_bytes(bytes(100))
+    os.utime(tmp_path / (key + compilecache.SUFFIX), ns=(i * 10**9, i * 10**9))
+  c = compilecache.CompileCache()
+  c.open(str(tmp_path), budget=250)
+  assert sorted(c.entries) == ['b', 'c']
+  assert c.stats()['evictions'] == 1
+
+
+def test_corrupt_entry_is_dropped(cache):
+  cache.put('bad', b'not a program image')
+  assert cache.get('bad', tpuprog.loads) is None
+  st = cache.stats()
+  assert (st['errors'], st['misses'], st['entries'], st['bytes']) == (1, 1, 0, 0)
+  assert not os.path.exists(cache.file('bad'))
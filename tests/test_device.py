@@ -0,0 +1,50 @@
+import ctypes
+
+import libtpujesus
+
+from . import devices
+
+
+def alloc(lib, executor, size):
+  return lib.TpuExecutor_Allocate(executor, size, 0).opaque
+
+
+def test_memory_file_per_device(tmp_path):
+  path = tmp_path / 'device.mem'
+  lib = devices.capi()
+  (a, ea), (b, eb) = devices.bind(path=str(path)), devices.bind(path=str(path))
+  assert sorted(p.name for p in tmp_path.iterdir()) == [f'device.mem.{a}', f'device.mem.{b}']
+  assert libtpujesus.device_stats(a)['file_backed']
+  # each device has memory of its own
+  pa, pb = alloc(lib, ea, 4096), alloc(lib, eb, 4096)
+  ctypes.memset(pa, 1, 4096)
+  ctypes.memset(pb, 2, 4096)
+  assert ctypes.string_at(pa, 4096) == b'\1' * 4096
+
+
+def test_memory_file_directory(tmp_path):
+  ordinal, _ = devices.bind(path=str(tmp_path))
+  assert libtpujesus.device_stats(ordinal)['file_backed']
+  # the spill file is unlinked as soon as it's open
+  assert list(tmp_path.iterdir()) == []
+
+
+def test_committed_bytes():
+  page = 4096
+  ordinal, executor = devices.bind(memory_limit=1 << 24, release_threshold=4 * page)
+  lib = devices.capi()
+  stats = lambda: libtpujesus.device_stats(ordinal)
+  assert stats()['committed_bytes'] == 0
+  a = alloc(lib, executor, 16 * page)
+  b = alloc(lib, executor, 100)  # shares nothing with a, one page
+  assert stats()['committed_bytes'] == 17 * page
+  lib.TpuExecutor_Deallocate(executor, devices.DeviceMemoryBase(a, 0, 0))
+  # a's pages were released; the peak stays
+  assert stats()['committed_bytes'] == page
+  assert stats()['peak_committed_bytes'] == 17 * page
+  # small frees keep their pages, so reusing them commits nothing new
+  lib.TpuExecutor_Deallocate(executor, devices.DeviceMemoryBase(b, 0, 0))
+  assert stats()['committed_bytes'] == page
+  c = alloc(lib, executor, 200)
+  assert c == a
+  assert stats()['committed_bytes'] == 2 * page
@@ -0,0 +1,181 @@
+import threading
+import time
+
+import pytest
+
+import libtpujesus
+
+from . import devices
+
+# stream_executor::Event::Status
+ERROR, PENDING, COMPLETE = 1, 2, 3
+
+
+@pytest.fixture
+def streams():
+  """Two streams on one device, and their library."""
+  lib = devices.capi()
+  a = devices.Stream(lib)
+  b = devices.Stream(lib, a.executor)
+  yield lib, a, b
+  a.free()
+  b.free()
+
+
+def gate(stream):
+  """Hold `stream` up until the returned event is set."""
+  opened = threading.Event()
+  stream.enqueue(lambda: opened.wait(5))
+  return opened
+
+
+def events_live():
+  return libtpujesus.pool_stats()['SE_Event']['live']
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Events
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_record_and_poll(streams):
+  lib, a, _ = streams
+  ev = lib.TpuEvent_New(a.executor)
+  poll = lambda: lib.TpuExecutor_PollForEventStatus(a.executor, ev)
+  # never recorded: nothing to wait for
+  assert poll() == COMPLETE
+  opened = gate(a)
+  lib.TpuExecutor_RecordEvent(a.executor, a.handle, ev, None)
+  assert poll() == PENDING
+  opened.set()
+  assert a.wait() == 0
+  assert poll() == COMPLETE
+  # a second record is pending again until the stream reaches it
+  opened = gate(a)
+  lib.TpuExecutor_RecordEvent(a.executor, a.handle, ev, None)
+  assert poll() == PENDING
+  opened.set()
+  a.wait()
+  assert poll() == COMPLETE
+  lib.TpuEvent_Free(ev)
+
+
+def test_record_after_failure(streams, capfd):
+  lib, a, _ = streams
+  ev = lib.TpuEvent_New(a.executor)
+  a.enqueue(lambda: 1 / 0)
+  lib.TpuExecutor_RecordEvent(a.executor, a.handle, ev, None)
+  a.wait()
+  capfd.readouterr()
+  assert lib.TpuExecutor_PollForEventStatus(a.executor, ev) == ERROR
+  lib.TpuEvent_Free(ev)
+
+
+def test_wait_across_streams(streams):
+  lib, a, b = streams
+  seen = []
+  ev = lib.TpuEvent_New(a.executor)
+  opened = gate(a)
+  a.enqueue(lambda: seen.append('a'))
+  lib.TpuExecutor_RecordEvent(a.executor, a.handle, ev, None)
+  lib.TpuExecutor_WaitForEvent(b.executor, b.handle, ev, None)
+  b.enqueue(lambda: seen.append('b'))
+  # b is held up by a, without the host blocking
+  time.sleep(0.05)
+  assert seen == []
+  opened.set()
+  assert b.wait() == 0
+  assert seen == ['a', 'b']
+  lib.TpuEvent_Free(ev)
+
+
+def test_wait_for_unrecorded_event(streams):
+  lib, a, b = streams
+  seen = []
+  ev = lib.TpuEvent_New(a.executor)
+  lib.TpuExecutor_WaitForEvent(b.executor, b.handle, ev, None)
+  b.enqueue(lambda: seen.append('b'))
+  assert b.wait() == 0
+  assert seen == ['b']
+  lib.TpuEvent_Free(ev)
+
+
+def test_stream_dependency(streams):
+  lib, a, b = streams
+  seen = []
+  opened = gate(a)
+  a.enqueue(lambda: seen.append('a'))
+  assert lib.TpuExecutor_CreateStreamDependency(a.executor, b.handle, a.handle)
+  b.enqueue(lambda: seen.append('b'))
+  time.sleep(0.05)
+  assert seen == []
+  opened.set()
+  b.wait()
+  assert seen == ['a', 'b']
+  assert lib.TpuExecutor_CreateStreamDependency(a.executor, a.handle, a.handle)
+
+
+def test_event_outlives_free(streams):
+  # queued records and waits hold their own references
+  lib, a, b = streams
+  live = events_live()
+  ev = lib.TpuEvent_New(a.executor)
+  opened = gate(a)
+  lib.TpuExecutor_RecordEvent(a.executor, a.handle, ev, None)
+  lib.TpuExecutor_WaitForEvent(b.executor, b.handle, ev, None)
+  lib.TpuEvent_Free(ev)
+  assert events_live() == live + 1
+  opened.set()
+  a.wait()
+  b.wait()
+  assert events_live() == live
+  # a throwaway dependency event goes back too
+  assert lib.TpuExecutor_CreateStreamDependency(a.executor, b.handle, a.handle)
+  b.wait()
+  assert events_live() == live
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Timers
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def measure(lib, stream, timer, seconds):
+  assert lib.TpuExecutor_StartTimer(stream.executor, stream.handle, timer)
+  stream.enqueue(lambda: time.sleep(seconds))
+  assert lib.TpuExecutor_StopTimer(stream.executor, stream.handle, timer)
+  stream.wait()
+  return lib.TpuTimer_Nanoseconds(timer)
+
+
+def test_timer(streams):
+  lib, a, _ = streams
+  timer = lib.TpuTimer_New(a.executor)
+  assert lib.TpuTimer_Nanoseconds(timer) == 0
+  short = measure(lib, a, timer, 0.01)
+  assert short >= 10e6
+  assert lib.TpuTimer_Microseconds(timer) == short // 1000
+  long = measure(lib, a, timer, 0.04)
+  assert long >= 40e6 and long > short
+  # restarting resets the reading until the stop mark is reached
+  opened = gate(a)
+  assert lib.TpuExecutor_StartTimer(a.executor, a.handle, timer)
+  assert lib.TpuTimer_Nanoseconds(timer) == 0
+  assert lib.TpuExecutor_StopTimer(a.executor, a.handle, timer)
+  assert lib.TpuTimer_Nanoseconds(timer) == 0
+  opened.set()
+  a.wait()
+  assert 0 < lib.TpuTimer_Nanoseconds(timer) < short
+  lib.TpuTimer_Free(timer)
+
+
+def test_timer_measures_the_stream(streams):
+  # the marks are stamped by the worker, not when they're queued
+  lib, a, _ = streams
+  timer = lib.TpuTimer_New(a.executor)
+  opened = gate(a)
+  lib.TpuExecutor_StartTimer(a.executor, a.handle, timer)
+  lib.TpuExecutor_StopTimer(a.executor, a.handle, timer)
+  time.sleep(0.05)
+  opened.set()
+  a.wait()
+  assert 0 < lib.TpuTimer_Nanoseconds(timer) < 10e6
+  lib.TpuTimer_Free(timer)
@@ -0,0 +1,177 @@
+import ctypes
+import threading
+import time
+
+import pytest
+
+import libtpujesus
+
+from . import devices
+
+HEADER = 8
+
+
+@pytest.fixture
+def feed():
+  """(ordinal, executor, lib, status) for a device with 100-byte queues."""
+  ordinal, executor = devices.bind(feed_capacity=100)
+  return ordinal, executor, devices.capi(), libtpujesus.status_new()
+
+
+def dequeue_outfeed(lib, executor, size):
+  # a status keeps its error, so each call gets a new one
+  status = libtpujesus.status_new()
+  buf = ctypes.create_string_buffer(size)
+  lib.TpuExecutor_DequeueOutfeed(executor, 0, buf, size, status)
+  code = lib.TpuStatus_Code(status)
+  lib.TpuStatus_Free(ctypes.c_void_p(status))
+  return code, buf.raw
+
+
+def outfeed(ordinal):
+  return libtpujesus.feed_stats(ordinal)['outfeed'][0]
+
+
+def test_wraparound(feed):
+  ordinal, executor, lib, status = feed
+  # 38-byte records against a 100-byte ring, two in flight at a time
+  records = [bytes([i]) * 30 for i in range(20)]
+  assert libtpujesus.outfeed_enqueue(ordinal, records[0])
+  for i in range(1, len(records)):
+    assert libtpujesus.outfeed_enqueue(ordinal, records[i], 0, 0)
+    assert dequeue_outfeed(lib, executor, 30) == (0, records[i - 1])
+  assert dequeue_outfeed(lib, executor, 30) == (0, records[-1])
+  st = outfeed(ordinal)
+  assert st['pushed'] == st['popped'] == 20
+  assert st['bytes_pushed'] == 600
+  assert st['depth'] == st['depth_bytes'] == 0
+  assert st['peak_bytes'] == 2 * (30 + HEADER)
+
+
+def test_infeed_wraparound(feed):
+  ordinal, executor, lib, status = feed
+  for i in range(10):
+    data = bytes(range(i, i + 40))
+    lib.TpuExecutor_EnqueueInfeed(executor, 0, data, len(data), status)
+    assert lib.TpuStatus_Code(status) == 0
+    assert libtpujesus.infeed_dequeue(ordinal) == data
+
+
+def test_full_queue_times_out(feed):
+  ordinal = feed[0]
+  assert libtpujesus.outfeed_enqueue(ordinal, b'x' * 30)
+  assert libtpujesus.outfeed_enqueue(ordinal, b'y' * 30)
+  t0 = time.monotonic()
+  assert libtpujesus.outfeed_enqueue(ordinal, b'z' * 30, 0, 0.05) is False
+  assert time.monotonic() - t0 >= 0.04
+  st = outfeed(ordinal)
+  assert st['depth'] == 2
+  assert st['push_stall_ns'] >= 40e6
+  assert st['pop_stall_ns'] == 0
+
+
+def test_full_queue_blocks_until_room(feed):
+  ordinal, executor, lib, status = feed
+  libtpujesus.outfeed_enqueue(ordinal, b'x' * 30)
+  libtpujesus.outfeed_enqueue(ordinal, b'y' * 30)
+  done = threading.Event()
+  def produce():
+    libtpujesus.outfeed_enqueue(ordinal, b'z' * 30)
+    done.set()
+  thread = threading.Thread(target=produce)
+  thread.start()
+  assert not done.wait(0.05)
+  assert dequeue_outfeed(lib, executor, 30) == (0, b'x' * 30)
+  thread.join(5)
+  assert done.is_set()
+  assert outfeed(ordinal)['push_stall_ns'] >= 40e6
+  assert dequeue_outfeed(lib, executor, 30)[1] == b'y' * 30
+  assert dequeue_outfeed(lib, executor, 30)[1] == b'z' * 30
+
+
+def test_empty_queue_times_out(feed):
+  ordinal = feed[0]
+  assert libtpujesus.infeed_dequeue(ordinal, 0, 0.05) is None
+  st = libtpujesus.feed_stats(ordinal)['infeed'][0]
+  assert st['pop_stall_ns'] >= 40e6
+  assert st['popped'] == 0
+
+
+def test_consumer_waits_for_producer(feed):
+  ordinal, executor, lib, status = feed
+  def produce():
+    time.sleep(0.05)
+    lib.TpuExecutor_EnqueueInfeed(executor, 0, b'late', 4, libtpujesus.status_new())
+  thread = threading.Thread(target=produce)
+  thread.start()
+  assert libtpujesus.infeed_dequeue(ordinal) == b'late'
+  thread.join()
+  st = libtpujesus.feed_stats(ordinal)['infeed'][0]
+  assert st['pop_stall_ns'] >= 40e6
+  assert st['push_stall_ns'] == 0
+
+
+def test_undersized_consumer_buffer(feed):
+  ordinal, executor, lib, status = feed
+  libtpujesus.outfeed_enqueue(ordinal, b'r' * 30)
+  code, _ = dequeue_outfeed(lib, executor, 16)
+  assert code == 3  # INVALID_ARGUMENT
+  # the record stays for a consumer with room for it
+  assert outfeed(ordinal)['depth'] == 1
+  assert dequeue_outfeed(lib, executor, 30) == (0, b'r' * 30)
+  # a bigger buffer is fine; the tail is left alone
+  libtpujesus.outfeed_enqueue(ordinal, b's' * 10)
+  code, data = dequeue_outfeed(lib, executor, 16)
+  assert (code, data) == (0, b's' * 10 + b'\0' * 6)
+
+
+def test_record_too_big(feed):
+  ordinal, executor, lib, status = feed
+  with pytest.raises(ValueError):
+    libtpujesus.outfeed_enqueue(ordinal, b'x' * (100 - HEADER + 1))
+  assert libtpujesus.outfeed_enqueue(ordinal, b'x' * (100 - HEADER), 0, 0)
+  data = b'x' * 100
+  lib.TpuExecutor_EnqueueInfeed(executor, 0, data, len(data), status)
+  assert lib.TpuStatus_Code(status) == 8  # RESOURCE_EXHAUSTED
+
+
+def test_queue_index_out_of_range(feed):
+  ordinal = feed[0]
+  with pytest.raises(IndexError):
+    libtpujesus.infeed_dequeue(ordinal, 16, 0)
+  with pytest.raises(KeyError):
+    libtpujesus.feed_stats(63)
+
+
+def test_stats_while_consumer_waits():
+  # a consumer woken by the producer used to take the GIL back with the
+  # queue's mu held, while feed_stats held the GIL and waited for mu
+  out = devices.isolated('''
+    import threading
+    import libtpujesus
+    from tests import devices
+    ordinal, executor = devices.bind(feed_capacity=1 << 12)
+    lib = devices.capi()
+    N = 50000
+    done = threading.Event()
+    def consumer():
+      for _ in range(N):
+        libtpujesus.infeed_dequeue(ordinal)
+    def producer():
+      status = libtpujesus.status_new()
+      for i in range(N):
+        lib.TpuExecutor_EnqueueInfeed(executor, 0, b'x' * 64, 64, status)
+    def monitor():
+      while not done.is_set():
+        libtpujesus.feed_stats(ordinal)
+    threads = [threading.Thread(target=f) for f in (consumer, producer)]
+    watcher = threading.Thread(target=monitor)
+    for t in threads + [watcher]:
+      t.start()
+    for t in threads:
+      t.join()
+    done.set()
+    watcher.join()
+    print(libtpujesus.feed_stats(ordinal)['infeed'][0]['popped'])
+  ''')
+  assert out.split() == ['50000']
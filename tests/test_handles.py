@@ -0,0 +1,122 @@
+import io
+
+import pytest
+
+from libtpu import handles
+from libtpu.handles import HandleError, HandleTable
+
+
+class Platform:
+  pass
+
+
+class Stream:
+  pass
+
+
+@pytest.fixture
+def table():
+  return HandleTable()
+
+
+def test_new_and_get(table):
+  p = Platform()
+  h = table.new(p)
+  assert handles.is_handle(h)
+  assert h >> 56 == handles.MAGIC
+  assert table.new(p) == h
+  assert table.get(h) is p
+  assert table.lookup(h, Platform) is p
+  assert table.converter(Platform)(h) is p
+  assert table.converter(Platform)(0) is None
+
+
+def test_reuse_after_delete(table):
+  a = Platform()
+  h = table.new(a)
+  table.delete(a)
+  with pytest.raises(HandleError, match='use after free of Platform'):
+    table.get(h)
+  # the slot is reused with a new generation; the stale handle stays dead
+  b = Stream()
+  h2 = table.new(b)
+  assert h2 & handles.INDEX_MASK == h & handles.INDEX_MASK
+  assert (h2 >> 32) & handles.GEN_MASK == ((h >> 32) & handles.GEN_MASK) + 1
+  assert table.get(h2) is b
+  with pytest.raises(HandleError, match='use after free'):
+    table.get(h)
+  with pytest.raises(HandleError, match='use after free'):
+    table.converter(Stream)(h)
+  with pytest.raises(HandleError):
+    table.delete(h)
+
+
+def test_generation_wraps(table):
+  h = table.new(Platform())
+  for _ in range(handles.GEN_MASK + 1):
+    table.delete(h)
+    h = table.new(Platform())
+  assert (h >> 32) & handles.GEN_MASK == 0
+
+
+def test_delete_by_handle(table):
+  p = Platform()
+  h = table.new(p)
+  table.delete(h)
+  assert table.stats()['live'] == 0
+  with pytest.raises(HandleError, match='untracked'):
+    table.delete(p)
+
+
+def test_type_tags(table):
+  p, s = Platform(), Stream()
+  hp, hs = table.new(p), table.new(s)
+  assert hp >> 48 == table.key(Platform)
+  assert hs >> 48 == table.key(Stream)
+  assert table.key(Platform) != table.key(Stream)
+  with pytest.raises(HandleError, match='is a Stream, expected Platform'):
+    table.lookup(hs, Platform)
+  with pytest.raises(HandleError, match='is a Stream, expected Platform'):
+    table.converter(Platform)(hs)
+  assert table.lookup(hs) is s
+
+
+def test_invalid_handles(table):
+  with pytest.raises(HandleError, match='invalid handle'):
+    table.get(handles.MAGIC << 56 | 12345)
+  with pytest.raises(HandleError, match='unknown handle'):
+    table.lookup(0x7f0012345678, Platform)
+
+
+def test_pinned(table):
+  obj = Platform()
+  assert table.pin(obj, 0x7f0012345678) == 0x7f0012345678
+  assert table.lookup(0x7f0012345678, Platform) is obj
+  assert table.converter(Platform)(0x7f0012345678) is obj
+  assert table.unpin(0x7f0012345678)
+  assert not table.unpin(0x7f0012345678)
+
+
+def test_stats(table):
+  objs = [Platform(), Platform(), Stream()]
+  for obj in objs:
+    table.new(obj)
+  table.delete(objs[0])
+  st = table.stats()
+  assert (st['live'], st['peak'], st['slots']) == (2, 3, 3)
+  assert st['by_type'] == {'Platform': 1, 'Stream': 1}
+
+
+def test_report_leaks(table):
+  out = io.StringIO()
+  table.report_leaks(out)
+  assert out.getvalue() == ''
+  objs = [Stream(), Stream(), Platform()]
+  for obj in objs:
+    table.new(obj)
+  table.delete(objs[2])
+  table.report_leaks(out)
+  assert out.getvalue().splitlines() == [
+    'libtpu: 2 live handles at exit (peak 3):',
+    '         2 Stream',
+  ]
@@ -0,0 +1,385 @@
+import ctypes
+
+import numpy as np
+import pytest
+
+import libtpujesus
+from libtpu import hlo, interpreter
+from libtpu.interpreter import PRED, U8, S32, U32, F32, BF16, TOKEN
+
+from . import devices
+from .hlobuild import Module, literal, shape, tuple_shape
+
+
+def rng():
+  return np.random.default_rng(0)
+
+#
+# sort
+#
+
+def sort_module(t, direction, params=(0, 1), n=5):
+  m = Module('sort')
+  less = m.computation('compare')
+  p = [less.param(t), less.param(t)]
+  less.op('compare', PRED, [], p[params[0]], p[params[1]], comparison_direction=direction)
+  c = m.computation('main')
+  x = c.param(t, [n])
+  c.op('sort', t, [n], x, dimensions=[0], called_computation_ids=[less.id], is_stable=True)
+  return m.compile(c)
+
+
+@pytest.mark.parametrize('dtype, t', [(np.uint32, U32), (np.int32, S32), (np.float32, F32)])
+@pytest.mark.parametrize('direction, params', [('GT', (0, 1)), ('LT', (1, 0))])
+def test_sort_descending(dtype, t, direction, params):
+  lo, hi = (np.iinfo(dtype).min, np.iinfo(dtype).max) if dtype != np.float32 else (-np.inf, np.inf)
+  x = np.array([0, 1, lo, 2, hi], dtype)
+  out = sort_module(t, direction, params).evaluate(x)
+  np.testing.assert_array_equal(out, np.sort(x)[::-1])
+
+
+def test_sort_ascending():
+  x = np.array([0, 1, np.iinfo(np.int32).min, 2, np.iinfo(np.int32).max], np.int32)
+  np.testing.assert_array_equal(sort_module(S32, 'LT').evaluate(x), np.sort(x))
+
+#
+# dot and convolution
+#
+
+def test_dot():
+  m = Module('dot')
+  c = m.computation('main')
+  a, b = c.param(F32, [2, 3]), c.param(F32, [3, 4])
+  dnums = hlo.DotDimensionNumbers()
+  dnums.lhs_contracting_dimensions, dnums.rhs_contracting_dimensions = [1], [0]
+  c.op('dot', F32, [2, 4], a, b, dot_dimension_numbers=dnums)
+  x, y = rng().standard_normal((2, 3), np.float32), rng().standard_normal((3, 4), np.float32)
+  np.testing.assert_allclose(m.compile(c).evaluate(x, y), x @ y, rtol=1e-6)
+
+
+def test_batch_dot():
+  m = Module('dot')
+  c = m.computation('main')
+  a, b = c.param(F32, [2, 3, 4]), c.param(F32, [2, 5, 4])
+  dnums = hlo.DotDimensionNumbers()
+  dnums.lhs_batch_dimensions, dnums.rhs_batch_dimensions = [0], [0]
+  dnums.lhs_contracting_dimensions, dnums.rhs_contracting_dimensions = [2], [2]
+  c.op('dot', F32, [2, 3, 5], a, b, dot_dimension_numbers=dnums)
+  x, y = rng().standard_normal((2, 3, 4), np.float32), rng().standard_normal((2, 5, 4), np.float32)
+  np.testing.assert_allclose(m.compile(c).evaluate(x, y), np.einsum('bik,bjk->bij', x, y), rtol=1e-5)
+
+
+def conv_reference(x, w, stride, pad, groups):
+  x = np.pad(x, ((0, 0), (0, 0), (pad, pad), (pad, pad)))
+  n, c, h, wd = x.shape
+  o, cg, kh, kw = w.shape
+  oh, ow = (h - kh) // stride + 1, (wd - kw) // stride + 1
+  out = np.zeros((n, o, oh, ow), x.dtype)
+  for b, oc, i, j in np.ndindex(n, o, oh, ow):
+    g = oc // (o // groups)
+    patch = x[b, g * cg:(g + 1) * cg, i * stride:i * stride + kh, j * stride:j * stride + kw]
+    out[b, oc, i, j] = np.sum(patch * w[oc])
+  return out
+
+
+@pytest.mark.parametrize('stride, pad, groups', [(1, 1, 1), (2, 0, 1), (1, 1, 2)])
+def test_convolution(stride, pad, groups):
+  x = rng().standard_normal((2, 4, 5, 5), np.float32)
+  w = rng().standard_normal((6, 4 // groups, 3, 3), np.float32)
+  want = conv_reference(x, w, stride, pad, groups)
+  m = Module('conv')
+  c = m.computation('main')
+  a, b = c.param(F32, x.shape), c.param(F32, w.shape)
+  window = hlo.Window()
+  for _ in range(2):
+    d = hlo.WindowDimension()
+    d.size, d.stride, d.padding_low, d.padding_high = 3, stride, pad, pad
+    d.window_dilation = d.base_dilation = 1
+    window.dimensions.append(d)
+  dnums = hlo.ConvolutionDimensionNumbers()
+  dnums.input_batch_dimension, dnums.input_feature_dimension = 0, 1
+  dnums.kernel_output_feature_dimension, dnums.kernel_input_feature_dimension = 0, 1
+  dnums.output_batch_dimension, dnums.output_feature_dimension = 0, 1
+  dnums.input_spatial_dimensions = dnums.kernel_spatial_dimensions = [2, 3]
+  dnums.output_spatial_dimensions = [2, 3]
+  c.op('convolution', F32, want.shape, a, b, window=window, convolution_dimension_numbers=dnums,
+       feature_group_count=groups, batch_group_count=1)
+  np.testing.assert_allclose(m.compile(c).evaluate(x, w), want, rtol=1e-4, atol=1e-5)
+
+#
+# gather and scatter
+#
+
+def test_gather_rows():
+  # x[idx] with out-of-range starts clamped, as XLA does
+  m = Module('gather')
+  c = m.computation('main')
+  a, i = c.param(F32, [5, 3]), c.param(S32, [3, 1])
+  dnums = hlo.GatherDimensionNumbers()
+  dnums.offset_dims, dnums.collapsed_slice_dims, dnums.start_index_map = [1], [0], [0]
+  dnums.index_vector_dim = 1
+  c.op('gather', F32, [3, 3], a, i, gather_dimension_numbers=dnums, gather_slice_sizes=[1, 3])
+  x = np.arange(15, dtype=np.float32).reshape(5, 3)
+  idx = np.array([[3], [0], [7]], np.int32)
+  np.testing.assert_array_equal(m.compile(c).evaluate(x, idx), x[[3, 0, 4]])
+
+
+def scatter_module(combiner):
+  m = Module('scatter')
+  combine = m.binary(combiner, F32) if combiner else None
+  if combine is None:
+    combine = m.computation('assign')
+    combine.param(F32)
+    combine.root(combine.param(F32))
+  c = m.computation('main')
+  a, i, u = c.param(F32, [5]), c.param(S32, [4, 1]), c.param(F32, [4])
+  dnums = hlo.ScatterDimensionNumbers()
+  dnums.inserted_window_dims, dnums.scatter_dims_to_operand_dims = [0], [0]
+  dnums.index_vector_dim = 1
+  c.op('scatter', F32, [5], a, i, u, scatter_dimension_numbers=dnums,
+       called_computation_ids=[combine.id])
+  return m.compile(c)
+
+
+def test_scatter_add():
+  x = np.ones(5, np.float32)
+  idx = np.array([[1], [3], [1], [9]], np.int32)
+  u = np.array([10, 20, 30, 40], np.float32)
+  want = x.copy()
+  np.add.at(want, [1, 3, 1], u[:3])  # index 9 is out of range and dropped
+  np.testing.assert_array_equal(scatter_module('add').evaluate(x, idx, u), want)
+
+
+def test_scatter_assign():
+  x = np.zeros(5, np.float32)
+  idx = np.array([[4], [0], [2], [-1]], np.int32)
+  u = np.array([1, 2, 3, 4], np.float32)
+  np.testing.assert_array_equal(scatter_module(None).evaluate(x, idx, u), [2, 0, 3, 0, 1])
+
+#
+# reductions
+#
+
+def test_reduce():
+  m = Module('reduce')
+  add = m.binary('add', F32)
+  c = m.computation('main')
+  x = c.param(F32, [2, 3])
+  zero = c.constant(literal(F32, 'f32s', [0.0]))
+  c.op('reduce', F32, [2], x, zero, dimensions=[1], called_computation_ids=[add.id])
+  v = rng().standard_normal((2, 3), np.float32)
+  np.testing.assert_allclose(m.compile(c).evaluate(v), v.sum(1), rtol=1e-6)
+
+
+def test_variadic_reduce_argmax():
+  # (value, index) pairs folded by a computation that keeps the larger value
+  m = Module('argmax')
+  r = m.computation('argmax')
+  v0, i0, v1, i1 = r.param(F32), r.param(S32), r.param(F32), r.param(S32)
+  gt = r.op('compare', PRED, [], v0, v1, comparison_direction='GE')
+  v = r.op('select', F32, [], gt, v0, v1)
+  i = r.op('select', S32, [], gt, i0, i1)
+  r.add('tuple', tuple_shape(shape(F32), shape(S32)), [v, i])
+  c = m.computation('main')
+  x, idx = c.param(F32, [3, 6]), c.param(S32, [3, 6])
+  ninf = c.constant(literal(F32, 'f32s', [-np.inf]))
+  zero = c.constant(literal(S32, 's32s', [0]))
+  c.add('reduce', tuple_shape(shape(F32, [3]), shape(S32, [3])), [x, idx, ninf, zero],
+        dimensions=[1], called_computation_ids=[r.id])
+  v = rng().standard_normal((3, 6), np.float32)
+  values, index = m.compile(c).evaluate(v, np.broadcast_to(np.arange(6, dtype=np.int32), (3, 6)))
+  np.testing.assert_array_equal(values, v.max(1))
+  np.testing.assert_array_equal(index, v.argmax(1))
+
+
+@pytest.mark.parametrize('combiner', ['maximum', 'add'])
+def test_reduce_window(combiner):
+  # 2x2 pooling with stride 2 and one row of padding at the bottom
+  m = Module('pool')
+  fn = m.binary(combiner, F32)
+  c = m.computation('main')
+  x = c.param(F32, [3, 4])
+  init = -np.inf if combiner == 'maximum' else 0.0
+  i = c.constant(literal(F32, 'f32s', [init]))
+  window = hlo.Window()
+  for pad in (1, 0):
+    d = hlo.WindowDimension()
+    d.size, d.stride, d.padding_high = 2, 2, pad
+    d.window_dilation = d.base_dilation = 1
+    window.dimensions.append(d)
+  c.op('reduce-window', F32, [2, 2], x, i, window=window, called_computation_ids=[fn.id])
+  v = rng().standard_normal((3, 4), np.float32)
+  padded = np.pad(v, ((0, 1), (0, 0)), constant_values=init).reshape(2, 2, 2, 2)
+  want = padded.max((1, 3)) if combiner == 'maximum' else padded.sum((1, 3))
+  np.testing.assert_allclose(m.compile(c).evaluate(v), want, rtol=1e-6)
+
+
+def test_sort_with_values():
+  # a general comparator, so the pairwise path, carrying a second operand
+  m = Module('sort')
+  less = m.computation('compare')
+  k0, k1, _, _ = less.param(F32), less.param(F32), less.param(S32), less.param(S32)
+  a, b = less.op('abs', F32, [], k0), less.op('abs', F32, [], k1)
+  less.op('compare', PRED, [], a, b, comparison_direction='LT')
+  c = m.computation('main')
+  keys, values = c.param(F32, [2, 5]), c.param(S32, [2, 5])
+  c.add('sort', tuple_shape(shape(F32, [2, 5]), shape(S32, [2, 5])), [keys, values],
+        dimensions=[1], called_computation_ids=[less.id], is_stable=True)
+  k = np.array([[3, -1, 2, -3, 0], [-2, 1, 2, -1, 5]], np.float32)
+  v = np.broadcast_to(np.arange(5, dtype=np.int32), (2, 5))
+  order = np.argsort(np.abs(k), axis=1, kind='stable')
+  ks, vs = m.compile(c).evaluate(k, v)
+  np.testing.assert_array_equal(ks, np.take_along_axis(k, order, 1))
+  np.testing.assert_array_equal(vs, order)
+
+#
+# control flow
+#
+
+def test_while():
+  # (i, x) -> (i + 1, x * 2) while i < 4
+  m = Module('while')
+  state = tuple_shape(shape(S32), shape(F32, [3]))
+  cond = m.computation('cond')
+  s = cond.param(None, s=state)
+  i = cond.add('get-tuple-element', shape(S32), [s], tuple_index=0)
+  n = cond.constant(literal(S32, 's32s', [4]))
+  cond.op('compare', PRED, [], i, n, comparison_direction='LT')
+  body = m.computation('body')
+  s = body.param(None, s=state)
+  i = body.add('get-tuple-element', shape(S32), [s], tuple_index=0)
+  x = body.add('get-tuple-element', shape(F32, [3]), [s], tuple_index=1)
+  one = body.constant(literal(S32, 's32s', [1]))
+  two = body.constant(literal(F32, 'f32s', [2.0]))
+  twos = body.op('broadcast', F32, [3], two)
+  body.add('tuple', state, [body.op('add', S32, [], i, one), body.op('multiply', F32, [3], x, twos)])
+  c = m.computation('main')
+  s = c.param(None, s=state)
+  c.add('while', state, [s], called_computation_ids=[body.id, cond.id])
+  i, x = m.compile(c).evaluate((np.int32(0), np.array([1, 2, 3], np.float32)))
+  assert i == 4
+  np.testing.assert_array_equal(x, [16, 32, 48])
+
+
+def conditional_module(t):
+  m = Module('conditional')
+  branches = []
+  for opcode in ('negate', 'abs', 'exponential'):
+    b = m.computation(opcode)
+    b.op(opcode, F32, [3], b.param(F32, [3]))
+    branches.append(b)
+  if t == PRED:
+    branches = branches[:2]
+  c = m.computation('main')
+  index = c.param(t)
+  args = [c.param(F32, [3]) for _ in branches]
+  c.op('conditional', F32, [3], index, *args, called_computation_ids=[b.id for b in branches])
+  return m.compile(c), len(branches)
+
+
+def test_conditional_pred():
+  exe, n = conditional_module(PRED)
+  x = np.array([-1, 2, -3], np.float32)
+  np.testing.assert_array_equal(exe.evaluate(np.bool_(True), x, x), -x)
+  np.testing.assert_array_equal(exe.evaluate(np.bool_(False), x, x), np.abs(x))
+
+
+def test_conditional_index():
+  exe, n = conditional_module(S32)
+  x = np.array([-1, 2, -3], np.float32)
+  args = [x] * n
+  np.testing.assert_array_equal(exe.evaluate(np.int32(1), *args), np.abs(x))
+  np.testing.assert_allclose(exe.evaluate(np.int32(2), *args), np.exp(x), rtol=1e-6)
+  # out of range runs the last branch
+  np.testing.assert_allclose(exe.evaluate(np.int32(7), *args), np.exp(x), rtol=1e-6)
+  np.testing.assert_allclose(exe.evaluate(np.int32(-1), *args), np.exp(x), rtol=1e-6)
+
+#
+# conversions
+#
+
+def convert_module(src, dst, n):
+  m = Module('convert')
+  c = m.computation('main')
+  c.op('convert', dst, [n], c.param(src, [n]))
+  return m.compile(c)
+
+
+def test_convert_float_to_int_saturates():
+  x = np.array([np.nan, np.inf, -np.inf, 2.7, -2.7, 3e9], np.float32)
+  info = np.iinfo(np.int32)
+  np.testing.assert_array_equal(convert_module(F32, S32, 6).evaluate(x),
+                                [0, info.max, info.min, 2, -2, info.max])
+  np.testing.assert_array_equal(convert_module(F32, U8, 6).evaluate(x), [0, 255, 0, 2, 0, 255])
+
+
+def test_convert_to_pred():
+  x = np.array([0, 3, -1, 0], np.int32)
+  np.testing.assert_array_equal(convert_module(S32, PRED, 4).evaluate(x), [False, True, True, False])
+
+
+def test_convert_bf16_rounds_to_nearest_even():
+  ulp = 2.0 ** -7  # at 1.0
+  x = np.array([1 + ulp / 2, 1 + 1.5 * ulp, 1 + 0.75 * ulp, -(1 + ulp / 2), np.nan], np.float32)
+  out = convert_module(F32, BF16, 5).evaluate(x)
+  np.testing.assert_array_equal(out[:4], [1.0, 1 + 2 * ulp, 1 + ulp, -1.0])
+  assert np.isnan(out[4])
+
+
+def test_bf16_ops_round_their_results():
+  m = Module('bf16')
+  c = m.computation('main')
+  a, b = c.param(BF16, [2]), c.param(BF16, [2])
+  c.op('add', BF16, [2], a, b)
+  out = m.compile(c).evaluate(np.float32([1.0, 256.0]), np.float32([2.0 ** -8, 1.0]))
+  # both sums are ties and round to the even neighbor
+  np.testing.assert_array_equal(out, [1.0, 256.0])
+  assert out.dtype == np.float32
+
+#
+# infeed and outfeed
+#
+
+def test_feed_records_round_trip():
+  s = tuple_shape(shape(F32, [2, 3], minor_to_major=[0, 1]), shape(BF16, [2]), shape(TOKEN))
+  value = (np.arange(6, dtype=np.float32).reshape(2, 3), np.float32([1.5, -3.0]), None)
+  data = interpreter.to_record(s, value)
+  # the first leaf in column-major order, then two bfloat16s
+  assert data[:24] == np.float32([0, 3, 1, 4, 2, 5]).tobytes()
+  assert len(data) == 24 + 4
+  x, y, token = interpreter.from_record(s, data)
+  np.testing.assert_array_equal(x, value[0])
+  np.testing.assert_array_equal(y, value[1])
+  with pytest.raises(ValueError):
+    interpreter.from_record(s, data[:-1])
+  with pytest.raises(ValueError):
+    interpreter.from_record(s, data + b'\0')
+
+
+def test_infeed_outfeed(monkeypatch):
+  # y = infeed() * 2, sent back through outfeed, on a device of its own
+  ordinal, executor = devices.bind()
+  monkeypatch.setattr(interpreter.running, 'device', ordinal, raising=False)
+  m = Module('feed')
+  c = m.computation('main')
+  token = c.add('after-all', shape(TOKEN))
+  fed = c.add('infeed', tuple_shape(shape(F32, [3]), shape(TOKEN)), [token])
+  x = c.add('get-tuple-element', shape(F32, [3]), [fed], tuple_index=0)
+  token = c.add('get-tuple-element', shape(TOKEN), [fed], tuple_index=1)
+  two = c.op('broadcast', F32, [3], c.constant(literal(F32, 'f32s', [2.0])))
+  y = c.op('multiply', F32, [3], x, two)
+  c.add('outfeed', shape(TOKEN), [y, token])
+  c.root(y)
+  exe = m.compile(c)
+
+  lib, status = devices.capi(), libtpujesus.status_new()
+  data = np.float32([1, 2, 3]).tobytes()
+  lib.TpuExecutor_EnqueueInfeed(executor, 0, data, len(data), status)
+  assert lib.TpuStatus_Code(status) == 0
+  np.testing.assert_array_equal(exe.evaluate(), [2, 4, 6])
+  out = ctypes.create_string_buffer(12)
+  lib.TpuExecutor_DequeueOutfeed(executor, 0, out, 12, status)
+  assert lib.TpuStatus_Code(status) == 0
+  np.testing.assert_array_equal(np.frombuffer(out.raw, np.float32), [2, 4, 6])
+  stats = libtpujesus.feed_stats(ordinal)
+  assert stats['infeed'][0]['popped'] == stats['outfeed'][0]['popped'] == 1
@@ -0,0 +1,92 @@
+import pytest
+
+import libtpu
+from libtpu import XLA_Shape
+from libtpu.interpreter import PRED, S8, U8, F32, BF16, C128, TUPLE, TOKEN, OPAQUE_TYPE
+
+from .hlobuild import shape, tuple_shape
+
+
+def sizes(s):
+  """(ShapeSize, ShapeSizeCompact, ShapeSizeCompactRaw) of an XLA_Shape."""
+  return tuple(libtpu.shape_byte_size(s, mode) for mode in
+               (libtpu.SIZE_PADDED, libtpu.SIZE_COMPACT, libtpu.SIZE_COMPACT_RAW))
+
+
+def host(t, dims=(), minor_to_major=None, element_size_in_bits=0):
+  s = libtpu.shape_from_proto(shape(t, dims, minor_to_major), XLA_Shape())
+  s.layout.element_size_in_bits = element_size_in_bits
+  return s
+
+
+def device(t, dims=(), minor_to_major=None, element_size_in_bits=0, compact=False):
+  """The device shape the tiled (default) or compact layout policy gives."""
+  h = host(t, dims, minor_to_major, element_size_in_bits)
+  d = (libtpu.compact_layout if compact else libtpu.device_layout)(h, XLA_Shape())
+  h.Free()
+  return d
+
+
+@pytest.mark.parametrize('t, n', [(TUPLE, 3), (TUPLE, 0)])
+def test_tuple_is_its_index_table(t, n):
+  s = libtpu.shape_from_proto(tuple_shape(*[shape(F32, [1000])] * n), XLA_Shape())
+  assert sizes(s) == (8 * n,) * 3
+  s.Free()
+
+
+def test_token_and_opaque():
+  assert sizes(host(TOKEN)) == (0, 0, 0)
+  assert sizes(host(OPAQUE_TYPE)) == (8, 8, 8)
+
+
+def test_pred_is_a_byte():
+  # 7 bytes, rounded up to a word when compact, one 512-byte vector tiled
+  assert sizes(host(PRED, [7])) == (7, 8, 7)
+  assert sizes(device(PRED, [7])) == (512, 8, 7)
+
+
+def test_scalar_is_not_tiled():
+  assert sizes(device(F32)) == (4, 4, 4)
+  assert sizes(device(C128)) == (16, 16, 16)
+
+
+def test_rank1_tiles():
+  # one 4096-bit vector per tile: 128 f32s, 256 bf16s
+  assert sizes(device(F32, [200])) == (1024, 800, 800)
+  assert sizes(device(BF16, [200])) == (512, 400, 400)
+  assert sizes(device(S8, [3])) == (512, 4, 3)
+
+
+def test_rank2_tiles():
+  # (8, 128) on the two minor-most dims; sub-32-bit types pack more rows
+  assert sizes(device(F32, [1, 200])) == (8 * 256 * 4, 800, 800)
+  assert sizes(device(F32, [3, 5])) == (8 * 128 * 4, 60, 60)
+  assert sizes(device(BF16, [3, 5])) == (16 * 128 * 2, 32, 30)
+  assert sizes(device(S8, [2, 3, 300])) == (2 * 32 * 384, 1800, 1800)
+
+
+def test_minor_to_major():
+  # tiles apply to the physical order: [3, 200] column-major is 200 rows of 3
+  assert sizes(device(F32, [3, 200])) == (8 * 256 * 4, 2400, 2400)
+  assert sizes(device(F32, [3, 200], [0, 1])) == (200 * 128 * 4, 2400, 2400)
+  d = device(F32, [3, 200], [0, 1])
+  assert d.layout.minor_to_major.items() == [0, 1]
+
+
+def test_element_size_in_bits():
+  # packed predicates, no tiles
+  assert sizes(host(PRED, [10], element_size_in_bits=1)) == (2, 4, 2)
+  assert sizes(host(U8, [3, 5], element_size_in_bits=4)) == (8, 8, 8)
+  assert sizes(host(U8, [3], element_size_in_bits=4)) == (2, 4, 2)
+  # tiled, 4-bit elements pack 64 rows per tile
+  d = device(U8, [3, 5], element_size_in_bits=4)
+  assert [d.layout.tiles.u[0].dimensions.items()] == [[64, 128]]
+  assert sizes(d) == (64 * 128 // 2, 8, 8)
+
+
+def test_compact_policy():
+  d = device(F32, [3, 200], compact=True)
+  assert d.layout.tiles.size == 0
+  assert sizes(d) == (2400, 2400, 2400)
+  # compact drops sub-byte packing too
+  assert sizes(device(U8, [3], element_size_in_bits=4, compact=True)) == (3, 4, 3)
@@ -0,0 +1,149 @@
+import ctypes
+import os
+import threading
+
+import pytest
+
+import libtpujesus
+
+from . import devices
+
+# tpu_memcpy.c
+MEMCPY_SPLIT = 4 << 20
+TF_INVALID_ARGUMENT = 3
+
+SIZES = [0, 1, 4097, MEMCPY_SPLIT - 1, MEMCPY_SPLIT, (9 << 20) + 123]
+
+
+@pytest.fixture(scope='module')
+def device():
+  """(lib, executor) with room for a few of the biggest copies."""
+  ordinal, executor = devices.bind(memory_limit=64 << 20)
+  return devices.capi(), executor
+
+
+@pytest.fixture
+def stream(device):
+  lib, executor = device
+  s = devices.Stream(lib, executor)
+  yield s
+  s.free()
+
+
+class Buffer:
+  def __init__(self, lib, executor, size):
+    self.lib, self.executor = lib, executor
+    self.mem = lib.TpuExecutor_Allocate(executor, max(size, 1), 0)
+    assert self.mem.opaque
+
+  def free(self):
+    self.lib.TpuExecutor_Deallocate(self.executor, ctypes.byref(self.mem))
+
+
+def sync_copy(lib, executor, direction, *args):
+  status = libtpujesus.status_new()
+  getattr(lib, 'TpuExecutor_SynchronousMemcpy' + direction)(executor, *args, status)
+  code = lib.TpuStatus_Code(status)
+  lib.TpuStatus_Free(ctypes.c_void_p(status))
+  return code
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_synchronous(device, size):
+  lib, executor = device
+  buf = Buffer(lib, executor, size)
+  data = os.urandom(size)
+  src = ctypes.create_string_buffer(data, max(size, 1))
+  dst = ctypes.create_string_buffer(max(size, 1))
+  assert sync_copy(lib, executor, 'FromHost', ctypes.byref(buf.mem), src, size) == 0
+  # done on return: the source can go right away
+  ctypes.memset(src, 0, size)
+  assert sync_copy(lib, executor, 'ToHost', dst, ctypes.byref(buf.mem), size) == 0
+  assert dst.raw[:size] == data
+  buf.free()
+
+
+def test_synchronous_overrun(device):
+  lib, executor = device
+  buf = Buffer(lib, executor, 256)
+  host = ctypes.create_string_buffer(512)
+  # the allocator rounds up; the buffer's own size is the limit
+  buf.mem.size = 100
+  assert sync_copy(lib, executor, 'FromHost', ctypes.byref(buf.mem), host, 101) == TF_INVALID_ARGUMENT
+  assert sync_copy(lib, executor, 'ToHost', host, ctypes.byref(buf.mem), 101) == TF_INVALID_ARGUMENT
+  buf.mem.size = 256
+  buf.free()
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_stream_ordered(stream, size):
+  # host -> a -> b -> host, all queued before any of it runs
+  lib = stream.lib
+  a, b = Buffer(lib, stream.executor, size), Buffer(lib, stream.executor, size)
+  data = os.urandom(size)
+  src = ctypes.create_string_buffer(data, max(size, 1))
+  dst = ctypes.create_string_buffer(max(size, 1))
+  opened = threading.Event()
+  stream.enqueue(lambda: opened.wait(5))
+  assert lib.TpuExecutor_MemcpyFromHost(stream.executor, stream.handle, ctypes.byref(a.mem), src, size)
+  lib.TpuStream_TpuEnqueueOnDeviceSendRecvLocal(stream.handle, a.mem, b.mem, None)
+  assert lib.TpuExecutor_MemcpyToHost(stream.executor, stream.handle, dst, ctypes.byref(b.mem), size)
+  # nothing has moved yet
+  assert dst.raw == bytes(max(size, 1))
+  opened.set()
+  assert stream.block() == 0
+  assert dst.raw[:size] == data
+  a.free()
+  b.free()
+
+
+def test_stream_transfers(stream):
+  lib, size = stream.lib, MEMCPY_SPLIT + 1
+  buf = Buffer(lib, stream.executor, size)
+  data = os.urandom(size)
+  src = ctypes.create_string_buffer(data, size)
+  dst = ctypes.create_string_buffer(size)
+  status = libtpujesus.status_new()
+  lib.TpuStream_EnqueueTransferHostToDevice(stream.handle, buf.mem, src, size, status)
+  lib.TpuStream_EnqueueTransferDeviceToHost(stream.handle, buf.mem, dst, size, status)
+  assert stream.block() == 0
+  assert lib.TpuStatus_Code(status) == 0
+  assert dst.raw == data
+  # stream-ordered copies past the buffer are refused when queued
+  assert not lib.TpuExecutor_MemcpyToHost(stream.executor, stream.handle, dst,
+                                          ctypes.byref(buf.mem), buf.mem.size + 1)
+  buf.free()
+
+
+def test_split_across_threads():
+  # the pool sizes itself from the CPU count on first use, so force it
+  # in a fresh process
+  out = devices.isolated('''
+    import ctypes, os, threading
+    os.environ['LIBTPU_MEMCPY_THREADS'] = '4'
+    import libtpujesus
+    from tests import devices
+    lib = devices.capi()
+    ordinal, executor = devices.bind(memory_limit=256 << 20)
+    def copy(size, results):
+      status = libtpujesus.status_new()
+      mem = lib.TpuExecutor_Allocate(executor, size, 0)
+      data = os.urandom(size)
+      src = ctypes.create_string_buffer(data, size)
+      dst = ctypes.create_string_buffer(size)
+      for _ in range(4):
+        lib.TpuExecutor_SynchronousMemcpyFromHost(executor, ctypes.byref(mem), src, size, status)
+        lib.TpuExecutor_SynchronousMemcpyToHost(executor, dst, ctypes.byref(mem), size, status)
+        results.append(dst.raw == data and lib.TpuStatus_Code(status) == 0)
+    # several jobs in the pool at once, with ragged last chunks
+    results = []
+    threads = [threading.Thread(target=copy, args=((8 << 20) + 64 * i + 1, results))
+               for i in range(4)]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    copy((32 << 20) + 17, results)
+    print(len(results), all(results))
+  ''')
+  assert out.split() == ['20', 'True']
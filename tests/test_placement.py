@@ -0,0 +1,122 @@
+import ctypes
+
+import pytest
+
+import libtpu
+from libtpu import make_topology, placement
+
+
+def ids(cores):
+  return [core.id for core in cores]
+
+
+def test_ring_is_id_order():
+  t = make_topology('2x2x2', host_count=2)
+  assert ids(placement.device_order(t, 'ring')) == list(range(8))
+
+
+def test_snake_rows():
+  t = make_topology('4x2x1')
+  # x forward on row 0, back on row 1
+  assert ids(placement.device_order(t, 'snake')) == [0, 1, 2, 3, 7, 6, 5, 4]
+
+
+@pytest.mark.parametrize('chips', ['2x2x2', '4x3x1', '3x3x3', '4x4x2'])
+def test_snake_steps_one_hop(chips):
+  t = make_topology(chips)
+  order = placement.device_order(t, 'snake')
+  assert sorted(ids(order)) == list(range(len(t.cores)))
+  assert all(placement.hops(t, a, b) == 1 for a, b in zip(order, order[1:]))
+
+
+def test_snake_keeps_a_chip_together():
+  t = make_topology('2x2x1', cores_per_chip=2)
+  order = placement.device_order(t, 'snake')
+  assert [(c.x, c.y, c.index) for c in order] == [
+    (0, 0, 0), (0, 0, 1), (1, 0, 0), (1, 0, 1),
+    (1, 1, 0), (1, 1, 1), (0, 1, 0), (0, 1, 1)]
+
+
+def test_host_first():
+  t = make_topology('4x2x1', host_count=2)
+  host = t.hosts[1]
+  order = placement.device_order(t, 'host', host)
+  assert ids(order[:4]) == [7, 6, 5, 4]
+  assert ids(order[4:]) == [0, 1, 2, 3]
+  # no host, plain snake
+  assert ids(placement.device_order(t, 'host')) == [0, 1, 2, 3, 7, 6, 5, 4]
+  # ring and snake only look at the host when asked for local cores
+  assert ids(placement.device_order(t, 'ring', host)) == list(range(8))
+  assert ids(placement.device_order(t, 'ring', host, local=True)) == [4, 5, 6, 7]
+  assert ids(placement.device_order(t, 'host', host, local=True)) == [7, 6, 5, 4]
+
+
+def test_unknown_strategy():
+  with pytest.raises(ValueError, match='unknown placement strategy'):
+    placement.device_order(make_topology(), 'random')
+
+
+def test_assign_row_major():
+  t = make_topology('4x2x1', cores_per_chip=2)
+  cores = placement.device_order(t, 'snake')
+  out = placement.assign(cores, 3, 2)
+  for r in range(3):
+    for c in range(2):
+      assert out[r * 2 + c] == cores[r * 2 + c].id
+  assert placement.assign(cores, 16, 1) == ids(cores)
+
+
+@pytest.mark.parametrize('replicas, computations', [(9, 1), (3, 3), (0, 1), (1, 0), (-1, 1), (2, -1)])
+def test_assign_bad_counts(replicas, computations):
+  cores = make_topology('4x2x1').cores
+  with pytest.raises(ValueError):
+    placement.assign(cores, replicas, computations)
+
+
+def test_report():
+  t = make_topology('4x4x1', host_count=2)
+  out = placement.report(t, t.hosts[0])
+  assert set(out) == set(placement.STRATEGIES)
+  for strategy in placement.STRATEGIES:
+    assert out[strategy]['links'] == 16
+  assert out['snake']['neighbor_links'] == 16
+  assert out['ring']['neighbor_links'] < out['snake']['neighbor_links']
+  assert placement.report(t, devices=1)['ring'] == dict(neighbor_links=0, links=0)
+
+
+# ~~~ place(), behind TpuComputationPlacer_Assign*Devices ~~~
+
+def place(topology, host, local, replicas, computations):
+  status = libtpu.TF_Status.New()
+  n = max(replicas * computations, 1)
+  out = (libtpu.int_t * n)(*[-1] * n)
+  try:
+    libtpu.place(topology, host, local, replicas, computations, ctypes.pointer(out), status)
+    return status.code, status.message, list(out)
+  finally:
+    status.Free()
+
+
+def test_place(monkeypatch):
+  monkeypatch.setenv('LIBTPU_PLACEMENT', 'snake')
+  t = make_topology('4x2x1', host_count=2)
+  assert place(t, t.hosts[1], False, 4, 2) == (0, '', [0, 1, 2, 3, 7, 6, 5, 4])
+  assert place(t, t.hosts[1], True, 2, 2) == (0, '', [7, 6, 5, 4])
+
+
+@pytest.mark.parametrize('replicas, computations, local', [
+  (9, 1, False), (5, 1, True), (0, 2, False), (2, 0, False), (-2, -1, False)])
+def test_place_bad_counts(monkeypatch, replicas, computations, local):
+  monkeypatch.setenv('LIBTPU_PLACEMENT', 'host')
+  t = make_topology('4x2x1', host_count=2)
+  code, message, out = place(t, t.hosts[0], local, replicas, computations)
+  assert code == 3  # INVALID_ARGUMENT
+  assert message
+  assert set(out) == {-1}
+
+
+def test_place_bad_strategy(monkeypatch):
+  monkeypatch.setenv('LIBTPU_PLACEMENT', 'diagonal')
+  code, message, _ = place(make_topology(), None, False, 1, 1)
+  assert code == 3
+  assert 'diagonal' in message
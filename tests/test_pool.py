@@ -0,0 +1,85 @@
+import libtpu
+import libtpujesus
+
+from . import devices
+
+
+def stats(name='TF_Status'):
+  return libtpujesus.pool_stats()[name]
+
+
+def test_reuse():
+  before = stats()
+  a = libtpujesus.status_new()
+  libtpujesus.status_set(a, 13, b'broken')
+  libtpujesus.status_free(a)
+  # the free list is LIFO, and what comes off it is zeroed
+  b = libtpujesus.status_new()
+  assert b == a
+  view = libtpu.TF_Status.from_address(b)
+  assert (view.code, view.message) == (0, '')
+  libtpujesus.status_free(b)
+  after = stats()
+  assert after['hits'] - before['hits'] == 2 - (before['free'] == 0)
+  assert after['live'] == before['live']
+  assert after['free'] == max(before['free'], 1)
+
+
+def test_live_and_high_water():
+  before = stats()
+  held = [libtpujesus.status_new() for _ in range(50)]
+  assert len(set(held)) == 50
+  st = stats()
+  assert st['live'] == before['live'] + 50
+  assert st['high_water'] >= st['live']
+  assert st['hits'] + st['misses'] == before['hits'] + before['misses'] + 50
+  assert st['free'] == max(before['free'] - 50, 0)
+  for p in held:
+    libtpujesus.status_free(p)
+  st = stats()
+  assert st['live'] == before['live']
+  assert st['free'] == max(before['free'], 50)
+  # the same 50 come back without reaching malloc
+  again = [libtpujesus.status_new() for _ in range(50)]
+  assert set(again) == set(held)
+  assert stats()['misses'] == st['misses']
+  for p in again:
+    libtpujesus.status_free(p)
+
+
+def test_full_pool_releases():
+  before = stats()
+  cap = before['capacity']
+  held = [libtpujesus.status_new() for _ in range(cap + 10)]
+  for p in held:
+    libtpujesus.status_free(p)
+  st = stats()
+  assert st['free'] == cap
+  assert st['released'] - before['released'] == 10
+  assert st['live'] == before['live']
+  assert 0 < st['hit_rate'] <= 1
+
+
+def test_native_objects_share_the_pools():
+  ordinal, executor = devices.bind()
+  lib = devices.capi()
+  before = stats('SE_Event')
+  ev = lib.TpuEvent_New(executor)
+  assert stats('SE_Event')['live'] == before['live'] + 1
+  lib.TpuEvent_Free(ev)
+  ev2 = lib.TpuEvent_New(executor)
+  assert ev2 == ev
+  lib.TpuEvent_Free(ev2)
+  st = stats('SE_Event')
+  assert st['live'] == before['live']
+  assert st['hits'] > before['hits']
+
+
+def test_every_pool_reported():
+  out = libtpujesus.pool_stats()
+  assert set(out) == {'TF_Status', 'SE_StreamExecutorConfig', 'SE_DeviceDescription',
+                      'SE_Stream', 'stream_op_t', 'SE_Event', 'SE_Timer'}
+  for st in out.values():
+    assert st['size'] > 0 and st['capacity'] > 0
+    assert st['free'] <= st['capacity']
+    assert st['live'] <= st['high_water']
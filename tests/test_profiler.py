@@ -0,0 +1,160 @@
+import ctypes
+import json
+import time
+
+import pytest
+
+import libtpujesus
+from libtpu import profiler
+
+from . import devices
+
+
+@pytest.fixture
+def session():
+  """A profile of a compile span, then an allocation and a 64-byte
+  transfer on a stream; (chrome trace, XSpace, device ordinal)."""
+  stream = devices.Stream()
+  lib = stream.lib
+  assert profiler.start()
+  try:
+    with profiler.span('compile it', profiler.COMPILE):
+      time.sleep(0.002)
+    mem = lib.TpuExecutor_Allocate(stream.executor, 64, 0)
+    status = libtpujesus.status_new()
+    lib.TpuStream_EnqueueTransferHostToDevice(stream.handle, mem, b'x' * 64, 64, status)
+    stream.wait()
+  finally:
+    profiler.stop()
+  space = profiler.collect()
+  stream.free()
+  lib.TpuExecutor_Deallocate(stream.executor, ctypes.byref(mem))
+  lib.TpuStatus_Free(ctypes.c_void_p(status))
+  return profiler.chrome_trace(space), space, stream.ordinal
+
+
+def of(trace, ph, **match):
+  return [e for e in trace['traceEvents']
+          if e['ph'] == ph and all(e.get(k) == v for k, v in match.items())]
+
+
+def test_planes_are_processes(session):
+  trace, space, ordinal = session
+  assert trace['displayTimeUnit'] == 'ns'
+  procs = {e['args']['name']: e['pid'] for e in of(trace, 'M', name='process_name')}
+  assert procs == {'/host:CPU': 1, f'/device:TPU:{ordinal}': 2}
+  assert [e['args']['sort_index'] for e in of(trace, 'M', name='process_sort_index')] == [1, 2]
+  # every event's thread is named
+  named = {(e['pid'], e['tid']) for e in of(trace, 'M', name='thread_name')}
+  assert {(e['pid'], e['tid']) for e in of(trace, 'X')} <= named
+
+
+def test_host_events(session):
+  trace = session[0]
+  [span] = of(trace, 'X', name='compile it')
+  assert (span['pid'], span['cat']) == (1, 'compile')
+  assert span['dur'] >= 2000  # microseconds
+  [alloc] = of(trace, 'X', name='TpuExecutor_Allocate', pid=1)
+  assert alloc['cat'] == 'native'
+  assert alloc['tid'] == span['tid']
+  assert alloc['ts'] >= span['ts'] + span['dur']
+
+
+def test_device_events(session):
+  trace = session[0]
+  [transfer] = of(trace, 'X', cat='transfer')
+  assert transfer['pid'] == 2
+  assert transfer['name'] == 'TpuStream_EnqueueTransferHostToDevice'
+  assert transfer['args'] == {'bytes': 64}
+  [worker] = of(trace, 'M', name='thread_name', pid=2, tid=transfer['tid'])
+  assert worker['args']['name'].startswith('Stream')
+  # device memory is a counter, not a slice
+  [memory] = of(trace, 'C')
+  assert memory['pid'] == 2
+  assert memory['args']['bytes_in_use'] >= 64
+  assert all(e['ts'] >= 0 for e in of(trace, 'X') + of(trace, 'C'))
+
+
+def test_serialized_space(session, tmp_path):
+  trace, space, _ = session
+  assert profiler.chrome_trace(space.serialize()) == trace
+  path = tmp_path / 'trace.json'
+  profiler.write_chrome_trace(str(path), space)
+  assert json.loads(path.read_text()) == trace
+
+
+# ~~~ TpuProfiler_* ~~~
+
+@pytest.fixture
+def lib():
+  lib = ctypes.CDLL(libtpujesus.__file__)
+  for name in ('TpuProfiler_Create', 'TpuProfiler_Start', 'TpuProfiler_Stop'):
+    getattr(lib, name).argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+  lib.TpuProfiler_Destroy.argtypes = [ctypes.c_void_p]
+  lib.TpuProfiler_CollectData.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p,
+                                          ctypes.POINTER(ctypes.c_size_t)]
+  lib.TpuStatus_Code.argtypes = [ctypes.c_void_p]
+  lib.TpuStatus_Message.argtypes = [ctypes.c_void_p]
+  lib.TpuStatus_Message.restype = ctypes.c_char_p
+  lib.TpuStatus_Free.argtypes = [ctypes.c_void_p]
+  return lib
+
+
+def call(lib, name, *args):
+  """Call a TpuProfiler_* entry point with a new status; (code, message)."""
+  status = libtpujesus.status_new()
+  fn = getattr(lib, name)
+  fn(*args[:1], status, *args[1:])
+  result = lib.TpuStatus_Code(status), lib.TpuStatus_Message(status).decode()
+  lib.TpuStatus_Free(status)
+  return result
+
+
+def create(lib):
+  handle = ctypes.c_void_p()
+  status = libtpujesus.status_new()
+  lib.TpuProfiler_Create(ctypes.byref(handle), status)
+  assert lib.TpuStatus_Code(status) == 0
+  lib.TpuStatus_Free(status)
+  return handle.value
+
+
+def test_one_session_at_a_time(lib):
+  a, b = create(lib), create(lib)
+  try:
+    assert call(lib, 'TpuProfiler_Start', a)[0] == 0
+    assert call(lib, 'TpuProfiler_Start', b)[0] == 9  # FAILED_PRECONDITION
+    assert call(lib, 'TpuProfiler_Stop', a)[0] == 0
+    assert call(lib, 'TpuProfiler_Start', b)[0] == 0
+  finally:
+    lib.TpuProfiler_Destroy(a)
+    lib.TpuProfiler_Destroy(b)
+  assert not libtpujesus.profiling()
+
+
+def test_collect_data(lib):
+  p = create(lib)
+  try:
+    assert call(lib, 'TpuProfiler_Start', p)[0] == 0
+    with profiler.span('collected'):
+      pass
+    assert call(lib, 'TpuProfiler_Stop', p)[0] == 0
+    size = ctypes.c_size_t(0)
+    assert call(lib, 'TpuProfiler_CollectData', p, None, ctypes.byref(size)) == (0, '')
+    need = size.value
+    assert need > 0
+    # too small: the size it needs, and nothing written
+    buf = ctypes.create_string_buffer(need)
+    size.value = need - 1
+    code, message = call(lib, 'TpuProfiler_CollectData', p, buf, ctypes.byref(size))
+    assert code == 3  # INVALID_ARGUMENT
+    assert str(need) in message
+    assert size.value == need
+    assert buf.raw == b'\0' * need
+    # the data was kept for the retry
+    assert call(lib, 'TpuProfiler_CollectData', p, buf, ctypes.byref(size)) == (0, '')
+    assert size.value == need
+  finally:
+    lib.TpuProfiler_Destroy(p)
+  names = [e['name'] for e in of(profiler.chrome_trace(buf.raw), 'X')]
+  assert 'collected' in names
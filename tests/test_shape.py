@@ -0,0 +1,104 @@
+import ctypes
+
+import libtpu
+import libtpujesus
+from libtpu import XLA_Shape, TPU_C_API_MAX_INLINED
+from libtpu.interpreter import PRED, S32, F32
+
+from .hlobuild import shape, tuple_shape
+
+RANK = TPU_C_API_MAX_INLINED + 2  # spills dimensions to the heap
+
+
+def heap(lst):
+  """The heap array behind a list that spilled out of its inline slots."""
+  return ctypes.cast(ctypes.addressof(lst.u), libtpu.ptr_p)[0]
+
+
+def set_dynamic(s, values):
+  s.dynamic_dimensions.size = len(values)
+  if len(values) > TPU_C_API_MAX_INLINED:
+    p = libtpujesus.malloc(len(values))
+    (ctypes.c_bool * len(values)).from_address(p)[:] = values
+    ctypes.cast(ctypes.addressof(s.dynamic_dimensions.u), libtpu.ptr_p)[0] = p
+  else:
+    s.dynamic_dimensions.u[:len(values)] = values
+
+
+def describe(s):
+  """Everything a copy has to reproduce, as plain Python values."""
+  return (s.element_type, s.dimensions.items(), s.dynamic_dimensions.items(),
+          s.layout.minor_to_major.items(),
+          [t.dimensions.items() for t in s.layout.tiles.items()],
+          s.layout.element_size_in_bits,
+          [describe(libtpu.tuple_shape(s, i)) for i in range(s.ntuple_shapes)])
+
+
+def make():
+  """((F32[1,2,...,8], (S32[4,128], PRED[7])) with device layouts, so
+  leaves carry tiles, and a heap dynamic_dimensions on the wide leaf."""
+  host = libtpu.shape_from_proto(tuple_shape(
+    shape(F32, range(1, RANK + 1)),
+    tuple_shape(shape(S32, [4, 128]), shape(PRED, [7]))), XLA_Shape())
+  s = libtpu.device_layout(host, XLA_Shape())
+  host.Free()
+  set_dynamic(libtpu.tuple_shape(s, 0), [i % 2 == 0 for i in range(RANK)])
+  return s
+
+
+def test_tuple_round_trip():
+  orig = make()
+  before = describe(orig)
+  # the device layout tiled the S32 leaf
+  assert libtpu.tuple_shape(libtpu.tuple_shape(orig, 1), 0).layout.tiles.size
+  copy = XLA_Shape().Set(orig)
+  assert describe(copy) == before
+  assert libtpu.shape_fingerprint(copy) == libtpu.shape_fingerprint(orig)
+  copy.Free()
+  orig.Free()
+
+
+def test_copy_is_deep():
+  orig = make()
+  before = describe(orig)
+  copy = XLA_Shape().Set(orig)
+  wide, copy_wide = libtpu.tuple_shape(orig, 0), libtpu.tuple_shape(copy, 0)
+  # every level of tuple shapes and every heap list is its own allocation
+  assert ctypes.addressof(copy_wide) != ctypes.addressof(wide)
+  assert ctypes.addressof(libtpu.tuple_shape(copy, 1)) != ctypes.addressof(libtpu.tuple_shape(orig, 1))
+  assert heap(copy_wide.dimensions) != heap(wide.dimensions)
+  assert heap(copy_wide.dynamic_dimensions) != heap(wide.dynamic_dimensions)
+  # so writes to the copy don't reach the original
+  (ctypes.c_int64 * RANK).from_address(heap(copy_wide.dimensions))[0] = 99
+  libtpu.tuple_shape(libtpu.tuple_shape(copy, 1), 0).dimensions.u[0] = 99
+  assert describe(orig) == before
+  assert describe(copy) != before
+  copy.Free()
+  orig.Free()
+
+
+def test_free_leaves_the_original():
+  orig = make()
+  before = describe(orig)
+  fp = libtpu.shape_fingerprint(orig)
+  copy = XLA_Shape().Set(orig)
+  copy.Free()
+  assert copy.ntuple_shapes == 0 and copy.dimensions.size == 0
+  assert describe(orig) == before
+  assert libtpu.shape_fingerprint(orig) == fp
+  # and it can be copied again, and that copy freed, as often as needed
+  for _ in range(3):
+    again = XLA_Shape().Set(orig)
+    assert describe(again) == before
+    again.Free()
+  orig.Free()
+
+
+def test_wide_tuple():
+  n = 100
+  orig = libtpu.shape_from_proto(tuple_shape(*[shape(F32, [i + 1]) for i in range(n)]), XLA_Shape())
+  copy = XLA_Shape().Set(orig)
+  assert copy.ntuple_shapes == n
+  assert [libtpu.tuple_shape(copy, i).dimensions.items() for i in range(n)] == [[i + 1] for i in range(n)]
+  copy.Free()
+  orig.Free()
@@ -0,0 +1,114 @@
+import pytest
+
+import libtpu
+from libtpu import XLA_Shape
+from libtpu.interpreter import F32
+from libtpu.shapecache import ShapeCache
+
+from .hlobuild import shape
+
+
+class Value:
+  """Stands in for a cached XLA_Shape; records when the cache frees it."""
+  def __init__(self, name, freed):
+    self.name, self.freed = name, freed
+
+  def Free(self):
+    self.freed.append(self.name)
+
+
+@pytest.fixture
+def freed():
+  return []
+
+
+def test_hit_and_miss():
+  cache = ShapeCache(4)
+  assert cache.get(1, 'bytes') is None
+  assert cache.put(1, 'bytes', 64) == 64
+  assert cache.get(1, 'bytes') == 64
+  # another kind for the same shape is its own miss
+  assert cache.get(1, 'device') is None
+  st = cache.stats()
+  assert (st['size'], st['hits'], st['misses']) == (1, 1, 2)
+
+
+def test_eviction_frees_least_recently_used(freed):
+  cache = ShapeCache(2)
+  cache.put(1, 'device', Value('a', freed))
+  cache.put(2, 'device', Value('b', freed))
+  cache.get(1, 'device')
+  cache.put(3, 'device', Value('c', freed))
+  assert freed == ['b']
+  assert cache.get(2, 'device') is None
+  assert cache.get(1, 'device').name == 'a'
+  cache.put(4, 'device', Value('d', freed))
+  assert freed == ['b', 'c']
+  assert cache.stats()['evictions'] == 2
+
+
+def test_eviction_frees_every_kind(freed):
+  cache = ShapeCache(1)
+  cache.put(1, 'device', Value('device', freed))
+  cache.put(1, 'compact', Value('compact', freed))
+  cache.put(1, 'bytes', 64)
+  cache.put(2, 'bytes', 32)
+  assert sorted(freed) == ['compact', 'device']
+
+
+def test_replacing_frees_the_old_value(freed):
+  cache = ShapeCache(4)
+  cache.put(1, 'device', Value('old', freed))
+  cache.put(1, 'device', Value('new', freed))
+  assert freed == ['old']
+  assert cache.get(1, 'device').name == 'new'
+
+
+def test_resize_and_flush(freed):
+  cache = ShapeCache(4)
+  for i in range(4):
+    cache.put(i, 'device', Value(i, freed))
+  cache.resize(2)
+  assert freed == [0, 1]
+  cache.flush()
+  assert freed == [0, 1, 2, 3]
+  st = cache.stats()
+  assert (st['size'], st['flushes'], st['evictions']) == (0, 1, 4)
+
+
+def test_disabled(freed):
+  cache = ShapeCache(0)
+  value = Value('kept', freed)
+  assert cache.put(1, 'device', value) is value
+  assert cache.get(1, 'device') is None
+  assert freed == []
+
+
+def test_layout_policy_change_flushes():
+  cache = libtpu.shape_cache
+  host = libtpu.shape_from_proto(shape(F32, [3, 5]), XLA_Shape())
+  fp = libtpu.shape_fingerprint(host)
+
+  def size(kind):
+    out = libtpu.cached_shape(kind, host, XLA_Shape(), libtpu.device_layout)
+    n = libtpu.shape_byte_size(out)
+    out.Free()
+    return n
+
+  flushes = cache.stats()['flushes']
+  tiled = size('device')
+  assert cache.get(fp, 'device') is not None
+  # setting the same policy again keeps the cache
+  libtpu.set_layout_policy('tiled')
+  assert cache.stats()['flushes'] == flushes
+  try:
+    libtpu.set_layout_policy('compact')
+    assert cache.stats()['flushes'] == flushes + 1
+    assert cache.get(fp, 'device') is None
+    # recomputed under the new policy, not served stale
+    assert size('device') == 60 < tiled
+  finally:
+    libtpu.set_layout_policy('tiled')
+  assert cache.get(fp, 'device') is None
+  assert size('device') == tiled
+  host.Free()
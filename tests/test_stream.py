@@ -0,0 +1,156 @@
+import ctypes
+import threading
+import time
+
+import pytest
+
+import libtpujesus
+
+from . import devices
+
+TF_INVALID_ARGUMENT = 3
+TF_INTERNAL = 13
+
+
+@pytest.fixture
+def stream():
+  s = devices.Stream()
+  yield s
+  s.free()
+
+
+def device_buffer(s, size):
+  return s.lib.TpuExecutor_Allocate(s.executor, size, 0)
+
+
+def test_runs_in_order_on_the_worker(stream):
+  seen = []
+  for i in range(1000):
+    stream.enqueue(lambda i=i: seen.append((i, threading.get_ident())))
+  assert stream.wait() == 0
+  assert [i for i, _ in seen] == list(range(1000))
+  assert {t for _, t in seen} != {threading.get_ident()}
+  assert len({t for _, t in seen}) == 1
+
+
+def test_wait_blocks_until_done(stream):
+  done = []
+  stream.enqueue(lambda: time.sleep(0.05))
+  stream.enqueue(lambda: done.append(1))
+  assert stream.block() == 0
+  assert done == [1]
+  # nothing queued: returns straight away
+  assert stream.wait() == 0
+
+
+def test_transfers_in_order(stream):
+  lib, status = stream.lib, libtpujesus.status_new()
+  mem = device_buffer(stream, 4096)
+  src = ctypes.create_string_buffer(bytes(range(256)) * 16, 4096)
+  dst = ctypes.create_string_buffer(4096)
+  lib.TpuStream_EnqueueTransferHostToDevice(stream.handle, mem, src, 4096, status)
+  # overwriting src after the copy is queued must not change what lands
+  stream.enqueue(lambda: ctypes.memset(src, 0, 4096))
+  lib.TpuStream_EnqueueTransferDeviceToHost(stream.handle, mem, dst, 4096, status)
+  assert stream.block() == 0
+  assert lib.TpuStatus_Code(status) == 0
+  assert dst.raw == bytes(range(256)) * 16
+  lib.TpuStream_EnqueueTransferDeviceToHost(stream.handle, mem, dst, 8192, status)
+  assert lib.TpuStatus_Code(status) == TF_INVALID_ARGUMENT
+  lib.TpuExecutor_Deallocate(stream.executor, ctypes.byref(mem))
+
+
+def test_errors_are_sticky(stream, capfd):
+  lib, ran = stream.lib, []
+  stream.enqueue(lambda: 1 / 0)
+  stream.enqueue(lambda: ran.append(1))
+  assert stream.block() == TF_INTERNAL
+  assert 'ZeroDivisionError' in capfd.readouterr().err
+  # later ops still run, and the first failure stays until it's forgotten
+  assert ran == [1]
+  assert not lib.TpuStream_Status(stream.handle)
+  assert stream.wait() == TF_INTERNAL
+  lib.TpuExecutor_SyncAndForgetFailedStreams(stream.executor)
+  assert lib.TpuStream_Status(stream.handle)
+  assert stream.block() == 0
+
+
+def test_synchronize_all_streams():
+  lib = devices.capi()
+  a = devices.Stream(lib)
+  b = devices.Stream(lib, a.executor)
+  seen = []
+  a.enqueue(lambda: (time.sleep(0.05), seen.append('a')))
+  b.enqueue(lambda: (time.sleep(0.05), seen.append('b')))
+  assert lib.TpuExecutor_SynchronizeAllActivity(a.executor)
+  assert sorted(seen) == ['a', 'b']
+  b.enqueue(lambda: 1 / 0)
+  assert not lib.TpuExecutor_SynchronizeAllActivity(a.executor)
+  lib.TpuExecutor_SyncAndForgetFailedStreams(a.executor)
+  assert lib.TpuExecutor_SynchronizeAllActivity(a.executor)
+  a.free()
+  b.free()
+
+
+def test_deallocate_stops_the_worker(stream):
+  lib, seen = stream.lib, []
+  stream.enqueue(lambda: (time.sleep(0.05), seen.append(1)))
+  lib.TpuExecutor_DeallocateStream(stream.executor, stream.handle)
+  # the queue drained before the worker stopped
+  assert seen == [1]
+  # and the next op starts it again
+  stream.enqueue(lambda: seen.append(2))
+  assert stream.wait() == 0
+  assert seen == [1, 2]
+  assert lib.TpuExecutor_AllocateStream(stream.executor, stream.handle)
+
+
+def test_free_waits_for_queued_work():
+  s, seen = devices.Stream(), []
+  s.enqueue(lambda: (time.sleep(0.05), seen.append(1)))
+  s.lib.TpuStream_Free(s.handle)
+  assert seen == [1]
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Threads
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_wait_while_another_thread_enqueues():
+  # stream_wait used to take the GIL back with the stream's mu held, while
+  # an enqueuing thread held the GIL and waited for mu
+  out = devices.isolated('''
+    import threading
+    from tests import devices
+    s = devices.Stream()
+    ran = []
+    def waiter():
+      for _ in range(20000):
+        s.enqueue(lambda: ran.append(1))
+        s.wait()
+    def producer():
+      for _ in range(20000):
+        s.enqueue(lambda: ran.append(1))
+    threads = [threading.Thread(target=waiter), threading.Thread(target=producer)]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    print(s.wait(), len(ran))
+  ''')
+  assert out.split() == ['0', '40000']
+
+
+def test_allocate_twice():
+  # a second AllocateStream used to link the stream to itself, and
+  # device_wait then went round the cycle forever
+  out = devices.isolated('''
+    from tests import devices
+    s = devices.Stream()
+    assert s.lib.TpuExecutor_AllocateStream(s.executor, s.handle)
+    s.enqueue(lambda: None)
+    print(s.lib.TpuExecutor_SynchronizeAllActivity(s.executor))
+    s.free()
+    print(s.lib.TpuExecutor_SynchronizeAllActivity(s.executor))
+  ''', timeout=20)
+  assert out.split() == ['True', 'True']
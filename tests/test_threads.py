@@ -0,0 +1,129 @@
+"""The native paths driven from several threads at once, the way jaxlib's
+worker threads call them. Each case runs in a child interpreter under a
+timeout, so a deadlock fails the test instead of hanging the run."""
+import textwrap
+
+from . import devices
+
+THREADS = 8
+
+HARNESS = f'''
+import ctypes
+import threading
+import libtpujesus
+from tests import devices
+lib = devices.capi()
+THREADS = {THREADS}
+'''
+
+START = '''
+results = [None] * THREADS
+def worker(tid):
+  results[tid] = body(tid)
+threads = [threading.Thread(target=worker, args=(i,)) for i in range(THREADS)]
+for t in threads:
+  t.start()
+for t in threads:
+  t.join()
+'''
+
+
+def run(code, after=''):
+  """Run body(tid), defined by `code`, on THREADS threads. The child
+  prints the list of results, then runs `after`."""
+  return devices.isolated(HARNESS + textwrap.dedent(code) + START + 'print(results)\n'
+                          + textwrap.dedent(after))
+
+
+def test_status():
+  out = run('''
+    lib.TpuStatus_Message.restype = ctypes.c_char_p
+    def body(tid):
+      msg = b'thread %d' % tid
+      wrong = 0
+      for _ in range(20000):
+        s = libtpujesus.status_new()
+        lib.TpuStatus_Set(ctypes.c_void_p(s), tid + 1, msg, len(msg))
+        wrong += (lib.TpuStatus_Code(s) != tid + 1 or
+                  lib.TpuStatus_Message(ctypes.c_void_p(s)) != msg)
+        lib.TpuStatus_Free(ctypes.c_void_p(s))
+      return wrong
+  ''')
+  assert eval(out) == [0] * THREADS
+
+
+def test_memcpy():
+  out = run('''
+    ordinal, executor = devices.bind(memory_limit=64 << 20)
+    def body(tid):
+      status = libtpujesus.status_new()
+      size = 256 << 10
+      mem = lib.TpuExecutor_Allocate(executor, size, 0)
+      src = ctypes.create_string_buffer(bytes([tid]) * size, size)
+      dst = ctypes.create_string_buffer(size)
+      wrong = 0
+      for _ in range(200):
+        lib.TpuExecutor_SynchronousMemcpyFromHost(executor, ctypes.byref(mem), src, size, status)
+        lib.TpuExecutor_SynchronousMemcpyToHost(executor, dst, ctypes.byref(mem), size, status)
+        wrong += dst.raw != src.raw
+      lib.TpuExecutor_Deallocate(executor, ctypes.byref(mem))
+      return wrong + lib.TpuStatus_Code(status)
+  ''')
+  assert eval(out) == [0] * THREADS
+
+
+def test_stream_enqueue_and_wait():
+  # half the threads wait after each enqueue, half only enqueue, all on
+  # one stream
+  out = run('''
+    s = devices.Stream()
+    ran = [0] * THREADS
+    def body(tid):
+      def op():
+        ran[tid] += 1
+      for _ in range(5000):
+        s.enqueue(op)
+        if tid % 2 == 0 and s.wait():
+          return 'failed'
+      return 'ok'
+  ''', after='''
+    print(s.wait(), ran)
+  ''')
+  results, tail = out.splitlines()
+  assert eval(results) == ['ok'] * THREADS
+  assert tail == '0 ' + str([5000] * THREADS)
+
+
+def test_feed_producers_consumers_and_stats():
+  # producers go through the C API, consumers and monitors hold the GIL
+  out = run('''
+    ordinal, executor = devices.bind(feed_capacity=1 << 12)
+    N = 5000
+    producers = range(0, THREADS, 3)
+    consumers = range(1, THREADS, 3)
+    total = N * len(producers)
+    popped = []
+    def body(tid):
+      if tid in producers:
+        status = libtpujesus.status_new()
+        record = bytes([tid]) * 64
+        for _ in range(N):
+          lib.TpuExecutor_EnqueueInfeed(executor, 0, record, 64, status)
+        return lib.TpuStatus_Code(status)
+      if tid in consumers:
+        wrong = 0
+        while len(popped) < total:
+          record = libtpujesus.infeed_dequeue(ordinal, 0, 0.01)
+          if record is not None:
+            popped.append(1)
+            wrong += len(record) != 64 or len(set(record)) != 1
+        return wrong
+      while len(popped) < total:
+        libtpujesus.feed_stats(ordinal)
+      return 0
+  ''', after='''
+    print(len(popped), libtpujesus.feed_stats(ordinal)['infeed'][0]['popped'])
+  ''')
+  results, tail = out.splitlines()
+  assert eval(results) == [0] * THREADS
+  assert tail == '15000 15000'
@@ -0,0 +1,77 @@
+import pytest
+
+import libtpu
+from libtpu import make_topology, kTensorCore, kEmbeddingV1
+
+
+def coords(core):
+  return core.x, core.y, core.z, core.index
+
+
+def test_default_is_one_core():
+  t = make_topology()
+  assert t.bounds == t.host_bounds == (1, 1, 1)
+  assert [coords(c) for c in t.cores] == [(0, 0, 0, 0)]
+  assert t.HostCount() == 1 and t.ChipsPerHost() == 1
+
+
+def test_slice_across_hosts():
+  # 4x2 chips, 2 cores each, over 2 hosts: x is carved first, so each
+  # host gets a whole row
+  t = make_topology('4x2x1', cores_per_chip=2, host_count=2)
+  assert t.bounds == (4, 2, 1)
+  assert t.host_bounds == (1, 2, 1)
+  assert t.NumCores(kTensorCore) == 16
+  assert t.NumCores(kEmbeddingV1) == 0
+  assert t.HostCount() == 2
+  assert t.ChipsPerHost() == 4
+  assert t.LogicalDevicesPerHost(kTensorCore) == 8
+  assert t.LogicalDevicesPerChip(kTensorCore) == 2
+  assert (t.ChipBounds_X(), t.ChipBounds_Y(), t.ChipBounds_Z()) == (4, 2, 1)
+  for host in t.hosts:
+    assert {c.y for c in host.cores} == {host.id}
+    assert host.NumCores(kTensorCore) == 8
+  # ids run host by host, then chip by chip, a chip's cores together
+  assert [c.id for c in t.cores] == list(range(16))
+  assert [coords(c) for c in t.hosts[1].cores[:4]] == [(0, 1, 0, 0), (0, 1, 0, 1),
+                                                       (1, 1, 0, 0), (1, 1, 0, 1)]
+  assert [c.id for c in t.hosts[1].cores] == list(range(8, 16))
+
+
+def test_hosts_in_z():
+  t = make_topology('2x2x2', host_count=2)
+  assert t.host_bounds == (1, 1, 2)
+  assert {c.z for c in t.hosts[1].cores} == {1}
+  assert t.IdForHost(0, 0, 1) == 1
+  assert t.IdForHost(0, 0, 2) == -1
+
+
+def test_lookups():
+  t = make_topology('2x3x2', cores_per_chip=2, host_count=3)
+  for core in t.cores:
+    assert t.CoreForId(kTensorCore, core.id) is core
+    assert t.Core(kTensorCore, core.x, core.y, core.z, core.index) is core
+    assert t.HasChip(core.x, core.y, core.z)
+  assert t.CoreForId(kTensorCore, len(t.cores)) is None
+  assert t.CoreForId(kEmbeddingV1, 0) is None
+  assert t.Core(kTensorCore, 0, 0, 0, 2) is None
+  assert t.Core(kTensorCore, 2, 0, 0, 0) is None
+  assert not t.HasChip(0, 3, 0)
+  assert not t.HasChip(-1, 0, 0)
+
+
+def test_short_spec():
+  assert make_topology('4').bounds == (4, 1, 1)
+  assert make_topology('2x2').bounds == (2, 2, 1)
+
+
+@pytest.mark.parametrize('chips, cores_per_chip, host_count', [
+  ('0x1x1', 1, 1),
+  ('2x2x1', 0, 1),
+  ('2x2x1', 1, 0),
+  ('3x1x1', 1, 2),  # 3 chips don't split over 2 hosts
+  ('2x2x1', 1, 3),
+])
+def test_bad_topology(chips, cores_per_chip, host_count):
+  with pytest.raises(ValueError):
+    make_topology(chips, cores_per_chip, host_count)
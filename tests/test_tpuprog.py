@@ -0,0 +1,102 @@
+import struct
+
+import numpy as np
+import pytest
+
+from libtpu import interpreter, tpuprog
+from libtpu.interpreter import S32, F32, C64, BF16
+
+from .hlobuild import Module, literal, tuple_shape
+
+
+def program():
+  """Adds a parameter to constants of several kinds; returns them all."""
+  m = Module('constants')
+  c = m.computation('main')
+  x = c.param(F32, [2, 3])
+  n = c.param(S32)
+  # stored column-major in the literal
+  lit = literal(F32, 'f32s', [1, 4, 2, 5, 3, 6], [2, 3])
+  lit.shape.layout.minor_to_major = [0, 1]
+  matrix = c.constant(lit)
+  halves = c.constant(literal(BF16, 'bf16s', interpreter.bf16_bits(np.float32([1.5, -2, 3])).tobytes(), [3]))
+  z = c.constant(literal(C64, 'c64s', [1, 2, -3, 0.5], [2]))
+  k = c.constant(literal(S32, 's32s', [7]))
+  outs = [c.op('add', F32, [2, 3], x, matrix),
+          c.op('add', BF16, [3], halves, halves),
+          c.op('negate', C64, [2], z),
+          c.op('add', S32, [], n, k)]
+  c.add('tuple', tuple_shape(*[o.shape for o in outs]), outs)
+  return m.compile(c)
+
+
+ARGS = (np.arange(6, dtype=np.float32).reshape(2, 3), np.int32(5))
+
+
+def assert_same(a, b):
+  assert len(a) == len(b)
+  for x, y in zip(a, b):
+    np.testing.assert_array_equal(x, y)
+    assert np.asarray(x).dtype == np.asarray(y).dtype
+
+
+def test_round_trip():
+  exe = program()
+  want = exe.evaluate(*ARGS)
+  np.testing.assert_array_equal(want[0], ARGS[0] + [[1, 2, 3], [4, 5, 6]])
+  image = tpuprog.dumps(exe)
+  loaded = tpuprog.loads(image)
+  assert_same(loaded.evaluate(*ARGS), want)
+  assert loaded.fingerprint == exe.fingerprint
+  assert loaded.name == exe.name
+  # every constant came from the pool, as a view of the image
+  assert len(loaded.module.constants) == 4
+  assert all(not v.flags.writeable for v in loaded.module.constants.values())
+  assert tpuprog.summary(image)['constants'] == 4
+  # and dumping the loaded program gives the same image
+  assert tpuprog.dumps(loaded) == image
+
+
+def test_load_file(tmp_path):
+  exe = program()
+  path = tmp_path / 'program.tpuprog'
+  path.write_bytes(tpuprog.dumps(exe))
+  assert_same(tpuprog.load(str(path)).evaluate(*ARGS), exe.evaluate(*ARGS))
+
+
+def test_metadata_only():
+  image = tpuprog.dumps(program(), metadata_only=True)
+  assert tpuprog.summary(image)['sections'].keys() == {'META'}
+  with pytest.raises(ValueError, match='no op table'):
+    tpuprog.loads(image)
+
+
+def test_rejects_truncated():
+  image = tpuprog.dumps(program())
+  for n in (0, 10, tpuprog.HEADER.size - 1, tpuprog.HEADER.size, len(image) - 1):
+    with pytest.raises(ValueError, match='truncated'):
+      tpuprog.loads(image[:n])
+
+
+def test_rejects_bad_magic():
+  image = bytearray(tpuprog.dumps(program()))
+  image[:8] = b'NOTAPROG'
+  with pytest.raises(ValueError, match='not a program image'):
+    tpuprog.loads(bytes(image))
+
+
+def test_rejects_other_versions():
+  image = bytearray(tpuprog.dumps(program()))
+  struct.pack_into('<H', image, 8, tpuprog.VERSION + 1)
+  with pytest.raises(ValueError, match='version'):
+    tpuprog.loads(bytes(image))
+
+
+def test_rejects_constant_outside_pool():
+  image = bytearray(tpuprog.dumps(program()))
+  _, index = tpuprog.sections(image)
+  table = index['CONS'][0]
+  id, offset, size = tpuprog.CONSTANT.unpack_from(image, table)
+  tpuprog.CONSTANT.pack_into(image, table, id, offset, size + 4)
+  with pytest.raises(ValueError, match='does not fit'):
+    tpuprog.loads(bytes(image))